@@ -1,6 +1,20 @@
 from django.contrib import admin
-from .models import Location, Offering
+from .models import Location, Offering, OfferingTag
 
 # Register your models here.
+
+class OfferingTagInline(admin.TabularInline):
+    '''
+    Edits the tags of an offering on its page. Its tag bits follow them (see
+    offering_tags.py).
+    '''
+    model = OfferingTag
+    extra = 1
+
+
+class OfferingAdmin(admin.ModelAdmin):
+    inlines = [OfferingTagInline]
+
+
 admin.site.register(Location)
-admin.site.register(Offering)
+admin.site.register(Offering, OfferingAdmin)
@@ -5,3 +5,12 @@ from django.apps import AppConfig
 
 class FoodmapAppConfig(AppConfig):
     name = 'foodmap_app'
+
+    def ready(self):
+        from foodmap_app import coordinates, offering_tags, offerings_cache, offerings_changes, offerings_events, recurrence
+        offering_tags.connect_signals() # first, so tags are on offerings before anything reads them
+        recurrence.connect_signals() # so offerings are indexed before they are announced
+        offerings_cache.connect_signals()
+        offerings_changes.connect_signals() # before events, so changes are logged when they are announced
+        offerings_events.connect_signals()
+        coordinates.connect_signals()
@@ -0,0 +1,119 @@
+'''
+clusters.py
+
+Groups the locations with offerings that would be drawn on top of each other
+on the map at a zoom level, so the /offerings/clusters/ view can send one
+marker for each group instead of one for each location.
+
+Locations are grouped on a grid: at each zoom level, the map is divided into
+square cells of CELL_SIZE pixels, and the locations in the same cell form a
+cluster. Cells line up with the map's tiles, so a cluster is never split
+between the tiles a client asks for. Past MAX_ZOOM, locations are never
+grouped, since the map cannot zoom in further to tell them apart.
+
+The clusters at each zoom level are cached for as long as the same offerings
+are on the map (the ETag of offerings_cache.get_etag() stays the same), so
+each is only worked out once for all requests.
+'''
+
+import threading
+from collections import OrderedDict
+from foodmap_app import locations_index, offerings_cache
+
+# Side of each cell of the grid, in pixels at the zoom level it is for. Tiles
+# are TILE_SIZE pixels across, so each has a whole number of cells.
+CELL_SIZE = 64
+TILE_SIZE = 256
+
+# The map cannot zoom in further than 18
+MAX_ZOOM = 17
+
+
+def get_cell(lat, lng, zoom):
+    '''
+    Returns the cell of the grid at 'zoom' that ('lat', 'lng') is in.
+    '''
+    x, y = locations_index.get_tile_position(lat, lng, zoom)
+    return (int(x * TILE_SIZE // CELL_SIZE), int(y * TILE_SIZE // CELL_SIZE))
+
+
+def build_clusters(names, positions, zoom):
+    '''
+    Groups the locations 'names', at 'positions' (which maps names to
+    (lat, lng)), by cell at 'zoom'. Returns a list of clusters of more than
+    one location, and a list of the names of those left on their own. Each
+    cluster is:
+    {"names": [...], "lat": 12.345, "lng": 12.345, "bounds": [south, west, north, east]}
+    at the middle of its locations, with the box around them. Both lists are
+    in the order of 'names' (of each cluster's first location).
+    '''
+    cells = OrderedDict()
+    for name in names:
+        lat, lng = positions[name]
+        cells.setdefault(get_cell(lat, lng, zoom) if zoom <= MAX_ZOOM else name, []).append(name)
+
+    clusters = []
+    singles = []
+    for cell_names in cells.values():
+        if len(cell_names) == 1:
+            singles.append(cell_names[0])
+            continue
+        lats = [positions[name][0] for name in cell_names]
+        lngs = [positions[name][1] for name in cell_names]
+        clusters.append({
+            'names': cell_names,
+            'lat': sum(lats) / len(lats),
+            'lng': sum(lngs) / len(lngs),
+            'bounds': [min(lats), min(lngs), max(lats), max(lngs)]
+        })
+    return clusters, singles
+
+
+_lock = threading.Lock()
+_etag = None # ETag of the offerings that '_clusters' is for
+_clusters = {} # maps zoom levels to what build_clusters() returned for them
+
+
+def get_clusters(snapshot, etag, zoom, now):
+    '''
+    Returns what build_clusters() does for the locations with offerings on the
+    map at 'now' in 'snapshot', whose ETag is 'etag', at 'zoom'. Cached for
+    each zoom level until the ETag changes.
+    '''
+    global _etag, _clusters
+    with _lock:
+        if _etag != etag:
+            _etag = etag
+            _clusters = {}
+        if zoom not in _clusters:
+            names = [entry['location']['name'] for entry in offerings_cache.render(snapshot, now)]
+            _clusters[zoom] = build_clusters(names, _get_positions(snapshot, names), zoom)
+        return _clusters[zoom]
+
+
+def _get_positions(snapshot, names):
+    '''
+    Returns the positions of 'names' from the index of locations, or from
+    'snapshot' for those not indexed yet (e.g. loaded by another process
+    since the table of coordinates was).
+    '''
+    positions = locations_index.get_index().positions
+    missing = set(names) - set(positions)
+    if len(missing) == 0:
+        return positions
+    positions = dict(positions)
+    for entry in snapshot:
+        location = entry['compact_location']
+        if location['name'] in missing:
+            positions[location['name']] = (location['lat'], location['lng'])
+    return positions
+
+
+def invalidate():
+    '''
+    Drops the cached clusters.
+    '''
+    global _etag, _clusters
+    with _lock:
+        _etag = None
+        _clusters = {}
@@ -0,0 +1,139 @@
+'''
+coordinates.py
+
+Keeps the coordinates of every location in memory, so that formatting
+locations for the views, and finding those near a point (see
+locations_index.py), does not convert Decimals from the database each time.
+
+The table is loaded with one query, and never changed: it is dropped
+whenever a Location is saved or deleted through Django, and loaded again
+when next needed. Since locations can also be loaded by other processes (e.g.
+the loadlocations command), it is also loaded again once it is
+LOCATION_COORDINATES_TIMEOUT seconds old. Locations missing from it (e.g.
+loaded since) are formatted from their model instead.
+
+Locations are formatted in one of two versions, which the views take as the
+'version' GET parameter:
+ 1. (the default) with coordinates as strings, as they are in the database:
+    {"name": "Frist Campus Center", "lat": "40.346870000000", "lng": "-74.655100000000"}
+ 2. with coordinates as numbers, rounded to COMPACT_DECIMAL_PLACES:
+    {"name": "Frist Campus Center", "lat": 40.34687, "lng": -74.6551}
+'''
+
+import threading
+import time
+from array import array
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from foodmap_app.models import Location
+
+VERSIONS = [1, 2]
+DEFAULT_VERSION = 1
+
+# Coordinates in the compact version are rounded to this many decimal places,
+# about 10 cm
+COMPACT_DECIMAL_PLACES = 6
+
+DEFAULT_TIMEOUT = 10 * 60 # seconds
+
+
+class CoordinateTable(object):
+    '''
+    The coordinates of 'locations', a list of (id, name, lat, lng) with
+    coordinates as Decimals. Coordinates are kept as float64 arrays, and as
+    the strings the views send, with a row for each location.
+    '''
+
+    def __init__(self, locations):
+        self.rows = {} # maps location ids to their row
+        self.names = []
+        self.lats = array('d')
+        self.lngs = array('d')
+        self.lat_strings = []
+        self.lng_strings = []
+        for row, (location_id, name, lat, lng) in enumerate(locations):
+            self.rows[location_id] = row
+            self.names.append(name)
+            self.lats.append(float(lat))
+            self.lngs.append(float(lng))
+            self.lat_strings.append(str(lat))
+            self.lng_strings.append(str(lng))
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, location_id):
+        '''
+        Returns the coordinates of the location 'location_id' as floats
+        (lat, lng), or None if it is not in the table.
+        '''
+        row = self.rows.get(location_id)
+        return (self.lats[row], self.lngs[row]) if row is not None else None
+
+    def serialize(self, location, version=DEFAULT_VERSION):
+        '''
+        Formats 'location', a Location, in 'version' (see above), with its
+        coordinates from the table if it is there.
+        '''
+        row = self.rows.get(location.id)
+        if version == 1:
+            if row is None:
+                return {'name': location.name, 'lat': str(location.lat), 'lng': str(location.lng)}
+            return {'name': location.name, 'lat': self.lat_strings[row], 'lng': self.lng_strings[row]}
+
+        if row is None:
+            lat, lng = float(location.lat), float(location.lng)
+        else:
+            lat, lng = self.lats[row], self.lngs[row]
+        return {'name': location.name, 'lat': round(lat, COMPACT_DECIMAL_PLACES),
+            'lng': round(lng, COMPACT_DECIMAL_PLACES)}
+
+
+def load():
+    '''
+    Returns a table of the coordinates of every Location in the database.
+    '''
+    return CoordinateTable(Location.objects.values_list('id', 'name', 'lat', 'lng'))
+
+
+_lock = threading.Lock()
+_table = None
+_loaded_at = 0
+
+
+def _get_timeout():
+    '''
+    Returns how many seconds a table is used for.
+    '''
+    return getattr(settings, 'LOCATION_COORDINATES_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def get_table():
+    '''
+    Returns the table of coordinates, loading it if there is none or it has
+    timed out. Only one thread loads it at a time.
+    '''
+    global _table, _loaded_at
+    with _lock:
+        if _table is None or time.time() - _loaded_at > _get_timeout():
+            _table = load()
+            _loaded_at = time.time()
+        return _table
+
+
+def invalidate(**kwargs):
+    '''
+    Drops the table, so the next lookup loads it again. Can be connected
+    directly to model signals.
+    '''
+    global _table
+    with _lock:
+        _table = None
+
+
+def connect_signals():
+    '''
+    Drops the table whenever a Location changes.
+    '''
+    post_save.connect(invalidate, sender=Location, dispatch_uid='coordinates_save_Location')
+    post_delete.connect(invalidate, sender=Location, dispatch_uid='coordinates_delete_Location')
@@ -0,0 +1,73 @@
+'''
+expiry.py
+
+Deletes offerings once they are too old to be shown on the map. Works on all
+expired offerings at once: a fixed number of queries, however many offerings
+expire.
+
+Recurring offerings are rules rather than single offerings (see
+recurrence.py), so they are only deleted once their last occurrence has
+expired.
+'''
+
+from django.db import transaction
+from django.db.models import Max, Q
+from foodmap_app import offerings_cache, offerings_changes
+from foodmap_app.models import Offering, OfferingOccurrence, OfferingTag
+from foodmap_app.offerings_cache import MAX_AGE
+
+
+def expire_offerings(now):
+    '''
+    Deletes the offerings that are too old to be on the map at 'now', along
+    with their tags and images: those that do not recur, and recurring ones
+    whose end date has passed. Returns the number expired.
+    '''
+    min_timestamp = now - MAX_AGE
+    expired = Offering.objects.filter(Q(recur=None, timestamp__lte=min_timestamp) |
+        Q(recur_end_datetime__lte=min_timestamp))
+
+    # Only offerings expired by now are handled, even if more expire in the
+    # meantime
+    max_id = expired.aggregate(Max('id'))['id__max']
+    if max_id is None:
+        return 0
+    expired = expired.filter(id__lte=max_id)
+    images = list(expired.exclude(image=None).exclude(image='').values_list('image', flat=True))
+
+    with transaction.atomic():
+        offerings_changes.record_all(expired, now)
+
+        num_expired = delete_offerings(expired)
+
+    # Images are files, so are deleted only once the rows are gone for good
+    storage = Offering._meta.get_field('image').storage
+    for image in images:
+        storage.delete(image)
+
+    offerings_cache.invalidate()
+    return num_expired
+
+
+def delete_offerings(offerings):
+    '''
+    Deletes the offerings in the QuerySet 'offerings' along with their tags
+    and occurrences, in a fixed number of queries however many there are.
+    Sends no model signals, so callers must log the changes (see
+    offerings_changes.record_all()) and invalidate the cache themselves.
+    Returns the number of offerings deleted. Call it inside a transaction.
+    '''
+    # Occurrences have no signals or related rows, so QuerySet.delete() does
+    # them in one query
+    OfferingOccurrence.objects.filter(offering__in=offerings).delete()
+
+    # QuerySet.delete() would fetch every offering and tag to send their
+    # signals, so tags and offerings are deleted with the private
+    # QuerySet._raw_delete(), a single DELETE of the rows the QuerySet
+    # matches. That is safe here because nothing else references them once
+    # the tags and occurrences are gone, and nothing but the signals handled
+    # by the callers listens for their deletion. _raw_delete() is not a
+    # public API: check it still does this when upgrading Django from the
+    # version pinned in requirements.txt (1.10.6).
+    OfferingTag.objects.filter(offering__in=offerings)._raw_delete(OfferingTag.objects.db)
+    return offerings._raw_delete(Offering.objects.db)
@@ -0,0 +1,492 @@
+'''
+extractor.py
+
+Native Python port of the food, location and request type extraction done by
+the NodeJS scraper (see getFood(), listCheck(), getLocation() and
+getRequestType() in scraper/scraper.js).
+The data files are read once per process, so scraping a description does not
+require starting up a NodeJS process.
+
+Results are meant to match the NodeJS scraper exactly. If you change the
+behavior of one, change the other as well.
+'''
+
+import io
+import os
+import re
+from collections import deque
+from foodmap_proj.settings.common import BASE_DIR
+
+# Data files
+FOODS_PATH = os.path.join(BASE_DIR, 'scraper', 'data', 'foods.txt')
+LOCATION_MAP_PATH = os.path.join(BASE_DIR, 'scraper', 'data', 'locationMap.txt')
+REGEX_MAP_PATH = os.path.join(BASE_DIR, 'scraper', 'data', 'regexMap.txt')
+
+# Constants (same as in scraper.js)
+PUNCTUATIONS = ['[', '.', ',', '\\', '/', '#', '!', '$', '%', '^', '&',
+                '*', ';', ':', '{', '}', '=', '-', '_', '`', '~', '(',
+                ')', ']', '\'', '?', '<', '>', '+', '=']
+TOO_LONG_FOR_FOOD = 5 # No food with 5 or more words
+DELETE_REQUESTS = ['all gone']
+
+# Request types
+INSERT = 1
+DELETE = 0
+
+# Compiled once, used by every call
+_PUNCTUATION_REGEX = re.compile(r'[.,/#!$%^&*;:{}=\-_`~()\']')
+_WORD_SEPARATOR_REGEX = re.compile(r'[\s,]+', re.UNICODE)
+_LIST_SEPARATOR_REGEX = re.compile(r',| and | or ')
+_WHITESPACE_REGEX = re.compile(r'\s', re.UNICODE)
+_NON_WHITESPACE_REGEX = re.compile(r'\S', re.UNICODE)
+# Runs of word/non-word characters, i.e. the pieces of JS's split(/\b/)
+_WORD_BOUNDARY_TOKEN_REGEX = re.compile(r'[A-Za-z0-9_]+|[^A-Za-z0-9_]+')
+
+
+def prepare_text(text):
+    '''
+    Prepares text to be parsed by lowercasing it and deleting punctuation.
+    '''
+    return _PUNCTUATION_REGEX.sub('', text.lower())
+
+
+class PreparedText(object):
+    '''
+    A text to extract from, along with its prepared form and the words of
+    that, computed once. Pass one to several extractors to prepare the text
+    only once for all of them.
+    '''
+    __slots__ = ('text', 'prepared', 'words')
+
+    def __init__(self, text):
+        self.text = text
+        self.prepared = prepare_text(text)
+        self.words = _WORD_SEPARATOR_REGEX.split(self.prepared)
+
+
+def _prepared(text):
+    '''
+    Returns 'text' as a PreparedText, if it is not one already.
+    '''
+    return text if isinstance(text, PreparedText) else PreparedText(text)
+
+
+def get_request_type(text):
+    '''
+    Gets the type of request in 'text': DELETE if it says the food is gone,
+    INSERT otherwise. 'text' may be a PreparedText.
+    '''
+    prepared = _prepared(text).prepared
+    for request in DELETE_REQUESTS:
+        if request in prepared:
+            return DELETE
+    return INSERT
+
+
+def capitalize(text):
+    '''
+    Capitalizes the first letter of 'text'.
+    '''
+    return text[:1].upper() + text[1:]
+
+
+def _boundary_tokens(text):
+    '''
+    Splits 'text' at word boundaries and drops the pieces that are only
+    whitespace.
+    '''
+    return [token for token in _WORD_BOUNDARY_TOKEN_REGEX.findall(text)
+        if _NON_WHITESPACE_REGEX.search(token)]
+
+
+def _read_lines(path):
+    '''
+    Reads the lines of the data file at 'path'.
+    '''
+    with io.open(path, 'r', encoding='utf-8') as file:
+        return file.read().split('\n')
+
+
+def _read_map(path):
+    '''
+    Reads a data file of 'key,value' lines into a list of (key, value) pairs,
+    in the order they appear in the file.
+    '''
+    pairs = []
+    for line in _read_lines(path):
+        tokens = line.split(',')
+        pairs.append((tokens[0], tokens[1] if len(tokens) > 1 else None))
+    return pairs
+
+
+def _unique(items):
+    '''
+    Returns 'items' without duplicates, keeping the first occurrence of each.
+    '''
+    seen = set()
+    unique_items = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique_items.append(item)
+    return unique_items
+
+
+class _TrieNode(object):
+    '''
+    A node in a trie of food phrases, keyed by word.
+    '''
+    __slots__ = ('children', 'is_food')
+
+    def __init__(self):
+        self.children = {}  # maps the next word of a phrase to a _TrieNode
+        self.is_food = False
+
+
+class FoodExtractor(object):
+    '''
+    Finds the foods mentioned in a text, using a fixed dictionary of foods.
+
+    All foods are compiled into a trie keyed by word, so every food starting
+    at a given word (including plural forms) is found by walking at most
+    TOO_LONG_FOR_FOOD - 1 words ahead. A whole text is matched in a single
+    pass over its words, no matter how big the dictionary is.
+    '''
+
+    def __init__(self, foods):
+        '''
+        Builds the lookup tables for the foods in 'foods', a list of
+        lowercase food words/phrases.
+        '''
+        self.foods = set(foods)
+
+        self.trie = _TrieNode()
+        for food in foods:
+            node = self.trie
+            for word in food.split(' '):
+                node = node.children.setdefault(word, _TrieNode())
+            node.is_food = True
+
+        # Maps each word of a multi-word food to the lengths of the
+        # multi-word foods it appears in, in the order they are listed in the
+        # dictionary. getFood() in scraper.js tries phrase lengths in this
+        # order, so we do too.
+        self.phrase_lengths = {}
+        for food in foods:
+            split_food = food.split(' ')
+            if len(split_food) > 1:
+                for word in split_food:
+                    lengths = self.phrase_lengths.setdefault(word, [])
+                    if len(split_food) not in lengths:
+                        lengths.append(len(split_food))
+
+    @classmethod
+    def from_file(cls, path=FOODS_PATH):
+        '''
+        Creates a FoodExtractor from a dictionary file with one food per line.
+        '''
+        return cls(_read_lines(path))
+
+    def is_valid_food(self, text):
+        '''
+        Checks whether 'text' is a food word/phrase, or the plural form of
+        one.
+        '''
+        # Exact match
+        if text in self.foods:
+            return True
+
+        # Plural form
+        if text[-1:] == 's' and text[:-1] in self.foods:
+            return True
+        if text[-2:] == 'es' and text[:-2] in self.foods:
+            return True
+
+        return False
+
+    def match_lengths(self, words, start):
+        '''
+        Returns the set of lengths n for which the phrase made of the n words
+        of 'words' beginning at index 'start' is a food or the plural form of
+        one.
+        '''
+        lengths = set()
+        node = self.trie
+        for i in range(start, len(words)):
+            word = words[i]
+
+            # Plural form: only the last word of a phrase can be plural
+            if word[-1:] == 's':
+                child = node.children.get(word[:-1])
+                if child is not None and child.is_food:
+                    lengths.add(i - start + 1)
+            if word[-2:] == 'es':
+                child = node.children.get(word[:-2])
+                if child is not None and child.is_food:
+                    lengths.add(i - start + 1)
+
+            # Exact match
+            node = node.children.get(word)
+            if node is None:
+                break
+            if node.is_food:
+                lengths.add(i - start + 1)
+        return lengths
+
+    def get_food(self, text):
+        '''
+        Gets all foods that are in 'text'. Returns them in a list, in the order
+        they were found, with the first letter of each food capitalized.
+        'text' may be a PreparedText.
+        '''
+        # Clean text and separate by whitespace
+        text = _prepared(text)
+        words = text.words
+
+        matches = []
+        i = 0
+        while i < len(words):
+            word = words[i]
+            lengths = self.match_lengths(words, i)
+
+            # Check if the word starts a multi-word food
+            phrase_found = False
+            for length in self.phrase_lengths.get(word, []):
+                if length in lengths:
+                    matches.append(capitalize(' '.join(words[i:i+length])))
+                    i += length - 1 # skip over the phrase
+                    phrase_found = True
+                    break
+
+            if not phrase_found and 1 in lengths:
+                matches.append(capitalize(word))
+            i += 1
+
+        matches += self.list_check(text.text)
+        return _unique(matches)
+
+    def list_check(self, text):
+        '''
+        Checks if there is a list of food in 'text' and returns the foods in
+        the list, with the first letter of each capitalized.
+        '''
+        chunks = [chunk for chunk in _LIST_SEPARATOR_REGEX.split(text.lower()) if chunk]
+        can_be_food = [True] * len(chunks)
+        is_food = [False] * len(chunks)
+
+        # Label chunks
+        for i in range(0, len(chunks)):
+            chunks[i] = chunks[i].strip()
+
+            # If it has punctuation, ignore
+            for punctuation in PUNCTUATIONS:
+                if punctuation in chunks[i]:
+                    can_be_food[i] = False
+                    break
+            if '\n' in chunks[i]:
+                can_be_food[i] = False
+
+            # If the chunk has too many words, it cannot be food
+            elif len(_WHITESPACE_REGEX.split(chunks[i])) >= TOO_LONG_FOR_FOOD:
+                can_be_food[i] = False
+
+            is_food[i] = self.is_valid_food(chunks[i])
+
+        matches = []
+        list_start = None
+        list_end = None
+
+        # Find list pattern by iterating through chunks
+        for i in range(0, len(chunks)):
+            if list_start is None and is_food[i]:
+                list_start = i
+            if list_start is not None and not can_be_food[i]:
+                list_end = i
+
+            # If the list ends with the text, make sure that list is parsed
+            if list_start is not None and i == len(chunks) - 1:
+                list_end = i
+
+            # Found a complete list
+            if list_start is not None and list_end is not None:
+                # Inner elements can be added safely
+                for j in range(list_start, list_end):
+                    matches.append(capitalize(chunks[j]))
+
+                # Start of list: food word/phrase should be at the end of chunk
+                if list_start > 0:
+                    tokens = _boundary_tokens(chunks[list_start-1])
+                    while len(tokens) > 0:
+                        if self.is_valid_food(' '.join(tokens)):
+                            matches.append(capitalize(' '.join(tokens)))
+                            break
+                        tokens.pop(0)
+
+                # End of list: food word/phrase should be at the beginning of
+                # chunk
+                tokens = _boundary_tokens(chunks[list_end])
+                while len(tokens) > 0:
+                    if self.is_valid_food(' '.join(tokens)):
+                        matches.append(capitalize(' '.join(tokens)))
+                        break
+                    tokens.pop()
+
+                # Reset list
+                list_start = None
+                list_end = None
+
+        return matches
+
+
+class _AliasAutomaton(object):
+    '''
+    Aho-Corasick automaton over a list of patterns. Finds the longest pattern
+    occurring anywhere in a text (the first one listed, on ties) with a single
+    scan over the text.
+    '''
+
+    def __init__(self, patterns):
+        '''
+        Compiles 'patterns', a list of strings. Empty patterns are ignored.
+        '''
+        self.patterns = patterns
+        self.goto = [{}]   # maps state -> {char: next state}
+        self.fail = [0]    # maps state -> longest proper suffix state
+        self.best = [None] # maps state -> index of best pattern ending there
+
+        # Build the trie of patterns
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.best[state] = self._better(self.best[state], index)
+
+        # Add failure links breadth-first, carrying the best pattern of each
+        # state's suffixes along with it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.best[next_state] = self._better(self.best[next_state],
+                    self.best[self.fail[next_state]])
+
+    def _better(self, index1, index2):
+        '''
+        Returns whichever of two pattern indices (or None) is the better
+        match: the longer pattern, or the one listed first.
+        '''
+        if index1 is None:
+            return index2
+        if index2 is None:
+            return index1
+        length1 = len(self.patterns[index1])
+        length2 = len(self.patterns[index2])
+        if length1 != length2:
+            return index1 if length1 > length2 else index2
+        return min(index1, index2)
+
+    def longest_match(self, text):
+        '''
+        Returns the index of the longest pattern that is a substring of
+        'text', or None if there is none.
+        '''
+        best = None
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.best[state] is not None:
+                best = self._better(best, self.best[state])
+        return best
+
+
+class LocationExtractor(object):
+    '''
+    Finds the official name of the location mentioned in a text, using a
+    fixed list of aliases and regular expressions for each location.
+    '''
+
+    def __init__(self, aliases, regexes):
+        '''
+        Compiles 'aliases' and 'regexes', lists of (alias, location name) and
+        (regex, location name) pairs, in order of priority.
+        '''
+        # If an alias is listed more than once, its last location is used
+        location_map = dict(aliases)
+        self.aliases = [(alias, location_map[alias]) for alias, location in aliases]
+        self.automaton = _AliasAutomaton([alias.lower() for alias, location in self.aliases])
+
+        regex_map = dict(regexes)
+        self.regexes = [(re.compile(regex, re.IGNORECASE | re.UNICODE), len(regex), regex_map[regex])
+            for regex, location in regexes]
+
+    @classmethod
+    def from_files(cls, location_map_path=LOCATION_MAP_PATH, regex_map_path=REGEX_MAP_PATH):
+        '''
+        Creates a LocationExtractor from data files of 'alias,location' and
+        'regex,location' lines.
+        '''
+        return cls(_read_map(location_map_path), _read_map(regex_map_path))
+
+    def get_location(self, text):
+        '''
+        Gets the location in 'text'. Returns the official name of the location
+        matching the longest alias or regex, or the empty string if there is
+        none. 'text' may be a PreparedText.
+        '''
+        text = _prepared(text).prepared
+        location = ''
+        alias_length = 0
+
+        index = self.automaton.longest_match(text)
+        if index is not None:
+            alias, location = self.aliases[index]
+            alias_length = len(alias)
+
+        for regex, regex_length, regex_location in self.regexes:
+            if alias_length < regex_length and regex.search(text): # for longest match
+                location = regex_location
+                alias_length = regex_length
+
+        return location
+
+
+_food_extractor = None
+
+def get_food_extractor():
+    '''
+    Returns the FoodExtractor for this process, loading the food dictionary
+    the first time it is needed.
+    '''
+    global _food_extractor
+    if _food_extractor is None:
+        _food_extractor = FoodExtractor.from_file()
+    return _food_extractor
+
+
+_location_extractor = None
+
+def get_location_extractor():
+    '''
+    Returns the LocationExtractor for this process, loading the location data
+    the first time it is needed.
+    '''
+    global _location_extractor
+    if _location_extractor is None:
+        _location_extractor = LocationExtractor.from_files()
+    return _location_extractor
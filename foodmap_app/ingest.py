@@ -0,0 +1,428 @@
+'''
+ingest.py
+
+Native Python parsing of the emails sent to the Free Food listserv into
+entries for the database, like formatEmail() in scraper/scraper.js and
+parseMessage() in scraper/pipeline.js, for ingesting recorded emails in bulk.
+
+A message is either a Gmail API message, as users.messages.get returns it
+with format=full (parts with base64url data) or format=raw (a base64url
+'raw' RFC 822 email), or a raw RFC 822 email. Each message's MIME tree is
+walked once, depth first, for its text body and first image, and its text is
+prepared once and shared by the food, location and request type extractors.
+
+Messages are read in bulk with read_messages(), from a directory of .json
+and .eml files or from a JSONL file of Gmail API messages, and the entries
+made of them are written a sweep at a time with write(), as scraper/db.js
+writes them.
+'''
+
+import base64
+import datetime
+import email
+import email.header
+import email.message
+import email.utils
+import hashlib
+import io
+import json
+import os
+from django.db import transaction
+from django.utils import timezone
+from foodmap_app import expiry, extractor, offerings_cache, offerings_changes
+from foodmap_app.models import Location, Offering
+
+# Constants (same as in scraper.js and pipeline.js)
+LISTSERV_SENDER = 'Free Food <freefood@princeton.edu>'
+FREEFOOD_FOOTER = (u'-----\r\nYou are receiving this email because you are subscribed to the Free Food '
+    u'mailing list, operated by the USG. If you have questions or are having difficulties with this '
+    u'listserv, please send an email to usg@princeton.edu.\r\n\r\nIn your message to the freefood '
+    u'listserv, please state what type of food it is, where it is, until when it will be available and '
+    u'how delicious it is.\r\n\r\nTo unsubscribe, please email listserv@princeton.edu the line '
+    u'UNSUBSRIBE FREEFOOD in the body of the message. Please be sure to remove your e-mail signature '
+    u'(if any) before you send that message.\r\n')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+THREAD_ID_LENGTH = 16 # same as Offering.thread_id, and Gmail's thread ids
+DEFAULT_CHARSET = 'utf-8'
+CHUNK_SIZE = 500 # thread ids per query, within sqlite's limit of parameters
+
+# Extensions of the files read_messages() reads as JSON; others are read as
+# RFC 822 emails
+JSON_EXTENSION = '.json'
+JSONL_EXTENSION = '.jsonl'
+
+
+class Email(object):
+    '''
+    The parts of an email that entries are made from, whatever form the
+    message came in.
+    '''
+    __slots__ = ('message_id', 'thread_id', 'timestamp', 'sender', 'title', 'body', 'image')
+
+    def __init__(self, message_id, thread_id, timestamp, sender, title, body, image):
+        self.message_id = message_id
+        self.thread_id = thread_id
+        self.timestamp = timestamp # 'YYYY-MM-DD HH:MM:SS', in UTC
+        self.sender = sender
+        self.title = title
+        self.body = body # the text/plain body, without the listserv's footer
+        self.image = image # {'name': ..., 'id': ...} of the first image, or None
+
+    def is_from_listserv(self):
+        '''
+        Checks whether the email was sent through the Free Food listserv.
+        '''
+        return self.sender == LISTSERV_SENDER
+
+
+def _find_parts(root, describe):
+    '''
+    Walks the MIME tree under 'root' once, depth first, and returns its first
+    text/plain part that is not an attachment and its first image part (each
+    None if there is none). 'describe' returns the (content type, whether it
+    is an attachment, subparts) of a part.
+    '''
+    text_part = None
+    image_part = None
+    stack = [root]
+    while stack and (text_part is None or image_part is None):
+        part = stack.pop()
+        content_type, is_attachment, subparts = describe(part)
+        if subparts:
+            stack.extend(reversed(subparts))
+        elif content_type == 'text/plain' and not is_attachment:
+            text_part = text_part or part
+        elif content_type.startswith('image/'):
+            image_part = image_part or part
+    return text_part, image_part
+
+
+def _clean_body(body):
+    '''
+    Deletes the listserv's footer and null characters from 'body'.
+    '''
+    return body.replace(FREEFOOD_FOOTER, u'').replace(u'\0', u'')
+
+
+def _decode(data, charset):
+    '''
+    Decodes the bytes 'data' with 'charset', replacing what cannot be decoded.
+    '''
+    try:
+        return data.decode(charset or DEFAULT_CHARSET, 'replace')
+    except LookupError: # unknown charset
+        return data.decode(DEFAULT_CHARSET, 'replace')
+
+
+def _decode_base64url(data):
+    '''
+    Decodes base64url (or base64) 'data', with or without padding, as the
+    Gmail API encodes parts and raw messages.
+    '''
+    data = str(data).rstrip('=').replace('-', '+').replace('_', '/')
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def _format_timestamp(seconds):
+    '''
+    Formats a UNIX time like getTimestampFromMime() in scraper.js.
+    '''
+    return datetime.datetime.utcfromtimestamp(seconds).strftime(TIMESTAMP_FORMAT)
+
+
+#-------------------------------------------------------------------------------
+# Gmail API messages
+
+def _describe_gmail_part(part):
+    '''
+    Describes a part of a Gmail API message for _find_parts().
+    '''
+    return part.get('mimeType', ''), bool(part.get('filename')), part.get('parts')
+
+
+def _gmail_header(part, name):
+    '''
+    Gets the value of the header 'name' of a part of a Gmail API message, or
+    None if it has none.
+    '''
+    for header in part.get('headers', []):
+        if header['name'] == name:
+            return header['value']
+    return None
+
+
+def _gmail_charset(part):
+    '''
+    Gets the charset of a part of a Gmail API message, from its Content-Type
+    header, or None if it has none.
+    '''
+    content_type = _gmail_header(part, 'Content-Type')
+    if content_type is None:
+        return None
+    message = email.message.Message()
+    message['Content-Type'] = content_type
+    return message.get_content_charset()
+
+
+def parse_gmail(message):
+    '''
+    Parses a Gmail API message, as users.messages.get returns it with
+    format=full or format=raw, into an Email.
+    '''
+    if 'raw' in message:
+        parsed = parse_rfc822(_decode_base64url(message['raw']))
+        parsed.message_id = message.get('id', parsed.message_id)
+        parsed.thread_id = message.get('threadId', parsed.thread_id)
+        if 'internalDate' in message:
+            parsed.timestamp = _format_timestamp(int(message['internalDate']) // 1000)
+        return parsed
+
+    payload = message['payload']
+    text_part, image_part = _find_parts(payload, _describe_gmail_part)
+
+    body = u''
+    if text_part is not None and text_part.get('body', {}).get('data'):
+        body = _decode(_decode_base64url(text_part['body']['data']), _gmail_charset(text_part))
+
+    image = None
+    if image_part is not None:
+        image = {'name': image_part.get('filename'), 'id': image_part.get('body', {}).get('attachmentId')}
+
+    return Email(
+        message_id=message.get('id'),
+        thread_id=message.get('threadId'),
+        timestamp=_format_timestamp(int(message['internalDate']) // 1000),
+        sender=_gmail_header(payload, 'Sender'),
+        title=_gmail_header(payload, 'Subject') or u'',
+        body=_clean_body(body),
+        image=image
+    )
+
+
+#-------------------------------------------------------------------------------
+# RFC 822 emails
+
+def _describe_rfc822_part(part):
+    '''
+    Describes a part of an RFC 822 email for _find_parts().
+    '''
+    subparts = part.get_payload() if part.is_multipart() else None
+    is_attachment = bool(part.get_filename()) or (part.get('Content-Disposition') or '').startswith('attachment')
+    return part.get_content_type(), is_attachment, subparts
+
+
+def _decode_header(value):
+    '''
+    Decodes a header of an RFC 822 email, which may be RFC 2047 encoded.
+    '''
+    if value is None:
+        return None
+    return u''.join(_decode(text, charset) if isinstance(text, bytes) else text
+        for text, charset in email.header.decode_header(value))
+
+
+def _rfc822_thread_id(message):
+    '''
+    Makes up a thread id for an RFC 822 email, which has none of its own,
+    from the Message-ID of the first email of its thread, so replies get the
+    same thread id as the email they reply to.
+    '''
+    references = (message.get('References') or '').split() + (message.get('In-Reply-To') or '').split()
+    root = references[0] if references else message.get('Message-ID')
+    if root is None:
+        return None
+    return hashlib.sha1(root.strip().encode('utf-8')).hexdigest()[:THREAD_ID_LENGTH]
+
+
+def parse_rfc822(raw):
+    '''
+    Parses 'raw', the bytes of an RFC 822 email, into an Email.
+    '''
+    message = email.message_from_string(raw)
+    text_part, image_part = _find_parts(message, _describe_rfc822_part)
+
+    body = u''
+    if text_part is not None:
+        body = _decode(text_part.get_payload(decode=True) or b'', text_part.get_content_charset())
+
+    image = None
+    if image_part is not None:
+        content_id = image_part.get('Content-ID')
+        image = {'name': image_part.get_filename(), 'id': content_id.strip('<>') if content_id else None}
+
+    timestamp = None
+    date = email.utils.parsedate_tz(message.get('Date') or '')
+    if date is not None:
+        timestamp = _format_timestamp(email.utils.mktime_tz(date))
+
+    return Email(
+        message_id=(message.get('Message-ID') or '').strip('<>') or None,
+        thread_id=_rfc822_thread_id(message),
+        timestamp=timestamp,
+        sender=_decode_header(message.get('Sender')),
+        title=_decode_header(message.get('Subject')) or u'',
+        body=_clean_body(body),
+        image=image
+    )
+
+
+#-------------------------------------------------------------------------------
+# Entries
+
+def parse(message):
+    '''
+    Parses a message in any of the forms described above into an Email.
+    '''
+    if isinstance(message, dict):
+        return parse_gmail(message)
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    return parse_rfc822(message)
+
+
+def make_entry(parsed):
+    '''
+    Makes the entry for the Email 'parsed', with the same fields as
+    formatEmail() in scraper.js returns. The text is prepared once for all of
+    the extractors.
+    '''
+    text = extractor.PreparedText(parsed.title + parsed.body)
+    return {
+        'message_id': parsed.message_id,
+        'thread_id': parsed.thread_id,
+        'timestamp': parsed.timestamp,
+        'title': parsed.title,
+        'body': parsed.title + u'\n' + parsed.body,
+        'image': parsed.image,
+        'food': u', '.join(extractor.get_food_extractor().get_food(text)),
+        'location': extractor.get_location_extractor().get_location(text),
+        'request_type': extractor.get_request_type(text),
+    }
+
+
+def parse_message(message):
+    '''
+    Parses a message into an entry to be inserted or deleted. Returns None if
+    the message is not from the listserv or has no location, like
+    parseMessage() in pipeline.js.
+    '''
+    parsed = parse(message)
+    if not parsed.is_from_listserv():
+        return None
+    entry = make_entry(parsed)
+    if entry['location'] == '':
+        return None
+    return entry
+
+
+#-------------------------------------------------------------------------------
+# Reading messages in bulk
+
+def _read_file(path):
+    '''
+    Yields the messages in the file at 'path': every line of a .jsonl file,
+    the message (or list of messages) in a .json file, or the RFC 822 email
+    in any other file.
+    '''
+    if path.endswith(JSONL_EXTENSION):
+        with io.open(path, 'r', encoding='utf-8') as file:
+            for line in file: # one at a time, so big files are not read at once
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith(JSON_EXTENSION):
+        with io.open(path, 'r', encoding='utf-8') as file:
+            messages = json.load(file)
+        for message in (messages if isinstance(messages, list) else [messages]):
+            yield message
+    else:
+        with open(path, 'rb') as file:
+            yield file.read()
+
+
+def read_messages(path):
+    '''
+    Yields the messages in the file at 'path', or in every file of the
+    directory at 'path' (in order of name, skipping hidden files), as Gmail
+    API messages (dicts) or RFC 822 emails (bytes).
+    '''
+    if not os.path.isdir(path):
+        for message in _read_file(path):
+            yield message
+        return
+
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        if name.startswith('.') or not os.path.isfile(file_path):
+            continue
+        for message in _read_file(file_path):
+            yield message
+
+
+#-------------------------------------------------------------------------------
+# Writing entries
+
+def _chunks(items):
+    '''
+    Splits the list 'items' into lists of at most CHUNK_SIZE items.
+    '''
+    return [items[i:i+CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+
+
+def _parse_timestamp(timestamp):
+    '''
+    Parses a timestamp of an entry, in UTC.
+    '''
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def write(entries):
+    '''
+    Writes the entries of a sweep to the database in one transaction, like
+    write() in scraper/db.js. An offering is inserted for each INSERT entry
+    at a known location, unless its thread already has one or is deleted in
+    the same sweep, and the offerings of the threads of DELETE entries are
+    deleted. Entries without a thread id or timestamp are skipped, as they
+    could never be deleted. Returns the number of offerings inserted and
+    deleted.
+    '''
+    entries = [entry for entry in entries if entry['thread_id'] and entry['timestamp']]
+    deleted_thread_ids = list(set(entry['thread_id'] for entry in entries
+        if entry['request_type'] == extractor.DELETE))
+    inserts = [entry for entry in entries if entry['request_type'] == extractor.INSERT]
+
+    with transaction.atomic():
+        location_ids = dict(Location.objects.filter(name__in=set(entry['location'] for entry in inserts))
+            .values_list('name', 'id'))
+        seen = set(deleted_thread_ids)
+        for chunk in _chunks(list(set(entry['thread_id'] for entry in inserts))):
+            seen.update(Offering.objects.filter(thread_id__in=chunk).values_list('thread_id', flat=True))
+
+        offerings = []
+        for entry in inserts:
+            if entry['location'] not in location_ids or entry['thread_id'] in seen:
+                continue
+            seen.add(entry['thread_id'])
+            offerings.append(Offering(
+                timestamp=_parse_timestamp(entry['timestamp']),
+                location_id=location_ids[entry['location']],
+                title=entry['food'][:Offering.TITLE_MAX_LENGTH],
+                description=entry['body'][:Offering.DESCRIPTION_MAX_LENGTH],
+                thread_id=entry['thread_id'],
+                image=entry['image']['name'] if entry['image'] else None
+            ))
+        Offering.objects.bulk_create(offerings, batch_size=CHUNK_SIZE)
+        for chunk in _chunks([offering.thread_id for offering in offerings]):
+            # bulk_create() sends no signals, and only sets ids on Postgres
+            offerings_changes.record(Offering.objects.filter(thread_id__in=chunk).values_list('id', flat=True))
+
+        # Bulk deletes, which send no signals, so the changes are logged first
+        num_deleted = 0
+        now = timezone.now()
+        for chunk in _chunks(deleted_thread_ids):
+            deleted = Offering.objects.filter(thread_id__in=chunk)
+            offerings_changes.record_all(deleted, now)
+            num_deleted += expiry.delete_offerings(deleted)
+
+    if len(offerings) > 0 or num_deleted > 0:
+        offerings_cache.invalidate()
+    return len(offerings), num_deleted
@@ -0,0 +1,210 @@
+'''
+locations_index.py
+
+Finds the locations near a point, for the /offerings/nearby/ view, with an
+in-memory grid over the locations on campus.
+
+Locations are projected onto a flat plane around the middle of campus, in
+meters, so distances are plain Euclidean ones (accurate to well under a meter
+across campus). The plane is divided into square cells of CELL_SIZE meters,
+and a query only looks at the locations in the cells that its circle
+overlaps. Coordinates come as floats from the table in coordinates.py, rather
+than from Decimals on every query.
+
+It also finds the locations inside a box, for the /offerings/ view when the
+map asks for only what it shows. The map asks for the box of one of the
+standard web map tiles at a time (see snap_to_tiles()), so that it can cache
+each tile's offerings.
+
+The index is rebuilt whenever that table is loaded again (e.g. after a
+Location changes).
+'''
+
+import math
+import threading
+from foodmap_app import coordinates
+
+EARTH_RADIUS = 6371000.0 # meters
+
+# Side of each cell of the grid, in meters. About the distance between
+# neighboring buildings, so cells hold a few locations each.
+CELL_SIZE = 100.0
+
+# Web map tiles cover latitudes up to this far from the equator
+MAX_TILE_LAT = 85.0511287798
+MAX_TILE_ZOOM = 24
+
+
+class LocationIndex(object):
+    '''
+    A grid over 'locations', a list of (name, lat, lng), with coordinates as
+    floats.
+    '''
+
+    def __init__(self, locations, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.points = [] # (x, y, name)
+        self.positions = {} # maps names to (lat, lng)
+        self.cells = {} # maps (column, row) to the points in that cell
+
+        # Project around the middle of the locations, where the projection is
+        # most accurate
+        if len(locations) > 0:
+            self.origin_lat = sum([lat for name, lat, lng in locations]) / len(locations)
+            self.origin_lng = sum([lng for name, lat, lng in locations]) / len(locations)
+        else:
+            self.origin_lat = self.origin_lng = 0.0
+        self.meters_per_radian_lng = EARTH_RADIUS * math.cos(math.radians(self.origin_lat))
+
+        for name, lat, lng in locations:
+            self.positions[name] = (lat, lng)
+            x, y = self.project(lat, lng)
+            point = (x, y, name)
+            self.points.append(point)
+            self.cells.setdefault(self.get_cell(x, y), []).append(point)
+
+    def project(self, lat, lng):
+        '''
+        Returns the position of ('lat', 'lng') on the plane, in meters from
+        the middle of the locations.
+        '''
+        return (math.radians(lng - self.origin_lng) * self.meters_per_radian_lng,
+            math.radians(lat - self.origin_lat) * EARTH_RADIUS)
+
+    def get_cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def _within(self, points, x, y, radius):
+        '''
+        Returns (distance, name) for each of 'points' within 'radius' of
+        (x, y), closest first.
+        '''
+        found = []
+        radius_squared = radius * radius
+        for px, py, name in points:
+            dx = px - x
+            dy = py - y
+            distance_squared = dx * dx + dy * dy
+            if distance_squared <= radius_squared:
+                found.append((math.sqrt(distance_squared), name))
+        found.sort()
+        return found
+
+    def _get_points(self, min_x, min_y, max_x, max_y):
+        '''
+        Returns the points in the cells that the rectangle from (min_x, min_y)
+        to (max_x, max_y) overlaps.
+        '''
+        min_column, min_row = self.get_cell(min_x, min_y)
+        max_column, max_row = self.get_cell(max_x, max_y)
+
+        # Look at the cells the rectangle overlaps, or at every cell with
+        # locations if there are fewer of those (for very large rectangles)
+        if (max_column - min_column + 1) * (max_row - min_row + 1) > len(self.cells):
+            cells = [points for (column, row), points in self.cells.items()
+                if min_column <= column <= max_column and min_row <= row <= max_row]
+        else:
+            cells = [self.cells[(column, row)]
+                for column in range(min_column, max_column + 1)
+                for row in range(min_row, max_row + 1)
+                if (column, row) in self.cells]
+        return [point for points in cells for point in points]
+
+    def nearby(self, lat, lng, radius):
+        '''
+        Returns (distance in meters, name) for each location within 'radius'
+        meters of ('lat', 'lng'), closest first.
+        '''
+        x, y = self.project(lat, lng)
+        return self._within(self._get_points(x - radius, y - radius, x + radius, y + radius), x, y, radius)
+
+    def within_bounds(self, south, west, north, east):
+        '''
+        Returns the set of names of the locations inside the box with the
+        given edges, in degrees.
+        '''
+        # The projection keeps lines of latitude and longitude straight, so
+        # the box is a rectangle on the plane
+        min_x, min_y = self.project(south, west)
+        max_x, max_y = self.project(north, east)
+        return set([name for x, y, name in self._get_points(min_x, min_y, max_x, max_y)
+            if min_x <= x <= max_x and min_y <= y <= max_y])
+
+    def scan(self, lat, lng, radius):
+        '''
+        Same as nearby(), but looks at every location. For testing and
+        benchmarking the grid against.
+        '''
+        x, y = self.project(lat, lng)
+        return self._within(self.points, x, y, radius)
+
+
+def get_tile_position(lat, lng, zoom):
+    '''
+    Returns the position of ('lat', 'lng') among the web map tiles (the
+    Web Mercator ones Leaflet and most tile servers use) at 'zoom', in tiles
+    from the north-west corner of the world, as (x, y) floats.
+    '''
+    lat = math.radians(max(-MAX_TILE_LAT, min(MAX_TILE_LAT, lat)))
+    tiles = 2 ** zoom
+    return ((lng + 180.0) / 360.0 * tiles,
+        (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * tiles)
+
+
+def get_tile_bounds(x, y, zoom):
+    '''
+    Returns the edges of the tile at column 'x' and row 'y' at 'zoom', as
+    (south, west, north, east) in degrees.
+    '''
+    tiles = 2 ** zoom
+    def get_lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * row / tiles))))
+    return (get_lat(y + 1), x * 360.0 / tiles - 180, get_lat(y), (x + 1) * 360.0 / tiles - 180)
+
+
+def snap_to_tiles(south, west, north, east, zoom):
+    '''
+    Returns the edges of the smallest box made of whole tiles at 'zoom' that
+    contains the box with the given edges, as (south, west, north, east).
+    Edges within a millionth of a tile of a tile's edge count as on it, so
+    that a tile's own edges, computed with floats elsewhere (e.g. by the
+    map), give back exactly that tile.
+    '''
+    min_x, min_y = get_tile_position(north, west, zoom)
+    max_x, max_y = get_tile_position(south, east, zoom)
+    min_x, min_y = int(math.floor(round(min_x, 6))), int(math.floor(round(min_y, 6)))
+    max_x, max_y = max(int(math.ceil(round(max_x, 6))) - 1, min_x), max(int(math.ceil(round(max_y, 6))) - 1, min_y)
+    south = get_tile_bounds(min_x, max_y, zoom)[0]
+    west = get_tile_bounds(min_x, min_y, zoom)[1]
+    north, east = get_tile_bounds(max_x, min_y, zoom)[2:]
+    return (south, west, north, east)
+
+
+def build(table=None):
+    '''
+    Returns an index of the locations in 'table', a
+    coordinates.CoordinateTable, by default the current one.
+    '''
+    if table is None:
+        table = coordinates.get_table()
+    index = LocationIndex(zip(table.names, table.lats, table.lngs))
+    index.table = table
+    return index
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def get_index():
+    '''
+    Returns the index of locations, building it if there is none or the
+    table of coordinates has been loaded again since. Only one thread builds
+    it at a time.
+    '''
+    global _index
+    table = coordinates.get_table()
+    with _lock:
+        if _index is None or _index.table is not table:
+            _index = build(table)
+        return _index
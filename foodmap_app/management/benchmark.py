@@ -0,0 +1,72 @@
+'''
+benchmark.py
+
+Helpers shared by the benchmark commands, to run them on a database of their
+own filled with generated offerings.
+'''
+
+import datetime
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import override_settings
+from foodmap_app.models import Location, Offering
+
+BATCH_SIZE = 1000
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    }
+}
+
+
+@contextmanager
+def test_database():
+    '''
+    Creates a test database, separate from the real one, for the duration of
+    the block. Works with whichever database the settings configure. The
+    offerings cache is swapped for one in local memory too, so that
+    invalidating it does not empty the real one.
+    '''
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+    try:
+        with override_settings(CACHES=TEST_CACHES, OFFERINGS_CACHE_ALIAS='default'):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=False)
+
+
+def seed_locations(count, rng):
+    '''
+    Adds 'count' locations around campus. Returns their ids.
+    '''
+    Location.objects.bulk_create([Location(name='Location %d' % i, lat=rng.uniform(40.33, 40.36),
+        lng=rng.uniform(-74.68, -74.64)) for i in range(0, count)])
+    return list(Location.objects.values_list('id', flat=True))
+
+
+def seed_offerings(count, location_ids, start, period, rng, recur_choices=None):
+    '''
+    Adds 'count' offerings at random times over 'period' (a timedelta) from
+    'start', at random locations among 'location_ids'. Each recurs as a
+    random choice from 'recur_choices', a list of Offering.RECUR_CHOICES
+    values and None, if it is given.
+    '''
+    seconds = period.total_seconds()
+    for batch_start in range(0, count, BATCH_SIZE):
+        offerings = []
+        for i in range(batch_start, min(batch_start + BATCH_SIZE, count)):
+            timestamp = start + datetime.timedelta(seconds=rng.uniform(0, seconds))
+            recur = rng.choice(recur_choices) if recur_choices else None
+            offerings.append(Offering(
+                timestamp=timestamp,
+                location_id=rng.choice(location_ids),
+                title='Pizza',
+                description='Come get some pizza!',
+                thread_id='%016x' % i,
+                recur=recur,
+                recur_end_datetime=timestamp + datetime.timedelta(days=365) if recur else None
+            ))
+        Offering.objects.bulk_create(offerings)
@@ -0,0 +1,95 @@
+'''
+benchmarkexpiry.py
+
+Management command that times expiry.expire_offerings() on a separate test
+database (never the real one) seeded with expired offerings, a share of them
+recurring:
+
+    python manage.py benchmarkexpiry
+
+Recurring offerings are not deleted until their end date (see recurrence.py).
+With --compare, it also times the previous approach of
+delete_old_offerings.py, which saved a copy of each recurring offering at its
+next occurrence and deleted each expired one individually, on the same
+offerings.
+'''
+
+import datetime
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from foodmap_app import expiry, recurrence
+from foodmap_app.management import benchmark
+from foodmap_app.models import Offering, OfferingTag
+from foodmap_app.offerings_cache import MAX_AGE
+
+
+class Command(BaseCommand):
+    help = 'Seeds a test database with expired offerings and times how long expiring them takes.'
+
+    DEFAULT_OFFERINGS = 100000
+    DEFAULT_LOCATIONS = 200
+
+    # Seeded offerings expired at some point over this period
+    SEED_PERIOD = datetime.timedelta(days=7)
+
+    # Each seeded offering recurs as a choice from this list, so about a third
+    # of them recur
+    RECUR_CHOICES = [None, None, None, None, recurrence.DAILY, recurrence.WEEKLY]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offerings', type=int, default=Command.DEFAULT_OFFERINGS,
+            help='Number of expired offerings to seed the test database with.')
+        parser.add_argument('--locations', type=int, default=Command.DEFAULT_LOCATIONS,
+            help='Number of locations to spread the offerings over.')
+        parser.add_argument('--compare', action='store_true', default=False,
+            help='Also time deleting offerings one at a time, as delete_old_offerings.py used to.')
+
+    def handle(self, *args, **options):
+        with benchmark.test_database():
+            now = timezone.now()
+            location_ids = benchmark.seed_locations(options['locations'], random.Random(42))
+
+            approaches = [('bulk expiry', expiry.expire_offerings)]
+            if options['compare']:
+                approaches.append(('one at a time', self.expire_one_at_a_time))
+
+            for name, expire in approaches:
+                self.seed(options['offerings'], location_ids, now)
+                start = time.time()
+                expire(now)
+                elapsed = time.time() - start
+                self.stdout.write('%s: %.2f s for %d offerings (%s), %d left'
+                    % (name, elapsed, options['offerings'], connection.vendor, Offering.objects.count()))
+
+    def seed(self, count, location_ids, now):
+        '''
+        Replaces any offerings in the test database with 'count' expired
+        offerings, each with a tag.
+        '''
+        expiry.delete_offerings(Offering.objects.all())
+        rng = random.Random(42) # same offerings every time
+        benchmark.seed_offerings(count, location_ids, now - MAX_AGE - Command.SEED_PERIOD,
+            Command.SEED_PERIOD, rng, Command.RECUR_CHOICES)
+        OfferingTag.objects.bulk_create([OfferingTag(offering_id=offering_id, tag='vegan')
+            for offering_id in Offering.objects.values_list('id', flat=True)])
+
+    def expire_one_at_a_time(self, now):
+        '''
+        The approach delete_old_offerings.py used to take, with its date
+        arithmetic fixed: save the next occurrence of each recurring offering,
+        and delete each expired offering, one at a time.
+        '''
+        min_timestamp = now - MAX_AGE
+        for offering in Offering.objects.filter(timestamp__lte=min_timestamp):
+            if offering.recur is not None:
+                # Its first occurrence after it expired
+                timestamp = next(recurrence.occurrences(offering.timestamp, offering.recur,
+                    min_timestamp + datetime.timedelta(microseconds=1)))
+                if timestamp < offering.recur_end_datetime:
+                    Offering(timestamp=timestamp, location_id=offering.location_id, title=offering.title,
+                        description=offering.description, recur=offering.recur,
+                        recur_end_datetime=offering.recur_end_datetime).save()
+            offering.delete()
@@ -0,0 +1,211 @@
+'''
+benchmarkingest.py
+
+Management command that replays recorded emails of the Free Food listserv
+through the whole ingestion path of ingest.py (parse, extract, write) on a
+separate test database (never the real one) seeded with the locations in
+locations.json, and reports the throughput, the latency of each stage and
+the peak memory used:
+
+    python manage.py benchmarkingest [path] [--output results.json]
+    python manage.py benchmarkingest [path] --baseline results.json
+
+The emails are read as parseemails reads them, by default from the recorded
+messages the scraper is tested with. They are replayed --repeat times, each
+time with thread ids of their own, so every replay inserts and deletes as
+the first one did. Replies saying the food is gone are written in the sweep
+after the one they would be in, so that the offering they delete is in the
+database by then, rather than cancelled in memory in the same sweep; the
+command fails if there were replies but nothing was deleted. Results can be saved with --output, and compared with
+saved ones with --baseline: the command then fails if the throughput drops
+by more than --tolerance, so it can be run as a regression benchmark.
+'''
+
+import hashlib
+import json
+import os
+import resource
+import sys
+import time
+from StringIO import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from foodmap_app import extractor, ingest
+from foodmap_app.management import benchmark
+from foodmap_proj.settings.common import BASE_DIR
+
+DEFAULT_PATH = os.path.join(BASE_DIR, 'scraper', 'test', 'fixtures', 'messages')
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(sorted_times, percent):
+    '''
+    Returns the 'percent'th percentile of 'sorted_times', a sorted list, by
+    the nearest rank.
+    '''
+    rank = int(round(percent / 100.0 * len(sorted_times)))
+    return sorted_times[min(max(rank, 1), len(sorted_times)) - 1]
+
+
+def peak_memory():
+    '''
+    Returns the peak resident memory of this process so far, in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in KB, macOS in bytes
+    return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1)
+
+
+class Command(BaseCommand):
+    help = 'Replays recorded listserv emails through parsing, extraction and writing, and times each stage.'
+
+    DEFAULT_REPEAT = 200
+    DEFAULT_SWEEP_SIZE = 100
+    DEFAULT_TOLERANCE = 0.2
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=DEFAULT_PATH,
+            help='Directory of .json and .eml files, or a JSONL, JSON or RFC 822 file. Defaults to '
+                'the recorded messages in scraper/test/fixtures/messages.')
+        parser.add_argument('--repeat', type=int, default=Command.DEFAULT_REPEAT,
+            help='Number of times to replay the emails.')
+        parser.add_argument('--sweep-size', type=int, default=Command.DEFAULT_SWEEP_SIZE,
+            help='Number of emails written in each transaction, as in a sweep of the inbox.')
+        parser.add_argument('--output',
+            help='JSON file to save the results to, to compare later runs with.')
+        parser.add_argument('--baseline',
+            help='JSON file of results saved with --output. Fails if the emails per second drop by more than '
+                '--tolerance from it.')
+        parser.add_argument('--tolerance', type=float, default=Command.DEFAULT_TOLERANCE,
+            help='Fraction of the baseline emails per second that may be lost before failing.')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError('No such file or directory: %s' % options['path'])
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+
+        # Read every email and load the extractors up front, so neither is timed
+        extractor.get_food_extractor()
+        extractor.get_location_extractor()
+        messages = list(ingest.read_messages(options['path']))
+        if len(messages) == 0:
+            raise CommandError('No emails found in %s' % options['path'])
+
+        with benchmark.test_database():
+            call_command('loadlocations', stdout=StringIO())
+            results = self.replay(messages, options['repeat'], options['sweep_size'])
+        if results['replies'] > 0 and results['deleted'] == 0:
+            raise CommandError('The replies in %s deleted no offerings, so deleting was not timed'
+                % options['path'])
+
+        self.stdout.write('Replayed %d emails (%d inserted, %d deleted) in %.2f s: %.1f emails/s (%s).'
+            % (results['emails'], results['inserted'], results['deleted'], results['seconds'],
+                results['emails_per_second'], connection.vendor))
+        for stage in ['parse', 'extract', 'write']:
+            latencies = results['stages'][stage]
+            self.stdout.write('%s (%s): %s' % (stage, 'ms per sweep' if stage == 'write' else 'ms per email',
+                ', '.join('p%d %.3f' % (percent, latencies['p%d' % percent]) for percent in PERCENTILES)
+                + ', max %.3f' % latencies['max']))
+        self.stdout.write('Peak memory: %.1f MB' % results['peak_memory_mb'])
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            floor = baseline['emails_per_second'] * (1 - options['tolerance'])
+            self.stdout.write('Baseline: %.1f emails/s' % baseline['emails_per_second'])
+            if results['emails_per_second'] < floor:
+                raise CommandError('Throughput regressed: %.1f emails/s, below %.1f (baseline %.1f, tolerance %d%%)'
+                    % (results['emails_per_second'], floor, baseline['emails_per_second'],
+                        options['tolerance'] * 100))
+
+    def replay(self, messages, repeat, sweep_size):
+        '''
+        Parses, extracts from and writes 'messages' 'repeat' times, a sweep of
+        'sweep_size' emails at a time, with replies held back to the next
+        sweep. Returns the results.
+        '''
+        times = {'parse': [], 'extract': [], 'write': []}
+        counts = {'inserted': 0, 'deleted': 0, 'replies': 0}
+        total = 0.0
+        sweep = []
+        replies = [] # written in the next sweep
+        for i in range(0, repeat):
+            for message in messages:
+                start = time.time()
+                parsed = ingest.parse(message)
+                parsed_time = time.time()
+                entry = None
+                if parsed.is_from_listserv():
+                    entry = ingest.make_entry(parsed)
+                extracted_time = time.time()
+                times['parse'].append(parsed_time - start)
+                times['extract'].append(extracted_time - parsed_time)
+                total += extracted_time - start
+
+                if entry is not None and entry['location'] != '':
+                    entry['thread_id'] = self.replay_thread_id(entry['thread_id'], i)
+                    if entry['request_type'] == extractor.DELETE:
+                        replies.append(entry)
+                        counts['replies'] += 1
+                    else:
+                        sweep.append(entry)
+                if len(sweep) + len(replies) >= sweep_size:
+                    if len(sweep) > 0:
+                        total += self.write(sweep, times, counts)
+                    sweep, replies = replies, []
+        for last_sweep in [sweep, replies]:
+            if len(last_sweep) > 0:
+                total += self.write(last_sweep, times, counts)
+
+        return {
+            'emails': len(messages) * repeat,
+            'seconds': total,
+            'emails_per_second': len(messages) * repeat / total if total > 0 else 0.0,
+            'inserted': counts['inserted'],
+            'deleted': counts['deleted'],
+            'replies': counts['replies'],
+            'stages': dict((stage, self.summarize(stage_times)) for stage, stage_times in times.items()),
+            'peak_memory_mb': peak_memory(),
+            'database': connection.vendor,
+        }
+
+    def write(self, sweep, times, counts):
+        '''
+        Writes 'sweep', a list of entries, and adds the time it took to
+        'times' and the offerings it inserted and deleted to 'counts'.
+        Returns the time it took.
+        '''
+        start = time.time()
+        inserted, deleted = ingest.write(sweep)
+        elapsed = time.time() - start
+        times['write'].append(elapsed)
+        counts['inserted'] += inserted
+        counts['deleted'] += deleted
+        return elapsed
+
+    def replay_thread_id(self, thread_id, i):
+        '''
+        Returns the thread id 'thread_id' has in the 'i'th replay. Replies
+        still get the same thread id as the email they reply to, and emails
+        without one still have none.
+        '''
+        if i == 0 or not thread_id:
+            return thread_id
+        return hashlib.sha1('%s:%d' % (thread_id, i)).hexdigest()[:ingest.THREAD_ID_LENGTH]
+
+    def summarize(self, stage_times):
+        '''
+        Returns the percentiles and maximum of 'stage_times', in ms.
+        '''
+        stage_times = sorted(stage_times)
+        if len(stage_times) == 0:
+            stage_times = [0.0]
+        summary = dict(('p%d' % percent, percentile(stage_times, percent) * 1000) for percent in PERCENTILES)
+        summary['max'] = stage_times[-1] * 1000
+        return summary
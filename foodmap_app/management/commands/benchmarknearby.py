@@ -0,0 +1,82 @@
+'''
+benchmarknearby.py
+
+Management command that times finding the locations near a point, as the
+/offerings/nearby/ view does, on a separate test database (never the real
+one) seeded with locations around campus:
+
+    python manage.py benchmarknearby
+
+It compares the grid in locations_index.py with looking at every location in
+the index, and with looking at every location in the database (converting
+each coordinate from a Decimal), as a query would without the index.
+'''
+
+import math
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from foodmap_app import locations_index
+from foodmap_app.management import benchmark
+from foodmap_app.models import Location
+
+
+class Command(BaseCommand):
+    help = 'Seeds a test database with locations and times finding those near random points.'
+
+    DEFAULT_LOCATIONS = 900
+    DEFAULT_QUERIES = 200
+    DEFAULT_RADIUS = 300 # meters
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', type=int, default=Command.DEFAULT_LOCATIONS,
+            help='Number of locations to seed the test database with.')
+        parser.add_argument('--queries', type=int, default=Command.DEFAULT_QUERIES,
+            help='Number of random points to search around. The median time is reported.')
+        parser.add_argument('--radius', type=float, default=Command.DEFAULT_RADIUS,
+            help='Radius to search within, in meters.')
+
+    def handle(self, *args, **options):
+        with benchmark.test_database():
+            rng = random.Random(42) # fixed seed, so runs are comparable
+            benchmark.seed_locations(options['locations'], rng)
+            points = [(rng.uniform(40.33, 40.36), rng.uniform(-74.68, -74.64)) for i in range(0, options['queries'])]
+            radius = options['radius']
+
+            start = time.time()
+            index = locations_index.build()
+            self.stdout.write('Built the index of %d locations in %.2f ms (%s).'
+                % (options['locations'], (time.time() - start) * 1000, connection.vendor))
+
+            approaches = [
+                ('grid', index.nearby),
+                ('index scan', index.scan),
+                ('database scan', lambda lat, lng, radius: self.scan_database(index, lat, lng, radius)),
+            ]
+            for name, find in approaches:
+                times = []
+                found = 0
+                for lat, lng in points:
+                    start = time.time()
+                    found += len(find(lat, lng, radius))
+                    times.append(time.time() - start)
+                times.sort()
+                self.stdout.write('%s: median %.3f ms, max %.3f ms (%.1f locations found on average)'
+                    % (name, times[len(times) // 2] * 1000, times[-1] * 1000, float(found) / len(points)))
+
+    def scan_database(self, index, lat, lng, radius):
+        '''
+        Finds the locations near a point by loading every location and
+        converting its Decimal coordinates, with the same projection as
+        'index'.
+        '''
+        x, y = index.project(lat, lng)
+        found = []
+        for name, location_lat, location_lng in Location.objects.values_list('name', 'lat', 'lng'):
+            location_x, location_y = index.project(float(location_lat), float(location_lng))
+            distance = math.hypot(location_x - x, location_y - y)
+            if distance <= radius:
+                found.append((distance, name))
+        found.sort()
+        return found
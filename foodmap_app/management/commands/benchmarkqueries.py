@@ -0,0 +1,119 @@
+'''
+benchmarkqueries.py
+
+Management command that benchmarks the queries run most often against the
+Offerings table, with and without the index on Offering.timestamp. Seeds a
+separate test database (never the real one) with offerings, then prints each
+query's plan and latency before and after the index is created:
+
+    python manage.py benchmarkqueries
+
+Runs against whichever database the settings configure, so to benchmark
+Postgres, use settings with a Postgres database (and a user allowed to
+create the test database).
+'''
+
+import datetime
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from foodmap_app.management import benchmark
+from foodmap_app.models import Location, Offering
+from foodmap_app.offerings_cache import MAX_AGE
+
+
+class Command(BaseCommand):
+    help = 'Seeds a test database with offerings and reports query plans and latency with and without indexes.'
+
+    DEFAULT_OFFERINGS = 100000
+    DEFAULT_LOCATIONS = 200
+    DEFAULT_REPEAT = 20
+
+    # Seeded offerings are spread over this period, starting just before they
+    # would be deleted. Most of the table is offerings to come, as it is when
+    # delete_old_offerings.py runs regularly.
+    SEED_PERIOD = datetime.timedelta(days=90)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offerings', type=int, default=Command.DEFAULT_OFFERINGS,
+            help='Number of offerings to seed the test database with.')
+        parser.add_argument('--locations', type=int, default=Command.DEFAULT_LOCATIONS,
+            help='Number of locations to spread the offerings over.')
+        parser.add_argument('--repeat', type=int, default=Command.DEFAULT_REPEAT,
+            help='Number of times to run each query. The median time is reported.')
+
+    def handle(self, *args, **options):
+        with benchmark.test_database():
+            now = timezone.now()
+            rng = random.Random(42) # fixed seed, so runs are comparable
+            location_ids = benchmark.seed_locations(options['locations'], rng)
+            benchmark.seed_offerings(options['offerings'], location_ids,
+                now - MAX_AGE - datetime.timedelta(hours=1), Command.SEED_PERIOD, rng)
+            self.stdout.write('Seeded %d offerings at %d locations (%s).\n'
+                % (options['offerings'], options['locations'], connection.vendor))
+
+            # Drop the index, benchmark, then put it back and benchmark again
+            indexed_field = Offering._meta.get_field('timestamp')
+            unindexed_field = Offering._meta.get_field('timestamp').clone()
+            unindexed_field.set_attributes_from_name('timestamp')
+            unindexed_field.model = Offering
+            unindexed_field.db_index = False
+
+            with connection.schema_editor() as schema_editor:
+                schema_editor.alter_field(Offering, indexed_field, unindexed_field)
+            before = self.run_queries('Without index on Offering.timestamp', now, options['repeat'])
+
+            with connection.schema_editor() as schema_editor:
+                schema_editor.alter_field(Offering, unindexed_field, indexed_field)
+            after = self.run_queries('With index on Offering.timestamp', now, options['repeat'])
+
+            self.stdout.write('Summary (median ms, before -> after):')
+            for name, _ in self.get_queries(now):
+                self.stdout.write('  %-20s %9.3f -> %9.3f' % (name, before[name], after[name]))
+
+    def get_queries(self, now):
+        '''
+        Returns (name, QuerySet) for each of the hot queries, shaped like the
+        ones run by the views, delete_old_offerings.py and scraper/db.js.
+        '''
+        return [
+            ('offerings window', Offering.objects
+                .filter(timestamp__gte=now - MAX_AGE, timestamp__lte=now + datetime.timedelta(minutes=1))
+                .order_by('-timestamp').select_related('location')),
+            ('expired offerings', Offering.objects.filter(timestamp__lte=now - MAX_AGE)),
+            ('location by name', Location.objects.filter(name='Location 1')),
+            ('offering by thread', Offering.objects.filter(thread_id='%016x' % 1)),
+        ]
+
+    def explain(self, queryset):
+        '''
+        Returns the database's plan for 'queryset', as text.
+        '''
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return '\n'.join([str(row[-1]) for row in cursor.fetchall()])
+
+    def run_queries(self, title, now, repeat):
+        '''
+        Prints the plan and median latency of each query. Returns the
+        latencies, in milliseconds, by query name.
+        '''
+        self.stdout.write(title)
+        latencies = {}
+        for name, queryset in self.get_queries(now):
+            times = []
+            for i in range(0, repeat):
+                start = time.time()
+                list(queryset.all()) # all() makes a copy, so results are not cached
+                times.append((time.time() - start) * 1000)
+            latencies[name] = sorted(times)[len(times) // 2]
+
+            self.stdout.write('  %s: %.3f ms' % (name, latencies[name]))
+            for line in self.explain(queryset).split('\n'):
+                self.stdout.write('      ' + line)
+        self.stdout.write('')
+        return latencies
@@ -0,0 +1,95 @@
+'''
+loadlocations.py
+
+Management command that loads locations from a JSON file (by default,
+locations.json in the root of the project) into the Locations table:
+
+    python manage.py loadlocations [path]
+
+The file holds a list of {"name": ..., "lat": ..., "lng": ...} objects. New
+locations are inserted, and existing ones (matched by name) have their
+coordinates updated if they changed, all in one transaction. When a name is
+in the file more than once, its first entry is used. Running it again on the
+same file changes nothing, so it is safe to run on every deploy.
+'''
+
+import json
+import os
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from foodmap_app import coordinates
+from foodmap_app.models import Location
+from foodmap_proj.settings.common import BASE_DIR
+
+# Coordinates are stored with this many decimal places
+LAT_LNG_QUANTUM = Decimal(10) ** -Location.LAT_LNG_DECIMAL_PLACES
+
+
+class Command(BaseCommand):
+    help = 'Inserts or updates the locations in a JSON file (locations.json by default).'
+
+    DEFAULT_PATH = os.path.join(BASE_DIR, 'locations.json')
+    DEFAULT_BATCH_SIZE = 500 # below the number of query parameters sqlite allows
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=Command.DEFAULT_PATH,
+            help='JSON file to load the locations from.')
+        parser.add_argument('--batch-size', type=int, default=Command.DEFAULT_BATCH_SIZE,
+            help='Number of locations to look up and insert at a time.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+        seen = set()
+        try:
+            with open(options['path'], 'r') as file:
+                entries = json.load(file)
+            if not isinstance(entries, list):
+                raise ValueError('expected a list')
+            with transaction.atomic():
+                batch = []
+                for entry in entries:
+                    location = Location(name=entry['name'],
+                        lat=Decimal(str(entry['lat'])).quantize(LAT_LNG_QUANTUM),
+                        lng=Decimal(str(entry['lng'])).quantize(LAT_LNG_QUANTUM))
+                    if location.name in seen:
+                        counts['duplicates'] += 1
+                        continue
+                    seen.add(location.name)
+                    batch.append(location)
+                    if len(batch) == options['batch_size']:
+                        self.load_batch(batch, counts)
+                        batch = []
+                self.load_batch(batch, counts)
+        except (IOError, KeyError, ValueError) as e:
+            raise CommandError('Could not load locations from %s: %s' % (options['path'], e))
+
+        # Locations are written in bulk, without signals, so drop the
+        # coordinates kept in memory by hand
+        coordinates.invalidate()
+
+        self.stdout.write('Loaded %d locations in %.2f s: %d inserted, %d updated, %d unchanged '
+            '(%d duplicate names skipped).' % (len(seen), time.time() - start, counts['inserted'],
+            counts['updated'], counts['unchanged'], counts['duplicates']))
+
+    def load_batch(self, batch, counts):
+        '''
+        Inserts the locations in 'batch' that are not in the table, and
+        updates the coordinates of those that moved. Adds to 'counts'.
+        '''
+        existing = dict([(location.name, location)
+            for location in Location.objects.filter(name__in=[location.name for location in batch])])
+        new_locations = []
+        for location in batch:
+            old = existing.get(location.name)
+            if old is None:
+                new_locations.append(location)
+            elif old.lat != location.lat or old.lng != location.lng:
+                Location.objects.filter(id=old.id).update(lat=location.lat, lng=location.lng)
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+        Location.objects.bulk_create(new_locations)
+        counts['inserted'] += len(new_locations)
@@ -0,0 +1,41 @@
+'''
+parseemails.py
+
+Management command that parses recorded emails of the Free Food listserv into
+entries, as the scraper would, and prints each entry as a line of JSON. The
+emails are read from a directory of .json (Gmail API messages) and .eml
+(RFC 822) files, or from a JSONL file of Gmail API messages:
+
+    python manage.py parseemails scraper/test/fixtures/messages
+'''
+
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError
+from foodmap_app import ingest
+
+
+class Command(BaseCommand):
+    help = 'Parses recorded listserv emails into entries and prints them as JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+            help='Directory of .json and .eml files, or a JSONL, JSON or RFC 822 file.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError('No such file or directory: %s' % path)
+
+        total = 0
+        parsed = 0
+        for message in ingest.read_messages(path):
+            total += 1
+            entry = ingest.parse_message(message)
+            if entry is None:
+                continue # not from the listserv, or no location
+            parsed += 1
+            self.stdout.write(json.dumps(entry, sort_keys=True))
+
+        self.stderr.write('Parsed %d of %d emails (the others are not from the listserv or have no location).'
+            % (parsed, total))
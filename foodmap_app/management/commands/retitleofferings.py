@@ -0,0 +1,69 @@
+'''
+retitleofferings.py
+
+Management command that re-scrapes the description of every Offering for
+foods and updates its title to match. Run this after changing
+scraper/data/foods.txt, or to backfill titles of old offerings:
+
+    python manage.py retitleofferings
+'''
+
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from foodmap_app import offerings_cache, offerings_changes, scraper
+from foodmap_app.models import Offering
+
+
+class Command(BaseCommand):
+    help = 'Re-scrapes the description of every offering and updates its title with the foods found.'
+
+    DEFAULT_CHUNK_SIZE = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=Command.DEFAULT_CHUNK_SIZE,
+            help='Number of offerings to load and update at a time.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='Report how many titles would change without saving them.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+
+        total = 0
+        changed = 0
+        no_food = 0
+        last_pk = 0
+        while True:
+            # Walk the table in primary key order, one chunk at a time, so
+            # memory use does not grow with the size of the table
+            chunk = list(Offering.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'title', 'description')[:chunk_size])
+            if len(chunk) == 0:
+                break
+            last_pk = chunk[-1][0]
+            total += len(chunk)
+
+            # Group offerings whose title changes by their new title, so each
+            # distinct title takes a single UPDATE
+            pks_by_title = defaultdict(list)
+            descriptions = [description for pk, title, description in chunk]
+            for (pk, title, description), new_title in zip(chunk, scraper.get_food_batch(descriptions)):
+                new_title = new_title[:Offering.TITLE_MAX_LENGTH]
+                if new_title == '':
+                    no_food += 1 # keep the old title rather than blanking it
+                elif new_title != title:
+                    pks_by_title[new_title].append(pk)
+
+            for pks in pks_by_title.values():
+                changed += len(pks)
+            if not dry_run:
+                with transaction.atomic():
+                    for new_title, pks in pks_by_title.items():
+                        Offering.objects.filter(pk__in=pks).update(title=new_title)
+                        offerings_changes.record(pks) # update() sends no signals
+                if len(pks_by_title) > 0:
+                    offerings_cache.invalidate()
+
+        self.stdout.write('%s %d of %d offerings (%d with no foods found, left unchanged).'
+            % ('Would re-title' if dry_run else 'Re-titled', changed, total, no_food))
@@ -0,0 +1,45 @@
+'''
+runscheduler.py
+
+Management command that runs the maintenance jobs of scheduler.py at the
+intervals set by SCHEDULER_INTERVALS, until it is stopped:
+
+    python manage.py runscheduler
+
+Jobs can be named to run only those, and --once runs each of them once and
+exits, e.g. from cron:
+
+    python manage.py runscheduler --once expiry recurrence
+'''
+
+from django.core.management.base import BaseCommand, CommandError
+from foodmap_app import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Runs the expiry, recurrence and cache warm-up jobs at regular intervals.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('jobs', nargs='*', metavar='job',
+            help='Names of the jobs to run (default: all those with an interval in SCHEDULER_INTERVALS).')
+        parser.add_argument('--once', action='store_true', default=False,
+            help='Run each job once and exit.')
+
+    def handle(self, *args, **options):
+        try:
+            jobs = scheduler.get_jobs(options['jobs'] or None)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if len(jobs) == 0:
+            raise CommandError('No jobs to run. Set their intervals in SCHEDULER_INTERVALS.')
+
+        runner = scheduler.Scheduler(jobs, self.stdout)
+        if options['once']:
+            runner.run_all()
+            return
+
+        for job in jobs:
+            if job.interval is None:
+                raise CommandError('Job \'%s\' has no interval in SCHEDULER_INTERVALS.' % job.name)
+            self.stdout.write('Running %s every %d s.' % (job.name, job.interval))
+        runner.run_forever()
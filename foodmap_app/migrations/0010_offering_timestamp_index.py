@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodmap_app', '0009_offeringchange'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='offering',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
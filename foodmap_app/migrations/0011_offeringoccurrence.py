@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+import calendar
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+# Copies of the constants and date arithmetic of recurrence.py as they were
+# when this migration was written, so that later changes to it do not change
+# what this migration does
+OCCURRENCE_HORIZON = datetime.timedelta(days=7)
+MAX_AGE = datetime.timedelta(hours=2)
+DAILY = 'D'
+WEEKLY = 'W'
+MONTHLY = 'M'
+
+
+def add_local_months(local, months):
+    month_index = local.month - 1 + months
+    year = local.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(local.day, calendar.monthrange(year, month)[1])
+    return local.replace(year=year, month=month, day=day)
+
+
+def occurrences(timestamp, recur, start, end):
+    '''
+    Yields each occurrence, from 'start' up to 'end', of an offering at
+    'timestamp' recurring as 'recur', keeping its wall clock time in the
+    current time zone.
+    '''
+    local = timezone.localtime(timestamp).replace(tzinfo=None)
+    start_local = timezone.localtime(start).replace(tzinfo=None)
+    if recur == DAILY:
+        count = (start_local - local).days - 1
+    elif recur == WEEKLY:
+        count = (start_local - local).days // 7 - 1
+    else:
+        count = (start_local.year - local.year) * 12 + start_local.month - local.month - 1
+    count = max(count, 0)
+
+    while True:
+        if recur == DAILY:
+            occurrence = local + datetime.timedelta(days=count)
+        elif recur == WEEKLY:
+            occurrence = local + datetime.timedelta(weeks=count)
+        else:
+            occurrence = add_local_months(local, count)
+        occurrence = timezone.make_aware(occurrence, is_dst=False)
+        if occurrence > end:
+            return
+        if occurrence >= start:
+            yield occurrence
+        count += 1
+
+
+def index_occurrences(apps, schema_editor):
+    '''
+    Indexes the upcoming occurrences of the recurring offerings already in
+    the database.
+    '''
+    Offering = apps.get_model('foodmap_app', 'Offering')
+    OfferingOccurrence = apps.get_model('foodmap_app', 'OfferingOccurrence')
+    now = timezone.now()
+    occurrences_to_index = []
+    for offering in Offering.objects.exclude(recur=None):
+        for timestamp in occurrences(offering.timestamp, offering.recur, now - MAX_AGE, now + OCCURRENCE_HORIZON):
+            if offering.recur_end_datetime is None or timestamp < offering.recur_end_datetime:
+                occurrences_to_index.append(OfferingOccurrence(offering_id=offering.id, timestamp=timestamp))
+    OfferingOccurrence.objects.bulk_create(occurrences_to_index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodmap_app', '0010_offering_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OfferingOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('offering', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='foodmap_app.Offering')),
+            ],
+        ),
+        migrations.RunPython(index_occurrences, migrations.RunPython.noop),
+    ]
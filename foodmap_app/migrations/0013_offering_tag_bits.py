@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Tags in the order of OfferingTag.TAG_CHOICES when this migration was
+# written, so each sets the same bit as it does there
+TAGS = ['vegetarian', 'vegan', 'kosher', 'gluten-free', 'peanut-free']
+
+# Number of offerings updated per query, below the number of query parameters
+# sqlite allows
+BATCH_SIZE = 500
+
+
+def fill_tag_bits(apps, schema_editor):
+    '''
+    Sets the tag bits of the offerings already in the database from their
+    OfferingTags, with one update for each batch of offerings with the same
+    tags.
+    '''
+    Offering = apps.get_model('foodmap_app', 'Offering')
+    OfferingTag = apps.get_model('foodmap_app', 'OfferingTag')
+    bits_by_offering = {}
+    for offering_id, tag in OfferingTag.objects.values_list('offering_id', 'tag').iterator():
+        if tag in TAGS:
+            bits_by_offering[offering_id] = bits_by_offering.get(offering_id, 0) | (1 << TAGS.index(tag))
+
+    offerings_by_bits = {}
+    for offering_id, bits in bits_by_offering.items():
+        offerings_by_bits.setdefault(bits, []).append(offering_id)
+    for bits, offering_ids in offerings_by_bits.items():
+        for start in range(0, len(offering_ids), BATCH_SIZE):
+            Offering.objects.filter(id__in=offering_ids[start:start + BATCH_SIZE]).update(tag_bits=bits)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodmap_app', '0012_joblock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offering',
+            name='tag_bits',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(fill_tag_bits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 13:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodmap_app', '0014_mailboxcursor'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='offering',
+            name='tag_bits',
+            field=models.IntegerField(db_index=True, default=0, editable=False),
+        ),
+    ]
@@ -41,7 +41,10 @@ class Offering(models.Model):
         ('M', 'Monthly')
     ]
 
-    timestamp = models.DateTimeField()
+    # Offerings are shown on the map until they are this old
+    MAX_AGE = datetime.timedelta(hours=2)
+
+    timestamp = models.DateTimeField(db_index=True)
     location = models.ForeignKey(Location, on_delete=models.CASCADE) # TODO: What does CASCADE mean? This is advised in the django tutorial
     title = models.CharField(max_length=TITLE_MAX_LENGTH)
     description = models.CharField(max_length=DESCRIPTION_MAX_LENGTH, default='')
@@ -50,6 +53,18 @@ class Offering(models.Model):
     recur = models.CharField(max_length=RECUR_MAX_LENGTH, null=True, choices=RECUR_CHOICES)
     recur_end_datetime = models.DateTimeField(null=True)
 
+    # The tags of the offering, as OfferingTag.get_bits() returns them. Kept
+    # in sync with its OfferingTags (see offering_tags.py), so they can be
+    # read and filtered on without querying the Offering Tags table. Not
+    # editable, since only OfferingTags set them (e.g. inline in the admin).
+    tag_bits = models.IntegerField(default=0, db_index=True, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(Offering, self).__init__(*args, **kwargs)
+        # The values of the fields in its row, as last loaded or saved (see
+        # from_db()). Empty until it is either.
+        self._loaded_values = {}
+
     def save(self, *args, **kwargs):
         '''
         Overrides default save method to validate attributes in greater depth
@@ -75,16 +90,36 @@ class Offering(models.Model):
             self.image.delete(save=False)
             raise e
 
+        # The saved fields are now in its row, as if they were loaded
+        update_fields = kwargs.get('update_fields')
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname not in deferred and (update_fields is None or field.name in update_fields):
+                self._loaded_values[field.attname] = getattr(self, field.attname)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        '''
+        Loads an offering as Django does, keeping the values of its row in
+        '_loaded_values' (by attribute name, without deferred fields), so
+        signal handlers can tell which fields a save changes.
+        '''
+        new = super(Offering, cls).from_db(db, field_names, values)
+        new._loaded_values = dict(zip(field_names, values))
+        return new
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        '''
+        Updates the row of the offering as Django does, but without its tag
+        bits, which only its OfferingTags set (see offering_tags.py). The ones
+        in memory may have been loaded before its tags changed. If the row is
+        not there, Django inserts it with all of its fields.
+        '''
+        values = [value for value in values if value[0].name != 'tag_bits']
+        return super(Offering, self)._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
 
     def __unicode__(self):
-        tags = OfferingTag.objects.filter(offering=self)
-        tag_str = ''
-        if len(tags) > 0:
-            for tag in tags:
-                tag_str += str(tag) + ', '
-            tag_str = tag_str[:-2] # remove lingering comma
-        else:
-            tag_str = 'None'
+        tag_str = ', '.join(OfferingTag.get_tags(self.tag_bits)) or 'None'
 
         s = '%s %s at %s.' % (str(self.timestamp), self.title, str(self.location))
         if self.recur != None:
@@ -125,6 +160,10 @@ class OfferingTag(models.Model):
         ('peanut-free', 'Peanut-Free')
     ]
 
+    # Maps each tag to the bit it sets in Offering.tag_bits. Only add tags at
+    # the end of TAG_CHOICES, so the bits of the others stay the same.
+    TAG_BITS = dict([(tag, 1 << i) for i, (tag, name) in enumerate(TAG_CHOICES)])
+
     offering = models.ForeignKey(Offering, on_delete=models.CASCADE)
     tag = models.CharField(max_length=TAG_MAX_LENGTH, choices=TAG_CHOICES)
 
@@ -141,3 +180,89 @@ class OfferingTag(models.Model):
     def __unicode__(self):
         return self.tag
 
+    @staticmethod
+    def get_bits(tags):
+        '''
+        Returns the bits of Offering.tag_bits for 'tags', a list of tags
+        (unknown ones are ignored).
+        '''
+        bits = 0
+        for tag in tags:
+            bits |= OfferingTag.TAG_BITS.get(tag, 0)
+        return bits
+
+    @staticmethod
+    def get_tags(bits):
+        '''
+        Returns the list of tags in 'bits', from Offering.tag_bits, in the
+        order of TAG_CHOICES.
+        '''
+        return [tag for tag, name in OfferingTag.TAG_CHOICES if bits & OfferingTag.TAG_BITS[tag]]
+
+
+
+class OfferingChange(models.Model):
+    '''
+    Represents the Offering Changes table, a log of changes to Offerings. A
+    row is added whenever an Offering, or one of its OfferingTags, is saved or
+    deleted. Ids only go up, so the id of the last change a client has seen
+    tells which offerings changed since then (see offerings_changes.py).
+    '''
+    offering_id = models.IntegerField() # not a ForeignKey, since the offering may have been deleted
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __unicode__(self):
+        return 'Offering %d changed at %s.' % (self.offering_id, str(self.timestamp))
+
+
+class OfferingOccurrence(models.Model):
+    '''
+    Represents the Offering Occurrences table, an index of the upcoming
+    occurrences of recurring Offerings. Recurring offerings are stored once,
+    as a rule (their first 'timestamp', 'recur' and 'recur_end_datetime'),
+    and each of their occurrences up to a horizon has a row here, so that the
+    ones on the map at any time can be looked up by timestamp (see
+    recurrence.py).
+    '''
+    offering = models.ForeignKey(Offering, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return 'Offering %d occurs at %s.' % (self.offering_id, str(self.timestamp))
+
+
+class JobLock(models.Model):
+    '''
+    Represents the Job Locks table, with a row for each job of the scheduler.
+    A scheduler holds a job's lock while 'locked_until' is in the future and
+    'owner' is its own, so that the same job does not run in two processes at
+    once (see scheduler.py).
+    '''
+    NAME_MAX_LENGTH = 50
+    OWNER_MAX_LENGTH = 32
+
+    name = models.CharField(max_length=NAME_MAX_LENGTH, unique=True)
+    owner = models.CharField(max_length=OWNER_MAX_LENGTH, default='')
+    locked_until = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return 'Job %s locked by %s until %s.' % (self.name, self.owner, str(self.locked_until))
+
+
+class MailboxCursor(models.Model):
+    '''
+    Represents the Mailbox Cursors table, with a row for each mailbox the
+    email scraper reads. 'history_id' is the Gmail history id the scraper has
+    read the mailbox up to, so that its next run only fetches the emails added
+    since (see scraper/pipeline.js). Written by the scraper, in the same
+    transaction as the offerings it read.
+    '''
+    MAILBOX_MAX_LENGTH = 254 # longest email address
+    HISTORY_ID_MAX_LENGTH = 20 # history ids are unsigned 64-bit integers
+
+    mailbox = models.CharField(max_length=MAILBOX_MAX_LENGTH, unique=True)
+    history_id = models.CharField(max_length=HISTORY_ID_MAX_LENGTH)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return 'Mailbox %s read up to history id %s at %s.' % (self.mailbox, self.history_id, str(self.timestamp))
@@ -0,0 +1,120 @@
+'''
+offering_tags.py
+
+Keeps the tags of each offering stored on the offering itself, as bits of
+Offering.tag_bits (see OfferingTag.get_bits()), so that reading an offering's
+tags does not query the Offering Tags table, and offerings can be filtered
+by tag with one indexed condition on the Offerings table.
+
+The bits of an offering are worked out again from its OfferingTags whenever
+one of them is saved or deleted through Django, and Offering.save() never
+writes them back for an offering already in the table, so an offering loaded
+before its tags changed does not undo the change. New offerings have no
+OfferingTags, so their bits are cleared if they were created with some (e.g.
+when copying an offering). Code that writes OfferingTags in bulk, without
+signals, should call update_bits() itself.
+'''
+
+from collections import defaultdict
+from django.db.models.signals import post_delete, post_save
+from foodmap_app.models import Offering, OfferingTag
+
+
+def get_mask(tags):
+    '''
+    Returns the bits of 'tags', a list of tag names, or raises ValueError if
+    one of them is not a tag.
+    '''
+    for tag in tags:
+        if tag not in OfferingTag.TAG_BITS:
+            raise ValueError('unknown tag \'%s\'' % tag)
+    return OfferingTag.get_bits(tags)
+
+
+def parse_tags(tags):
+    '''
+    Returns the bits of 'tags', comma-separated tag names as the views take
+    them (e.g. "vegan,kosher"), or raises ValueError if one of them is not a
+    tag.
+    '''
+    return get_mask([tag.strip() for tag in tags.split(',') if tag.strip() != ''])
+
+
+def has_tags(bits, mask):
+    '''
+    Checks whether 'bits', from Offering.tag_bits, has every tag in 'mask'.
+    '''
+    return bits & mask == mask
+
+
+def get_supersets(mask):
+    '''
+    Returns every value of Offering.tag_bits that has all of the tags in
+    'mask'. There are at most 2 to the power of the number of tags.
+    '''
+    return [bits for bits in range(0, 1 << len(OfferingTag.TAG_CHOICES)) if has_tags(bits, mask)]
+
+
+def filter_tags(queryset, mask, field='tag_bits'):
+    '''
+    Filters 'queryset' down to the offerings with every tag in 'mask', where
+    'field' is the path to their tag bits (e.g. 'offering__tag_bits' for
+    OfferingOccurrences). The condition is on the values the bits can take,
+    rather than on a bitwise AND, so the database can use the index on them.
+    '''
+    if mask == 0:
+        return queryset
+    return queryset.filter(**{field + '__in': get_supersets(mask)})
+
+
+def update_bits(offering_ids):
+    '''
+    Sets the tag bits of the offerings 'offering_ids' from their OfferingTags,
+    with one update for each value the bits take. Returns them, mapped from
+    the offerings' ids.
+    '''
+    bits_by_offering = dict([(offering_id, 0) for offering_id in offering_ids])
+    for offering_id, tag in OfferingTag.objects.filter(offering_id__in=offering_ids).values_list('offering_id', 'tag'):
+        bits_by_offering[offering_id] |= OfferingTag.get_bits([tag])
+
+    # Group offerings by their bits, so each distinct value takes a single
+    # UPDATE
+    offerings_by_bits = defaultdict(list)
+    for offering_id, bits in bits_by_offering.items():
+        offerings_by_bits[bits].append(offering_id)
+    for bits, ids in offerings_by_bits.items():
+        Offering.objects.filter(id__in=ids).update(tag_bits=bits)
+    return bits_by_offering
+
+
+def _update_offering(sender, instance, **kwargs):
+    '''
+    Sets the tag bits of the Offering of the OfferingTag 'instance', in the
+    database and on the Offering in memory, if the OfferingTag has it.
+    Connected to model signals.
+    '''
+    bits = update_bits([instance.offering_id])[instance.offering_id]
+    offering = getattr(instance, OfferingTag._meta.get_field('offering').get_cache_name(), None)
+    if offering is not None:
+        offering.tag_bits = bits
+
+
+def _clear_new_bits(sender, instance, created, raw=False, **kwargs):
+    '''
+    Clears the tag bits of the Offering 'instance' if it was just created with
+    some, since it has no OfferingTags yet. Connected to model signals.
+    '''
+    if raw or not created or instance.tag_bits == 0:
+        return # loading fixtures, which set the bits themselves, or nothing to clear
+    Offering.objects.filter(id=instance.id).update(tag_bits=0)
+    instance.tag_bits = 0
+
+
+def connect_signals():
+    '''
+    Sets the tag bits of an Offering whenever one of its OfferingTags is saved
+    or deleted, and clears them when the Offering is created.
+    '''
+    post_save.connect(_clear_new_bits, sender=Offering, dispatch_uid='offering_tags_save_Offering')
+    post_save.connect(_update_offering, sender=OfferingTag, dispatch_uid='offering_tags_save_OfferingTag')
+    post_delete.connect(_update_offering, sender=OfferingTag, dispatch_uid='offering_tags_delete_OfferingTag')
@@ -0,0 +1,239 @@
+'''
+offerings_cache.py
+
+Caches the offerings shown on the map, so that the /offerings/ view does not
+query the database on every poll. The cache holds a snapshot of the
+offerings grouped by location. Each offering's age in minutes is computed
+when the snapshot is read, so it stays accurate however old the snapshot is.
+
+Responses can be validated with an ETag computed from the offerings on the
+map, which does not change as their ages in minutes do (see get_etag()), and
+with the time the offerings on the map last changed (see
+get_last_modified()).
+
+The snapshot is dropped whenever an Offering or OfferingTag is saved or
+deleted through Django. The NodeJS scraper writes to the database directly,
+so snapshots also expire after OFFERINGS_CACHE_TIMEOUT seconds.
+
+Which cache is used is configured through Django's cache framework: the
+OFFERINGS_CACHE_ALIAS setting names one of the CACHES.
+'''
+
+import datetime
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from foodmap_app import coordinates, offering_tags, recurrence
+from foodmap_app.models import Offering, OfferingTag
+
+CACHE_KEY = 'foodmap_app:offerings:3' # changed whenever the format of snapshots does
+MODIFIED_CACHE_KEY = 'foodmap_app:offerings_modified:2'
+
+# How long to remember when the offerings on the map last changed
+MODIFIED_CACHE_TIMEOUT = 60 * 60 * 24 # seconds
+
+# Offerings are shown on the map until they are this old
+MAX_AGE = Offering.MAX_AGE
+
+DEFAULT_CACHE_ALIAS = 'default'
+DEFAULT_CACHE_TIMEOUT = 60 # seconds
+
+
+def _get_cache():
+    '''
+    Returns the cache that snapshots are stored in.
+    '''
+    return caches[getattr(settings, 'OFFERINGS_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+
+def _get_timeout():
+    '''
+    Returns how many seconds a snapshot is kept for.
+    '''
+    return getattr(settings, 'OFFERINGS_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def _digest(location, offering):
+    '''
+    Returns a hash of everything shown on the map for 'offering' at
+    'location', except its age in minutes.
+    '''
+    contents = [location['name'], location['lat'], location['lng'], offering['title'],
+        offering['description'], offering['timestamp'].isoformat(), offering['tags']]
+    return hashlib.sha1(json.dumps(contents).encode('utf-8')).hexdigest()
+
+
+def _is_live(offering, now):
+    '''
+    Checks whether 'offering', from a snapshot, is on the map at 'now'.
+    '''
+    return now - MAX_AGE <= offering['timestamp'] <= now
+
+
+def build_snapshot(now):
+    '''
+    Queries the database for every offering that is on the map at 'now', or
+    will be at some point before a snapshot taken at 'now' expires. Returns
+    them grouped by location:
+    [
+        {
+            "location": {"name": "Frist Campus Center", "lat": "12.3456789", "lng": "12.3456789"},
+            "offerings": [
+                {"title": "Pizza!", "description": "Come eat!", "timestamp": <datetime>, "tags": "kosher,gluten-free", "tag_bits": 12, "digest": "..."},
+                ...
+            ]
+        },
+        ...
+    ]
+    Locations are ordered by their most recent offering, and offerings at each
+    location from most to least recent. Each offering's digest identifies its
+    contents, including its location (see get_etag()). Each entry also has
+    its location in the compact version, as "compact_location" (see
+    coordinates.py).
+    '''
+    # Pull all offerings in the window, recurring ones at each of their
+    # occurrences. Their locations are joined in the same queries, and their
+    # tags are stored on them, so the number of queries does not grow with
+    # the number of offerings.
+    min_timestamp = now - MAX_AGE
+    max_timestamp = now + datetime.timedelta(seconds=_get_timeout())
+    offerings = recurrence.get_offerings_between(min_timestamp, max_timestamp)
+    table = coordinates.get_table()
+
+    # Accumulate list of offerings by location
+    snapshot = []
+    entries_by_location = {} # maps location ids to their entry in 'snapshot'
+    for timestamp, offering in offerings:
+        location = offering.location
+        if location.id not in entries_by_location:
+            entries_by_location[location.id] = {
+                'location': table.serialize(location),
+                'compact_location': table.serialize(location, version=2),
+                'offerings': []
+            }
+            snapshot.append(entries_by_location[location.id])
+
+        # Get this offering's tags, format into comma-separated list
+        entry = {
+            'title': offering.title,
+            'description': offering.description,
+            'timestamp': timestamp,
+            'tags': ','.join(OfferingTag.get_tags(offering.tag_bits)),
+            'tag_bits': offering.tag_bits
+        }
+        entry['digest'] = _digest(entries_by_location[location.id]['location'], entry)
+        entries_by_location[location.id]['offerings'].append(entry)
+
+    return snapshot
+
+
+def get_snapshot(now):
+    '''
+    Returns the cached snapshot of offerings, building and caching a new one
+    if there is none.
+    '''
+    cache = _get_cache()
+    snapshot = cache.get(CACHE_KEY)
+    if snapshot is None:
+        snapshot = build_snapshot(now)
+        cache.set(CACHE_KEY, snapshot, _get_timeout())
+    return snapshot
+
+
+def warm(now):
+    '''
+    Builds a fresh snapshot of offerings and caches it, so that requests do
+    not have to.
+    '''
+    _get_cache().set(CACHE_KEY, build_snapshot(now), _get_timeout())
+
+
+def filter_tags(snapshot, tag_mask):
+    '''
+    Returns the entries of 'snapshot' with only the offerings that have every
+    tag in 'tag_mask' (see offering_tags.py), leaving out locations left
+    without offerings.
+    '''
+    if tag_mask == 0:
+        return snapshot
+    filtered = []
+    for entry in snapshot:
+        offerings = [offering for offering in entry['offerings'] if offering_tags.has_tags(offering['tag_bits'], tag_mask)]
+        if len(offerings) > 0:
+            filtered.append(dict(entry, offerings=offerings))
+    return filtered
+
+
+def render(snapshot, now, version=coordinates.DEFAULT_VERSION):
+    '''
+    Formats 'snapshot' for the /offerings/ view as of 'now': drops offerings
+    that are not on the map at 'now' (and locations left without offerings),
+    and replaces each offering's timestamp with its age in minutes. Locations
+    are formatted in 'version' (see coordinates.py).
+    '''
+    location_key = 'location' if version == 1 else 'compact_location'
+    response = []
+    for entry in snapshot:
+        offerings = [
+            {
+                'title': offering['title'],
+                'description': offering['description'],
+                'minutes': int((now - offering['timestamp']).seconds / 60),
+                'tags': offering['tags']
+            }
+            for offering in entry['offerings']
+            if _is_live(offering, now)
+        ]
+        if len(offerings) > 0:
+            response.append({'location': entry[location_key], 'offerings': offerings})
+    return response
+
+
+def get_etag(snapshot, now):
+    '''
+    Returns an entity tag for the offerings in 'snapshot' that are on the map
+    at 'now'. It only changes when offerings appear, disappear or change, not
+    as their ages in minutes go up.
+    '''
+    etag = hashlib.sha1()
+    for entry in snapshot:
+        for offering in entry['offerings']:
+            if _is_live(offering, now):
+                etag.update(offering['digest'].encode('utf-8'))
+    return etag.hexdigest()
+
+
+def get_last_modified(now):
+    '''
+    Returns when the offerings on the map last changed, as of 'now'. This
+    only ever moves forward: if the offerings go back to an earlier set, they
+    get a new time, so a client never gets a 304 for offerings it has not
+    seen. The whole map is compared, so it also holds for the parts of it
+    that views filter out.
+    '''
+    etag = get_etag(get_snapshot(now), now)
+    cache = _get_cache()
+    modified = cache.get(MODIFIED_CACHE_KEY)
+    if modified is None or modified['etag'] != etag:
+        # max(), in case another process has set a later time already
+        modified = {'etag': etag, 'time': max(now, modified['time']) if modified is not None else now}
+        cache.set(MODIFIED_CACHE_KEY, modified, MODIFIED_CACHE_TIMEOUT)
+    return modified['time']
+
+
+def invalidate(**kwargs):
+    '''
+    Drops the cached snapshot. Can be connected directly to model signals.
+    '''
+    _get_cache().delete(CACHE_KEY)
+
+
+def connect_signals():
+    '''
+    Drops the cached snapshot whenever an Offering or OfferingTag changes.
+    '''
+    for sender in [Offering, OfferingTag]:
+        post_save.connect(invalidate, sender=sender, dispatch_uid='offerings_cache_save_%s' % sender.__name__)
+        post_delete.connect(invalidate, sender=sender, dispatch_uid='offerings_cache_delete_%s' % sender.__name__)
@@ -0,0 +1,247 @@
+'''
+offerings_changes.py
+
+Computes what changed in the offerings on the map since a client last looked,
+for the /offerings/changes/ view, so the map only pulls again the tiles with
+changed offerings in them instead of every tile in view (see mapbuilder.js).
+Changes only say where each offering is: the tiles bring its details.
+
+Offerings on the map change in two ways:
+ - They are saved or deleted, or their tags are. Every such write adds a row
+   to the OfferingChange log, whose ids only go up.
+ - Time passes. Offerings appear on the map once their timestamp comes, and
+   drop off once they are MAX_AGE old, and recurring ones do so at each of
+   their occurrences. These are found with range queries on the offerings'
+   timestamps, and on the indexed occurrences of recurring ones.
+
+Clients are handed a cursor that records both: the id of the last change in
+the log, and the time it was handed out. The log is pruned of changes older
+than CHANGE_LOG_RETENTION (see prune()), so older cursors get the whole map
+back instead of a delta.
+
+Ids are handed out when changes are added, but changes are only seen once
+their transaction commits, which may be after a change with a larger id
+commits. So the cursor also records the ids below its own that were missing
+from the log among the last COMMIT_MARGIN of changes, and the next request
+looks for those again. A write that keeps its transaction open for longer
+than COMMIT_MARGIN can still be missed, so writes to the log are kept short
+(see ingest.write() and scraper/db.js).
+'''
+
+import calendar
+import datetime
+from django.db import connection
+from django.db.models import Max, Min
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from foodmap_app import coordinates, recurrence
+from foodmap_app.models import Offering, OfferingChange, OfferingOccurrence, OfferingTag
+from foodmap_app.offerings_cache import MAX_AGE
+
+# Changes are kept in the log for this long
+CHANGE_LOG_RETENTION = datetime.timedelta(days=1)
+
+# Changes missing from the log are looked for again for this long after the
+# changes around them were made, in case they were not committed yet
+COMMIT_MARGIN = datetime.timedelta(minutes=5)
+
+# Most missing changes a cursor records. Past this, the cursor goes back to
+# before the first of them instead, and the changes since are sent again.
+MAX_PENDING = 50
+
+
+def make_cursor(version, now, pending=()):
+    '''
+    Returns a cursor for a client that has seen every change up to the one
+    with id 'version' but those with ids in 'pending', and the offerings on
+    the map at 'now'.
+    '''
+    cursor = '%d:%d' % (version, calendar.timegm(now.utctimetuple()))
+    if len(pending) > 0:
+        cursor += ':' + '.'.join(str(change_id) for change_id in sorted(pending))
+    return cursor
+
+
+def parse_cursor(cursor):
+    '''
+    Returns the (version, time, pending ids) recorded in 'cursor', or None if
+    it is not a valid cursor.
+    '''
+    try:
+        parts = cursor.split(':')
+        if len(parts) not in (2, 3):
+            return None
+        version = int(parts[0])
+        timestamp = datetime.datetime.fromtimestamp(int(parts[1]), timezone.utc)
+        pending = [int(change_id) for change_id in parts[2].split('.')] if len(parts) == 3 else []
+    except (AttributeError, ValueError, OverflowError, OSError):
+        return None
+    if len(pending) > MAX_PENDING:
+        return None
+    return version, timestamp, pending
+
+
+def _get_cursor(version, now):
+    '''
+    Returns the cursor for a client that has seen the log up to the change
+    with id 'version', at 'now': with the ids below 'version' missing from the
+    last COMMIT_MARGIN of changes, which may not have been committed yet.
+    '''
+    first_recent_id = OfferingChange.objects.filter(timestamp__gte=now - COMMIT_MARGIN, id__lte=version) \
+        .aggregate(Min('id'))['id__min']
+    if first_recent_id is None:
+        return make_cursor(version, now)
+
+    # Missing ids are looked for from the last change before the recent ones
+    floor = OfferingChange.objects.filter(id__lt=first_recent_id).aggregate(Max('id'))['id__max']
+    if floor is None:
+        floor = first_recent_id - 1 # nothing older is left in the log to tell
+    seen = OfferingChange.objects.filter(id__gt=floor, id__lte=version)
+    missing = version - floor - seen.count()
+    if missing == 0:
+        return make_cursor(version, now)
+    if missing > MAX_PENDING:
+        return make_cursor(floor, now) # too many to list, so send the changes since the floor again
+    return make_cursor(version, now, set(range(floor + 1, version + 1)).difference(seen.values_list('id', flat=True)))
+
+
+def record(offering_ids):
+    '''
+    Adds a change to the log for each of 'offering_ids'. Use this after
+    writes that do not send model signals, such as QuerySet.update().
+    '''
+    OfferingChange.objects.bulk_create([OfferingChange(offering_id=offering_id)
+        for offering_id in offering_ids])
+
+
+def record_all(offerings, now):
+    '''
+    Adds a change at 'now' to the log for each offering in the QuerySet
+    'offerings', in a single query however many there are.
+    '''
+    sql, params = offerings.values_list('id').query.sql_with_params()
+    timestamp = OfferingChange._meta.get_field('timestamp').get_db_prep_value(now, connection)
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s, %s) SELECT changed.id, %%s FROM (%s) AS changed' % (
+            connection.ops.quote_name(OfferingChange._meta.db_table),
+            connection.ops.quote_name('offering_id'),
+            connection.ops.quote_name('timestamp'),
+            sql
+        ), (timestamp,) + tuple(params))
+
+
+def _record_offering(sender, instance, **kwargs):
+    '''
+    Logs a change to the Offering 'instance'. Connected to model signals.
+    '''
+    record([instance.id])
+
+
+def _record_offering_tag(sender, instance, **kwargs):
+    '''
+    Logs a change to the Offering of the OfferingTag 'instance'. Connected to
+    model signals.
+    '''
+    record([instance.offering_id])
+
+
+def connect_signals():
+    '''
+    Logs a change whenever an Offering or OfferingTag is saved or deleted.
+    '''
+    for sender, receiver in [(Offering, _record_offering), (OfferingTag, _record_offering_tag)]:
+        post_save.connect(receiver, sender=sender, dispatch_uid='offerings_changes_save_%s' % sender.__name__)
+        post_delete.connect(receiver, sender=sender, dispatch_uid='offerings_changes_delete_%s' % sender.__name__)
+
+
+def prune(now):
+    '''
+    Deletes changes older than CHANGE_LOG_RETENTION from the log.
+    '''
+    OfferingChange.objects.filter(timestamp__lt=now - CHANGE_LOG_RETENTION).delete()
+
+
+def _serialize(offering, table, format_version):
+    '''
+    Formats 'offering' for the /offerings/changes/ view: its id and the
+    coordinates of its location from 'table' (a coordinates.CoordinateTable)
+    in 'format_version'.
+    '''
+    location = table.serialize(offering.location, format_version)
+    return {'id': offering.id, 'lat': location['lat'], 'lng': location['lng']}
+
+
+def get_changes(cursor, now, format_version=coordinates.DEFAULT_VERSION, tag_mask=0):
+    '''
+    Returns the changes to the offerings on the map between the time of
+    'cursor' and 'now', with a new cursor to ask for the next changes with:
+    {
+        "cursor": "1234:1494086400",
+        "reset": false,
+        "updated": [{"id": 12, "lat": "12.3456789", "lng": "12.3456789"}, ...],
+        "removed": [10, 11, ...]
+    }
+    "updated" has the offerings that were added to the map or changed, most
+    recent first, with the coordinates of their locations, and "removed" the
+    ids of offerings that left it. Clients pull the rest of an offering with
+    the tiles it is in. If 'cursor'
+    is missing, invalid or too old, "reset" is true and "updated" has every
+    offering on the map instead.
+
+    Cursors are opaque to clients: one may also list the ids of changes
+    that were not committed yet when it was handed out (see COMMIT_MARGIN).
+    Updates and removals may be repeated from the last set of changes, so
+    clients should apply them by id. Locations are formatted in
+    'format_version' (see coordinates.py).
+
+    With a 'tag_mask' (see offering_tags.py), only offerings with all of its
+    tags count as on the map, so an offering whose tags change to not match
+    is removed.
+    '''
+    since = parse_cursor(cursor)
+    if since is not None and (now - since[1] > CHANGE_LOG_RETENTION or since[1] > now):
+        since = None # changes since then may have been pruned, or it was not handed out by us
+
+    live_offerings = recurrence.get_offerings_between(now - MAX_AGE, now, tag_mask)
+    table = coordinates.get_table()
+
+    if since is None:
+        version = OfferingChange.objects.aggregate(Max('id'))['id__max'] or 0
+        return {
+            'cursor': _get_cursor(version, now),
+            'reset': True,
+            'updated': [_serialize(offering, table, format_version) for timestamp, offering in live_offerings],
+            'removed': []
+        }
+
+    # Offerings that were written to since the cursor, whether or not they
+    # are still on the map
+    since_version, since_time, pending = since
+    version = OfferingChange.objects.filter(id__gt=since_version).aggregate(Max('id'))['id__max'] or since_version
+    changed_ids = set(OfferingChange.objects.filter(id__gt=since_version, id__lte=version)
+        .values_list('offering_id', flat=True))
+    if len(pending) > 0:
+        changed_ids.update(OfferingChange.objects.filter(id__in=pending).values_list('offering_id', flat=True))
+
+    # Offerings on the map that were changed, or whose time came, since the
+    # cursor. (The offerings on the map are few, so they are matched against
+    # the changes here rather than in the query, which there can be too many
+    # changes to list in, e.g. after expiry.)
+    updated = [(timestamp, offering) for timestamp, offering in live_offerings
+        if offering.id in changed_ids or timestamp > since_time]
+
+    # Offerings that were changed, or got too old, since the cursor, and are
+    # not on the map (e.g. deleted, or between occurrences)
+    removed = set(changed_ids)
+    removed.update(Offering.objects.filter(recur=None, timestamp__gte=since_time - MAX_AGE,
+        timestamp__lt=now - MAX_AGE).values_list('id', flat=True))
+    removed.update(OfferingOccurrence.objects.filter(timestamp__gte=since_time - MAX_AGE,
+        timestamp__lt=now - MAX_AGE).values_list('offering_id', flat=True))
+    removed.difference_update([offering.id for _, offering in live_offerings])
+
+    return {
+        'cursor': _get_cursor(version, now),
+        'reset': False,
+        'updated': [_serialize(offering, table, format_version) for timestamp, offering in updated],
+        'removed': sorted(removed)
+    }
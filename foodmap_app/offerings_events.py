@@ -0,0 +1,327 @@
+'''
+offerings_events.py
+
+Pushes events to the map as offerings are saved or deleted, through the
+/offerings/events/ stream of Server-Sent Events. Each event only tells the
+map which offering changed:
+
+    event: save
+    data: {"id": 12}
+
+and the map pulls the changes themselves from /offerings/changes/ (see
+offerings_changes.py), then pulls again only the tiles of the map they are
+in. So an event that is announced twice costs an extra request, and one that
+is dropped is picked up with the next one (or the map's poll every minute).
+
+Events come from two places:
+ - Model signals, once the transaction saving or deleting an Offering or
+   OfferingTag commits in this process.
+ - A ChangeLogWatcher, which tails the OfferingChange log while anyone is
+   listening. It picks up offerings written by the NodeJS scraper, which
+   writes to the database directly, or by other server processes.
+
+Both publish to a Broker, which fans each event out to every open stream.
+
+Each open stream holds on to a server thread, so the server must run with
+enough threads (see Procfile). Streams are closed after STREAM_DURATION, and
+browsers reconnect by themselves. At most OFFERINGS_EVENTS_MAX_STREAMS
+streams are open at once in each process, so that they cannot take every
+thread away from other requests; past that, and when OFFERINGS_EVENTS_ENABLED
+is False, clients are turned away and the map falls back to polling.
+'''
+
+import datetime
+import json
+import threading
+import time
+from Queue import Empty, Full, Queue
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from foodmap_app.models import Offering, OfferingChange, OfferingTag
+
+# Event names
+SAVE = 'save'
+DELETE = 'delete'
+
+# Events waiting to be sent on one stream. Once this many are waiting, newer
+# ones are dropped, since the waiting ones will fetch their changes anyway.
+QUEUE_SIZE = 100
+
+# A comment is sent on a stream after this many seconds without events, so
+# that proxies do not time it out
+HEARTBEAT_INTERVAL = 15
+
+# Streams are closed after this many seconds, so that threads are not held
+# forever by clients that went away
+STREAM_DURATION = 5 * 60
+
+# How long browsers wait before reconnecting to a closed stream
+RETRY_MILLISECONDS = 5000
+
+DEFAULT_POLL_INTERVAL = 2 # seconds
+
+# Streams open at once in each process, if OFFERINGS_EVENTS_MAX_STREAMS is not
+# set. Keep it well under the number of server threads (see Procfile).
+DEFAULT_MAX_STREAMS = 25
+
+# How long an offering announced by signals has its changes skipped by the
+# ChangeLogWatcher, if none of them are polled
+ANNOUNCED_DURATION = datetime.timedelta(minutes=1)
+
+
+class Broker(object):
+    '''
+    Fans out events to subscribers. Each subscriber gets a queue, which every
+    event published after it subscribed is put on. Safe to use from several
+    threads.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = set()
+
+    def subscribe(self, limit=None):
+        '''
+        Returns a new queue of the events published from now on, or None if
+        there are already 'limit' subscribers.
+        '''
+        queue = Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            if limit is not None and len(self._queues) >= limit:
+                return None
+            self._queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        '''
+        Stops publishing events to 'queue', from subscribe().
+        '''
+        with self._lock:
+            self._queues.discard(queue)
+
+    def has_subscribers(self):
+        '''
+        Checks whether anyone is subscribed.
+        '''
+        with self._lock:
+            return len(self._queues) > 0
+
+    def publish(self, name, data):
+        '''
+        Puts the event 'name', with the JSON-serializable 'data', on every
+        subscriber's queue.
+        '''
+        with self._lock:
+            queues = list(self._queues)
+        for queue in queues:
+            try:
+                queue.put_nowait((name, data))
+            except Full:
+                pass # the subscriber has not caught up with earlier events
+
+
+class ChangeLogWatcher(object):
+    '''
+    Publishes an event to 'broker' for each change added to the OfferingChange
+    log, checking for new ones periodically on a background thread. The
+    thread stops once the broker has no subscribers.
+    '''
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._lock = threading.Lock()
+        self._thread = None
+        self._announced = {} # offering id -> when it was last announced by signals
+
+    def start(self, interval):
+        '''
+        Starts checking the log for changes every 'interval' seconds, unless
+        it is already being watched.
+        '''
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='ChangeLogWatcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def skip(self, offering_id):
+        '''
+        Skips the changes logged for 'offering_id' up to now, since they were
+        committed and announced already.
+        '''
+        with self._lock:
+            if self._thread is not None:
+                self._announced[offering_id] = timezone.now()
+
+    def poll(self, last_id):
+        '''
+        Publishes an event for each offering changed in the log after the
+        change with id 'last_id', unless it was already announced. Returns the
+        id of the last change in the log.
+
+        Only the announcements covering the changes polled are used up, so
+        ones made while polling still skip their changes in the next poll.
+        Announcements older than ANNOUNCED_DURATION are dropped, as their
+        changes were polled before they were made.
+        '''
+        changes = list(OfferingChange.objects.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'offering_id', 'timestamp'))
+        now = timezone.now()
+        with self._lock:
+            offering_ids = set()
+            announced_ids = set()
+            for change_id, offering_id, timestamp in changes:
+                announced = self._announced.get(offering_id)
+                if announced is not None and timestamp <= announced:
+                    announced_ids.add(offering_id)
+                else:
+                    offering_ids.add(offering_id)
+            for offering_id, announced in self._announced.items():
+                if offering_id in announced_ids or announced < now - ANNOUNCED_DURATION:
+                    del self._announced[offering_id]
+        if len(changes) == 0:
+            return last_id
+
+        existing_ids = set(Offering.objects.filter(id__in=offering_ids).values_list('id', flat=True))
+        for offering_id in sorted(offering_ids):
+            self.broker.publish(SAVE if offering_id in existing_ids else DELETE, {'id': offering_id})
+        return changes[-1][0]
+
+    def _run(self, interval):
+        try:
+            last_id = OfferingChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            while True:
+                time.sleep(interval)
+                if not self.broker.has_subscribers():
+                    break
+                last_id = self.poll(last_id)
+        finally:
+            with self._lock:
+                self._thread = None
+                self._announced = {}
+            connection.close() # this thread's connection is not closed by Django
+
+
+broker = Broker()
+watcher = ChangeLogWatcher(broker)
+
+
+def is_enabled():
+    '''
+    Checks whether the stream of events is turned on.
+    '''
+    return getattr(settings, 'OFFERINGS_EVENTS_ENABLED', True)
+
+
+def get_max_streams():
+    '''
+    Returns how many streams may be open at once in this process.
+    '''
+    return getattr(settings, 'OFFERINGS_EVENTS_MAX_STREAMS', DEFAULT_MAX_STREAMS)
+
+
+def watch():
+    '''
+    Starts watching the OfferingChange log for changes made outside of this
+    process, every OFFERINGS_EVENTS_POLL_INTERVAL seconds. Does nothing if
+    that setting is 0.
+    '''
+    interval = getattr(settings, 'OFFERINGS_EVENTS_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    if interval:
+        watcher.start(interval)
+
+
+def format_event(name, data):
+    '''
+    Formats an event to be sent on a stream of Server-Sent Events.
+    '''
+    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data))
+
+
+class Stream(object):
+    '''
+    Iterates over the events put on 'queue', a subscription to 'broker',
+    formatted as Server-Sent Events, for 'duration' seconds, with a heartbeat
+    every 'heartbeat' seconds without events. Unsubscribes once it ends or is
+    closed, even if it was never iterated over (e.g. the client went away
+    before the response started).
+    '''
+
+    def __init__(self, broker, queue, heartbeat, duration):
+        self.broker = broker
+        self.queue = queue
+        self._chunks = self._generate(heartbeat, duration)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+        self.broker.unsubscribe(self.queue)
+
+    def _generate(self, heartbeat, duration):
+        yield 'retry: %d\n\n' % RETRY_MILLISECONDS
+        deadline = time.time() + duration
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                name, data = self.queue.get(timeout=min(heartbeat, remaining))
+            except Empty:
+                yield ': keep-alive\n\n'
+                continue
+            yield format_event(name, data)
+        self.broker.unsubscribe(self.queue)
+
+
+def stream(broker, heartbeat=HEARTBEAT_INTERVAL, duration=STREAM_DURATION, limit=None):
+    '''
+    Subscribes to 'broker' and returns a Stream of the events published to it
+    from now on, for 'duration' seconds, or None if 'broker' already has
+    'limit' subscribers.
+    '''
+    queue = broker.subscribe(limit)
+    if queue is None:
+        return None
+    return Stream(broker, queue, heartbeat, duration)
+
+
+def _publish_on_commit(name, offering_id):
+    '''
+    Publishes the event 'name' for 'offering_id' to the broker once the
+    current transaction commits.
+    '''
+    def publish():
+        watcher.skip(offering_id)
+        broker.publish(name, {'id': offering_id})
+    transaction.on_commit(publish)
+
+
+def _offering_saved(sender, instance, **kwargs):
+    _publish_on_commit(SAVE, instance.id)
+
+
+def _offering_deleted(sender, instance, **kwargs):
+    _publish_on_commit(DELETE, instance.id)
+
+
+def _offering_tag_changed(sender, instance, **kwargs):
+    _publish_on_commit(SAVE, instance.offering_id)
+
+
+def connect_signals():
+    '''
+    Publishes an event whenever an Offering or OfferingTag is saved or
+    deleted.
+    '''
+    post_save.connect(_offering_saved, sender=Offering, dispatch_uid='offerings_events_save_Offering')
+    post_delete.connect(_offering_deleted, sender=Offering, dispatch_uid='offerings_events_delete_Offering')
+    post_save.connect(_offering_tag_changed, sender=OfferingTag, dispatch_uid='offerings_events_save_OfferingTag')
+    post_delete.connect(_offering_tag_changed, sender=OfferingTag, dispatch_uid='offerings_events_delete_OfferingTag')
@@ -0,0 +1,196 @@
+'''
+recurrence.py
+
+Expands recurring offerings into their occurrences. A recurring offering is
+stored once, as a rule: its first 'timestamp', how it recurs ('recur', one of
+Offering.RECUR_CHOICES) and, optionally, when it stops ('recur_end_datetime',
+which no occurrence reaches).
+
+The occurrences of each recurring offering up to OCCURRENCE_HORIZON from now
+are kept in the OfferingOccurrence table, so that the recurring offerings on
+the map at any time are found with a range query on its indexed timestamps,
+like offerings that do not recur. The index is rebuilt for an offering
+whenever it is saved through Django with a new timestamp or recurrence, and
+extended for all of them by extend_index(), which the scheduler runs (see
+scheduler.py).
+
+Date arithmetic works on the wall clock time in the current time zone, so
+occurrences keep their time of day across daylight saving time changes.
+'''
+
+import calendar
+import datetime
+from django.db.models import Max, Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+from foodmap_app import offering_tags
+from foodmap_app.models import Offering, OfferingOccurrence
+
+DAILY = Offering.RECUR_CHOICES[0][0]
+WEEKLY = Offering.RECUR_CHOICES[1][0]
+MONTHLY = Offering.RECUR_CHOICES[2][0]
+
+# Occurrences are indexed this far ahead. extend_index() must run more often
+# than this, or later occurrences are missing from the map.
+OCCURRENCE_HORIZON = datetime.timedelta(days=7)
+
+# The fields of an offering that its occurrences are worked out from
+INDEXED_FIELDS = ('timestamp', 'recur', 'recur_end_datetime')
+
+
+def _local(timestamp):
+    '''
+    Returns the wall clock time of 'timestamp' in the current time zone, as a
+    naive datetime.
+    '''
+    return timezone.localtime(timestamp).replace(tzinfo=None)
+
+
+def _aware(local):
+    '''
+    Returns the naive wall clock time 'local' in the current time zone.
+    '''
+    return timezone.make_aware(local, is_dst=False)
+
+
+def _add_local_months(local, months):
+    month_index = local.month - 1 + months
+    year = local.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(local.day, calendar.monthrange(year, month)[1])
+    return local.replace(year=year, month=month, day=day)
+
+
+def occurrences(timestamp, recur, start, end=None):
+    '''
+    Yields each occurrence, from 'start' up to 'end' (both included, and
+    'end' only if given), of an offering at 'timestamp' recurring as 'recur'.
+    The first occurrence is 'timestamp' itself. Occurrences are always
+    counted from 'timestamp', so that monthly ones do not drift to earlier
+    days once they hit a short month.
+    '''
+    local = _local(timestamp)
+    start_local = _local(start)
+
+    # Start counting from an occurrence that is surely not after 'start', so
+    # that offerings that started long ago do not take many steps
+    if recur == DAILY:
+        count = (start_local - local).days - 1
+    elif recur == WEEKLY:
+        count = (start_local - local).days // 7 - 1
+    elif recur == MONTHLY:
+        count = (start_local.year - local.year) * 12 + start_local.month - local.month - 1
+    else:
+        raise ValueError('unknown recurrence \'%s\'' % recur)
+    count = max(count, 0)
+
+    while True:
+        if recur == DAILY:
+            occurrence = _aware(local + datetime.timedelta(days=count))
+        elif recur == WEEKLY:
+            occurrence = _aware(local + datetime.timedelta(weeks=count))
+        else:
+            occurrence = _aware(_add_local_months(local, count))
+        if end is not None and occurrence > end:
+            return
+        if occurrence >= start:
+            yield occurrence
+        count += 1
+
+
+def _get_occurrences(offering, start, end):
+    '''
+    Returns an OfferingOccurrence for each occurrence of the recurring
+    'offering' between 'start' and 'end', before its end date.
+    '''
+    return [OfferingOccurrence(offering_id=offering.id, timestamp=timestamp)
+        for timestamp in occurrences(offering.timestamp, offering.recur, start, end)
+        if offering.recur_end_datetime is None or timestamp < offering.recur_end_datetime]
+
+
+def index_offering(offering, now):
+    '''
+    Replaces the indexed occurrences of 'offering' with the ones from those
+    on the map at 'now' up to OCCURRENCE_HORIZON, if it recurs.
+    '''
+    OfferingOccurrence.objects.filter(offering_id=offering.id).delete()
+    if offering.recur is not None:
+        OfferingOccurrence.objects.bulk_create(
+            _get_occurrences(offering, now - Offering.MAX_AGE, now + OCCURRENCE_HORIZON))
+
+
+def extend_index(now):
+    '''
+    Indexes the occurrences of every recurring offering up to
+    OCCURRENCE_HORIZON from 'now', after the last one already indexed.
+    Returns the number of occurrences added.
+    '''
+    min_timestamp = now - Offering.MAX_AGE
+    indexed_until = dict(OfferingOccurrence.objects.values('offering_id').annotate(Max('timestamp'))
+        .values_list('offering_id', 'timestamp__max'))
+    recurring = Offering.objects.exclude(recur=None) \
+        .filter(Q(recur_end_datetime=None) | Q(recur_end_datetime__gt=min_timestamp)) \
+        .only('id', 'timestamp', 'recur', 'recur_end_datetime')
+
+    new_occurrences = []
+    for offering in recurring:
+        start = min_timestamp
+        if offering.id in indexed_until:
+            start = max(start, indexed_until[offering.id] + datetime.timedelta(microseconds=1))
+        new_occurrences.extend(_get_occurrences(offering, start, now + OCCURRENCE_HORIZON))
+    OfferingOccurrence.objects.bulk_create(new_occurrences)
+    return len(new_occurrences)
+
+
+def prune_index(before):
+    '''
+    Drops the indexed occurrences earlier than 'before', in a single query
+    (occurrences have no signals or related rows for Django to collect).
+    '''
+    OfferingOccurrence.objects.filter(timestamp__lt=before).delete()
+
+
+def get_offerings_between(start, end, tag_mask=0):
+    '''
+    Returns (timestamp, offering) for each time an offering occurs between
+    'start' and 'end', latest first: offerings that do not recur at their
+    timestamp, and recurring ones at each of their indexed occurrences. Only
+    offerings with every tag in 'tag_mask' (see offering_tags.py) are
+    returned. Offerings come with their locations, fetched in a fixed number
+    of queries however many there are. (Their tags are stored on them.)
+    '''
+    single = Offering.objects.filter(recur=None, timestamp__gte=start, timestamp__lte=end) \
+        .select_related('location')
+    recurring = OfferingOccurrence.objects.filter(timestamp__gte=start, timestamp__lte=end) \
+        .select_related('offering__location')
+    single = offering_tags.filter_tags(single, tag_mask)
+    recurring = offering_tags.filter_tags(recurring, tag_mask, 'offering__tag_bits')
+
+    result = [(offering.timestamp, offering) for offering in single]
+    result.extend([(occurrence.timestamp, occurrence.offering) for occurrence in recurring])
+    result.sort(key=lambda pair: pair[0], reverse=True)
+    return result
+
+
+def _index_offering(sender, instance, created, **kwargs):
+    '''
+    Rebuilds the index of the Offering 'instance', if it was just created
+    recurring, or if a field its occurrences depend on changed since it was
+    loaded or last saved. Connected to model signals.
+    '''
+    if created:
+        if instance.recur is None:
+            return # it has no occurrences to clear or add
+    else:
+        loaded = instance._loaded_values
+        if all([field in loaded and loaded[field] == getattr(instance, field) for field in INDEXED_FIELDS]):
+            return
+    index_offering(instance, timezone.now())
+
+
+def connect_signals():
+    '''
+    Rebuilds the indexed occurrences of an Offering whenever it is saved
+    with a new timestamp or recurrence. (Deleting an Offering deletes them along with it.)
+    '''
+    post_save.connect(_index_offering, sender=Offering, dispatch_uid='recurrence_save_Offering')
@@ -0,0 +1,244 @@
+'''
+scheduler.py
+
+Runs maintenance jobs at regular intervals inside a long-running worker
+process, started with:
+
+    python manage.py runscheduler
+
+so that they do not pay for starting Django on every run, and can run often
+enough that expired offerings leave the map promptly. The jobs are:
+ - expiry: deletes offerings that are too old to be on the map, and prunes
+   the change log (see expiry.py and offerings_changes.py).
+ - recurrence: indexes upcoming occurrences of recurring offerings, and drops
+   old ones (see recurrence.py).
+ - warm_cache: caches a fresh snapshot of the offerings on the map, so that
+   requests do not have to build one (see offerings_cache.py). This only
+   helps if the cache is shared with the server processes.
+
+How often each job runs is set by SCHEDULER_INTERVALS, in seconds. Each wait
+varies at random by up to SCHEDULER_JITTER of it, so that schedulers started
+together do not keep running jobs at the same moment.
+
+A job only runs while its scheduler holds the job's JobLock row, so it does
+not run twice at once, however many schedulers there are (e.g. while a
+deployment restarts the worker, or when delete_old_offerings.py runs from
+cron). A lock is held until the job finishes, or for SCHEDULER_LOCK_TIMEOUT
+seconds if its scheduler dies first.
+'''
+
+import datetime
+import random
+import time
+import traceback
+import uuid
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from foodmap_app import expiry, offerings_cache, offerings_changes, recurrence
+from foodmap_app.models import JobLock
+from foodmap_app.offerings_cache import MAX_AGE
+
+DEFAULT_INTERVALS = {
+    'expiry': 60,
+    'recurrence': 60 * 60,
+    'warm_cache': None,
+}
+DEFAULT_JITTER = 0.1
+DEFAULT_LOCK_TIMEOUT = 10 * 60 # seconds
+
+
+def expire(now):
+    '''
+    Deletes expired offerings, and changes that no client needs anymore.
+    '''
+    expired = expiry.expire_offerings(now)
+    offerings_changes.prune(now)
+    return '%d offerings expired' % expired
+
+
+def index_recurrences(now):
+    '''
+    Indexes upcoming occurrences of recurring offerings. Past occurrences are
+    kept for as long as changes are, so that clients following the change
+    log still see them leave the map.
+    '''
+    recurrence.prune_index(now - MAX_AGE - offerings_changes.CHANGE_LOG_RETENTION)
+    indexed = recurrence.extend_index(now)
+    if indexed > 0:
+        offerings_cache.invalidate()
+    return '%d occurrences indexed' % indexed
+
+
+def warm_cache(now):
+    '''
+    Caches a fresh snapshot of the offerings on the map.
+    '''
+    offerings_cache.warm(now)
+    return 'cache warmed'
+
+
+# Functions run by each job, by name. Each takes the current time, and
+# returns a summary of what it did.
+JOB_FUNCTIONS = {
+    'expiry': expire,
+    'recurrence': index_recurrences,
+    'warm_cache': warm_cache,
+}
+
+
+def acquire_lock(name, owner, now, timeout):
+    '''
+    Takes the lock of the job 'name' for 'owner' until 'timeout' seconds
+    after 'now', unless someone else holds it. Returns whether it was taken.
+    '''
+    JobLock.objects.get_or_create(name=name, defaults={'locked_until': now})
+    until = now + datetime.timedelta(seconds=timeout)
+    return JobLock.objects.filter(name=name, locked_until__lte=now).update(owner=owner, locked_until=until) == 1
+
+
+def release_lock(name, owner, now):
+    '''
+    Gives up the lock of the job 'name', if 'owner' holds it.
+    '''
+    JobLock.objects.filter(name=name, owner=owner).update(locked_until=now)
+
+
+class Job(object):
+    '''
+    A function run by the scheduler every 'interval' seconds, with timings of
+    its runs.
+    '''
+
+    def __init__(self, name, function, interval):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0 # times it was due but running elsewhere
+        self.last_seconds = 0.0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds):
+        '''
+        Records a run that took 'seconds'.
+        '''
+        self.runs += 1
+        self.last_seconds = seconds
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def mean_seconds(self):
+        return self.total_seconds / self.runs if self.runs > 0 else 0.0
+
+    def format_timings(self):
+        return 'runs %d, failures %d, skipped %d, last %.3f s, mean %.3f s, max %.3f s' % (self.runs,
+            self.failures, self.skipped, self.last_seconds, self.mean_seconds(), self.max_seconds)
+
+
+def get_jobs(names=None):
+    '''
+    Returns the jobs that SCHEDULER_INTERVALS gives an interval, or those
+    named in 'names' whatever their interval.
+    '''
+    intervals = getattr(settings, 'SCHEDULER_INTERVALS', DEFAULT_INTERVALS)
+    if names is None:
+        names = sorted([name for name in JOB_FUNCTIONS if intervals.get(name) is not None])
+    for name in names:
+        if name not in JOB_FUNCTIONS:
+            raise ValueError('unknown job \'%s\'' % name)
+    return [Job(name, JOB_FUNCTIONS[name], intervals.get(name)) for name in names]
+
+
+class Scheduler(object):
+    '''
+    Runs 'jobs' when they are due, writing a line about each run to 'out'.
+    '''
+
+    def __init__(self, jobs, out, jitter=None, lock_timeout=None, rng=None, clock=time.time, sleep=time.sleep,
+        acquire=acquire_lock, release=release_lock):
+        self.jobs = jobs
+        self.out = out
+        self.jitter = jitter if jitter is not None else getattr(settings, 'SCHEDULER_JITTER', DEFAULT_JITTER)
+        self.lock_timeout = lock_timeout if lock_timeout is not None \
+            else getattr(settings, 'SCHEDULER_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self.sleep = sleep
+        self.acquire = acquire
+        self.release = release
+        self.owner = uuid.uuid4().hex
+        self.next_runs = dict([(job.name, clock()) for job in jobs]) # all due at start
+
+    def get_delay(self, job):
+        '''
+        Returns how many seconds to wait before running 'job' again.
+        '''
+        return job.interval * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def run_job(self, job):
+        '''
+        Runs 'job' now, unless it is running elsewhere. Failures, including
+        failures to take or give up its lock (e.g. when the database drops the
+        connection), are written to 'out' rather than raised, so that one job
+        does not stop the others.
+        '''
+        try:
+            acquired = self.acquire(job.name, self.owner, timezone.now(), self.lock_timeout)
+        except Exception:
+            job.failures += 1
+            self.out.write('%s: failed to lock, not run\n%s' % (job.name, traceback.format_exc()))
+            return
+        if not acquired:
+            job.skipped += 1
+            self.out.write('%s: skipped, running elsewhere' % job.name)
+            return
+
+        start = self.clock()
+        release_error = None
+        try:
+            summary = job.function(timezone.now())
+        except Exception:
+            job.failures += 1
+            summary = 'failed\n%s' % traceback.format_exc()
+        finally:
+            job.record(self.clock() - start)
+            try:
+                self.release(job.name, self.owner, timezone.now())
+            except Exception:
+                release_error = traceback.format_exc()
+        if release_error is not None:
+            # The lock is given up anyway once it times out
+            job.failures += 1
+            summary += ', then failed to unlock\n%s' % release_error
+        self.out.write('%s: %s in %.3f s (%s)' % (job.name, summary, job.last_seconds, job.format_timings()))
+
+    def run_all(self):
+        '''
+        Runs every job once.
+        '''
+        for job in self.jobs:
+            self.run_job(job)
+
+    def run_pending(self):
+        '''
+        Runs the jobs that are due, and schedules their next runs. Returns how
+        many seconds until the next one is due.
+        '''
+        for job in self.jobs:
+            if self.next_runs[job.name] <= self.clock():
+                self.run_job(job)
+                self.next_runs[job.name] = self.clock() + self.get_delay(job)
+        return max(min(self.next_runs.values()) - self.clock(), 0)
+
+    def run_forever(self):
+        '''
+        Runs jobs as they come due, until the process is stopped.
+        '''
+        while True:
+            # Drop connections that the database closed, or that are too old
+            # to keep, as Django does between requests
+            close_old_connections()
+            self.sleep(self.run_pending())
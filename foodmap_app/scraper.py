@@ -2,26 +2,40 @@
 scraper.py
 Author: Michael Friedman
 
-This is a Python interface into the NodeJS scraper, for the purpose of using
-Python to request that something be scraped.
+This is a Python interface into the scraper, for the purpose of using Python
+to request that something be scraped. Food extraction runs in this process
+through the native port of the NodeJS scraper in extractor.py.
 '''
 
-import os
-import sys
-from foodmap_proj.settings.common import BASE_DIR
-from subprocess import Popen, PIPE
+from foodmap_app import extractor
 
 def get_food(text):
     '''
     Get all foods that are in 'text'. Return them in a string as a
     comma-separated list, with the first letter of the each food capitalized.
     '''
-    # Start new process for NodeJS scraper. Pipe stdin/stdout between this
-    # process and the NodeJS process to send data between them.
-    node_program_name = ['node', os.path.join(BASE_DIR, 'scraper/scrapeFood.js')]
-    node_process = Popen(node_program_name, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    output, err = node_process.communicate(input=text)
-    if err != '':
-        print >> sys.stderr, err
-        return '' # something went wrong, so bail
-    return output
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return ', '.join(extractor.get_food_extractor().get_food(text))
+
+def get_location(text):
+    '''
+    Get the location mentioned in 'text'. Return the official name of the
+    location, or the empty string if no location was found.
+    '''
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return extractor.get_location_extractor().get_location(text)
+
+def get_food_batch(texts):
+    '''
+    Get all foods in each text of 'texts', an iterable of texts. Yields one
+    string per text, in order, formatted like the result of get_food(). All of
+    the texts go through the same extractor, so the food dictionary is only
+    loaded once.
+    '''
+    food_extractor = extractor.get_food_extractor()
+    for text in texts:
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        yield ', '.join(food_extractor.get_food(text))
@@ -32,91 +32,216 @@
 
     /*------------------------------------------------------------------------*/
 
-    // Pull latest offerings from database, store in 'offerings'
+    // Pull the offerings in view from the database, a tile at a time, store
+    // in 'tiles'. Locations close together at the map's zoom level come
+    // grouped into clusters.
 
-    function pullOfferings() {
-        var offerings = {
-            "type": "FeatureCollection",
-            "features": [],
-            "error": false   // this is set to true to indicate a failure to retrieve offerings
+    // Offerings are asked for by the tile, at this many zoom levels out from
+    // the map's, so that a few tiles cover the map
+    var TILE_ZOOM_OFFSET = 2;
+
+    var tiles = {};       // tiles pulled, as returned by the /offerings/clusters/ url, plus the map's zoom level, their edges, ETag and when they were received
+    var staleTiles = {};  // tiles dropped since the last ones arrived, shown until their replacements do
+    var pending = 0;      // number of tiles being pulled
+    var shownZoom = map.getZoom();  // zoom level of the tiles shown, which is the map's once its tiles have all arrived
+
+    // Helper function: Returns the key of a tile in 'tiles', for the map at
+    // 'zoom'.
+    function tileKey(zoom, x, y) {
+        return zoom + '/' + x + '/' + y;
+    }
+
+    // Helper function: Returns the column and row, as floats, of the tile at
+    // 'zoom' that 'latlng' is on (Web Mercator tiles, as the map uses).
+    function tilePosition(latlng, zoom) {
+        var lat = Math.max(-85.0511, Math.min(85.0511, latlng.lat)) * Math.PI / 180;
+        var count = Math.pow(2, zoom);  // tiles across the world
+        return {
+            x: (latlng.lng + 180) / 360 * count,
+            y: (1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * count
         };
+    }
 
-        // Helper function: Returns HTML that formats the *popup* content for
-        // 'entry', where 'entry' is one of the objects returned by the
-        // /offerings/ url. Places this HTML inside a div.popup-content.
-        function makePopupContent(entry) {
-            popupContent = '<div class="popup-content"><b>' + entry.location.name + '</b>';
-            for (var i = 0; i < entry.offerings.length; i++) {
-                // Append a <p> for each offering. Only show minutes and title
-                minutes_string = (entry.offerings[i].minutes > 60? '1 hour, '+(entry.offerings[i].minutes-60): entry.offerings[i].minutes) + (entry.offerings[i].minutes%60 == 1? ' minute old': ' minutes old');
-                popupContent += '<p><i>' + entry.offerings[i].title + '</i><br>' + minutes_string + '</p>';
-            }
-            return popupContent;
+    // Helper function: Returns the edges of a tile, in the order of the 'bbox'
+    // parameter of the /offerings/clusters/ url: [west, south, east, north].
+    function tileBBox(zoom, x, y) {
+        var count = Math.pow(2, zoom);  // tiles across the world
+        function lat(row) {
+            return Math.atan(Math.sinh(Math.PI * (1 - 2 * row / count))) * 180 / Math.PI;
         }
+        return [x / count * 360 - 180, lat(y + 1), (x + 1) / count * 360 - 180, lat(y)];
+    }
+
+    // Helper function: Drops the tile with 'key' from 'tiles', so that it is
+    // pulled again. It is shown until its replacement arrives, unless it was
+    // still pending.
+    function dropTile(key) {
+        if (!tiles[key].pending) {
+            staleTiles[key] = tiles[key];
+        }
+        delete tiles[key];
+    }
+
+    // Helper function: Shows the tiles for the map's zoom level once none
+    // are being pulled, and drops the stale ones.
+    function onTilesPulled() {
+        if (pending == 0) {
+            staleTiles = {};
+            shownZoom = map.getZoom();
+        }
+    }
 
-        // Helper function: Returns HTML that formats the *sidebar* content for
-        // 'entry', where 'entry' is one of the objects returned by the
-        // /offerings/ url. Places this HTML inside a div.sidebar-content.
-        function makeSidebarContent(entry) {
-            sidebarContent = '<div class="sidebar-content"><b>' + entry.location.name + '</b>';
-            for (var i = 0; i < entry.offerings.length; i++) {
-                // Append two <p>'s for each offering: one for minutes and title, one for description.
-                minutes_string = (entry.offerings[i].minutes > 60? '1 hour, '+(entry.offerings[i].minutes-60): entry.offerings[i].minutes) + (entry.offerings[i].minutes%60 == 1? ' minute old': ' minutes old');
-                sidebarContent += '<p><i>' + entry.offerings[i].title + '</i><br>' + minutes_string + '</p>';
-                sidebarContent += '<p>' + entry.offerings[i].description + '</p><hr>';
+    // Pulls the offerings of the tiles in view that are not in 'tiles' yet,
+    // and updates the markers as they arrive. Tiles already pulled are not
+    // asked for again until they are dropped (see refresh() and
+    // applyChanges()).
+    function pullTiles() {
+        var mapZoom = map.getZoom();
+        var zoom = Math.max(mapZoom - TILE_ZOOM_OFFSET, 0);
+        var bounds = map.getBounds();
+        var northWest = tilePosition(bounds.getNorthWest(), zoom);
+        var southEast = tilePosition(bounds.getSouthEast(), zoom);
+        var last = Math.pow(2, zoom) - 1;
+
+        for (var x = Math.max(Math.floor(northWest.x), 0); x <= Math.min(Math.floor(southEast.x), last); x++) {
+            for (var y = Math.max(Math.floor(northWest.y), 0); y <= Math.min(Math.floor(southEast.y), last); y++) {
+                var key = tileKey(mapZoom, x, y);
+                if (!tiles[key]) {
+                    pullTile(mapZoom, zoom, x, y, staleTiles[key]);
+                }
             }
-            return sidebarContent;
         }
+        onTilesPulled();
+        updateMarkers();
+    }
+
+    // Helper function: Pulls the offerings of one tile (at 'zoom') for the
+    // map at 'mapZoom' into 'tiles'. If 'previous', the same tile pulled
+    // before, has an ETag, it is sent as If-None-Match, and if the server
+    // answers 304 Not Modified, 'previous' is kept as it is: its offerings'
+    // minutes still count from when it was received.
+    function pullTile(mapZoom, zoom, x, y, previous) {
+        var key = tileKey(mapZoom, x, y);
+        var bbox = tileBBox(zoom, x, y);
+        var placeholder = {zoom: mapZoom, bbox: bbox, clusters: [], locations: [], receivedAt: Date.now(), pending: true};
+        tiles[key] = placeholder;  // not asked for again while pending
+        pending++;
 
         $.ajax({
-            url: document.URL + 'offerings',
-            async: false,
+            url: document.URL + 'offerings/clusters/',
+            data: {bbox: bbox.join(','), zoom: mapZoom, version: 2},  // version 2 has coordinates as numbers
+            headers: previous && previous.etag? {'If-None-Match': previous.etag}: {},
             timeout: 5000,
-            success: function(result) {
-                // Parse JSON response and fill in places.features with location names
-                // and GPS coordinates
-                var response_offerings = JSON.parse(result);
-                for (var i = 0; i < response_offerings.length; i++) {
-                    entry = response_offerings[i];
-
-                    // Each feature has mostly standard parameters. We set 'coordinates'
-                    // (GPS coordinates), 'popupContent' (text that appears in a
-                    // popup window), 'sidebarContent' (text that appears in the
-                    // sidebar), and 'id' (which just needs to be a unique integer).
-                    offerings.features.push({
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": [
-                                // NOTE: The format for the coordinates is LONGITUDE, LATITUDE
-                                // (backwards from the norm). This is DUMB! But ugh such is life.
-                                parseFloat(entry.location.lng), parseFloat(entry.location.lat)
-                            ]
-                        },
-                        "properties": {
-                            "popupContent": makePopupContent(entry),
-                            "sidebarContent": makeSidebarContent(entry)
-                        },
-                        "id": i
-                    });
+            success: function(result, status, xhr) {
+                if (tiles[key] !== placeholder) {
+                    return;  // dropped while pending, and pulled again since
+                }
+                if (xhr.status == 304) {
+                    tiles[key] = previous;
+                    return;
                 }
+                var tile = JSON.parse(result);
+                tile.zoom = mapZoom;
+                tile.bbox = bbox;
+                tile.etag = xhr.getResponseHeader('ETag');
+                tile.receivedAt = Date.now();
+                tiles[key] = tile;
             },
-
             error: function() {
-                offerings.error = true;
+                console.log('Failed to pull the offerings of tile ' + key + '.');
+                if (tiles[key] === placeholder) {
+                    delete tiles[key];  // try again on the next move, or once changes are pulled
+                }
+            },
+            complete: function() {
+                pending--;
+                onTilesPulled();
+                updateMarkers();
+            }
+        });
+    }
+
+    // Helper function: Calls 'callback(tile)' for each tile shown: those in
+    // 'tiles' at the zoom level shown, and those in 'staleTiles' before them.
+    function forEachShownTile(callback) {
+        [staleTiles, tiles].forEach(function(source) {
+            for (var key in source) {
+                if (source[key].zoom == shownZoom) {
+                    callback(source[key]);
+                }
             }
         });
+    }
 
-        return offerings;
+    // Helper function: Groups the offerings of the tiles shown by the name
+    // of their location. Returns an object mapping each name to an entry
+    // formatted like the objects returned by the /offerings/ url:
+    // {location: {...}, offerings: [{title: ..., minutes: ..., ...}, ...]},
+    // with minutes counting the time since the tile was received.
+    function groupByLocation() {
+        var found = {};  // maps each name to {entry: ..., receivedAt: ...}
+        forEachShownTile(function(tile) {
+            // A location from a stale tile may be in a tile pulled since
+            for (var i = 0; i < tile.locations.length; i++) {
+                found[tile.locations[i].location.name] = {entry: tile.locations[i], receivedAt: tile.receivedAt};
+            }
+        });
+
+        var entries = {};
+        for (var name in found) {
+            var minutesSince = Math.floor((Date.now() - found[name].receivedAt) / 60000);
+            entries[name] = {
+                location: found[name].entry.location,
+                offerings: found[name].entry.offerings.map(function(offering) {
+                    return {
+                        title: offering.title,
+                        description: offering.description,
+                        minutes: offering.minutes + minutesSince,
+                        tags: offering.tags
+                    };
+                })
+            };
+        }
+        return entries;
     }
 
-    var offerings = pullOfferings();
-    // TODO: Make nicer looking alert messages built into the UI
-    if (offerings.error) {
-        // alert('Oops! We could not get the free food offerings!');
+    // Helper function: Returns the clusters of the tiles shown, as returned
+    // by the /offerings/clusters/ url, by their position.
+    function groupClusters() {
+        var clusters = {};
+        forEachShownTile(function(tile) {
+            for (var i = 0; i < tile.clusters.length; i++) {
+                clusters[tile.clusters[i].lat + ',' + tile.clusters[i].lng] = tile.clusters[i];
+            }
+        });
+        return clusters;
+    }
+
+    // Helper function: Returns HTML that formats the *popup* content for
+    // 'entry', where 'entry' is one of the objects returned by
+    // groupByLocation(). Places this HTML inside a div.popup-content.
+    function makePopupContent(entry) {
+        popupContent = '<div class="popup-content"><b>' + entry.location.name + '</b>';
+        for (var i = 0; i < entry.offerings.length; i++) {
+            // Append a <p> for each offering. Only show minutes and title
+            minutes_string = (entry.offerings[i].minutes > 60? '1 hour, '+(entry.offerings[i].minutes-60): entry.offerings[i].minutes) + (entry.offerings[i].minutes%60 == 1? ' minute old': ' minutes old');
+            popupContent += '<p><i>' + entry.offerings[i].title + '</i><br>' + minutes_string + '</p>';
+        }
+        return popupContent;
     }
-    if (offerings.features.length == 0) {
-        //alert("There is currently no free food available. Sorry!");
+
+    // Helper function: Returns HTML that formats the *sidebar* content for
+    // 'entry', where 'entry' is one of the objects returned by
+    // groupByLocation(). Places this HTML inside a div.sidebar-content.
+    function makeSidebarContent(entry) {
+        sidebarContent = '<div class="sidebar-content"><b>' + entry.location.name + '</b>';
+        for (var i = 0; i < entry.offerings.length; i++) {
+            // Append two <p>'s for each offering: one for minutes and title, one for description.
+            minutes_string = (entry.offerings[i].minutes > 60? '1 hour, '+(entry.offerings[i].minutes-60): entry.offerings[i].minutes) + (entry.offerings[i].minutes%60 == 1? ' minute old': ' minutes old');
+            sidebarContent += '<p><i>' + entry.offerings[i].title + '</i><br>' + minutes_string + '</p>';
+            sidebarContent += '<p>' + entry.offerings[i].description + '</p><hr>';
+        }
+        return sidebarContent;
     }
 
     /*------------------------------------------------------------------------*/
@@ -149,56 +274,250 @@
     });
   map.addControl(sidebar);
 
-    // Place markers on map
-    function placeMarkers() {
-        layers.offerings = L.geoJSON(offerings, {
-            style: function (feature) {
-                return feature.properties && feature.properties.style;
-            },
+    layers.offerings = L.layerGroup().addTo(map);
+    var markersByLocation = {};  // markers in 'layers.offerings' by location name
+    var markersByCluster = {};   // cluster markers in 'layers.offerings' by position
+
+    // One icon is shared by every location's marker
+    var locationIcon = L.icon({
+        iconUrl: marker.icon,
+        iconSize: [marker.width, marker.height],
+        iconAnchor: [marker.width / 2, marker.height],  // rel to top-left
+        popupAnchor: [0, -marker.height]  // rel to iconAnchor
+    });
+
+    // Helper function: Returns a new marker for the location of 'entry', one
+    // of the objects returned by groupByLocation().
+    function makeMarker(entry) {
+        var name = entry.location.name;
+        // NOTE: Unlike GeoJSON, Leaflet takes coordinates as LATITUDE, LONGITUDE
+        var latlng = [entry.location.lat, entry.location.lng];
+        var layer = L.marker(latlng, {
+            icon: locationIcon,
+            opacity: marker.default_opacity,
+            riseOnHover: true
+        });
+
+        // Adds mouse hover/click listeners and sets the marker's popup window
+        // content
+        layer.bindPopup(makePopupContent(entry), {closeButton: false, autoPan: false});
+        layer.on({
+            'mouseover': onSetHover,
+            'mouseout': onRemoveHover,
+            'click': function() {
+                var entry = groupByLocation()[name];
+                if (entry) {
+                    sidebar.setContent(makeSidebarContent(entry));
+                    sidebar.show();
+                }
+            }
+         });
+        return layer;
+    }
+
+    // Helper function: Returns a new marker for 'cluster', one of the
+    // clusters returned by groupClusters(), showing how many offerings it
+    // has. Clicking it zooms in until its locations are apart.
+    function makeClusterMarker(cluster) {
+        var size = cluster.offerings < 10? 32: cluster.offerings < 100? 40: 48;
+        var layer = L.marker([cluster.lat, cluster.lng], {
+            icon: L.divIcon({
+                className: 'cluster-marker',
+                html: '<span>' + cluster.offerings + '</span>',
+                iconSize: [size, size]
+            }),
+            title: cluster.offerings + ' offerings at ' + cluster.locations + ' locations'
+        });
+        layer.on('click', function() {
+            var south = cluster.bounds[0], west = cluster.bounds[1], north = cluster.bounds[2], east = cluster.bounds[3];
+            map.fitBounds([[south, west], [north, east]], {maxZoom: Math.min(map.getZoom() + 2, map.getMaxZoom())});
+        });
+        return layer;
+    }
 
-            onEachFeature: function (feature, layer) {
-                // Adds mouse hover/click listeners and sets the marker's popup window
-                // content. The parameter 'feature' passed in is one of the feature
-                // objects in 'places', defined in the last section.
-                var popupContent = feature.properties.popupContent;
-                layer.bindPopup(popupContent, {closeButton: false, autoPan: false});
-                layer.on({
-                    'mouseover': onSetHover,
-                    'mouseout': onRemoveHover,
-                    'click': function() {
-                        var sidebarContent = feature.properties.sidebarContent;
-                        sidebar.setContent(sidebarContent);
-                        sidebar.show();
-                    }
-                 });
+    // Patch markers on the map in place: add markers for locations that got
+    // their first offering, remove markers for locations left without
+    // offerings, and refresh the popups of the rest (whose minutes go up
+    // even if nothing changed). Cluster markers are replaced when their
+    // counts change.
+    function updateMarkers() {
+        var entries = groupByLocation();
+
+        for (var name in markersByLocation) {
+            if (!entries[name]) {
+                layers.offerings.removeLayer(markersByLocation[name]);
+                delete markersByLocation[name];
+            }
+        }
+
+        for (var name in entries) {
+            var location = entries[name].location;
+            if (markersByLocation[name]) {
+                markersByLocation[name].setLatLng([location.lat, location.lng]);
+                markersByLocation[name].setPopupContent(makePopupContent(entries[name]));
+            }
+            else {
+                markersByLocation[name] = makeMarker(entries[name]);
+                layers.offerings.addLayer(markersByLocation[name]);
+            }
+        }
+
+        var clusters = groupClusters();
+        for (var key in markersByCluster) {
+            if (!clusters[key] || clusters[key].offerings != markersByCluster[key].offerings) {
+                layers.offerings.removeLayer(markersByCluster[key]);
+                delete markersByCluster[key];
+            }
+        }
+        for (var key in clusters) {
+            if (!markersByCluster[key]) {
+                markersByCluster[key] = makeClusterMarker(clusters[key]);
+                markersByCluster[key].offerings = clusters[key].offerings;
+                layers.offerings.addLayer(markersByCluster[key]);
+            }
+        }
+    }
+
+    // Pull the offerings of the tiles in view whenever the map moves (or
+    // zooms)
+    map.on('moveend', pullTiles);
+
+    // Pull the offerings in view again, and update markers. Tiles out of view
+    // are dropped, so they are pulled again when they come back into view.
+    function refresh() {
+        for (var key in tiles) {
+            dropTile(key);
+        }
+        pullTiles();
+    }
+
+    /*------------------------------------------------------------------------*/
+
+    // Keep up with changes to the offerings through the /offerings/changes/
+    // url, which hands out a cursor to ask for the changes since with. It
+    // only says where changed offerings are: the tiles they are in are
+    // pulled again for the rest.
+
+    var cursor = null;           // cursor of the last changes pulled
+    var offeringPlaces = {};     // [lat, lng] of the location of each offering on the map, by id
+    var pullingChanges = false;  // whether changes are being pulled
+    var changesWanted = false;   // whether to pull changes again once they arrive
+
+    // Pulls the changes since 'cursor' (every offering on the map, the first
+    // time), and applies them. Pulls them again once they arrive if asked to
+    // meanwhile.
+    function pullChanges() {
+        if (pullingChanges) {
+            changesWanted = true;
+            return;
+        }
+        pullingChanges = true;
+
+        $.ajax({
+            url: document.URL + 'offerings/changes/',
+            data: cursor == null? {version: 2}: {since: cursor, version: 2},
+            timeout: 5000,
+            success: function(result) {
+                applyChanges(JSON.parse(result));
+            },
+            error: function() {
+                console.log('Failed to pull the changes to the offerings.');
+                if (cursor == null) {
+                    pullTiles();  // show the offerings anyway
+                }
             },
+            complete: function() {
+                pullingChanges = false;
+                if (changesWanted) {
+                    changesWanted = false;
+                    pullChanges();
+                }
+            }
+        });
+    }
 
-            pointToLayer: function (feature, latlng) {
-                return L.marker(latlng, {
-                    icon: L.icon({
-                      iconUrl: marker.icon,
-                      iconSize: [marker.width, marker.height],
-                      iconAnchor: [marker.width / 2, marker.height],  // rel to top-left
-                      popupAnchor: [0, -marker.height]  // rel to iconAnchor
-                    }),
-                    opacity: marker.default_opacity,
-                    riseOnHover: true
-                });
+    // Helper function: Applies 'changes', as returned by the
+    // /offerings/changes/ url: drops the tiles that the offerings updated or
+    // removed are (or were) in, at every zoom level, and pulls those in view
+    // again. If the server could not tell what changed since 'cursor', pulls
+    // every tile in view again instead (unchanged ones only get back a 304).
+    function applyChanges(changes) {
+        var first = cursor == null;
+        var places = [];
+        if (changes.reset) {
+            offeringPlaces = {};
+        }
+        changes.updated.forEach(function(offering) {
+            if (offeringPlaces[offering.id]) {
+                places.push(offeringPlaces[offering.id]);  // in case it moved
+            }
+            offeringPlaces[offering.id] = [offering.lat, offering.lng];
+            places.push(offeringPlaces[offering.id]);
+        });
+        changes.removed.forEach(function(id) {
+            if (offeringPlaces[id]) {
+                places.push(offeringPlaces[id]);
+                delete offeringPlaces[id];
             }
-        }).addTo(map);
+        });
+        cursor = changes.cursor;
+
+        if (first) {
+            pullTiles();  // the tiles in view, from after the cursor
+            return;
+        }
+        if (changes.reset) {
+            refresh();
+            return;
+        }
+        for (var key in tiles) {
+            var bbox = tiles[key].bbox;
+            for (var i = 0; i < places.length; i++) {
+                if (bbox[0] <= places[i][1] && places[i][1] <= bbox[2] && bbox[1] <= places[i][0] && places[i][0] <= bbox[3]) {
+                    dropTile(key);
+                    break;
+                }
+            }
+        }
+        pullTiles();
     }
 
-    placeMarkers();
+    // Pull the offerings on the map, then the tiles in view
+    pullChanges();
 
-    // Update markers every minute
-    setInterval(function() {
-        offerings = pullOfferings();
-        if (!offerings.error) {
-            map.removeLayer(layers.offerings);
-            placeMarkers();
-        } else {
-            console.log('Failed to update markers. Retaining the old markers.');
+    // Listen for the server to say offerings changed, so they show up right
+    // away. Events that come in together only pull the changes once.
+    var events = null;
+    var changesTimeout = null;
+    function onEvent() {
+        if (changesTimeout == null) {
+            changesTimeout = setTimeout(function() {
+                changesTimeout = null;
+                pullChanges();
+            }, 250);
         }
+    }
+    if (window.EventSource) {
+        events = new EventSource(document.URL + 'offerings/events/');
+        events.addEventListener('save', onEvent);
+        events.addEventListener('delete', onEvent);
+        events.addEventListener('open', onEvent);  // catch up on changes missed while disconnected
+        events.addEventListener('error', function() {
+            // The browser reconnects by itself unless the stream is closed for
+            // good (e.g. the server turned it off, or has as many streams open
+            // as it allows). Then fall back to polling.
+            if (events.readyState == EventSource.CLOSED) {
+                events = null;
+            }
+        });
+    }
+
+    // Update markers every minute. Offerings also leave the map (or come
+    // onto it) as time passes, which the server does not push, so the
+    // changes are pulled every minute either way.
+    setInterval(function() {
+        pullChanges();
+        updateMarkers();
     }, 60000);
 
 });
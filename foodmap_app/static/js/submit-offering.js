@@ -18,4 +18,28 @@ $(document).ready(function() {
         controlType: 'select',
         stepMinute: 5
     });
+
+    // Suggest a location from the description, unless the user already
+    // picked one. The description is POSTed, since a long one (e.g. a pasted
+    // email) would not fit in a URL.
+    $('#id_description').change(function() {
+        if ($('#id_location').val()) {
+            return;
+        }
+        $.ajax({
+            url: '/suggest-location/',
+            method: 'POST',
+            data: {
+                description: $(this).val(),
+                csrfmiddlewaretoken: $('input[name=csrfmiddlewaretoken]').val()
+            },
+            timeout: 5000,
+            success: function(result) {
+                var location = JSON.parse(result);
+                if (location.id && !$('#id_location').val()) {
+                    $('#id_location').val(location.id);
+                }
+            }
+        });
+    });
 });
@@ -0,0 +1,176 @@
+/******************************************************************************/
+/* browser.js                                                                 */
+/*                                                                            */
+/* A fake browser page for testing the map script (static/js/mapbuilder.js)   */
+/* without a browser. It runs the script with just enough of jQuery and       */
+/* Leaflet for it to build the map, and lets tests answer the requests it     */
+/* makes, move the clock on, fire its timers, and read the markers it shows.  */
+/******************************************************************************/
+
+var fs = require('fs');
+var path = require('path');
+var vm = require('vm');
+
+const MAPBUILDER_PATH = path.join(__dirname, '..', '..', 'static', 'js', 'mapbuilder.js');
+const PAGE_URL = 'http://localhost:8000/';
+
+/**
+ * Helper function: Returns an object whose methods are named 'names', which
+ * do nothing and return the object, so calls to them can be chained.
+ */
+function chainable(names) {
+    var object = {};
+    for(var name of names) {
+        object[name] = function() { return object; };
+    }
+    return object;
+}
+
+/**
+ * A fake page running mapbuilder.js. The map is at 'options.zoom' (16 by
+ * default), and the page has EventSource only if 'options.EventSource' is
+ * given.
+ */
+function FakePage(options) {
+    options = options || {};
+    var page = this;
+    this.now = 1494086400000;
+    this.requests = [];  // requests made with $.ajax() and not answered yet
+    this.timers = [];    // {callback: ..., interval: ...} for setTimeout() and setInterval()
+    this.layers = [];    // markers on the map
+
+    var Clock = function() {};
+    Clock.now = function() { return page.now; };
+
+    var map = chainable(['setMaxZoom', 'setMinZoom', 'addControl', 'fitBounds']);
+    map.center = {lat: 0, lng: 0};
+    map.zoom = options.zoom || 16;
+    map.handlers = {};
+    map.setView = function(center, zoom) {
+        map.center = {lat: center[0], lng: center[1]};
+        map.zoom = zoom;
+        return map;
+    };
+    map.getZoom = function() { return map.zoom; };
+    map.getMaxZoom = function() { return 18; };
+    map.getBounds = function() {
+        // About a phone screen across, at zoom 16
+        var span = 0.004 * Math.pow(2, 16 - map.zoom);
+        return {
+            getNorthWest: function() { return {lat: map.center.lat + span, lng: map.center.lng - span}; },
+            getSouthEast: function() { return {lat: map.center.lat - span, lng: map.center.lng + span}; }
+        };
+    };
+    map.on = function(name, handler) { map.handlers[name] = handler; };
+    this.map = map;
+
+    var L = {
+        map: function() { return map; },
+        tileLayer: function() { return chainable(['addTo']); },
+        control: {
+            locate: function() { return chainable(['addTo']); },
+            sidebar: function() { return chainable(['setContent', 'show']); }
+        },
+        layerGroup: function() {
+            var group = chainable(['addTo']);
+            group.addLayer = function(layer) { page.layers.push(layer); };
+            group.removeLayer = function(layer) { page.layers.splice(page.layers.indexOf(layer), 1); };
+            return group;
+        },
+        icon: function() { return {}; },
+        divIcon: function(options) { return options; },
+        marker: function(latlng, options) {
+            var marker = chainable(['on', 'setOpacity', 'openPopup', 'closePopup']);
+            marker.latlng = latlng;
+            marker.options = options;
+            marker.bindPopup = function(content) { marker.popup = content; return marker; };
+            marker.setPopupContent = marker.bindPopup;
+            marker.setLatLng = function(latlng) { marker.latlng = latlng; return marker; };
+            return marker;
+        }
+    };
+
+    var $ = function() {
+        return {ready: function(callback) { callback(); }};
+    };
+    $.ajax = function(settings) { page.requests.push(settings); };
+
+    var context = {
+        $: $,
+        L: L,
+        Date: Clock,
+        Math: Math,
+        JSON: JSON,
+        console: {log: function() {}},
+        document: {URL: PAGE_URL},
+        icons: {fork_and_knife: 'fork-and-knife.png'},
+        setTimeout: function(callback) { page.timers.push({callback: callback}); return page.timers.length; },
+        clearTimeout: function() {},
+        setInterval: function(callback, interval) { page.timers.push({callback: callback, interval: interval}); }
+    };
+    context.window = context;
+    if(options.EventSource) {
+        context.EventSource = options.EventSource;
+    }
+    vm.runInNewContext(fs.readFileSync(MAPBUILDER_PATH).toString(), context, {filename: MAPBUILDER_PATH});
+}
+
+/**
+ * Returns the requests not answered yet to 'url' (relative to the page), and
+ * takes them off the list.
+ */
+FakePage.prototype.takeRequests = function(url) {
+    var taken = this.requests.filter(request => request.url == PAGE_URL + url);
+    this.requests = this.requests.filter(request => request.url != PAGE_URL + url);
+    return taken;
+};
+
+/**
+ * Answers 'request' with 'body' (serialized to JSON) and status 200, or with
+ * an empty 304 Not Modified if 'body' is null, as jQuery would. 'headers'
+ * are the response's headers.
+ */
+FakePage.prototype.respond = function(request, body, headers) {
+    headers = headers || {};
+    var xhr = {
+        status: body === null? 304: 200,
+        getResponseHeader: function(name) { return headers[name] || null; }
+    };
+    request.success(body === null? undefined: JSON.stringify(body), body === null? 'notmodified': 'success', xhr);
+    request.complete(xhr, 'success');
+};
+
+/**
+ * Fires the timers set with setInterval() to go off every 'interval' ms.
+ */
+FakePage.prototype.fireInterval = function(interval) {
+    for(var timer of this.timers.filter(timer => timer.interval == interval)) {
+        timer.callback();
+    }
+};
+
+/**
+ * Fires the timers set with setTimeout() that have not gone off yet.
+ */
+FakePage.prototype.fireTimeouts = function() {
+    var timeouts = this.timers.filter(timer => timer.interval === undefined);
+    this.timers = this.timers.filter(timer => timer.interval !== undefined);
+    for(var timer of timeouts) {
+        timer.callback();
+    }
+};
+
+/**
+ * Returns the popups of the markers of locations on the map, by location.
+ */
+FakePage.prototype.popups = function() {
+    var popups = {};
+    for(var layer of this.layers) {
+        if(layer.popup) {
+            popups[layer.popup.match(/<b>(.*?)<\/b>/)[1]] = layer.popup;
+        }
+    }
+    return popups;
+};
+
+module.exports.FakePage = FakePage;
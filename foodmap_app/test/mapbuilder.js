@@ -0,0 +1,159 @@
+/******************************************************************************/
+/* mapbuilder.js                                                              */
+/*                                                                            */
+/* This is a mocha test file that tests how the map script                    */
+/* (static/js/mapbuilder.js) pulls offerings and shows them, on a fake page   */
+/* (see fake/browser.js).                                                     */
+/******************************************************************************/
+
+var assert = require("assert");
+var FakePage = require('./fake/browser.js').FakePage;
+
+const MINUTE = 60000;
+const CHANGES_URL = 'offerings/changes/';
+const CLUSTERS_URL = 'offerings/clusters/';
+
+// Two locations in different tiles of the map as it starts
+const FRIST = {name: 'Frist Campus Center', lat: 40.34687, lng: -74.6551};
+const DILLON = {name: 'Dillon Gym', lat: 40.3445, lng: -74.6585};
+
+/**
+ * Helper function: Returns an offering with 'id' at 'location', 'minutes'
+ * old, as the /offerings/changes/ url formats it.
+ */
+function makeOffering(id, location, minutes) {
+    return {id: id, location: location, title: 'Offering ' + id, description: 'Come eat!', minutes: minutes, tags: ''};
+}
+
+/**
+ * Helper function: Answers the tile requests of 'page' with the offerings
+ * in 'offerings' (from makeOffering()) inside each tile, with an ETag of
+ * 'etag' and the tile's edges.
+ */
+function respondWithTiles(page, offerings, etag) {
+    var requests = page.takeRequests(CLUSTERS_URL);
+    for(var request of requests) {
+        var bbox = request.data.bbox.split(',').map(Number);  // west, south, east, north
+        var locations = {};
+        for(var offering of offerings) {
+            var location = offering.location;
+            if(bbox[0] <= location.lng && location.lng <= bbox[2] && bbox[1] <= location.lat && location.lat <= bbox[3]) {
+                locations[location.name] = locations[location.name] || {location: location, offerings: []};
+                locations[location.name].offerings.push(offering);
+            }
+        }
+        page.respond(request, {clusters: [], locations: Object.keys(locations).map(name => locations[name])},
+            {ETag: '"' + etag + ':' + request.data.bbox + '"'});
+    }
+    return requests;
+}
+
+/**
+ * Helper function: Answers the request of 'page' for changes with
+ * 'changes', whose updated offerings (from makeOffering()) are sent with
+ * just their ids and coordinates, filling in the cursor.
+ */
+function respondWithChanges(page, changes) {
+    var requests = page.takeRequests(CHANGES_URL);
+    assert.equal(requests.length, 1);
+    changes.cursor = 'cursor-' + page.now;
+    changes.updated = changes.updated.map(offering => ({id: offering.id, lat: offering.location.lat, lng: offering.location.lng}));
+    page.respond(requests[0], changes);
+    return requests[0];
+}
+
+/**
+ * Helper function: Returns a new page, with the map showing 'offerings'.
+ */
+function loadPage(offerings, options) {
+    var page = new FakePage(options);  // the map starts on campus
+    respondWithChanges(page, {reset: true, updated: offerings, removed: []});
+    assert.equal(respondWithTiles(page, offerings, 'first').length, 2);
+    return page;
+}
+
+describe('mapbuilder.js', function() {
+    describe('tiles', function() {
+        it('should show the offerings of the tiles in view', function() {
+            var page = new FakePage();
+            var changesRequest = respondWithChanges(page, {reset: true, updated: [makeOffering(1, FRIST, 5)], removed: []});
+            assert.equal(changesRequest.data.since, undefined);
+
+            var requests = respondWithTiles(page, [makeOffering(1, FRIST, 5)], 'first');
+            assert.equal(requests.length, 2);
+            for(var request of requests) {
+                assert.equal(request.data.zoom, 16);
+            }
+            assert.ok(page.popups()[FRIST.name].indexOf('5 minutes old') != -1);
+        });
+
+        it('should keep counting minutes from when a tile revalidated with 304 was received', function() {
+            var page = loadPage([makeOffering(1, FRIST, 5)]);
+
+            // The offering is announced again a few times, but nothing changed
+            for(var i = 0; i < 3; i++) {
+                page.now += MINUTE;
+                page.fireInterval(MINUTE);
+                respondWithChanges(page, {reset: false, updated: [makeOffering(1, FRIST, 5 + i)], removed: []});
+                var requests = page.takeRequests(CLUSTERS_URL);
+                assert.equal(requests.length, 1);
+                assert.ok(requests[0].headers['If-None-Match'].indexOf('"first:') == 0);
+                page.respond(requests[0], null);
+            }
+            assert.ok(page.popups()[FRIST.name].indexOf('8 minutes old') != -1, page.popups()[FRIST.name]);
+        });
+    });
+
+    describe('changes', function() {
+        it('should pull again only the tiles that changed offerings are in', function() {
+            var offerings = [makeOffering(1, FRIST, 5), makeOffering(2, DILLON, 5)];
+            var page = loadPage(offerings);
+            assert.deepEqual(Object.keys(page.popups()).sort(), [DILLON.name, FRIST.name]);
+
+            page.fireInterval(MINUTE);
+            var request = respondWithChanges(page, {reset: false, updated: [], removed: [2]});
+            assert.equal(request.data.since, 'cursor-' + page.now);
+            assert.equal(respondWithTiles(page, [offerings[0]], 'second').length, 1);
+            assert.deepEqual(Object.keys(page.popups()), [FRIST.name]);
+
+            // Nothing changed, so nothing is pulled again
+            page.fireInterval(MINUTE);
+            respondWithChanges(page, {reset: false, updated: [], removed: []});
+            assert.equal(page.takeRequests(CLUSTERS_URL).length, 0);
+        });
+
+        it('should pull again every tile in view if the cursor is too old', function() {
+            var page = loadPage([makeOffering(1, FRIST, 5), makeOffering(2, DILLON, 5)]);
+            page.now += 2 * 24 * 60 * MINUTE;
+            page.fireInterval(MINUTE);
+            respondWithChanges(page, {reset: true, updated: [], removed: []});
+            var requests = page.takeRequests(CLUSTERS_URL);
+            assert.equal(requests.length, 2);
+            for(var request of requests) {
+                assert.ok(request.headers['If-None-Match'].indexOf('"first:') == 0);
+            }
+        });
+
+        it('should pull the changes once for events that come in together', function() {
+            var source = null;
+            var FakeEventSource = function(url) {
+                this.url = url;
+                this.listeners = {};
+                source = this;
+            };
+            FakeEventSource.prototype.addEventListener = function(name, listener) {
+                this.listeners[name] = listener;
+            };
+            var page = loadPage([makeOffering(1, FRIST, 5)], {EventSource: FakeEventSource});
+            assert.equal(source.url, 'http://localhost:8000/offerings/events/');
+
+            source.listeners.save();
+            source.listeners.save();
+            assert.equal(page.takeRequests(CHANGES_URL).length, 0);
+            page.fireTimeouts();
+            respondWithChanges(page, {reset: false, updated: [makeOffering(2, DILLON, 0)], removed: []});
+            assert.equal(respondWithTiles(page, [makeOffering(1, FRIST, 5), makeOffering(2, DILLON, 0)], 'second').length, 1);
+            assert.deepEqual(Object.keys(page.popups()).sort(), [DILLON.name, FRIST.name]);
+        });
+    });
+});
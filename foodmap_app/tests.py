@@ -1,15 +1,31 @@
+import base64
+import calendar
 import datetime
 import json
 import os
+import random
+import shutil
+import tempfile
+import threading
+from distutils.spawn import find_executable
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import IntegrityError, transaction
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
-from foodmap_proj.settings.common import MEDIA_ROOT
-from foodmap_app import scraper
+from foodmap_proj.settings.common import BASE_DIR, MEDIA_ROOT
+from foodmap_app import clusters, coordinates, expiry, extractor, ingest, locations_index, offering_tags, offerings_cache, offerings_changes, offerings_events, recurrence, scheduler, scraper
 from foodmap_app.forms import OfferingForm
-from foodmap_app.models import Location, Offering, OfferingTag
+from foodmap_app.models import JobLock, Location, Offering, OfferingChange, OfferingOccurrence, OfferingTag
+import scrape_locations
+from subprocess import Popen, PIPE
+from StringIO import StringIO
 from unittest import skipIf
 
 # Create your tests here.
@@ -82,6 +98,9 @@ class OfferingsViewTests(TestCase):
         Create two sample locations and two sample offerings for use during
         each test.
         '''
+        # Don't reuse offerings cached during another test
+        offerings_cache.invalidate()
+
         # Make two locations
         self.locationA = create_location(name='Frist Campus Center')
         self.locationB = create_location(name='Computer Science Building')
@@ -198,134 +217,1462 @@ class OfferingsViewTests(TestCase):
                 # Has correct attributes
                 self.assertEqual(sorted(test_offering.keys()), sorted(actual_offering.keys()))
 
-                # Has correct title and description
-                self.assertEqual(test_offering['title'], actual_offering['title'])
-                self.assertEqual(test_offering['description'], actual_offering['description'])
+                # Has correct title and description
+                self.assertEqual(test_offering['title'], actual_offering['title'])
+                self.assertEqual(test_offering['description'], actual_offering['description'])
+
+                # Has correct minutes
+                self.assertAlmostEqual(test_offering['minutes'], actual_offering['minutes'], delta=1)  # should be within a small delta
+
+                # Has correct tags
+                self.assertEqual(test_offering['tags'], actual_offering['tags'])
+
+
+    def test_offerings_with_tags(self):
+        '''
+        Requests the most recent offerings, where the offerings have tags,
+        and checks that the response has all of those tags in a comma-separated
+        list. (Assumes the rest of the response is correct, as this is
+        validated by another test.)
+        '''
+        # Add tags to each offering
+        actual_tags = ['kosher', 'gluten-free', 'peanut-free']
+        for offering in [self.offering1A, self.offering1B, self.offering2A, self.offering2B]:
+            for tag in actual_tags:
+                create_offering_tag(offering=offering, tag=tag).save()
+
+        # Make request
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        try:
+            parsed_response = json.loads(response.content)  # array of JSON objects, as specified in views.py
+        except:
+            self.fail('JSON response could not be parsed')
+
+        # Verify that response has exactly the same tags
+        test_response = parsed_response
+        actual_response = [
+            {
+                'location': {'name': self.locationA.name, 'lat': str(self.locationA.lat), 'lng': str(self.locationA.lng)},
+                'offerings': [
+                    {'title': offering.title, 'description': offering.description, 'minutes': (timezone.now() - offering.timestamp).seconds/60, 'tags': 'kosher,gluten-free,peanut-free'}
+                    for offering in [self.offering1A, self.offering2A]
+                ]
+            },
+            {
+                'location': {'name': self.locationB.name, 'lat': str(self.locationB.lat), 'lng': str(self.locationB.lng)},
+                'offerings': [
+                    {'title': offering.title, 'description': offering.description, 'minutes': (timezone.now() - offering.timestamp).seconds/60, 'tags': 'kosher,gluten-free,peanut-free'}
+                    for offering in [self.offering1B, self.offering2B]
+                ]
+            }
+        ]
+
+        # Sort test and actual response by location, and by title within each
+        # location so they can be compared side-by-side
+        for entry in test_response:
+            self.assertIn('location', entry.keys())
+            self.assertIn('name', entry['location'].keys())
+
+            self.assertIn('offerings', entry.keys())
+            for offering in entry['offerings']:
+                self.assertIn('title', offering)
+        test_response = sorted(test_response, cmp=lambda x, y: cmp(x['location']['name'], y['location']['name']))
+        actual_response = sorted(actual_response, cmp=lambda x, y: cmp(x['location']['name'], y['location']['name']))
+
+        for i in range(0, len(test_response)):
+            test_response[i]['offerings'] = sorted(test_response[i]['offerings'], cmp=lambda x, y: cmp(x['title'], y['title']))
+            actual_response[i]['offerings'] = sorted(actual_response[i]['offerings'], cmp=lambda x, y: cmp(x['title'], y['title']))
+
+        # Compare tags between test_response and actual_response
+        for i in range(0, len(actual_response)):
+            for j in range(0, len(actual_response[i]['offerings'])):
+                test_offering = test_response[i]['offerings'][j]
+                actual_offering = actual_response[i]['offerings'][j]
+
+                test_tags = sorted(test_offering['tags'].split(','))
+                actual_tags = sorted(actual_offering['tags'].split(','))
+                self.assertEqual(test_tags, actual_tags)
+
+    def test_offerings_query_count_does_not_grow(self):
+        '''
+        Requests the most recent offerings before and after adding more
+        offerings (with tags), and checks that the number of database queries
+        stays the same: one for the offerings and their locations, and one for
+        the occurrences of recurring offerings. (Tags are stored on offerings,
+        and the coordinates of locations are loaded beforehand, as they are
+        kept in memory.)
+        '''
+        for offering in [self.offering1A, self.offering1B, self.offering2A, self.offering2B]:
+            create_offering_tag(offering=offering, tag='kosher').save()
+        coordinates.get_table()
+
+        with self.assertNumQueries(2):
+            self.client.get(reverse('foodmap_app:offerings'))
+
+        # Add many more offerings, each with tags, spread over both locations
+        now = timezone.now()
+        extra_offerings = []
+        for i in range(0, 20):
+            offering = create_offering(
+                timestamp=now - datetime.timedelta(minutes=i),
+                location=[self.locationA, self.locationB][i % 2],
+                image=None,
+                thread_id='y%15d' % i  # thread_id must be unique
+            )
+            offering.save()
+            create_offering_tag(offering=offering, tag='vegan').save()
+            create_offering_tag(offering=offering, tag='kosher').save()
+            extra_offerings.append(offering)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('foodmap_app:offerings'))
+        parsed_response = json.loads(response.content)
+        self.assertEqual(sum([len(entry['offerings']) for entry in parsed_response]), 24)
+
+        for offering in extra_offerings:
+            offering.delete()
+
+    def test_offerings_timestamp_constraints(self):
+        '''
+        Requests the recent offerings and checks that they meet the time
+        constraint we impose: all offerings are from 2 hours ago to now
+        '''
+        # Set timestamps of the offerings to just before, just after 2-hours
+        # mark, and in future
+        offerings_good = [self.offering1A, self.offering1B]
+        offerings_bad  = [self.offering2A, self.offering2B]
+
+        now = timezone.now()
+        for offering in offerings_good:
+            offering.timestamp = now - datetime.timedelta(minutes=118) # under 2 hours
+            offering.save()
+        offerings_bad[0].timestamp = now - datetime.timedelta(minutes=121) # over 2 hours
+        offerings_bad[0].save()
+        offerings_bad[1].timestamp = now + datetime.timedelta(days=1) # future
+        offerings_bad[1].save()
+
+        # Make the request
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        test_response = json.loads(response.content)  # array of JSON objects, as specified in views.py
+
+        # Check that no offering is outside time range (approximately)
+        epsilon = 2  # some leeway in the timestamp to account for delay between request and response
+        for entry in test_response:
+            for offering in entry['offerings']:
+                self.assertTrue(offering['minutes'] < 120 + epsilon)
+                self.assertTrue(offering['minutes'] >= 0)
+
+    def test_offerings_with_empty_database(self):
+        '''
+        Requests all of the most recent offerings when there are no offerings
+        to show. Checks that we get back an empty JSON object.
+        '''
+        # Clear entries from database
+        self.tearDown()
+
+        # Make request
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        try:
+            parsed_response = json.loads(response.content)
+        except:
+            self.fail('JSON response could not be parsed')
+
+        # Verify that response is correct
+        self.assertEqual(parsed_response, [])
+
+        # Restore setup so that when tearDown() is called, we don't get errors
+        self.setUp()
+
+
+class OfferingsCacheTests(TestCase):
+    '''
+    Tests for the cached snapshot of offerings behind the /offerings/ view.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location with one offering, and start with an empty cache.
+        '''
+        offerings_cache.invalidate()
+        self.location = create_location(name='Frist Campus Center')
+        self.location.save()
+        self.offering = create_offering(location=self.location, image=None,
+            timestamp=timezone.now() - datetime.timedelta(minutes=10))
+        self.offering.save()
+
+    def get_offerings(self):
+        '''
+        Requests the most recent offerings and returns the parsed response.
+        '''
+        return json.loads(self.client.get(reverse('foodmap_app:offerings')).content)
+
+    def test_offerings_cache_serves_repeated_requests(self):
+        '''
+        Checks that only the first of several requests queries the database,
+        and that all of them get the same offerings.
+        '''
+        first_response = self.get_offerings()
+        with self.assertNumQueries(0):
+            second_response = self.get_offerings()
+        self.assertEqual(first_response, second_response)
+
+    def test_offerings_cache_invalidated_on_offering_changes(self):
+        '''
+        Checks that saving or deleting an offering shows up in the next
+        response.
+        '''
+        self.assertEqual(len(self.get_offerings()[0]['offerings']), 1)
+
+        new_offering = create_offering(location=self.location, image=None,
+            title='Bagels', thread_id='c%15d' % 1)
+        new_offering.save()
+        self.assertEqual(len(self.get_offerings()[0]['offerings']), 2)
+
+        self.offering.title = 'Cookies'
+        self.offering.save()
+        titles = [offering['title'] for offering in self.get_offerings()[0]['offerings']]
+        self.assertEqual(sorted(titles), ['Bagels', 'Cookies'])
+
+        new_offering.delete()
+        self.offering.delete()
+        self.assertEqual(self.get_offerings(), [])
+
+    def test_offerings_cache_invalidated_on_tag_changes(self):
+        '''
+        Checks that adding or deleting a tag shows up in the next response.
+        '''
+        self.assertEqual(self.get_offerings()[0]['offerings'][0]['tags'], '')
+
+        tag = create_offering_tag(offering=self.offering, tag='vegan')
+        tag.save()
+        self.assertEqual(self.get_offerings()[0]['offerings'][0]['tags'], 'vegan')
+
+        tag.delete()
+        self.assertEqual(self.get_offerings()[0]['offerings'][0]['tags'], '')
+
+    def test_offerings_cache_recomputes_minutes_on_read(self):
+        '''
+        Renders one snapshot at different times, and checks that the minutes
+        are computed at the time of rendering, and that offerings drop off
+        once they are over 2 hours old or appear once their time comes.
+        '''
+        now = timezone.now()
+        future_offering = create_offering(location=self.location, image=None,
+            timestamp=now + datetime.timedelta(seconds=30), thread_id='c%15d' % 2)
+        future_offering.save()
+        snapshot = offerings_cache.build_snapshot(now)
+
+        response = offerings_cache.render(snapshot, now)
+        self.assertEqual([offering['minutes'] for offering in response[0]['offerings']], [10])
+
+        response = offerings_cache.render(snapshot, now + datetime.timedelta(seconds=45))
+        self.assertEqual([offering['minutes'] for offering in response[0]['offerings']], [0, 10])
+
+        response = offerings_cache.render(snapshot, now + datetime.timedelta(minutes=111))
+        self.assertEqual([offering['minutes'] for offering in response[0]['offerings']], [110])
+
+        self.assertEqual(offerings_cache.render(snapshot, now + datetime.timedelta(hours=3)), [])
+
+
+class OfferingsConditionalGetTests(TestCase):
+    '''
+    Tests for conditional requests (If-None-Match, If-Modified-Since) to the
+    /offerings/ view.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location with one offering, and start with an empty cache.
+        '''
+        offerings_cache.invalidate()
+        self.location = create_location(name='Frist Campus Center')
+        self.location.save()
+        self.offering = create_offering(location=self.location, image=None,
+            timestamp=timezone.now() - datetime.timedelta(minutes=10))
+        self.offering.save()
+
+    def test_offerings_conditional_get_headers(self):
+        '''
+        Checks that responses have an ETag and Last-Modified, and are always
+        revalidated.
+        '''
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_offerings_conditional_get_if_none_match(self):
+        '''
+        Checks that a request with the ETag of the last response gets back an
+        empty 304 without querying the database.
+        '''
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('foodmap_app:offerings'),
+                HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+    def test_offerings_conditional_get_if_modified_since(self):
+        '''
+        Checks that a request with the Last-Modified of the last response gets
+        back a 304.
+        '''
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        response = self.client.get(reverse('foodmap_app:offerings'),
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_offerings_conditional_get_last_modified_moves_forward(self):
+        '''
+        Checks that Last-Modified moves forward when the offerings change,
+        even back to a set that was on the map before, so a client that saw
+        the newer set does not get a 304 for the older one.
+        '''
+        offerings_cache._get_cache().delete(offerings_cache.MODIFIED_CACHE_KEY)
+        now = timezone.now()
+        first = offerings_cache.get_last_modified(now)
+        self.assertEqual(offerings_cache.get_last_modified(now + datetime.timedelta(minutes=1)), first)
+
+        new_offering = create_offering(location=self.location, image=None, title='Bagels',
+            timestamp=now - datetime.timedelta(minutes=5), thread_id='c%15d' % 2)
+        new_offering.save()
+        later = now + datetime.timedelta(minutes=2)
+        self.assertEqual(offerings_cache.get_last_modified(later), later)
+
+        new_offering.delete()
+        latest = now + datetime.timedelta(minutes=3)
+        self.assertEqual(offerings_cache.get_last_modified(latest), latest)
+
+    def test_offerings_conditional_get_etag_ignores_minutes(self):
+        '''
+        Checks that the ETag stays the same as the offerings get older, until
+        one of them drops off the map.
+        '''
+        now = timezone.now()
+        snapshot = offerings_cache.build_snapshot(now)
+        etag = offerings_cache.get_etag(snapshot, now)
+        self.assertEqual(offerings_cache.get_etag(snapshot, now + datetime.timedelta(minutes=1)), etag)
+        self.assertNotEqual(offerings_cache.get_etag(snapshot, now + datetime.timedelta(hours=3)), etag)
+
+    def test_offerings_conditional_get_after_new_offering(self):
+        '''
+        Checks that a new offering changes the ETag, so clients with the old
+        one get the new offerings.
+        '''
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        old_etag = response['ETag']
+
+        new_offering = create_offering(location=self.location, image=None,
+            title='Bagels', thread_id='c%15d' % 1)
+        new_offering.save()
+        response = self.client.get(reverse('foodmap_app:offerings'),
+            HTTP_IF_NONE_MATCH=old_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], old_etag)
+        self.assertEqual(len(json.loads(response.content)[0]['offerings']), 2)
+
+
+class OfferingsBoundsViewTests(TestCase):
+    '''
+    Tests for retrieving the offerings inside a box on the map.
+    '''
+
+    def setUp(self):
+        '''
+        Create three locations, each with an offering.
+        '''
+        coordinates.invalidate()
+        offerings_cache.invalidate()
+        now = timezone.now()
+        for i, (name, lat, lng) in enumerate([('Frist Campus Center', 40.346870, -74.655100),
+            ('Firestone Library', 40.349500, -74.657500), ('Princeton University Art Museum', 40.347900, -74.663000)]):
+            location = create_location(name, lat=lat, lng=lng)
+            location.save()
+            create_offering(location=location, image=None, thread_id='b%15d' % i,
+                timestamp=now - datetime.timedelta(minutes=10 + i)).save()
+
+    def get_offerings(self, **params):
+        return self.client.get(reverse('foodmap_app:offerings'), params)
+
+    def get_names(self, **params):
+        return [entry['location']['name'] for entry in json.loads(self.get_offerings(**params).content)]
+
+    def test_offerings_bounds(self):
+        '''
+        Checks that only the locations inside the box are sent, in the same
+        order as without one.
+        '''
+        self.assertEqual(self.get_names(bbox='-74.656,40.346,-74.655,40.347'), ['Frist Campus Center'])
+        self.assertEqual(self.get_names(bbox='-74.66,40.34,-74.65,40.35'), ['Frist Campus Center', 'Firestone Library'])
+        self.assertEqual(self.get_names(bbox='-74.7,40.3,-74.6,40.4'), self.get_names())
+        self.assertEqual(self.get_names(bbox='-74.7,40.4,-74.6,40.5'), [])
+
+    def test_offerings_bounds_zoom(self):
+        '''
+        Checks that with a zoom level, the box is widened to the tiles it
+        overlaps.
+        '''
+        x, y = locations_index.get_tile_position(40.346870, -74.655100, 15)
+        south, west, north, east = locations_index.get_tile_bounds(int(x), int(y), 15)
+        expected = self.get_names(bbox='%r,%r,%r,%r' % (west, south, east, north))
+        self.assertIn('Frist Campus Center', expected)
+        self.assertEqual(self.get_names(bbox='-74.6552,40.3468,-74.6550,40.3469', zoom=15), expected)
+
+    def test_offerings_bounds_snap_to_tiles(self):
+        '''
+        Checks that a tile's own edges give back that tile, and that boxes are
+        widened to the tiles they overlap.
+        '''
+        x, y = locations_index.get_tile_position(40.346870, -74.655100, 15)
+        x, y = int(x), int(y)
+        tile = locations_index.get_tile_bounds(x, y, 15)
+        self.assertEqual(locations_index.snap_to_tiles(*(tile + (15,))), tile)
+        south, west, north, east = tile
+        self.assertEqual(locations_index.snap_to_tiles((south + north) / 2, (west + east) / 2,
+            (south + north) / 2, (west + east) / 2, 15), tile)
+        self.assertEqual(locations_index.snap_to_tiles(south, west, north, east + 1e-5, 15),
+            (south, west, north, locations_index.get_tile_bounds(x + 1, y, 15)[3]))
+        self.assertEqual(locations_index.snap_to_tiles(*(tile + (14,))),
+            locations_index.get_tile_bounds(x // 2, y // 2, 14))
+
+    def test_offerings_bounds_conditional_get(self):
+        '''
+        Checks that each box has its own ETag, and that requests with the
+        ETag of the last response for a box get back a 304 without querying
+        the database.
+        '''
+        all_etag = self.get_offerings()['ETag']
+        response = self.get_offerings(bbox='-74.656,40.346,-74.655,40.347')
+        self.assertNotEqual(response['ETag'], all_etag)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('foodmap_app:offerings'),
+                {'bbox': '-74.656,40.346,-74.655,40.347'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_offerings_bounds_invalid(self):
+        '''
+        Checks that invalid boxes and zoom levels get a 400 response.
+        '''
+        for params in [{'bbox': ''}, {'bbox': '1,2,3'}, {'bbox': 'a,b,c,d'}, {'bbox': '-74.6,40.3,-74.7,40.4'},
+            {'bbox': '-74.7,40.4,-74.6,40.3'}, {'bbox': '-74.7,40.3,-74.6,91'},
+            {'bbox': '-74.7,40.3,-74.6,40.4', 'zoom': 'a'}, {'bbox': '-74.7,40.3,-74.6,40.4', 'zoom': 25}]:
+            self.assertEqual(self.get_offerings(**params).status_code, 400)
+
+
+class OfferingClustersViewTests(TestCase):
+    '''
+    Tests for retrieving the offerings on the map grouped into clusters.
+    '''
+
+    def setUp(self):
+        '''
+        Create two locations next to each other, and one further away, each
+        with an offering.
+        '''
+        coordinates.invalidate()
+        offerings_cache.invalidate()
+        clusters.invalidate()
+        now = timezone.now()
+        self.locations = []
+        for i, (name, lat, lng) in enumerate([('Frist Campus Center', 40.346870, -74.655100),
+            ('Whig Hall', 40.347100, -74.655300), ('Princeton University Art Museum', 40.347900, -74.663000)]):
+            location = create_location(name, lat=lat, lng=lng)
+            location.save()
+            create_offering(location=location, image=None, thread_id='k%15d' % i,
+                timestamp=now - datetime.timedelta(minutes=10 + i)).save()
+            self.locations.append(location)
+
+    def get_clusters(self, **params):
+        return json.loads(self.client.get(reverse('foodmap_app:offering_clusters'), params).content)
+
+    def test_offering_clusters(self):
+        '''
+        Checks that locations close together are clustered when zoomed out,
+        and that the rest are sent as by /offerings/.
+        '''
+        response = self.get_clusters(zoom=15)
+        self.assertEqual(len(response['clusters']), 1)
+        cluster = response['clusters'][0]
+        self.assertEqual((cluster['locations'], cluster['offerings']), (2, 2))
+        self.assertAlmostEqual(cluster['lat'], (40.346870 + 40.347100) / 2)
+        self.assertEqual(cluster['bounds'], [40.346870, -74.655300, 40.347100, -74.655100])
+        self.assertEqual([entry['location']['name'] for entry in response['locations']], ['Princeton University Art Museum'])
+        self.assertEqual(response['locations'][0]['offerings'][0]['minutes'], 12)
+
+        response = self.get_clusters(zoom=18)
+        self.assertEqual(response['clusters'], [])
+        self.assertEqual(response['locations'], json.loads(self.client.get(reverse('foodmap_app:offerings')).content))
+
+    def test_offering_clusters_bounds(self):
+        '''
+        Checks that only the clusters and locations inside the box are sent.
+        '''
+        response = self.get_clusters(zoom=15, bbox='-74.656,40.346,-74.655,40.348')
+        self.assertEqual(len(response['clusters']), 1)
+        self.assertEqual(response['locations'], [])
+        response = self.get_clusters(zoom=15, bbox='-74.664,40.347,-74.662,40.348')
+        self.assertEqual((len(response['clusters']), len(response['locations'])), (0, 1))
+
+    def test_offering_clusters_cached(self):
+        '''
+        Checks that clusters are only worked out once for the same offerings
+        at each zoom level, and again when the offerings change.
+        '''
+        self.get_clusters(zoom=15)
+        build_clusters = clusters.build_clusters
+        try:
+            clusters.build_clusters = lambda *args: self.fail('clusters were not cached')
+            self.get_clusters(zoom=15)
+        finally:
+            clusters.build_clusters = build_clusters
+        create_offering(location=self.locations[1], image=None, thread_id='k%15d' % 3).save()
+        self.assertEqual(self.get_clusters(zoom=15)['clusters'][0]['offerings'], 3)
+
+    def test_offering_clusters_invalid(self):
+        '''
+        Checks that invalid zoom levels and boxes get a 400 response.
+        '''
+        for params in [{}, {'zoom': 'a'}, {'zoom': -1}, {'zoom': 25}, {'zoom': 15, 'bbox': '1,2'}]:
+            self.assertEqual(self.client.get(reverse('foodmap_app:offering_clusters'), params).status_code, 400)
+
+    def test_build_clusters(self):
+        '''
+        Checks that locations are grouped by cell, in order, and never past
+        the last zoom level that clusters.
+        '''
+        positions = {'A': (40.3469, -74.6551), 'B': (40.3471, -74.6553), 'C': (40.3479, -74.6630), 'D': (40.3470, -74.6552)}
+        found, singles = clusters.build_clusters(['A', 'C', 'B', 'D'], positions, 15)
+        self.assertEqual([cluster['names'] for cluster in found], [['A', 'B', 'D']])
+        self.assertEqual(singles, ['C'])
+        found, singles = clusters.build_clusters(['A', 'C', 'B', 'D'], positions, clusters.MAX_ZOOM + 1)
+        self.assertEqual((found, singles), ([], ['A', 'C', 'B', 'D']))
+
+
+class OfferingsNearbyViewTests(TestCase):
+    '''
+    Tests for retrieving the offerings near a point.
+    '''
+
+    def setUp(self):
+        '''
+        Create three locations a few hundred meters apart, each with an
+        offering, and one more location without offerings.
+        '''
+        coordinates.invalidate()
+        offerings_cache.invalidate()
+        now = timezone.now()
+        self.locations = []
+        for i, (name, lat, lng) in enumerate([('Frist Campus Center', 40.346870, -74.655100),
+            ('Firestone Library', 40.349500, -74.657500), ('Princeton University Art Museum', 40.347900, -74.663000)]):
+            location = create_location(name, lat=lat, lng=lng)
+            location.save()
+            create_offering(location=location, image=None, thread_id='n%15d' % i,
+                timestamp=now - datetime.timedelta(minutes=10)).save()
+            self.locations.append(location)
+        create_location('Whig Hall', lat=40.347800, lng=-74.656000).save()
+
+    def get_nearby(self, **params):
+        return self.client.get(reverse('foodmap_app:offerings_nearby'), params)
+
+    def test_offerings_nearby_sorted_by_distance(self):
+        '''
+        Checks that offerings within the radius come back closest first, with
+        their distances, and that those further away are left out.
+        '''
+        response = json.loads(self.get_nearby(lat=40.3469, lng=-74.6552, radius=400).content)
+        self.assertEqual([entry['location']['name'] for entry in response], ['Frist Campus Center', 'Firestone Library'])
+        self.assertTrue(0 <= response[0]['distance'] < 20 < response[1]['distance'] <= 400)
+        self.assertEqual(response[0]['offerings'][0]['minutes'], 10)
+
+        response = json.loads(self.get_nearby(lat=40.3469, lng=-74.6552).content) # default radius
+        self.assertEqual([entry['location']['name'] for entry in response], ['Frist Campus Center'])
+
+    def test_offerings_nearby_uses_index(self):
+        '''
+        Checks that the index is only built once, and is rebuilt when a
+        location changes.
+        '''
+        self.get_nearby(lat=40.3469, lng=-74.6552)
+        with self.assertNumQueries(0):
+            self.get_nearby(lat=40.3469, lng=-74.6552, radius=5000)
+
+        self.locations[2].lat = 40.3469
+        self.locations[2].lng = -74.6553
+        self.locations[2].save()
+        response = json.loads(self.get_nearby(lat=40.3469, lng=-74.6552, radius=50).content)
+        self.assertEqual(sorted([entry['location']['name'] for entry in response]), ['Frist Campus Center', 'Princeton University Art Museum'])
+
+    def test_offerings_nearby_invalid_parameters(self):
+        '''
+        Checks that missing or invalid parameters get a 400 response.
+        '''
+        for params in [{}, {'lat': 40.3}, {'lat': 'x', 'lng': -74.6}, {'lat': 91, 'lng': 0},
+            {'lat': 40.3, 'lng': -74.6, 'radius': -1}, {'lat': 40.3, 'lng': -74.6, 'radius': 100000}]:
+            self.assertEqual(self.get_nearby(**params).status_code, 400)
+
+
+class LocationIndexTests(TestCase):
+    '''
+    Tests for the grid over locations used to find nearby ones.
+    '''
+
+    def test_location_index_matches_scan(self):
+        '''
+        Checks that the grid finds the same locations, at the same distances,
+        as looking at every location, for radiuses small and large.
+        '''
+        rng = random.Random(42)
+        locations = [('Location %d' % i, rng.uniform(40.33, 40.36), rng.uniform(-74.68, -74.64)) for i in range(0, 500)]
+        index = locations_index.LocationIndex(locations)
+        for i in range(0, 50):
+            lat, lng = rng.uniform(40.32, 40.37), rng.uniform(-74.69, -74.63)
+            for radius in [0, 50, 300, 2000, 50000]:
+                self.assertEqual(index.nearby(lat, lng, radius), index.scan(lat, lng, radius))
+
+    def test_location_index_distances(self):
+        '''
+        Checks distances against known ones: a thousandth of a degree of
+        latitude is about 111 m, and of longitude about 85 m on campus.
+        '''
+        index = locations_index.LocationIndex([('A', 40.345, -74.655), ('B', 40.346, -74.655), ('C', 40.345, -74.654)])
+        found = dict([(name, distance) for distance, name in index.nearby(40.345, -74.655, 200)])
+        self.assertAlmostEqual(found['A'], 0, places=3)
+        self.assertAlmostEqual(found['B'], 111.2, delta=0.5)
+        self.assertAlmostEqual(found['C'], 84.8, delta=0.5)
+
+    def test_location_index_build(self):
+        '''
+        Checks that the index is built from the Locations table.
+        '''
+        create_location('Frist Campus Center', lat=40.346870, lng=-74.655100).save()
+        index = locations_index.build()
+        self.assertEqual([name for distance, name in index.nearby(40.3469, -74.6551, 10)], ['Frist Campus Center'])
+
+
+class CoordinatesTests(TestCase):
+    '''
+    Tests for the coordinates of locations kept in memory, and the versions
+    of the format of locations.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location with an offering.
+        '''
+        offerings_cache.invalidate()
+        self.location = create_location('Frist Campus Center', lat=40.3468701234, lng=-74.6551004321)
+        self.location.save()
+        self.location = Location.objects.get(id=self.location.id) # with coordinates as Decimals
+        create_offering(location=self.location, image=None, thread_id='c%15d' % 0).save()
+
+    def test_coordinates_serialize(self):
+        '''
+        Checks that locations are formatted with their coordinates as strings
+        by default, and as rounded numbers in version 2, whether or not they
+        are in the table.
+        '''
+        table = coordinates.get_table()
+        self.assertEqual(table.get(self.location.id), (float(self.location.lat), float(self.location.lng)))
+        self.assertEqual(table.serialize(self.location), {'name': 'Frist Campus Center',
+            'lat': str(self.location.lat), 'lng': str(self.location.lng)})
+        self.assertEqual(table.serialize(self.location, version=2), {'name': 'Frist Campus Center',
+            'lat': 40.34687, 'lng': -74.6551})
+
+        empty = coordinates.CoordinateTable([])
+        self.assertIsNone(empty.get(self.location.id))
+        self.assertEqual(empty.serialize(self.location), table.serialize(self.location))
+        self.assertEqual(empty.serialize(self.location, version=2), table.serialize(self.location, version=2))
+
+    def test_coordinates_table_reloaded(self):
+        '''
+        Checks that the table is kept until a Location changes, and that the
+        index of locations is rebuilt from the new one.
+        '''
+        table = coordinates.get_table()
+        index = locations_index.get_index()
+        with self.assertNumQueries(0):
+            self.assertIs(coordinates.get_table(), table)
+            self.assertIs(locations_index.get_index(), index)
+
+        self.location.lat = 40.35
+        self.location.save()
+        self.assertEqual(coordinates.get_table().get(self.location.id)[0], 40.35)
+        self.assertEqual(locations_index.get_index().positions['Frist Campus Center'][0], 40.35)
+
+    def test_coordinates_versions(self):
+        '''
+        Checks that the views send the version of locations asked for, with
+        an ETag for each, and reject unknown versions.
+        '''
+        response = self.client.get(reverse('foodmap_app:offerings'))
+        compact_response = self.client.get(reverse('foodmap_app:offerings'), {'version': 2})
+        self.assertEqual(json.loads(response.content)[0]['location']['lat'], str(self.location.lat))
+        self.assertEqual(json.loads(compact_response.content)[0]['location']['lat'], 40.34687)
+        self.assertNotEqual(response['ETag'], compact_response['ETag'])
+
+        changes = json.loads(self.client.get(reverse('foodmap_app:offering_changes'), {'version': 2}).content)
+        self.assertEqual(changes['updated'][0]['lng'], -74.6551)
+        nearby = json.loads(self.client.get(reverse('foodmap_app:offerings_nearby'),
+            {'lat': 40.3468, 'lng': -74.6551, 'version': 2}).content)
+        self.assertEqual(nearby[0]['location']['lng'], -74.6551)
+
+        for name in ['offerings', 'offering_changes']:
+            for version in ['0', '3', 'a']:
+                self.assertEqual(self.client.get(reverse('foodmap_app:' + name), {'version': version}).status_code, 400)
+
+
+class OfferingChangesViewTests(TestCase):
+    '''
+    Tests for retrieving the changes to the offerings on the map since a
+    cursor.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location with one offering.
+        '''
+        self.location = create_location(name='Frist Campus Center')
+        self.location.save()
+        self.offering = create_offering(location=self.location, image=None,
+            timestamp=timezone.now() - datetime.timedelta(minutes=10))
+        self.offering.save()
+
+    def get_changes(self, cursor=None):
+        '''
+        Requests the changes since 'cursor' and returns the parsed response.
+        '''
+        data = {'since': cursor} if cursor is not None else {}
+        return json.loads(self.client.get(reverse('foodmap_app:offering_changes'), data).content)
+
+    def test_offering_changes_without_cursor(self):
+        '''
+        Checks that a request without a valid cursor gets back every offering
+        on the map.
+        '''
+        for cursor in [None, 'not a cursor']:
+            changes = self.get_changes(cursor)
+            self.assertTrue(changes['reset'])
+            self.assertEqual(changes['removed'], [])
+            self.assertEqual(len(changes['updated']), 1)
+            offering = changes['updated'][0]
+            self.assertEqual(sorted(offering), ['id', 'lat', 'lng']) # the tiles bring the rest
+            self.assertEqual(offering['id'], self.offering.id)
+
+    def test_offering_changes_since_cursor(self):
+        '''
+        Checks that offerings saved, tagged or deleted after a cursor are the
+        only ones in the changes since then.
+        '''
+        cursor = self.get_changes()['cursor']
+        changes = self.get_changes(cursor)
+        self.assertFalse(changes['reset'])
+        self.assertEqual(changes['updated'], [])
+        self.assertEqual(changes['removed'], [])
+
+        new_offering = create_offering(location=self.location, image=None,
+            title='Bagels', thread_id='c%15d' % 1)
+        new_offering.save()
+        changes = self.get_changes(cursor)
+        self.assertEqual([offering['id'] for offering in changes['updated']], [new_offering.id])
+        cursor = changes['cursor']
+
+        tag = create_offering_tag(offering=self.offering, tag='vegan')
+        tag.save()
+        changes = self.get_changes(cursor)
+        self.assertEqual([offering['id'] for offering in changes['updated']], [self.offering.id])
+        cursor = changes['cursor']
+
+        new_offering_id = new_offering.id
+        new_offering.delete()
+        changes = self.get_changes(cursor)
+        self.assertEqual(changes['updated'], [])
+        self.assertEqual(changes['removed'], [new_offering_id])
+
+    def test_offering_changes_with_many_changes(self):
+        '''
+        Checks that the changes since a cursor can be more than the database
+        can list in one query, as after expiring many offerings.
+        '''
+        now = timezone.now()
+        cursor = offerings_changes.get_changes(None, now)['cursor']
+        offerings_changes.record(range(self.offering.id + 1, self.offering.id + 2001) + [self.offering.id])
+        changes = offerings_changes.get_changes(cursor, now)
+        self.assertEqual([offering['id'] for offering in changes['updated']], [self.offering.id])
+        self.assertEqual(len(changes['removed']), 2000)
+
+    def test_offering_changes_over_time(self):
+        '''
+        Checks that offerings whose time comes, or that get too old, after a
+        cursor are in the changes since then, without being written to.
+        '''
+        now = timezone.now()
+        future_offering = create_offering(location=self.location, image=None,
+            timestamp=now + datetime.timedelta(minutes=30), thread_id='c%15d' % 2)
+        future_offering.save()
+        cursor = offerings_changes.get_changes(None, now)['cursor']
+
+        changes = offerings_changes.get_changes(cursor, now + datetime.timedelta(minutes=1))
+        self.assertEqual(changes['updated'], [])
+        self.assertEqual(changes['removed'], [])
+
+        changes = offerings_changes.get_changes(cursor, now + datetime.timedelta(minutes=31))
+        self.assertEqual([offering['id'] for offering in changes['updated']], [future_offering.id])
+        cursor = changes['cursor']
+
+        changes = offerings_changes.get_changes(cursor, now + datetime.timedelta(minutes=111))
+        self.assertEqual(changes['updated'], [])
+        self.assertEqual(changes['removed'], [self.offering.id])
+
+    def test_offering_changes_with_bad_cursor_time(self):
+        '''
+        Checks that a cursor with a time out of range, or in the future, gets
+        back every offering on the map rather than an error.
+        '''
+        now = timezone.now()
+        for cursor in ['1:1000000000000', '1:-100000000000', '1:%d' % (calendar.timegm(now.utctimetuple()) + 3600)]:
+            self.assertTrue(offerings_changes.get_changes(cursor, now)['reset'], cursor)
+        response = self.client.get(reverse('foodmap_app:offering_changes'), {'since': '1:1000000000000'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['reset'])
+
+    def test_offering_changes_committed_late(self):
+        '''
+        Checks that a change whose id was missing from the log when a cursor
+        was handed out, as when its transaction had not committed yet, is in
+        the changes since that cursor once it shows up.
+        '''
+        now = timezone.now()
+        late_offering = create_offering(location=self.location, image=None, title='Bagels',
+            timestamp=now - datetime.timedelta(minutes=5), thread_id='c%15d' % 3)
+        late_offering.save()
+        offerings_changes.record([self.offering.id])
+        late_change_id = OfferingChange.objects.get(offering_id=late_offering.id).id
+        OfferingChange.objects.filter(id=late_change_id).delete() # not committed yet
+
+        cursor = offerings_changes.get_changes(None, now)['cursor']
+        self.assertTrue(cursor.endswith(':%d' % late_change_id))
+        OfferingChange.objects.create(id=late_change_id, offering_id=late_offering.id) # committed
+        changes = offerings_changes.get_changes(cursor, now)
+        self.assertEqual([offering['id'] for offering in changes['updated']], [late_offering.id])
+        self.assertEqual(changes['cursor'].count(':'), 1)
+
+    def test_offering_changes_with_pruned_cursor(self):
+        '''
+        Checks that a cursor older than the change log gets back every
+        offering on the map, and that old changes are pruned.
+        '''
+        now = timezone.now()
+        cursor = offerings_changes.get_changes(None, now)['cursor']
+        later = now + offerings_changes.CHANGE_LOG_RETENTION + datetime.timedelta(minutes=1)
+        self.assertTrue(offerings_changes.get_changes(cursor, later)['reset'])
+
+        self.assertEqual(OfferingChange.objects.count(), 1)
+        offerings_changes.prune(later)
+        self.assertEqual(OfferingChange.objects.count(), 0)
+
+
+class OfferingEventsTests(TestCase):
+    '''
+    Tests for the broker and the stream of Server-Sent Events that announce
+    changes to offerings, using a broker of their own.
+    '''
+
+    def test_offering_events_broker_fans_out(self):
+        '''
+        Checks that every subscriber gets each event published while it is
+        subscribed, and that full queues do not block publishing.
+        '''
+        broker = offerings_events.Broker()
+        first, second = broker.subscribe(), broker.subscribe()
+        broker.publish(offerings_events.SAVE, {'id': 1})
+        broker.unsubscribe(second)
+        broker.publish(offerings_events.DELETE, {'id': 2})
+
+        self.assertEqual([first.get_nowait(), first.get_nowait()],
+            [(offerings_events.SAVE, {'id': 1}), (offerings_events.DELETE, {'id': 2})])
+        self.assertEqual(second.get_nowait(), (offerings_events.SAVE, {'id': 1}))
+        self.assertTrue(second.empty())
+
+        for i in range(0, offerings_events.QUEUE_SIZE + 1):
+            broker.publish(offerings_events.SAVE, {'id': i})
+        self.assertTrue(first.full())
+
+        broker.unsubscribe(first)
+        self.assertFalse(broker.has_subscribers())
+
+    def test_offering_events_stream(self):
+        '''
+        Checks that the stream sends published events, and heartbeats while
+        there are none, and unsubscribes once it is closed.
+        '''
+        broker = offerings_events.Broker()
+        stream = offerings_events.stream(broker, heartbeat=0.01, duration=60)
+        self.assertEqual(next(stream), 'retry: %d\n\n' % offerings_events.RETRY_MILLISECONDS)
+        self.assertTrue(broker.has_subscribers())
+
+        broker.publish(offerings_events.SAVE, {'id': 12})
+        self.assertEqual(next(stream), 'event: save\ndata: {"id": 12}\n\n')
+        self.assertEqual(next(stream), ': keep-alive\n\n')
+
+        stream.close()
+        self.assertFalse(broker.has_subscribers())
+
+    def test_offering_events_stream_ends(self):
+        '''
+        Checks that the stream ends after its duration.
+        '''
+        broker = offerings_events.Broker()
+        chunks = list(offerings_events.stream(broker, heartbeat=0.01, duration=0.05))
+        self.assertTrue(len(chunks) >= 2)
+        self.assertFalse(broker.has_subscribers())
+
+    @override_settings(OFFERINGS_EVENTS_POLL_INTERVAL=0)
+    def test_offering_events_view(self):
+        '''
+        Checks that the view responds with a stream of events.
+        '''
+        response = self.client.get(reverse('foodmap_app:offering_events'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(next(iter(response.streaming_content)).startswith('retry:'))
+        response.close()
+        self.assertFalse(offerings_events.broker.has_subscribers())
+
+    @override_settings(OFFERINGS_EVENTS_ENABLED=False)
+    def test_offering_events_view_turned_off(self):
+        '''
+        Checks that the view tells clients not to reconnect when the stream is
+        turned off.
+        '''
+        response = self.client.get(reverse('foodmap_app:offering_events'))
+        self.assertEqual(response.status_code, 204)
+
+    @override_settings(OFFERINGS_EVENTS_POLL_INTERVAL=0, OFFERINGS_EVENTS_MAX_STREAMS=2)
+    def test_offering_events_view_limits_streams(self):
+        '''
+        Checks that clients are turned away once as many streams as allowed
+        are open, and let in again once one closes, and that a stream closed
+        before it was read from still gives up its place.
+        '''
+        first = self.client.get(reverse('foodmap_app:offering_events'))
+        second = self.client.get(reverse('foodmap_app:offering_events'))
+        self.assertEqual([first.status_code, second.status_code], [200, 200])
+        self.assertEqual(self.client.get(reverse('foodmap_app:offering_events')).status_code, 204)
+
+        first.close()
+        third = self.client.get(reverse('foodmap_app:offering_events'))
+        self.assertEqual(third.status_code, 200)
+        second.close()
+        third.close()
+        self.assertFalse(offerings_events.broker.has_subscribers())
+
+
+class OfferingEventsPublishingTests(TransactionTestCase):
+    '''
+    Tests that saving and deleting offerings publishes events. Uses a
+    TransactionTestCase, since events are only published once the changes
+    are committed.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location, and subscribe to the broker.
+        '''
+        self.location = create_location(name='Frist Campus Center')
+        self.location.save()
+        self.queue = offerings_events.broker.subscribe()
+
+    def tearDown(self):
+        '''
+        Unsubscribe from the broker.
+        '''
+        offerings_events.broker.unsubscribe(self.queue)
+
+    def test_offering_events_published_on_commit(self):
+        '''
+        Checks that saving, tagging and deleting an offering each publish an
+        event once committed.
+        '''
+        with transaction.atomic():
+            offering = create_offering(location=self.location, image=None)
+            offering.save()
+            self.assertTrue(self.queue.empty())
+        self.assertEqual(self.queue.get_nowait(), (offerings_events.SAVE, {'id': offering.id}))
+
+        create_offering_tag(offering=offering, tag='vegan').save()
+        self.assertEqual(self.queue.get_nowait(), (offerings_events.SAVE, {'id': offering.id}))
+
+        offering_id = offering.id
+        offering.delete()
+        events = []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        self.assertEqual(events[-1], (offerings_events.DELETE, {'id': offering_id}))
+
+    def test_offering_events_published_from_change_log(self):
+        '''
+        Checks that changes logged by other processes, such as the NodeJS
+        scraper, are published by the watcher. Polls the log directly rather
+        than on the watcher's thread, which cannot see the in-memory test
+        database.
+        '''
+        watcher = offerings_events.ChangeLogWatcher(offerings_events.broker)
+        offering = create_offering(location=self.location, image=None)
+        offering.save()
+        self.queue.get_nowait() # announced by signals
+
+        # Log changes the way scraper/db.js does, without signals
+        last_id = OfferingChange.objects.order_by('-id').first().id
+        OfferingChange.objects.bulk_create([OfferingChange(offering_id=offering.id),
+            OfferingChange(offering_id=offering.id + 1)])
+        last_id = watcher.poll(last_id)
+        self.assertEqual([self.queue.get_nowait(), self.queue.get_nowait()],
+            [(offerings_events.SAVE, {'id': offering.id}), (offerings_events.DELETE, {'id': offering.id + 1})])
+        self.assertEqual(last_id, OfferingChange.objects.order_by('-id').first().id)
+        self.assertEqual(watcher.poll(last_id), last_id)
+        self.assertTrue(self.queue.empty())
+
+    def test_offering_events_skipped_while_polling(self):
+        '''
+        Checks that an offering announced while the watcher polls has its
+        change skipped in the next poll, and that an announcement whose
+        change was polled already does not hide later changes.
+        '''
+        watcher = offerings_events.ChangeLogWatcher(offerings_events.broker)
+        watcher._thread = threading.current_thread() # as if watching, so announcements are kept
+        first = create_offering(location=self.location, image=None)
+        first.save()
+        second = create_offering(location=self.location, image=None, thread_id='2234567890123456')
+        second.save()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        last_id = OfferingChange.objects.order_by('-id').first().id
+
+        # 'first' is committed and polled before it is announced
+        OfferingChange.objects.create(offering_id=first.id)
+        last_id = watcher.poll(last_id)
+        watcher.skip(first.id)
+        self.assertEqual(self.queue.get_nowait(), (offerings_events.SAVE, {'id': first.id}))
+
+        # 'second' is committed and announced after a poll has read the log
+        def announce_second():
+            OfferingChange.objects.create(offering_id=second.id)
+            watcher.skip(second.id)
+        watcher._lock = InterleavedLock(announce_second)
+        OfferingChange.objects.create(offering_id=first.id)
+        last_id = watcher.poll(last_id)
+        self.assertEqual(self.queue.get_nowait(), (offerings_events.SAVE, {'id': first.id}))
+        self.assertEqual(watcher.poll(last_id), OfferingChange.objects.order_by('-id').first().id)
+        self.assertTrue(self.queue.empty())
+
+
+class InterleavedLock(object):
+    '''
+    A lock that calls 'interleave' the first time it is taken, as if another
+    thread had run just before.
+    '''
+
+    def __init__(self, interleave):
+        self.interleave = interleave
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        interleave, self.interleave = self.interleave, None
+        if interleave is not None:
+            interleave()
+        self.lock.acquire()
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+#-------------------------------------------------------------------------------
+
+### Recurrence, expiry and scheduler tests
+
+class RecurrenceTests(TestCase):
+    '''
+    Tests for expanding recurring offerings into their occurrences, and
+    indexing them.
+    '''
+
+    def local(self, *args):
+        '''
+        Returns the datetime 'args' in the current time zone.
+        '''
+        return timezone.make_aware(datetime.datetime(*args))
+
+    def days_later(self, timestamp, days):
+        '''
+        Returns 'timestamp' moved by 'days' days on the wall clock in the
+        current time zone.
+        '''
+        return timezone.make_aware(timezone.localtime(timestamp).replace(tzinfo=None) + datetime.timedelta(days=days))
+
+    def test_recurrence_monthly_occurrences(self):
+        '''
+        Checks that monthly occurrences fall on the same day of the month
+        where it exists, or the last day of shorter months, across the end
+        of the year.
+        '''
+        self.assertEqual(list(recurrence.occurrences(self.local(2016, 1, 31, 12), recurrence.MONTHLY,
+            self.local(2016, 1, 1), self.local(2016, 3, 1))), [self.local(2016, 1, 31, 12), self.local(2016, 2, 29, 12)])
+        self.assertEqual(list(recurrence.occurrences(self.local(2017, 12, 15, 12), recurrence.MONTHLY,
+            self.local(2018, 1, 1), self.local(2018, 2, 1))), [self.local(2018, 1, 15, 12)])
+        self.assertEqual(list(recurrence.occurrences(self.local(2017, 11, 30, 12), recurrence.MONTHLY,
+            self.local(2019, 2, 1), self.local(2019, 3, 1))), [self.local(2019, 2, 28, 12)])
+
+    def test_recurrence_occurrences_across_daylight_saving_time(self):
+        '''
+        Checks that daily and weekly occurrences keep their time of day, even
+        across a change to daylight saving time.
+        '''
+        self.assertEqual(list(recurrence.occurrences(self.local(2017, 3, 11, 12), recurrence.DAILY,
+            self.local(2017, 3, 12), self.local(2017, 3, 13))), [self.local(2017, 3, 12, 12)])
+        self.assertEqual(list(recurrence.occurrences(self.local(2017, 3, 5, 12), recurrence.WEEKLY,
+            self.local(2017, 3, 6), self.local(2017, 3, 13))), [self.local(2017, 3, 12, 12)])
+
+    def test_recurrence_occurrences(self):
+        '''
+        Checks that occurrences start with the offering's own timestamp, and
+        that those in a window are found however long ago the offering
+        started, without monthly ones drifting after a short month.
+        '''
+        timestamp = self.local(2017, 1, 31, 12)
+        self.assertEqual(list(recurrence.occurrences(timestamp, recurrence.DAILY, self.local(2017, 1, 1),
+            self.local(2017, 2, 2, 12))), [timestamp, self.local(2017, 2, 1, 12), self.local(2017, 2, 2, 12)])
+        self.assertEqual(list(recurrence.occurrences(timestamp, recurrence.WEEKLY, self.local(2017, 6, 1),
+            self.local(2017, 6, 14))), [self.local(2017, 6, 6, 12), self.local(2017, 6, 13, 12)])
+        self.assertEqual(list(recurrence.occurrences(timestamp, recurrence.MONTHLY, self.local(2017, 2, 1),
+            self.local(2017, 4, 1))), [self.local(2017, 2, 28, 12), self.local(2017, 3, 31, 12)])
+        self.assertEqual(next(recurrence.occurrences(timestamp, recurrence.DAILY, self.local(2017, 2, 3, 13))),
+            self.local(2017, 2, 4, 12))
+
+    def test_recurrence_saving_indexes_occurrences(self):
+        '''
+        Saves a recurring offering, and checks that its occurrences up to the
+        horizon are indexed, until its end date, and that they are replaced
+        when it changes to not recurring.
+        '''
+        now = timezone.now()
+        offering = create_offering(image=None, timestamp=self.days_later(now - datetime.timedelta(minutes=10), -3),
+            recur=recurrence.DAILY, recur_end_datetime=now + datetime.timedelta(days=2))
+        offering.save()
+        self.assertEqual(list(offering.offeringoccurrence_set.order_by('timestamp').values_list('timestamp', flat=True)),
+            [self.days_later(offering.timestamp, days) for days in [3, 4, 5]])
+
+        offering.recur = None
+        offering.recur_end_datetime = None
+        offering.save()
+        self.assertEqual(offering.offeringoccurrence_set.count(), 0)
+
+    def test_recurrence_index_left_alone_by_other_saves(self):
+        '''
+        Checks that the index is not touched when an offering is created
+        without recurring, or saved without changing its timestamp or
+        recurrence, and is rebuilt when a loaded offering starts recurring.
+        '''
+        occurrences_table = OfferingOccurrence._meta.db_table
+        now = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            single = create_offering(image=None, timestamp=now)
+            single.save()
+        self.assertFalse([query for query in queries.captured_queries if occurrences_table in query['sql']])
+
+        offering = create_offering(image=None, location=single.location, timestamp=now,
+            thread_id='2234567890123456', recur=recurrence.DAILY)
+        offering.save()
+        for loaded in [offering, Offering.objects.get(id=offering.id)]:
+            loaded.title = 'Renamed'
+            with CaptureQueriesContext(connection) as queries:
+                loaded.save()
+            self.assertFalse([query for query in queries.captured_queries if occurrences_table in query['sql']])
+
+        single = Offering.objects.get(id=single.id)
+        single.recur = recurrence.WEEKLY
+        single.save()
+        self.assertEqual(single.offeringoccurrence_set.first().timestamp, single.timestamp)
+
+    def test_recurrence_extend_index(self):
+        '''
+        Checks that extending the index adds the occurrences of each
+        recurring offering after the ones already indexed, up to the horizon
+        from the given time, and only once.
+        '''
+        now = timezone.now()
+        offering = create_offering(image=None, timestamp=now - datetime.timedelta(minutes=10),
+            recur=recurrence.DAILY)
+        offering.save()
+        indexed = offering.offeringoccurrence_set.count()
+
+        later = now + datetime.timedelta(days=2)
+        expected = list(recurrence.occurrences(offering.timestamp, recurrence.DAILY, now - datetime.timedelta(hours=2),
+            later + recurrence.OCCURRENCE_HORIZON))
+        self.assertEqual(recurrence.extend_index(later), len(expected) - indexed)
+        self.assertEqual(list(offering.offeringoccurrence_set.order_by('timestamp').values_list('timestamp', flat=True)),
+            expected)
+        self.assertEqual(recurrence.extend_index(later), 0)
+
+    def test_recurrence_recurring_offering_on_map(self):
+        '''
+        Adds a recurring offering that started days ago, and checks that it is
+        shown on the map at its current occurrence, and in the changes feed.
+        '''
+        now = timezone.now()
+        offering = create_offering(image=None, timestamp=self.days_later(now - datetime.timedelta(minutes=10), -3),
+            recur=recurrence.DAILY)
+        offering.save()
+
+        response = json.loads(self.client.get(reverse('foodmap_app:offerings')).content)
+        self.assertEqual(len(response), 1)
+        self.assertEqual([entry['minutes'] for entry in response[0]['offerings']], [10])
 
-                # Has correct minutes
-                self.assertAlmostEqual(test_offering['minutes'], actual_offering['minutes'], delta=1)  # should be within a small delta
+        changes = json.loads(self.client.get(reverse('foodmap_app:offering_changes')).content)
+        self.assertEqual([entry['id'] for entry in changes['updated']], [offering.id])
 
-                # Has correct tags
-                self.assertEqual(test_offering['tags'], actual_offering['tags'])
+    def test_recurrence_occurrences_leave_and_join_map_in_changes(self):
+        '''
+        Checks that the changes feed removes a recurring offering once its
+        occurrence is too old, and adds it back when the next one comes.
+        '''
+        now = timezone.now()
+        offering = create_offering(image=None, timestamp=now - datetime.timedelta(minutes=10),
+            recur=recurrence.DAILY)
+        offering.save()
+        cursor = offerings_changes.get_changes(None, now)['cursor']
 
+        later = now + datetime.timedelta(hours=3)
+        changes = offerings_changes.get_changes(cursor, later)
+        self.assertEqual((changes['updated'], changes['removed']), ([], [offering.id]))
 
-    def test_offerings_with_tags(self):
+        next_day = self.days_later(offering.timestamp, 1) + datetime.timedelta(minutes=5)
+        changes = offerings_changes.get_changes(changes['cursor'], next_day)
+        self.assertEqual([entry['id'] for entry in changes['updated']], [offering.id])
+        self.assertEqual(changes['removed'], [])
+
+    @skipIf(connection.vendor != 'sqlite', 'query plans are checked on sqlite')
+    def test_recurrence_occurrences_indexed(self):
         '''
-        Requests the most recent offerings, where the offerings have tags,
-        and checks that the response has all of those tags in a comma-separated
-        list. (Assumes the rest of the response is correct, as this is
-        validated by another test.)
+        Checks that the database looks up occurrences by timestamp with an
+        index, rather than scanning the whole table.
         '''
-        # Add tags to each offering
-        actual_tags = ['kosher', 'gluten-free', 'peanut-free']
-        for offering in [self.offering1A, self.offering1B, self.offering2A, self.offering2B]:
-            for tag in actual_tags:
-                create_offering_tag(offering=offering, tag=tag).save()
+        now = timezone.now()
+        queryset = OfferingOccurrence.objects.filter(timestamp__gte=now - datetime.timedelta(hours=2),
+            timestamp__lte=now).select_related('offering__location')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join([str(row[-1]) for row in cursor.fetchall()])
+        self.assertIn('foodmap_app_offeringoccurrence USING INDEX', plan)
 
-        # Make request
-        response = self.client.get(reverse('foodmap_app:offerings'))
-        try:
-            parsed_response = json.loads(response.content)  # array of JSON objects, as specified in views.py
-        except:
-            self.fail('JSON response could not be parsed')
 
-        # Verify that response has exactly the same tags
-        test_response = parsed_response
-        actual_response = [
-            {
-                'location': {'name': self.locationA.name, 'lat': str(self.locationA.lat), 'lng': str(self.locationA.lng)},
-                'offerings': [
-                    {'title': offering.title, 'description': offering.description, 'minutes': (timezone.now() - offering.timestamp).seconds/60, 'tags': 'kosher,gluten-free,peanut-free'}
-                    for offering in [self.offering1A, self.offering2A]
-                ]
-            },
-            {
-                'location': {'name': self.locationB.name, 'lat': str(self.locationB.lat), 'lng': str(self.locationB.lng)},
-                'offerings': [
-                    {'title': offering.title, 'description': offering.description, 'minutes': (timezone.now() - offering.timestamp).seconds/60, 'tags': 'kosher,gluten-free,peanut-free'}
-                    for offering in [self.offering1B, self.offering2B]
-                ]
-            }
-        ]
+class ExpiryTests(TestCase):
+    '''
+    Tests for deleting old offerings.
+    '''
 
-        # Sort test and actual response by location, and by title within each
-        # location so they can be compared side-by-side
-        for entry in test_response:
-            self.assertIn('location', entry.keys())
-            self.assertIn('name', entry['location'].keys())
+    def test_expiry_expire_offerings(self):
+        '''
+        Checks that expired offerings are deleted along with their tags and
+        images, and recurring ones once their end date has passed, while
+        recurring ones still to come are kept with their tags, and the rest
+        are untouched.
+        '''
+        now = timezone.now()
+        location = create_location('Frist Campus Center')
+        location.save()
 
-            self.assertIn('offerings', entry.keys())
-            for offering in entry['offerings']:
-                self.assertIn('title', offering)
-        test_response = sorted(test_response, cmp=lambda x, y: cmp(x['location']['name'], y['location']['name']))
-        actual_response = sorted(actual_response, cmp=lambda x, y: cmp(x['location']['name'], y['location']['name']))
+        live = create_offering(location=location, image=None, thread_id='l%15d' % 1,
+            timestamp=now - datetime.timedelta(minutes=10))
+        expired = create_offering(location=location, thread_id='e%15d' % 1,
+            timestamp=now - datetime.timedelta(hours=3))
+        recurring = create_offering(location=location, image=None, thread_id='r%15d' % 1,
+            timestamp=now - datetime.timedelta(days=2, hours=3), recur=recurrence.DAILY,
+            recur_end_datetime=now + datetime.timedelta(days=30))
+        ended = create_offering(location=location, image=None, thread_id='r%15d' % 2,
+            timestamp=now - datetime.timedelta(days=2, hours=3), recur=recurrence.WEEKLY,
+            recur_end_datetime=now - datetime.timedelta(days=1))
+        for offering in [live, expired, recurring, ended]:
+            offering.save()
+        for offering in [expired, recurring]:
+            create_offering_tag(offering=offering, tag='vegan').save()
 
-        for i in range(0, len(test_response)):
-            test_response[i]['offerings'] = sorted(test_response[i]['offerings'], cmp=lambda x, y: cmp(x['title'], y['title']))
-            actual_response[i]['offerings'] = sorted(actual_response[i]['offerings'], cmp=lambda x, y: cmp(x['title'], y['title']))
+        changes = OfferingChange.objects.count()
+        self.assertEqual(expiry.expire_offerings(now), 2)
 
-        # Compare tags between test_response and actual_response
-        for i in range(0, len(actual_response)):
-            for j in range(0, len(actual_response[i]['offerings'])):
-                test_offering = test_response[i]['offerings'][j]
-                actual_offering = actual_response[i]['offerings'][j]
+        self.assertEqual(sorted(Offering.objects.values_list('id', flat=True)), sorted([live.id, recurring.id]))
+        self.assertEqual(Offering.objects.get(id=recurring.id).timestamp, recurring.timestamp)
+        self.assertEqual(OfferingTag.objects.get().offering_id, recurring.id)
+        self.assertEqual(set(OfferingOccurrence.objects.values_list('offering_id', flat=True)), set([recurring.id]))
+        self.assertNotIn(TEST_IMAGE, os.listdir(os.path.join(MEDIA_ROOT, 'offerings')))
+        self.assertEqual(OfferingChange.objects.count(), changes + 2)
 
-                test_tags = sorted(test_offering['tags'].split(','))
-                actual_tags = sorted(actual_offering['tags'].split(','))
-                self.assertEqual(test_tags, actual_tags)
+        # Nothing else to expire
+        self.assertEqual(expiry.expire_offerings(now), 0)
 
-    def test_offerings_timestamp_constraints(self):
+    def test_expiry_query_count_does_not_grow(self):
         '''
-        Requests the recent offerings and checks that they meet the time
-        constraint we impose: all offerings are from 2 hours ago to now
+        Checks that expiring many offerings takes as many queries as expiring
+        a few.
         '''
-        # Set timestamps of the offerings to just before, just after 2-hours
-        # mark, and in future
-        offerings_good = [self.offering1A, self.offering1B]
-        offerings_bad  = [self.offering2A, self.offering2B]
-
         now = timezone.now()
-        for offering in offerings_good:
-            offering.timestamp = now - datetime.timedelta(minutes=118) # under 2 hours
-            offering.save()
-        offerings_bad[0].timestamp = now - datetime.timedelta(minutes=121) # over 2 hours
-        offerings_bad[0].save()
-        offerings_bad[1].timestamp = now + datetime.timedelta(days=1) # future
-        offerings_bad[1].save()
+        location = create_location('Frist Campus Center')
+        location.save()
 
-        # Make the request
-        response = self.client.get(reverse('foodmap_app:offerings'))
-        test_response = json.loads(response.content)  # array of JSON objects, as specified in views.py
+        def make_offerings(count):
+            for i in range(0, count):
+                create_offering(location=location, image=None, thread_id='q%15d' % i,
+                    timestamp=now - datetime.timedelta(hours=3), recur=recurrence.DAILY if i % 2 == 0 else None,
+                    recur_end_datetime=now + datetime.timedelta(days=30) if i % 2 == 0 else None).save()
 
-        # Check that no offering is outside time range (approximately)
-        epsilon = 2  # some leeway in the timestamp to account for delay between request and response
-        for entry in test_response:
-            for offering in entry['offerings']:
-                self.assertTrue(offering['minutes'] < 120 + epsilon)
-                self.assertTrue(offering['minutes'] >= 0)
+        make_offerings(2)
+        with CaptureQueriesContext(connection) as few:
+            expiry.expire_offerings(now)
+        Offering.objects.all().delete()
 
-    def test_offerings_with_empty_database(self):
-        '''
-        Requests all of the most recent offerings when there are no offerings
-        to show. Checks that we get back an empty JSON object.
+        make_offerings(20)
+        with self.assertNumQueries(len(few)):
+            expiry.expire_offerings(now)
+
+class SchedulerTests(TestCase):
+    '''
+    Tests for running maintenance jobs at regular intervals.
+    '''
+
+    def setUp(self):
+        self.time = 1000.0
+        self.calls = []
+
+    def clock(self):
+        return self.time
+
+    def make_job(self, name, interval, seconds=0.0, error=None):
+        '''
+        Returns a job that records its calls, and takes 'seconds' on the
+        scheduler's clock, or raises 'error'.
+        '''
+        def function(now):
+            self.calls.append(name)
+            self.time += seconds
+            if error is not None:
+                raise error
+            return 'done'
+        return scheduler.Job(name, function, interval)
+
+    def test_scheduler_runs_jobs_when_due(self):
+        '''
+        Checks that jobs all run at start, then each at its own interval, give
+        or take the jitter.
+        '''
+        fast = self.make_job('fast', 10)
+        slow = self.make_job('slow', 100)
+        runner = scheduler.Scheduler([fast, slow], StringIO(), jitter=0.1, clock=self.clock)
+
+        delay = runner.run_pending()
+        self.assertEqual(self.calls, ['fast', 'slow'])
+        self.assertTrue(9 <= delay <= 11)
+
+        self.time += 12
+        runner.run_pending()
+        self.assertEqual(self.calls, ['fast', 'slow', 'fast'])
+        self.assertTrue(9 <= runner.next_runs['fast'] - self.time <= 11)
+        self.assertTrue(1000 + 90 <= runner.next_runs['slow'] <= 1000 + 110)
+
+    def test_scheduler_records_timings_and_failures(self):
+        '''
+        Checks that each run is timed, and that a failing job is counted and
+        reported without stopping the others.
+        '''
+        out = StringIO()
+        timed = self.make_job('timed', 10, seconds=2.5)
+        failing = self.make_job('failing', 10, error=RuntimeError('boom'))
+        runner = scheduler.Scheduler([failing, timed], out, clock=self.clock)
+
+        runner.run_all()
+        runner.run_all()
+        self.assertEqual(self.calls, ['failing', 'timed', 'failing', 'timed'])
+        self.assertEqual((timed.runs, timed.failures, timed.max_seconds, timed.mean_seconds()), (2, 0, 2.5, 2.5))
+        self.assertEqual((failing.runs, failing.failures), (2, 2))
+        self.assertIn('RuntimeError: boom', out.getvalue())
+        self.assertIn('timed: done in 2.500 s', out.getvalue())
+
+        # Locks are released after each run, failed or not
+        self.assertTrue(scheduler.acquire_lock('failing', 'someone else', timezone.now(), 60))
+
+    def test_scheduler_survives_lock_failures(self):
+        '''
+        Checks that failing to take or give up a job's lock, as when the
+        database drops the connection, is counted and reported without
+        stopping the scheduler or the other jobs.
+        '''
+        def acquire(name, owner, now, timeout):
+            if name == 'unlockable':
+                raise RuntimeError('connection lost')
+            return scheduler.acquire_lock(name, owner, now, timeout)
+
+        def release(name, owner, now):
+            if name == 'unreleasable':
+                raise RuntimeError('connection lost again')
+            scheduler.release_lock(name, owner, now)
+
+        out = StringIO()
+        unlockable = self.make_job('unlockable', 10)
+        unreleasable = self.make_job('unreleasable', 10)
+        other = self.make_job('other', 10)
+        runner = scheduler.Scheduler([unlockable, unreleasable, other], out, clock=self.clock,
+            acquire=acquire, release=release)
+
+        runner.run_pending()
+        self.assertEqual(self.calls, ['unreleasable', 'other'])
+        self.assertEqual((unlockable.runs, unlockable.failures), (0, 1))
+        self.assertEqual((unreleasable.runs, unreleasable.failures), (1, 1))
+        self.assertEqual((other.runs, other.failures), (1, 0))
+        self.assertIn('unlockable: failed to lock, not run', out.getvalue())
+        self.assertIn('RuntimeError: connection lost again', out.getvalue())
+        self.assertTrue(9 <= runner.next_runs['unlockable'] - self.time <= 11)
+
+    def test_scheduler_skips_jobs_running_elsewhere(self):
+        '''
+        Checks that a job is skipped while another scheduler holds its lock,
+        and runs once the lock times out.
         '''
-        # Clear entries from database
-        self.tearDown()
+        now = timezone.now()
+        self.assertTrue(scheduler.acquire_lock('job', 'someone else', now, 60))
+        self.assertFalse(scheduler.acquire_lock('job', 'another', now, 60))
 
-        # Make request
-        response = self.client.get(reverse('foodmap_app:offerings'))
-        try:
-            parsed_response = json.loads(response.content)
-        except:
-            self.fail('JSON response could not be parsed')
+        job = self.make_job('job', 10)
+        scheduler.Scheduler([job], StringIO(), clock=self.clock).run_all()
+        self.assertEqual((self.calls, job.skipped), ([], 1))
 
-        # Verify that response is correct
-        self.assertEqual(parsed_response, [])
+        JobLock.objects.filter(name='job').update(locked_until=now - datetime.timedelta(seconds=1))
+        scheduler.Scheduler([job], StringIO(), clock=self.clock).run_all()
+        self.assertEqual((self.calls, job.runs), (['job'], 1))
 
-        # Restore setup so that when tearDown() is called, we don't get errors
-        self.setUp()
+    def test_scheduler_command_once(self):
+        '''
+        Runs the expiry and recurrence jobs once through the management
+        command, and checks that expired offerings are deleted and recurring
+        ones indexed.
+        '''
+        now = timezone.now()
+        location = create_location('Frist Campus Center')
+        location.save()
+        expired = create_offering(location=location, image=None, thread_id='e%15d' % 1,
+            timestamp=now - datetime.timedelta(hours=3))
+        expired.save()
+        recurring = create_offering(location=location, image=None, thread_id='r%15d' % 1,
+            timestamp=now - datetime.timedelta(hours=3), recur=recurrence.DAILY)
+        recurring.save()
+        OfferingOccurrence.objects.all().delete()
+
+        out = StringIO()
+        call_command('runscheduler', 'expiry', 'recurrence', once=True, stdout=out)
+        self.assertEqual(list(Offering.objects.values_list('id', flat=True)), [recurring.id])
+        self.assertTrue(recurring.offeringoccurrence_set.exists())
+        self.assertIn('expiry: 1 offerings expired', out.getvalue())
+        self.assertIn('recurrence: ', out.getvalue())
 
-#-------------------------------------------------------------------------------
 
 ### Database tests
 
@@ -516,6 +1863,21 @@ class OfferingsTableTests(TestCase):
             self.assertRaises(IntegrityError, offering2.save)
         offering1.delete()
 
+    @skipIf(connection.vendor != 'sqlite', 'query plans are checked on sqlite')
+    def test_offerings_table_timestamp_indexed(self):
+        '''
+        Checks that the database looks up offerings by timestamp with an
+        index, rather than scanning the whole table.
+        '''
+        now = timezone.now()
+        queryset = Offering.objects.filter(timestamp__gte=now - datetime.timedelta(hours=2), timestamp__lte=now) \
+            .order_by('-timestamp')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join([str(row[-1]) for row in cursor.fetchall()])
+        self.assertIn('USING INDEX', plan)
+
 
 class LocationsTableTests(TestCase):
     '''
@@ -641,10 +2003,277 @@ class OfferingTagsTableTests(TestCase):
         self.assertRaises(IntegrityError, offering_tag.save)
 
 
+class OfferingTagBitsTests(TestCase):
+    '''
+    Tests for the tags stored on offerings as bits, and filtering by them.
+    '''
+
+    def setUp(self):
+        '''
+        Create a location with three offerings: one vegan and kosher, one
+        vegan, and one without tags.
+        '''
+        offerings_cache.invalidate()
+        self.location = create_location(name='Frist Campus Center')
+        self.location.save()
+        now = timezone.now()
+        self.offerings = []
+        for i, tags in enumerate([['vegan', 'kosher'], ['vegan'], []]):
+            offering = create_offering(location=self.location, image=None, title='Offering %d' % i,
+                thread_id='t%15d' % i, timestamp=now - datetime.timedelta(minutes=10 + i))
+            offering.save()
+            for tag in tags:
+                create_offering_tag(offering=offering, tag=tag).save()
+            self.offerings.append(offering)
+
+    def get_titles(self, name, **params):
+        response = json.loads(self.client.get(reverse('foodmap_app:' + name), params).content)
+        if name == 'offering_changes':
+            titles = dict(Offering.objects.values_list('id', 'title'))
+            return [titles[offering['id']] for offering in response['updated']]
+        return [offering['title'] for entry in response for offering in entry['offerings']]
+
+    def test_tag_bits_kept_in_sync(self):
+        '''
+        Checks that the bits follow the offering's tags as they are saved and
+        deleted, in the database and on the offering in memory.
+        '''
+        offering = self.offerings[0]
+        self.assertEqual(OfferingTag.get_tags(Offering.objects.get(id=offering.id).tag_bits), ['vegan', 'kosher'])
+        self.assertEqual(offering.tag_bits, OfferingTag.get_bits(['kosher', 'vegan']))
+
+        OfferingTag.objects.get(offering=offering, tag='vegan').delete()
+        self.assertEqual(Offering.objects.get(id=offering.id).tag_bits, OfferingTag.TAG_BITS['kosher'])
+        offering.title = 'Renamed'
+        with CaptureQueriesContext(connection) as queries:
+            offering.save() # loaded before the tag was deleted, but does not put it back
+        self.assertFalse([query for query in queries.captured_queries if OfferingTag._meta.db_table in query['sql']])
+        self.assertEqual(Offering.objects.get(id=offering.id).title, 'Renamed')
+        self.assertEqual(Offering.objects.get(id=offering.id).tag_bits, OfferingTag.TAG_BITS['kosher'])
+
+        offering = Offering.objects.select_related('location').get(id=offering.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(unicode(offering).endswith('Tags: kosher.'))
+
+    def test_tag_bits_updated_in_bulk(self):
+        '''
+        Checks that update_bits() sets the bits of many offerings with one
+        update for each value they take.
+        '''
+        ids = [offering.id for offering in self.offerings]
+        Offering.objects.update(tag_bits=0)
+        with self.assertNumQueries(4): # one select, and an update for each of the three values
+            bits = offering_tags.update_bits(ids)
+        self.assertEqual(bits, dict(zip(ids, [OfferingTag.get_bits(['vegan', 'kosher']), OfferingTag.TAG_BITS['vegan'], 0])))
+        self.assertEqual(dict(Offering.objects.values_list('id', 'tag_bits')), bits)
+
+    def test_tag_bits_not_editable_in_admin(self):
+        '''
+        Checks that the admin page of an offering edits its tags, rather than
+        its tag bits.
+        '''
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('admin:foodmap_app_offering_change', args=[self.offerings[0].id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('name="tag_bits"', response.content)
+        self.assertIn('name="offeringtag_set-TOTAL_FORMS"', response.content)
+
+    def test_tag_bits_clone_and_force_insert(self):
+        '''
+        Checks that an offering can still be cloned, inserted with
+        force_insert, and saved again after its row was deleted, and that the
+        new rows get the bits of their own tags (none).
+        '''
+        offering = Offering.objects.get(id=self.offerings[0].id)
+        offering.pk = None
+        offering.thread_id = None
+        offering.save()
+        self.assertNotEqual(offering.id, self.offerings[0].id)
+        self.assertEqual(Offering.objects.get(id=offering.id).tag_bits, 0)
+
+        forced = Offering.objects.get(id=self.offerings[0].id)
+        forced.pk = None
+        forced.thread_id = None
+        forced.save(force_insert=True)
+        self.assertEqual((Offering.objects.get(id=forced.id).tag_bits, forced.tag_bits), (0, 0))
+
+        Offering.objects.filter(id=forced.id).delete()
+        forced.save()
+        self.assertTrue(Offering.objects.filter(id=forced.id).exists())
+
+    def test_tag_bits_filter_in_database(self):
+        '''
+        Checks that offerings are filtered by tags with one condition on the
+        tag bits, for both single and recurring offerings.
+        '''
+        mask = offering_tags.get_mask(['vegan'])
+        self.assertEqual(len(offering_tags.get_supersets(mask)), 2 ** (len(OfferingTag.TAG_CHOICES) - 1))
+        self.assertEqual(sorted([offering.title for offering in offering_tags.filter_tags(Offering.objects.all(), mask)]),
+            ['Offering 0', 'Offering 1'])
+
+        recurring = create_offering(location=self.location, image=None, title='Recurring', thread_id='t%15d' % 3,
+            timestamp=timezone.now() - datetime.timedelta(days=1, minutes=5), recur='D',
+            recur_end_datetime=timezone.now() + datetime.timedelta(days=7))
+        recurring.save()
+        create_offering_tag(offering=recurring, tag='vegan').save()
+        create_offering_tag(offering=recurring, tag='kosher').save()
+        now = timezone.now()
+        found = recurrence.get_offerings_between(now - Offering.MAX_AGE, now, offering_tags.get_mask(['kosher', 'vegan']))
+        self.assertEqual([offering.title for timestamp, offering in found], ['Recurring', 'Offering 0'])
+
+    def test_tag_bits_views(self):
+        '''
+        Checks that /offerings/ and /offerings/changes/ only send offerings
+        with all of the tags asked for, and reject unknown tags.
+        '''
+        self.assertEqual(self.get_titles('offerings', tags='vegan,kosher'), ['Offering 0'])
+        self.assertEqual(self.get_titles('offerings', tags='vegan'), ['Offering 0', 'Offering 1'])
+        self.assertEqual(self.get_titles('offerings', tags=''), ['Offering 0', 'Offering 1', 'Offering 2'])
+        self.assertEqual(self.get_titles('offering_changes', tags='kosher'), ['Offering 0'])
+        for name in ['offerings', 'offering_changes']:
+            self.assertEqual(self.client.get(reverse('foodmap_app:' + name), {'tags': 'vegan,spicy'}).status_code, 400)
+
+        # An offering that loses a tag leaves the changes filtered by it
+        cursor = json.loads(self.client.get(reverse('foodmap_app:offering_changes'), {'tags': 'kosher'}).content)['cursor']
+        OfferingTag.objects.get(offering=self.offerings[0], tag='kosher').delete()
+        changes = json.loads(self.client.get(reverse('foodmap_app:offering_changes'),
+            {'tags': 'kosher', 'since': cursor}).content)
+        self.assertEqual((changes['updated'], changes['removed']), ([], [self.offerings[0].id]))
+
+    def test_tag_bits_migration(self):
+        '''
+        Checks that the migration adding the bits fills them in from the
+        Offering Tags table.
+        '''
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('foodmap_app.migrations.0013_offering_tag_bits')
+        self.assertEqual(migration.TAGS, [tag for tag, name in OfferingTag.TAG_CHOICES])
+        expected = dict(Offering.objects.values_list('id', 'tag_bits'))
+        Offering.objects.update(tag_bits=0)
+        migration.fill_tag_bits(apps, None)
+        self.assertEqual(dict(Offering.objects.values_list('id', 'tag_bits')), expected)
+
+
 #-------------------------------------------------------------------------------
 
 ### Scraper interface tests
 
+class ScrapeLocationsTests(TestCase):
+    '''
+    Tests for scrape_locations.py, against pages recorded in test_locations/.
+    '''
+    FIXTURES = os.path.join(os.path.dirname(__file__), 'test_locations')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = scrape_locations.Checkpoint(os.path.join(self.directory, 'checkpoint.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scrape_locations_from_fixtures(self):
+        '''
+        Scrapes recorded pages with several workers, and checks the names and
+        coordinates found, and that they are saved to the checkpoint.
+        '''
+        locations, errors = scrape_locations.scrape([0, 1], lambda: scrape_locations.FixtureBackend(self.FIXTURES),
+            self.checkpoint, workers=2, out=StringIO())
+        self.assertEqual(errors, {})
+        self.assertEqual(locations[0], {'index': 0, 'name': 'Nassau Hall', 'lat': '40.348664519455',
+            'lng': '-74.659282697289'})
+        self.assertEqual(locations[1]['name'], 'Frist Campus Center')
+        self.assertEqual(self.checkpoint.load(), locations)
+
+    def test_scrape_locations_resumes_from_checkpoint(self):
+        '''
+        Checks that locations already in the checkpoint are not fetched
+        again, and that a line cut off by an interruption is ignored.
+        '''
+        self.checkpoint.add({'index': 0, 'name': 'Nassau Hall', 'lat': '1', 'lng': '2'})
+        with open(self.checkpoint.path, 'a') as file:
+            file.write('{"index": 1, "na')
+
+        fetched = []
+        class RecordingBackend(scrape_locations.FixtureBackend):
+            def fetch(backend, index):
+                fetched.append(index)
+                return scrape_locations.FixtureBackend.fetch(backend, index)
+
+        out = StringIO()
+        locations, errors = scrape_locations.scrape([0, 1], lambda: RecordingBackend(self.FIXTURES),
+            self.checkpoint, out=out)
+        self.assertEqual(fetched, [1])
+        self.assertIn('Resuming: 1 of 2', out.getvalue())
+        self.assertEqual(sorted(locations.keys()), [0, 1])
+
+    def test_scrape_locations_retries_with_backoff(self):
+        '''
+        Checks that a worker retries a location that fails, waiting longer
+        after each failure in a row and resetting its backend, and gives up
+        after the given number of retries.
+        '''
+        class FlakyBackend(scrape_locations.FixtureBackend):
+            failures = 2
+            resets = 0
+            def fetch(backend, index):
+                if backend.failures > 0:
+                    backend.failures -= 1
+                    raise scrape_locations.ScrapeError('rejected')
+                return scrape_locations.FixtureBackend.fetch(backend, index)
+            def reset(backend):
+                backend.resets += 1
+
+        backend = FlakyBackend(self.FIXTURES)
+        worker = scrape_locations.Worker(backend, None, None, threading.Event(), retries=2, backoff=0.001,
+            max_backoff=0.01)
+        self.assertEqual(worker.scrape(0)['name'], 'Nassau Hall')
+        self.assertEqual((len(worker.waits), backend.resets), (2, 2))
+        self.assertTrue(worker.waits[0] <= 0.001 <= worker.waits[1])
+
+        # Index 2 never has coordinates
+        result = worker.scrape(2)
+        self.assertEqual(result['index'], 2)
+        self.assertIn('View in Google Maps', result['error'])
+        self.assertEqual(len(worker.waits), 4)
+
+    def test_scrape_locations_unexpected_error(self):
+        '''
+        Checks that an error other than ScrapeError from the backend ends in
+        an error result, rather than a worker dying and the run waiting for
+        its result forever.
+        '''
+        class BrokenBackend(scrape_locations.FixtureBackend):
+            def fetch(backend, index):
+                raise RuntimeError('browser crashed')
+
+        locations, errors = scrape_locations.scrape([0, 1], lambda: BrokenBackend(self.FIXTURES),
+            self.checkpoint, workers=2, retries=1, backoff=0.001, max_backoff=0.001, out=StringIO())
+        self.assertEqual(locations, {})
+        self.assertEqual(errors, {0: 'RuntimeError: browser crashed', 1: 'RuntimeError: browser crashed'})
+
+    def test_scrape_locations_stops_when_workers_exit(self):
+        '''
+        Checks that the run stops once every worker has exited, even if some
+        locations have no result.
+        '''
+        class DeadWorker(scrape_locations.Worker):
+            def run(worker):
+                worker.backend.close() # exits without putting a result
+
+        out = StringIO()
+        original = scrape_locations.Worker
+        scrape_locations.Worker = DeadWorker
+        try:
+            locations, errors = scrape_locations.scrape([0, 1], lambda: scrape_locations.FixtureBackend(self.FIXTURES),
+                self.checkpoint, out=out)
+        finally:
+            scrape_locations.Worker = original
+        self.assertEqual((locations, errors), ({}, {}))
+        self.assertIn('Stopped: every worker exited with 2 locations left.', out.getvalue())
+
+
 class ScraperInterfaceTests(TestCase):
     '''
     Tests to make sure the scraper interface module works properly.
@@ -684,6 +2313,533 @@ class ScraperInterfaceTests(TestCase):
         '''
         self.assertEqual(scraper.get_food('We have nothing here.'), '')
 
+    def test_scraper_interface_get_food_batch(self):
+        '''
+        Test that get_food_batch() gets the foods of every text, in order, the
+        same as calling get_food() on each.
+        '''
+        texts = ['Eat bagels here.', 'We have nothing here.', '', 'Come get some pizza and pasta at Frist!']
+        self.assertEqual(list(scraper.get_food_batch(texts)), [scraper.get_food(text) for text in texts])
+        self.assertEqual(list(scraper.get_food_batch(texts)), ['Bagels', '', '', 'Pizza, Pasta'])
+
+
+class FoodExtractorTests(TestCase):
+    '''
+    Tests that the native Python food extractor gives the same results as the
+    NodeJS scraper. The cases mirror scraper/test/getFood.js and
+    scraper/test/listCheck.js.
+    '''
+
+    # (text, foods in any order)
+    GET_FOOD_CASES = [
+        # no match
+        ('', []),
+        ('xyz', []),
+        # one match
+        ('pizza', ['Pizza']),
+        ('lots of sushi', ['Sushi']),
+        # multiple matches
+        ('burrito taco', ['Burrito', 'Taco']),
+        ('taco burrito', ['Burrito', 'Taco']),
+        ('come and get bagel and muffin', ['Bagel', 'Muffin']),
+        # case-insensitive match
+        ('Mehek with milk', ['Mehek', 'Milk']),
+        ('PAPA JOHNS', ['Papa johns']),
+        ('Get excited for TiRaMiSu!', ['Tiramisu']),
+        # punctuation deletion
+        ('Time for P.I.Z.Z.A', ['Pizza']),
+        ('Food from Olive\'s', ['Olives']),
+        # words not substrings
+        ('population', []),
+        ('veggie!', ['Veggie']),
+        ('asdf popcorn\tasdf juice asdf', ['Juice', 'Popcorn']),
+        # plural forms
+        ('donuts', ['Donuts']),
+        ('Doughnuts!', ['Doughnuts']),
+        # comma-separated list of food
+        ('Bobas,fries', ['Bobas', 'Fries']),
+        ('Ziti, qdoba', ['Ziti', 'Qdoba']),
+        ('PANERA , quinoa', ['Panera', 'Quinoa']),
+        # multi-word foods
+        ('ice cream', ['Ice cream']),
+        # no duplicates
+        ('orange, orange, orange', ['Orange']),
+        # list check inside get_food
+        ('muffins and 123 and bagels', ['Muffins', '123', 'Bagels']),
+        ('froyo or something or sundae', ['Froyo', 'Something', 'Sundae']),
+        ('penne, lingueeni, spaghetti', ['Penne', 'Lingueeni', 'Spaghetti']),
+    ]
+
+    # (text, foods in any order)
+    LIST_CHECK_CASES = [
+        ('pizza and soda', ['Pizza', 'Soda']),
+        ('coke or pepsi', ['Coke', 'Pepsi']),
+        ('burrito, nacho', ['Burrito', 'Nacho']),
+        ('bread,butter', ['Bread', 'Butter']),
+        ('rice , beans', ['Rice', 'Beans']),
+        ('panera, olives, and princeton pi or mehek', ['Panera', 'Olives', 'Princeton pi', 'Mehek']),
+        ('veggie and hommos and bread', ['Veggie', 'Hommos', 'Bread']),
+        ('apple or strawbarry or melon', ['Apple', 'Strawbarry', 'Melon']),
+        ('burger, fryes, hotdog', ['Burger', 'Fryes', 'Hotdog']),
+        ('mango, peach, or asdf and fruit', ['Mango', 'Peach', 'Asdf', 'Fruit']),
+        ('melons', ['Melons']),
+        ('sandwich and corn', ['Corn', 'Sandwich']),
+        ('Come and get corn, potato, random stuff', ['Corn', 'Potato']),
+        ('Come and get rice, chicken, veggie at 1938 Hall!', ['Rice', 'Chicken', 'Veggie']),
+        ('We have apples, oranges, and carrots\n Also we got some QDoba, Jules and Mamouns!',
+            ['Apples', 'Oranges', 'Carrots', 'Qdoba', 'Jules', 'Mamouns']),
+    ]
+
+    def setUp(self):
+        self.extractor = extractor.get_food_extractor()
+
+    def test_food_extractor_get_food(self):
+        '''
+        Checks get_food() against the getFood() cases of the NodeJS scraper.
+        '''
+        for text, foods in FoodExtractorTests.GET_FOOD_CASES:
+            self.assertEqual(sorted(self.extractor.get_food(text)), sorted(foods), text)
+
+    def test_food_extractor_list_check(self):
+        '''
+        Checks list_check() against the listCheck() cases of the NodeJS
+        scraper.
+        '''
+        for text, foods in FoodExtractorTests.LIST_CHECK_CASES:
+            self.assertEqual(sorted(self.extractor.list_check(text)), sorted(foods), text)
+
+    def test_food_extractor_loads_dictionary_once(self):
+        '''
+        Checks that the food dictionary is only loaded once per process.
+        '''
+        self.assertIs(extractor.get_food_extractor(), extractor.get_food_extractor())
+
+    @skipIf(find_executable('node') is None, 'NodeJS is not installed')
+    def test_food_extractor_matches_node_scraper(self):
+        '''
+        Runs the same texts through the NodeJS scraper and checks that the
+        foods, and the order they are found in, are exactly the same.
+        '''
+        texts = [text for text, foods in FoodExtractorTests.GET_FOOD_CASES + FoodExtractorTests.LIST_CHECK_CASES]
+        texts.append('Leftover bacon egg and cheese sandwiches, hot chocolate and ice cream cones '
+            'in the Frist 100 level! Also some fro yo, chips & salsa. All gone by 5pm.')
+        for text in texts:
+            node_process = Popen(['node', os.path.join(BASE_DIR, 'scraper/scrapeFood.js')],
+                stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            output, err = node_process.communicate(input=text.encode('utf-8'))
+            self.assertEqual(err, b'')
+            self.assertEqual(scraper.get_food(text), output.decode('utf-8'), text)
+
+
+class LocationExtractorTests(TestCase):
+    '''
+    Tests that the native Python location extractor gives the same results as
+    the NodeJS scraper. The cases mirror scraper/test/getLocation.js.
+    '''
+
+    # (text, official location name)
+    GET_LOCATION_CASES = [
+        # no match
+        ('', ''),
+        ('xyz', ''),
+        # one match
+        ('clapp', '1927 - Clapp Hall'),
+        ('come to dod hall!', 'Dod Hall'),
+        # case-insensitive match
+        ('EQuad has food', 'Enginerring QUAD'),
+        ('FRIST HAS FOOD', 'Frist Campus Center'),
+        ('Pizza at CoLoNiAl ClUb', 'Colonial Club'),
+        # punctuation deletion
+        ('Come to F,r,i,s,t', 'Frist Campus Center'),
+        ('Edward\'s Hall', 'Edwards Hall'),
+        # regex match
+        ('Friend 112', 'Friend Center'),
+        ('Lewis 123', 'Lewis Library'),
+        # biggest substring
+        ('Ticket holders to Friend Center', 'Friend Center'),
+        ('Lewis 123, Bring your spoon!', 'Lewis Library'),
+    ]
+
+    def test_location_extractor_get_location(self):
+        '''
+        Checks get_location() against the getLocation() cases of the NodeJS
+        scraper.
+        '''
+        for text, location in LocationExtractorTests.GET_LOCATION_CASES:
+            self.assertEqual(scraper.get_location(text), location, text)
+
+    def test_location_extractor_longest_match(self):
+        '''
+        Checks that the longest alias or regex that matches wins, and that
+        the first one listed wins between matches of the same length.
+        '''
+        location_extractor = extractor.LocationExtractor(
+            [('hall', 'A'), ('dod hall', 'B'), ('DOD HALL', 'C'), ('od ha', 'D')],
+            [('x [0-9]+', 'E'), ('dod hall [0-9]+', 'F')]
+        )
+        self.assertEqual(location_extractor.get_location('the hall'), 'A')
+        self.assertEqual(location_extractor.get_location('the dod hall'), 'B')
+        self.assertEqual(location_extractor.get_location('the dod hall x 1'), 'B')
+        self.assertEqual(location_extractor.get_location('x 1 in the hall'), 'E')
+        self.assertEqual(location_extractor.get_location('x 1 in dod hall 12'), 'F')
+
+    @skipIf(find_executable('node') is None, 'NodeJS is not installed')
+    def test_location_extractor_matches_node_scraper(self):
+        '''
+        Runs the same texts through the NodeJS scraper and checks that the
+        locations are exactly the same.
+        '''
+        texts = [text for text, location in LocationExtractorTests.GET_LOCATION_CASES]
+        texts.append('Leftover sandwiches in the Frist 100 level, near the Frist MPR. '
+            'Also some cookies in Lewis 138 and Fine Hall!')
+        node_program = 'var scraper = require(%s); process.stdout.write(JSON.stringify(%s.map(scraper.getLocation)));' \
+            % (json.dumps(os.path.join(BASE_DIR, 'scraper/scraper.js')), json.dumps(texts))
+        node_process = Popen(['node', '-e', node_program], stdout=PIPE, stderr=PIPE)
+        output, err = node_process.communicate()
+        self.assertEqual(err, b'')
+        self.assertEqual([scraper.get_location(text) for text in texts], json.loads(output.decode('utf-8')))
+
+
+class IngestTests(TestCase):
+    '''
+    Tests for parsing listserv emails into entries in ingest.py.
+    '''
+
+    MESSAGES_DIR = os.path.join(BASE_DIR, 'scraper', 'test', 'fixtures', 'messages')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_email(self, subject, body, message_id, references=None, image=None):
+        '''
+        Helper method. Returns the bytes of an RFC 822 email from the
+        listserv, with 'body' in a multipart/alternative part nested in a
+        multipart/related one, and an attached image named 'image', if given.
+        '''
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText(body, 'plain'))
+        alternative.attach(MIMEText('<p>%s</p>' % body, 'html'))
+        related = MIMEMultipart('related')
+        related.attach(alternative)
+        message = MIMEMultipart('mixed')
+        message.attach(related)
+        if image is not None:
+            attachment = MIMEImage(open(os.path.join(os.path.dirname(__file__), TEST_IMAGE), 'rb').read(), 'png')
+            attachment.add_header('Content-Disposition', 'attachment', filename=image)
+            attachment.add_header('Content-ID', '<image1>')
+            message.attach(attachment)
+        message['Subject'] = subject
+        message['Sender'] = ingest.LISTSERV_SENDER
+        message['Date'] = 'Sat, 1 Apr 2017 11:00:00 -0400'
+        message['Message-ID'] = message_id
+        if references is not None:
+            message['References'] = references
+        return message.as_string()
+
+    def test_parse_message_matches_node_pipeline(self):
+        '''
+        Checks that the recorded messages parse into the same entries as
+        parseMessage() in scraper/pipeline.js makes of them.
+        '''
+        entries = dict((message['id'], ingest.parse_message(message))
+            for message in ingest.read_messages(IngestTests.MESSAGES_DIR))
+        self.assertEqual(len(entries), 6)
+
+        entry = entries['15b1a0c2d3e4f501']
+        self.assertEqual(entry['thread_id'], '15b1a0c2d3e4f501')
+        self.assertEqual(entry['location'], 'Frist Campus Center')
+        self.assertEqual(entry['food'], 'Leftover, Pizza, Soda')
+        self.assertEqual(entry['timestamp'], '2017-04-01 15:00:00')
+        self.assertEqual(entry['request_type'], extractor.INSERT)
+        self.assertTrue(entry['body'].startswith('Leftover pizza at Frist\nLeftover pizza and soda'))
+
+        # The footer of the listserv is deleted
+        self.assertEqual(entries['15b1a0c2d3e4f502']['body'],
+            'Bagels outside McCosh Hall\nThere are bagels and cream cheese outside McCosh Hall 10. Help yourselves!\r\n')
+
+        entry = entries['15b1a0c2d3e4f503']
+        self.assertEqual(entry['thread_id'], '15b1a0c2d3e4f501')
+        self.assertEqual(entry['request_type'], extractor.DELETE)
+
+        # Not from the listserv, and no location
+        self.assertIsNone(entries['15b1a0c2d3e4f504'])
+        self.assertIsNone(entries['15b1a0c2d3e4f505'])
+
+    def test_prepared_text_gives_same_results(self):
+        '''
+        Checks that extracting from a PreparedText gives the same results as
+        extracting from the text itself.
+        '''
+        food_extractor = extractor.get_food_extractor()
+        location_extractor = extractor.get_location_extractor()
+        texts = [text for text, foods in FoodExtractorTests.GET_FOOD_CASES + FoodExtractorTests.LIST_CHECK_CASES]
+        texts += [text for text, location in LocationExtractorTests.GET_LOCATION_CASES]
+        texts.append('Re: Pizza at Frist: all gone!')
+        for text in texts:
+            prepared = extractor.PreparedText(text)
+            self.assertEqual(food_extractor.get_food(prepared), food_extractor.get_food(text), text)
+            self.assertEqual(location_extractor.get_location(prepared), location_extractor.get_location(text), text)
+        self.assertEqual(extractor.get_request_type(extractor.PreparedText('ALL GONE!')), extractor.DELETE)
+        self.assertEqual(extractor.get_request_type('All there'), extractor.INSERT)
+
+    def test_parse_rfc822_nested_parts(self):
+        '''
+        Checks that the text body and the first image are found however deep
+        they are nested, and that a reply gets the thread id of the email it
+        replies to.
+        '''
+        raw = self.create_email('Pizza at Frist', 'Come get some pizza!', '<1@princeton.edu>', image='pizza.png')
+        entry = ingest.parse_message(raw)
+        self.assertEqual(entry['body'], 'Pizza at Frist\nCome get some pizza!')
+        self.assertEqual(entry['food'], 'Pizza')
+        self.assertEqual(entry['location'], 'Frist Campus Center')
+        self.assertEqual(entry['image'], {'name': 'pizza.png', 'id': 'image1'})
+        self.assertEqual(entry['timestamp'], '2017-04-01 15:00:00')
+        self.assertEqual(len(entry['thread_id']), Offering._meta.get_field('thread_id').max_length)
+
+        reply = ingest.parse_message(self.create_email('Re: Pizza at Frist', 'All gone!', '<2@princeton.edu>',
+            references='<1@princeton.edu>'))
+        self.assertIsNone(reply['image'])
+        self.assertEqual(reply['request_type'], extractor.DELETE)
+        self.assertEqual(reply['thread_id'], entry['thread_id'])
+
+    def test_read_messages_jsonl(self):
+        '''
+        Checks that a JSONL file of Gmail API messages is read one message per
+        line, with format=raw messages parsed as RFC 822 emails.
+        '''
+        full = json.load(open(os.path.join(IngestTests.MESSAGES_DIR, '15b1a0c2d3e4f502.json')))
+        raw = {'id': 'a', 'threadId': 'b', 'internalDate': '1491058800000',
+            'raw': base64.urlsafe_b64encode(self.create_email('Pizza at Frist', 'Pizza!', '<1@princeton.edu>')).rstrip('=')}
+        path = os.path.join(self.directory, 'messages.jsonl')
+        with open(path, 'w') as file:
+            file.write(json.dumps(full) + '\n\n' + json.dumps(raw) + '\n')
+
+        entries = [ingest.parse_message(message) for message in ingest.read_messages(path)]
+        self.assertEqual([entry['location'] for entry in entries], ['McCosh Hall', 'Frist Campus Center'])
+        self.assertEqual((entries[1]['message_id'], entries[1]['thread_id']), ('a', 'b'))
+        self.assertEqual(entries[1]['timestamp'], '2017-04-01 15:00:00')
+
+    def create_entry(self, thread_id, location='Frist Campus Center', request_type=extractor.INSERT):
+        '''
+        Helper method. Returns an entry as ingest.make_entry() makes them.
+        '''
+        return {'message_id': thread_id, 'thread_id': thread_id, 'timestamp': '2017-04-01 15:00:00',
+            'title': 'Pizza at Frist', 'body': 'Pizza at Frist\nPizza!', 'image': {'name': 'pizza.png', 'id': 'a'},
+            'food': 'Pizza', 'location': location, 'request_type': request_type}
+
+    def test_write_inserts(self):
+        '''
+        Checks that write() inserts an offering per thread at a known
+        location, and records each in the change log.
+        '''
+        create_location('Frist Campus Center').save()
+        create_offering(image=None, thread_id='000000000000000a').save()
+        changes = OfferingChange.objects.count()
+
+        entries = [self.create_entry('000000000000000a'), self.create_entry('000000000000000b'),
+            self.create_entry('000000000000000b'), self.create_entry('000000000000000c', location='Nowhere')]
+        self.assertEqual(ingest.write(entries), (1, 0))
+
+        offering = Offering.objects.get(thread_id='000000000000000b')
+        self.assertEqual(offering.location.name, 'Frist Campus Center')
+        self.assertEqual((offering.title, offering.description, offering.image.name),
+            ('Pizza', 'Pizza at Frist\nPizza!', 'pizza.png'))
+        self.assertEqual(offering.timestamp, datetime.datetime(2017, 4, 1, 15, 0, tzinfo=timezone.utc))
+        self.assertEqual(list(OfferingChange.objects.filter(id__gt=changes).values_list('offering_id', flat=True)),
+            [offering.id])
+        self.assertFalse(Offering.objects.filter(thread_id='000000000000000c').exists())
+
+    def test_write_deletes(self):
+        '''
+        Checks that write() deletes the offerings of threads that are all
+        gone, and does not insert those deleted in the same sweep.
+        '''
+        create_location('Frist Campus Center').save()
+        offering = create_offering(image=None, thread_id='000000000000000a')
+        offering.save()
+        changes = OfferingChange.objects.count()
+
+        entries = [self.create_entry('000000000000000a', request_type=extractor.DELETE),
+            self.create_entry('000000000000000b'), self.create_entry('000000000000000b', request_type=extractor.DELETE)]
+        self.assertEqual(ingest.write(entries), (0, 1))
+        self.assertEqual(Offering.objects.count(), 0)
+        self.assertEqual(list(OfferingChange.objects.filter(id__gt=changes).values_list('offering_id', flat=True)),
+            [offering.id])
+
+    def test_parseemails_command(self):
+        '''
+        Checks that the command prints one line of JSON per entry.
+        '''
+        with open(os.path.join(self.directory, 'pizza.eml'), 'w') as file:
+            file.write(self.create_email('Pizza at Frist', 'Pizza!', '<1@princeton.edu>'))
+        shutil.copy(os.path.join(IngestTests.MESSAGES_DIR, '15b1a0c2d3e4f502.json'), self.directory)
+        out = StringIO()
+        call_command('parseemails', self.directory, stdout=out, stderr=StringIO())
+        entries = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([entry['location'] for entry in entries], ['McCosh Hall', 'Frist Campus Center'])
+
+        with self.assertRaises(CommandError):
+            call_command('parseemails', os.path.join(self.directory, 'missing'), stderr=StringIO())
+
+
+class SuggestLocationViewTests(TestCase):
+    '''
+    Tests for suggesting a location from an offering's description.
+    '''
+
+    def test_suggest_location_with_known_location(self):
+        '''
+        Checks that a description mentioning a location in the Locations table
+        gets back that location.
+        '''
+        location = create_location(name='Frist Campus Center')
+        location.save()
+        response = self.client.post(reverse('foodmap_app:suggest_location'),
+            {'description': 'Pizza in the Frist MPR!'})
+        self.assertEqual(json.loads(response.content), {'id': location.id, 'name': location.name})
+
+    def test_suggest_location_with_no_location(self):
+        '''
+        Checks that a description without a known location gets back an empty
+        JSON object.
+        '''
+        create_location(name='Frist Campus Center').save()
+        for description in ['We have pizza!', 'Pizza at Dod Hall!', '']:
+            response = self.client.post(reverse('foodmap_app:suggest_location'),
+                {'description': description})
+            self.assertEqual(json.loads(response.content), {})
+
+    def test_suggest_location_with_long_description(self):
+        '''
+        Checks that a description too long for a URL, sent as the form sends
+        it, gets back its location, and that GET requests are refused.
+        '''
+        location = create_location(name='Frist Campus Center')
+        location.save()
+        description = 'Leftover pizza! ' * 600 + 'Come to the Frist MPR.'
+        client = Client(enforce_csrf_checks=True)
+        client.get(reverse('foodmap_app:submit_offering'))
+        response = client.post(reverse('foodmap_app:suggest_location'),
+            {'description': description, 'csrfmiddlewaretoken': client.cookies['csrftoken'].value})
+        self.assertEqual(json.loads(response.content), {'id': location.id, 'name': location.name})
+
+        response = self.client.get(reverse('foodmap_app:suggest_location'), {'description': 'Frist'})
+        self.assertEqual(response.status_code, 405)
+
+#-------------------------------------------------------------------------------
+
+### Management command tests
+
+class RetitleOfferingsCommandTests(TestCase):
+    '''
+    Tests for the command that re-scrapes offering descriptions for titles.
+    '''
+
+    def test_retitle_offerings_updates_titles_in_chunks(self):
+        '''
+        Creates offerings with stale titles and checks that every title is
+        updated from its description, except those with no foods.
+        '''
+        location = create_location('Frist Campus Center')
+        location.save()
+        descriptions = ['Eat bagels here.', 'Come get some pizza and pasta at Frist!', 'We have nothing here.']
+        offerings = []
+        for i in range(0, 7):
+            offering = create_offering(location=location, title='Old title', image=None,
+                description=descriptions[i % len(descriptions)], thread_id='r%15d' % i)
+            offering.save()
+            offerings.append(offering)
+
+        changes = OfferingChange.objects.count()
+        out = StringIO()
+        call_command('retitleofferings', chunk_size=3, stdout=out)
+        self.assertIn('Re-titled 5 of 7 offerings', out.getvalue())
+        self.assertEqual(OfferingChange.objects.count(), changes + 5) # re-titled offerings are logged
+
+        expected_titles = ['Bagels', 'Pizza, Pasta', 'Old title']
+        for i in range(0, len(offerings)):
+            self.assertEqual(Offering.objects.get(pk=offerings[i].pk).title, expected_titles[i % len(descriptions)])
+
+        # Running again changes nothing
+        out = StringIO()
+        call_command('retitleofferings', stdout=out)
+        self.assertIn('Re-titled 0 of 7 offerings', out.getvalue())
+
+    def test_retitle_offerings_dry_run(self):
+        '''
+        Checks that a dry run reports changes without saving them.
+        '''
+        offering = create_offering(title='Old title', image=None)
+        offering.save()
+        out = StringIO()
+        call_command('retitleofferings', dry_run=True, stdout=out)
+        self.assertIn('Would re-title 1 of 1 offerings', out.getvalue())
+        self.assertEqual(Offering.objects.get(pk=offering.pk).title, 'Old title')
+
+class LoadLocationsCommandTests(TestCase):
+    '''
+    Tests for the command that loads locations from a JSON file.
+    '''
+
+    def load(self, locations, **options):
+        '''
+        Writes 'locations' to a JSON file and loads it. Returns the output.
+        '''
+        with tempfile.NamedTemporaryFile(suffix='.json') as file:
+            file.write(json.dumps(locations))
+            file.flush()
+            out = StringIO()
+            call_command('loadlocations', file.name, stdout=out, **options)
+        return out.getvalue()
+
+    def test_load_locations_inserts_updates_and_skips_duplicates(self):
+        '''
+        Loads locations, then loads them again with one moved and one added,
+        and checks the counts reported and the coordinates stored.
+        '''
+        locations = [
+            {'name': 'Frist Campus Center', 'lat': '40.346870000000', 'lng': '-74.655100000000'},
+            {'name': 'Nassau Hall', 'lat': '40.348664519455', 'lng': '-74.659282697289'},
+            {'name': 'Frist Campus Center', 'lat': '1.0', 'lng': '1.0'}, # duplicate, skipped
+        ]
+        self.assertIn('2 inserted, 0 updated, 0 unchanged (1 duplicate names skipped)', self.load(locations))
+
+        locations[1]['lat'] = '40.3487'
+        locations.append({'name': 'Firestone Library', 'lat': '40.34950', 'lng': '-74.65750'})
+        self.assertIn('1 inserted, 1 updated, 1 unchanged', self.load(locations, batch_size=2))
+
+        self.assertEqual(Location.objects.count(), 3)
+        frist = Location.objects.get(name='Frist Campus Center')
+        self.assertEqual((str(frist.lat), str(frist.lng)), ('40.346870000000', '-74.655100000000'))
+        self.assertEqual(str(Location.objects.get(name='Nassau Hall').lat), '40.348700000000')
+
+    def test_load_locations_project_file_is_idempotent(self):
+        '''
+        Loads the project's locations.json twice, and checks that the second
+        time changes nothing.
+        '''
+        call_command('loadlocations', stdout=StringIO())
+        count = Location.objects.count()
+        out = StringIO()
+        call_command('loadlocations', stdout=out)
+        self.assertIn('0 inserted, 0 updated, %d unchanged' % count, out.getvalue())
+        self.assertEqual(Location.objects.count(), count)
+
+    def test_load_locations_invalid_file(self):
+        '''
+        Checks that a malformed file is reported, and nothing is loaded from
+        it.
+        '''
+        with tempfile.NamedTemporaryFile(suffix='.json') as file:
+            file.write('[{"name": "Nassau Hall", "lat": "40.3", "lng": "-74.6"}, {"name": ')
+            file.flush()
+            self.assertRaises(CommandError, call_command, 'loadlocations', file.name, stdout=StringIO())
+        self.assertEqual(Location.objects.count(), 0)
+
 #-------------------------------------------------------------------------------
 
 ### Form tests
@@ -6,6 +6,11 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^submit-offering/$', views.submit_offering, name='submit_offering'),
     url(r'^submitted/$', views.submitted, name='submitted'),
+    url(r'^suggest-location/$', views.suggest_location, name='suggest_location'),
     url(r'^offerings/$', views.offerings, name='offerings'),
+    url(r'^offerings/clusters/$', views.offering_clusters, name='offering_clusters'),
+    url(r'^offerings/nearby/$', views.offerings_nearby, name='offerings_nearby'),
+    url(r'^offerings/changes/$', views.offering_changes, name='offering_changes'),
+    url(r'^offerings/events/$', views.offering_events, name='offering_events'),
     url(r'^test/$', views.test, name='test')
 ]
@@ -1,19 +1,26 @@
-import datetime
+import calendar
 import json
-from collections import defaultdict
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
-from django.utils import timezone
 from django.urls import reverse
-from foodmap_app import scraper
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_POST
+from foodmap_app import clusters, coordinates, locations_index, offering_tags, offerings_cache, offerings_changes, offerings_events, scraper
 from foodmap_app.forms import OfferingForm
-from foodmap_app.models import Location, Offering, OfferingTag
+from foodmap_app.models import Location, Offering
 
 # Create your views here.
 
 # Name of HTTP header that indicates whether a user has submitted a form
 HEADER_SUBMITTED = 'submitted'
 
+# Radius searched by /offerings/nearby/ if none is given, and the largest one
+# allowed, in meters
+DEFAULT_NEARBY_RADIUS = 300
+MAX_NEARBY_RADIUS = 5000
+
 def index(request):
     '''
     Displays the map view.
@@ -65,6 +72,23 @@ def submitted(request):
         raise Http404('Error: cannot find the page requested') # TODO: Make an HTML page for this?
 
 
+@require_POST
+def suggest_location(request):
+    '''
+    Responds with the location mentioned in the 'description' POST parameter,
+    so the form for submitting offerings can fill it in. Formatted in JSON:
+    {"id": 12, "name": "Frist Campus Center"}
+    or {} if the description does not mention a known location. Descriptions
+    can be too long for a GET parameter, so other methods get back 405 Method
+    Not Allowed.
+    '''
+    name = scraper.get_location(request.POST.get('description', ''))
+    location = Location.objects.filter(name=name).first() if name != '' else None
+    if location is None:
+        return HttpResponse(json.dumps({}))
+    return HttpResponse(json.dumps({'id': location.id, 'name': location.name}))
+
+
 def offerings(request):
     '''
     Responds with all of the most recent offerings (under 2 hours old) at every
@@ -79,44 +103,281 @@ def offerings(request):
         },
         ...
     ]
+
+    Supports conditional requests: the response has an ETag and Last-Modified
+    that stay the same while the same offerings are on the map, and requests
+    with a matching If-None-Match or If-Modified-Since header get back an
+    empty 304 Not Modified response. Minutes are not part of the ETag, so
+    clients should age the offerings they already have themselves.
+
+    With a 'bbox' GET parameter, "west,south,east,north" in degrees (as
+    Leaflet's LatLngBounds.toBBoxString() formats it), only responds with the
+    locations inside that box. With a 'zoom' GET parameter as well, the box is
+    widened to the web map tiles at that zoom level that it overlaps, so that
+    clients can ask for (and cache) the offerings of one tile at a time.
+
+    With a 'version' GET parameter of 2, locations have their coordinates as
+    numbers, rounded to about 10 cm, rather than as strings (see
+    coordinates.py). The other views with locations take it too.
+
+    With a 'tags' GET parameter, comma-separated tags (e.g. "vegan,kosher"),
+    only responds with the offerings that have all of them.
+
+    Responds with 400 Bad Request if the box, zoom level, version or tags are
+    invalid.
     '''
-    # Pull all offerings under 2 hours old
+    bounds = None
+    try:
+        version = get_version(request)
+        tag_mask = offering_tags.parse_tags(request.GET.get('tags', ''))
+        if 'bbox' in request.GET:
+            bounds = get_bounds(request.GET['bbox'], request.GET.get('zoom'))
+    except ValueError as e:
+        return HttpResponseBadRequest('Error: %s' % e)
+
+    # Offerings come from a cached snapshot, so most polls do not touch the
+    # database. See offerings_cache.py. Locations inside the box come from an
+    # index in memory, see locations_index.py.
     now = timezone.now()
-    min_timestamp = now - datetime.timedelta(hours=2)
-    offerings = Offering.objects.filter(timestamp__gte=min_timestamp, timestamp__lte=now).order_by('-timestamp')
-    if len(offerings) == 0:
-        return HttpResponse(json.dumps([]))
-
-    # Accumulate list of offerings by location
-    offerings_by_location = defaultdict(lambda: []) # maps locations to a list of offerings there
-    for offering in offerings:
-        # Get this offering's tags, format into comma-separated list
-        tags = OfferingTag.objects.filter(offering=offering)
-        tags_str = ','.join([str(tag) for tag in tags])
-
-        offerings_by_location[offering.location].append({
-            'title': offering.title,
-            'description': offering.description,
-            'minutes': int((now - offering.timestamp).seconds / 60),
-            'tags': tags_str
-        })
-
-    # Attach other location information to each entry in the dict
-    response = []  # will contain final response as Python data type
-    for location, offerings in offerings_by_location.iteritems():
-        response.append({
-            'location': {
-                'name': location.name,
-                'lat': str(location.lat),
-                'lng': str(location.lng)
+    snapshot = offerings_cache.filter_tags(offerings_cache.get_snapshot(now), tag_mask)
+    if bounds is not None:
+        names = locations_index.get_index().within_bounds(*bounds)
+        snapshot = [entry for entry in snapshot if entry['location']['name'] in names]
+
+    return get_offerings_response(request, offerings_cache.get_etag(snapshot, now), version, now,
+        lambda: offerings_cache.render(snapshot, now, version))
+
+
+def get_version(request):
+    '''
+    Returns the version of the format of locations that 'request' asks for
+    (see coordinates.py), or raises ValueError if it is invalid.
+    '''
+    try:
+        version = int(request.GET.get('version', coordinates.DEFAULT_VERSION))
+    except ValueError:
+        version = None
+    if version not in coordinates.VERSIONS:
+        raise ValueError('\'version\' must be one of %s' % ', '.join([str(v) for v in coordinates.VERSIONS]))
+    return version
+
+
+def get_offerings_response(request, etag, version, now, get_content):
+    '''
+    Returns a response to 'request' for offerings with entity tag 'etag',
+    formatted in 'version', with 'get_content()' formatted in JSON, or an
+    empty 304 Not Modified response if the client already has them (see
+    offerings()).
+    '''
+    # Each version of the same offerings is a different response
+    if version != coordinates.DEFAULT_VERSION:
+        etag = '%s-v%d' % (etag, version)
+
+    # If the client already has these offerings, tell it so instead of
+    # sending them again
+    last_modified = calendar.timegm(offerings_cache.get_last_modified(now).utctimetuple())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(json.dumps(get_content()))
+
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'no-cache' # always revalidate, since minutes change
+    return response
+
+
+def get_bounds(bbox, zoom=None):
+    '''
+    Parses 'bbox', the 'bbox' GET parameter of the /offerings/ view, and
+    widens it to whole tiles if 'zoom' is given. Returns the edges of the box
+    as (south, west, north, east), or raises ValueError if either is invalid.
+    '''
+    try:
+        west, south, east, north = [float(edge) for edge in bbox.split(',')]
+    except ValueError:
+        raise ValueError('\'bbox\' must be four numbers: west,south,east,north')
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError('\'bbox\' is out of range, or its edges are in the wrong order')
+    if zoom is None:
+        return (south, west, north, east)
+
+    try:
+        zoom = int(zoom)
+    except ValueError:
+        raise ValueError('\'zoom\' must be a whole number')
+    if not 0 <= zoom <= locations_index.MAX_TILE_ZOOM:
+        raise ValueError('\'zoom\' must be from 0 to %d' % locations_index.MAX_TILE_ZOOM)
+    return locations_index.snap_to_tiles(south, west, north, east, zoom)
+
+
+def offering_clusters(request):
+    '''
+    Responds with the offerings on the map, with the locations that would be
+    drawn on top of each other at the zoom level in the 'zoom' GET parameter
+    grouped into clusters, formatted in JSON:
+    {
+        "clusters": [
+            {"lat": 12.345, "lng": 12.345, "bounds": [south, west, north, east], "locations": 3, "offerings": 5},
+            ...
+        ],
+        "locations": [
+            {
+                "location": {"name": "Frist Campus Center", "lat": "12.3456789", "lng": "12.3456789"},
+                "offerings": [...]
             },
-            'offerings': offerings
-        })
+            ...
+        ]
+    }
+    with the locations left on their own formatted as by /offerings/, and
+    each cluster at the middle of its locations, with the box around them to
+    zoom in to. See clusters.py.
 
-    # Json-ify and return
+    With a 'bbox' GET parameter, as for /offerings/ (but never widened), only
+    responds with the clusters and locations inside that box. Supports
+    conditional requests, and the 'version' GET parameter, like /offerings/.
+    Responds with 400 Bad Request if the zoom level, box or version is
+    invalid.
+    '''
+    try:
+        zoom = int(request.GET['zoom'])
+        if not 0 <= zoom <= locations_index.MAX_TILE_ZOOM:
+            raise ValueError
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('Error: \'zoom\' must be given, from 0 to %d' % locations_index.MAX_TILE_ZOOM)
+    try:
+        version = get_version(request)
+        bounds = get_bounds(request.GET['bbox']) if 'bbox' in request.GET else None
+    except ValueError as e:
+        return HttpResponseBadRequest('Error: %s' % e)
+
+    # Clusters are worked out once for each zoom level and set of offerings
+    now = timezone.now()
+    snapshot = offerings_cache.get_snapshot(now)
+    all_clusters, singles = clusters.get_clusters(snapshot, offerings_cache.get_etag(snapshot, now), zoom, now)
+    if bounds is not None:
+        names = locations_index.get_index().within_bounds(*bounds)
+        all_clusters = [cluster for cluster in all_clusters if any([name in names for name in cluster['names']])]
+        singles = [name for name in singles if name in names]
+        shown = set(singles).union(*[cluster['names'] for cluster in all_clusters])
+        snapshot = [entry for entry in snapshot if entry['location']['name'] in shown]
+
+    def get_content():
+        entries = dict([(entry['location']['name'], entry) for entry in offerings_cache.render(snapshot, now, version)])
+        return {
+            'clusters': [{'lat': cluster['lat'], 'lng': cluster['lng'], 'bounds': cluster['bounds'],
+                'locations': len(cluster['names']),
+                'offerings': sum([len(entries[name]['offerings']) for name in cluster['names']])}
+                for cluster in all_clusters],
+            'locations': [entries[name] for name in singles]
+        }
+
+    # The same offerings look different at each zoom level
+    etag = '%s-%d' % (offerings_cache.get_etag(snapshot, now), zoom)
+    return get_offerings_response(request, etag, version, now, get_content)
+
+
+def offerings_nearby(request):
+    '''
+    Responds with the offerings on the map at locations within 'radius'
+    meters (GET parameter, 300 by default) of the point at the 'lat' and 'lng'
+    GET parameters, closest first, formatted in JSON like /offerings/, with
+    each location's distance in meters:
+    [
+        {
+            "location": {"name": "Frist Campus Center", "lat": "12.3456789", "lng": "12.3456789"},
+            "distance": 120,
+            "offerings": [
+                {"title": "Pizza!", "description": "Come eat!", "minutes": 15, "tags": "kosher,gluten-free"},
+                ...
+            ]
+        },
+        ...
+    ]
+    Takes the 'version' GET parameter like /offerings/. Responds with 400 Bad
+    Request if the point, radius or version is invalid.
+    '''
+    try:
+        version = get_version(request)
+    except ValueError as e:
+        return HttpResponseBadRequest('Error: %s' % e)
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        radius = float(request.GET.get('radius', DEFAULT_NEARBY_RADIUS))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('Error: \'lat\' and \'lng\' must be given, and \'radius\' must be a number')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 0 <= radius <= MAX_NEARBY_RADIUS):
+        return HttpResponseBadRequest('Error: the point or radius is out of range (radius at most %d m)'
+            % MAX_NEARBY_RADIUS)
+
+    # Nearby locations come from an index in memory, and their offerings from
+    # the cached snapshot, so most requests do not touch the database
+    distances = dict([(name, distance)
+        for distance, name in locations_index.get_index().nearby(lat, lng, radius)])
+    now = timezone.now()
+    response = []
+    for entry in offerings_cache.render(offerings_cache.get_snapshot(now), now, version):
+        name = entry['location']['name']
+        if name in distances:
+            response.append({'location': entry['location'], 'distance': int(round(distances[name])),
+                'offerings': entry['offerings']})
+    response.sort(key=lambda entry: distances[entry['location']['name']])
     return HttpResponse(json.dumps(response))
 
 
+def offering_changes(request):
+    '''
+    Responds with the changes to the offerings on the map since the cursor in
+    the 'since' GET parameter, which comes from the last response, formatted
+    in JSON:
+    {
+        "cursor": "1234:1494086400",
+        "reset": false,
+        "updated": [{"id": 12, "lat": "12.3456789", "lng": "12.3456789"}, ...],
+        "removed": [10, 11, ...]
+    }
+    "updated" only has where each offering is: its details come with the
+    tiles from /offerings/clusters/. Without a valid cursor, "reset" is true
+    and "updated" has every offering on the map. See offerings_changes.py. Takes the 'version' and 'tags' GET
+    parameters like /offerings/ (a cursor only applies to the same tags), and
+    responds with 400 Bad Request if they are invalid.
+    '''
+    try:
+        version = get_version(request)
+        tag_mask = offering_tags.parse_tags(request.GET.get('tags', ''))
+    except ValueError as e:
+        return HttpResponseBadRequest('Error: %s' % e)
+    changes = offerings_changes.get_changes(request.GET.get('since'), timezone.now(), version, tag_mask)
+    return HttpResponse(json.dumps(changes))
+
+
+def offering_events(request):
+    '''
+    Streams an event as Server-Sent Events whenever an offering is saved or
+    deleted, formatted as:
+    event: save
+    data: {"id": 12}
+    The event is "delete" for deleted offerings. Clients should fetch the
+    changes from /offerings/changes/ when they get one. See
+    offerings_events.py.
+
+    Responds with 204 No Content if the stream is turned off, or if as many
+    streams as allowed are open already, which tells browsers not to
+    reconnect (the map polls instead).
+    '''
+    if not offerings_events.is_enabled():
+        return HttpResponse(status=204)
+    events = offerings_events.stream(offerings_events.broker, limit=offerings_events.get_max_streams())
+    if events is None:
+        return HttpResponse(status=204)
+
+    offerings_events.watch()
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # ask proxies not to buffer the stream
+    return response
+
+
 def test(request):
     '''
     Sample view to demonstrate end-to-end flow of data. Displays the
@@ -76,6 +76,47 @@ WSGI_APPLICATION = 'foodmap_proj.wsgi.application'
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 # See production.py or development.py
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Local memory by default. Override in production.py or development.py to
+# share the cache between processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cache (from CACHES) holding the offerings shown on the map, and how many
+# seconds they are kept for. See foodmap_app/offerings_cache.py.
+OFFERINGS_CACHE_ALIAS = 'default'
+OFFERINGS_CACHE_TIMEOUT = 60
+
+# How many seconds the coordinates of locations are kept in memory before they
+# are loaded again, to pick up locations loaded by other processes. See
+# foodmap_app/coordinates.py.
+LOCATION_COORDINATES_TIMEOUT = 10 * 60
+
+# Whether changes to offerings are pushed to the map as Server-Sent Events, how
+# many seconds apart the log of changes is checked for changes made by other
+# processes (0 to not check), and how many streams each process keeps open at
+# once (well under the server's threads, see Procfile), past which the map
+# polls. See foodmap_app/offerings_events.py.
+OFFERINGS_EVENTS_ENABLED = True
+OFFERINGS_EVENTS_POLL_INTERVAL = 2
+OFFERINGS_EVENTS_MAX_STREAMS = 25
+
+# How many seconds apart each job of the scheduler runs (None to not run it),
+# how much each wait varies at random (as a fraction of it), and how many
+# seconds a job may hold its lock. See foodmap_app/scheduler.py.
+SCHEDULER_INTERVALS = {
+    'expiry': 60,
+    'recurrence': 60 * 60,
+    'warm_cache': None, # only useful with a cache shared between processes
+}
+SCHEDULER_JITTER = 0.1
+SCHEDULER_LOCK_TIMEOUT = 10 * 60
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -1,113 +1,419 @@
 #-------------------------------------------------------------------------------
 # scrape_locations.py
 # Author: Michael Friedman
+# Usage: python scrape_locations.py [--workers N] [--backend phantomjs|fixtures]
 #
 # Scrapes the mobile Princeton map website (m.princeton.edu/map) for the GPS
 # coordinates of every building on campus. Saves the contents in JSON format
-# in the file locations.json. Along the way, it may have to retry some
-# locations; these instances are logged in scrape_database_log.txt (mostly)
-# for debugging purposes).
+# in the file locations.json. Locations whose pages fail to load are retried,
+# and failures are logged in scrape_locations_log.txt for debugging purposes.
 #
-# NOTE: This requires getting data for about 900 locations on campus. It
-# will therefore take a substantial amount of time to run (est. 45-60 mins).
+# Locations are scraped by a pool of workers, each with its own browser. Each
+# location scraped is saved right away to a checkpoint file, so an
+# interrupted run picks up where it left off when run again. Workers back off
+# exponentially while the server rejects their requests.
+#
+# Pages are fetched through a backend: PhantomJS by default, or recorded HTML
+# files (--backend fixtures --fixtures DIR), which needs no network.
 #-------------------------------------------------------------------------------
 
+import argparse
 import json
 import os
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from time import sleep
+import random
+import re
+import sys
+import threading
+import time
+from HTMLParser import HTMLParser
+from Queue import Empty, Queue
+
+MIN_LOCATION_INDEX = 0
+MAX_LOCATION_INDEX = 897
+
+DETAIL_URL = 'http://m.princeton.edu/map/detail?feed=91eda3cbe8&group=princeton&featureindex=%d&category=91eda3cbe8%%3AALL&_b=%%5B%%7B%%22t%%22%%3A%%22Map%%22%%2C%%22lt%%22%%3A%%22Map%%22%%2C%%22p%%22%%3A%%22index%%22%%2C%%22a%%22%%3A%%22%%22%%7D%%5D#'
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 2.0      # seconds to wait after a worker's first failure
+DEFAULT_MAX_BACKOFF = 60.0 # most seconds to wait between attempts
+
+DEFAULT_OUTPUT = 'locations.json'
+DEFAULT_CHECKPOINT = 'scrape_locations_checkpoint.json'
+LOG_FILE = 'scrape_locations_log.txt'
+
+# Coordinates in the link of the "View in Google Maps" button, which is of the
+# form: http://maps.google.com? ... &q=loc:LAT,LNG+ ...
+COORDINATES = re.compile(r'q=loc:(-?[0-9.]+),(-?[0-9.]+)')
+
+
+class ScrapeError(Exception):
+    '''
+    Raised when a location's page could not be fetched, or is missing what is
+    scraped from it.
+    '''
+    pass
+
+#-------------------------------------------------------------------------------
+
+### Parsing
+
+class _LocationPageParser(HTMLParser):
+    '''
+    Finds the text of the location's name (<h2 class="nonfocal">) and the
+    links on a page.
+    '''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.name = None
+        self.links = [] # (text, href)
+        self._in_name = False
+        self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'h2' and 'nonfocal' in (attrs.get('class') or '').split() and self.name is None:
+            self._in_name = True
+            self.name = ''
+        elif tag == 'a':
+            self._link = [attrs.get('href') or '', '']
+
+    def handle_endtag(self, tag):
+        if tag == 'h2':
+            self._in_name = False
+        elif tag == 'a' and self._link is not None:
+            self.links.append((self._link[1].strip(), self._link[0]))
+            self._link = None
+
+    def handle_data(self, data):
+        if self._in_name:
+            self.name += data
+        if self._link is not None:
+            self._link[1] += data
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
+def _parse(html):
+    parser = _LocationPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+def parse_name(html):
+    '''
+    Returns the name of the location on its detail page 'html'.
+    '''
+    name = _parse(html).name
+    if not name or not name.strip():
+        raise ScrapeError('no location name on the page')
+    return name.strip()
+
+
+def get_link(html, text):
+    '''
+    Returns the address of the first link with 'text' in 'html'.
+    '''
+    for link_text, href in _parse(html).links:
+        if link_text == text:
+            return href
+    raise ScrapeError('no "%s" link on the page' % text)
+
+
+def parse_coordinates(html):
+    '''
+    Returns the (lat, lng) of the location, as strings, from its "Directions"
+    tab 'html'.
+    '''
+    match = COORDINATES.search(get_link(html, 'View in Google Maps'))
+    if match is None:
+        raise ScrapeError('no coordinates in the "View in Google Maps" link')
+    float(match.group(1)), float(match.group(2)) # check that they are numbers
+    return match.group(1), match.group(2)
+
+#-------------------------------------------------------------------------------
+
+### Backends
+#
+# A backend fetches the pages of a location: fetch(index) returns the HTML of
+# its detail page and of its "Directions" tab. Each worker has a backend of
+# its own. reset() is called after a failure, and close() when the worker is
+# done.
+
+class PhantomJSBackend(object):
+    '''
+    Fetches pages from m.princeton.edu through a PhantomJS browser.
+    '''
+
+    def __init__(self):
+        self.driver = None
+
+    def fetch(self, index):
+        from selenium import webdriver
+        from selenium.common.exceptions import NoSuchElementException, WebDriverException
+        try:
+            if self.driver is None:
+                self.driver = webdriver.PhantomJS()
+            self.driver.get(DETAIL_URL % index)
+            detail = self.driver.page_source
+            self.driver.find_element_by_link_text('Directions').click()
+            return detail, self.driver.page_source
+        except (NoSuchElementException, WebDriverException) as e:
+            raise ScrapeError(str(e))
 
-min_location_index = 0
-max_location_index = 897
-driver = webdriver.PhantomJS()
+    def reset(self):
+        self.close()
 
-# Initialize output file locations.json to be empty
-open('locations.json', 'w').close()
+    def close(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
 
-# Get lat/lng coordinates for each location from m.princeton.edu's map
-print 'Getting locations...'
-locations = []  # will hold a list of "JSON objects", which hold name and lat/lng coordinates for each location
-c = 0           # index of intermediary file
-retry = False   # used to determine whether a location failed and must be retried
-for i in range (min_location_index, max_location_index+1):
-    if retry:
-        i -= 1 # try the previous location again
 
-    driver.get('http://m.princeton.edu/map/detail?feed=91eda3cbe8&group=princeton&featureindex=' + str(i) + '&category=91eda3cbe8%3AALL&_b=%5B%7B%22t%22%3A%22Map%22%2C%22lt%22%3A%22Map%22%2C%22p%22%3A%22index%22%2C%22a%22%3A%22%22%7D%5D#')
+class FixtureBackend(object):
+    '''
+    Reads pages recorded in 'directory', as detail-<index>.html and
+    directions-<index>.html.
+    '''
 
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, index):
+        pages = []
+        for page in ['detail', 'directions']:
+            path = os.path.join(self.directory, '%s-%d.html' % (page, index))
+            try:
+                with open(path, 'r') as file:
+                    pages.append(file.read())
+            except IOError as e:
+                raise ScrapeError(str(e))
+        return tuple(pages)
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+#-------------------------------------------------------------------------------
+
+### Checkpoint
+
+class Checkpoint(object):
+    '''
+    A file with a line of JSON for each location scraped so far:
+    {"index": 12, "name": "Nassau Hall", "lat": "40.3486", "lng": "-74.6592"}
+    Each line is written to disk as soon as it is added, so no more than the
+    location being written can be lost when a run is interrupted.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''
+        Returns the locations in the checkpoint, by index. A last line that
+        was cut off mid-write is ignored.
+        '''
+        locations = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        location = json.loads(line)
+                    except ValueError:
+                        continue
+                    locations[location['index']] = location
+        return locations
+
+    def add(self, location):
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(location) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+#-------------------------------------------------------------------------------
+
+### Scraping
+
+class Worker(threading.Thread):
+    '''
+    Scrapes the locations in the queue 'indexes' through 'backend', putting a
+    result on the queue 'results' for each: the location, or its index and
+    the error if it failed 'retries' + 1 times.
+
+    After each failure, the worker waits before trying again: 'backoff'
+    seconds after its first failure, twice as long after each failure in a
+    row after that, up to 'max_backoff', with a random part so that workers
+    do not retry in step. A success resets the wait.
+    '''
+
+    def __init__(self, backend, indexes, results, stop, retries, backoff, max_backoff, rng=None):
+        threading.Thread.__init__(self)
+        self.daemon = True # do not keep an interrupted run alive
+        self.backend = backend
+        self.indexes = indexes
+        self.results = results
+        self.stop = stop
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rng = rng or random.Random()
+        self.delay = 0
+        self.waits = [] # seconds waited after each failure
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                try:
+                    index = self.indexes.get_nowait()
+                except Empty:
+                    return
+                self.results.put(self.scrape(index))
+        finally:
+            self.backend.close()
+
+    def scrape(self, index):
+        attempt = 0
+        while True:
+            try:
+                detail, directions = self.backend.fetch(index)
+                lat, lng = parse_coordinates(directions)
+                self.delay = 0
+                return {'index': index, 'name': parse_name(detail), 'lat': lat, 'lng': lng}
+            except Exception as e:
+                # Any error must end in a result, or scrape() waits for it
+                # forever. Unexpected ones are retried like the others.
+                attempt += 1
+                if attempt > self.retries or self.stop.is_set():
+                    error = str(e) if isinstance(e, ScrapeError) else '%s: %s' % (type(e).__name__, e)
+                    return {'index': index, 'error': error}
+
+                # The server has probably started rejecting requests, so start
+                # over with a new browser after a while
+                self.delay = min(max(self.delay * 2, self.backoff), self.max_backoff)
+                wait = self.delay * self.rng.uniform(0.5, 1.0)
+                self.waits.append(wait)
+                self.stop.wait(wait)
+                self.backend.reset()
+
+
+def scrape(indexes, make_backend, checkpoint, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+    backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, out=sys.stdout, log=None):
+    '''
+    Scrapes the locations at 'indexes' that are not in 'checkpoint' yet,
+    with 'workers' workers, each with a backend from 'make_backend()'. Adds
+    each location to 'checkpoint' as it comes in. Returns (all locations in
+    the checkpoint by index, errors by index of the locations that failed).
+    '''
+    locations = checkpoint.load()
+    remaining = Queue()
+    for index in indexes:
+        if index not in locations:
+            remaining.put(index)
+    count = remaining.qsize()
+    if count < len(indexes):
+        out.write('Resuming: %d of %d locations already scraped.\n' % (len(indexes) - count, len(indexes)))
+
+    results = Queue()
+    stop = threading.Event()
+    pool = [Worker(make_backend(), remaining, results, stop, retries, backoff, max_backoff)
+        for i in range(0, min(workers, count))]
+    for worker in pool:
+        worker.start()
+
+    errors = {}
     try:
-        # Extract location name
-        location = driver.find_element_by_css_selector('h2.nonfocal').text
-
-        # Go to "Directions" tab
-        directions_tab = driver.find_element_by_link_text('Directions')
-        directions_tab.click()
-
-        # Extract lat/lng coordinates from "View in Google Maps" button
-        # Link is of the form:
-        # http://maps.google.com? ... &q=loc:LAT,LNG+ ...
-        button = driver.find_element_by_link_text('View in Google Maps')
-        link = button.get_attribute('href')
-        lat_str = link[link.index('q=loc:')+len('q=loc:'):link.index(',')]
-        lng_str = link[link.index(',')+1:link.index('+')]
-        lat = float(lat_str)
-        lng = float(lng_str)
-
-        # Add entry in dict for this location
-        locations.append(
-            {'name': location, 'lat': lat_str, 'lng': lng_str}
-        )
-        print 'Entered: ' + location
-
-        # Output every 10 entries to a file, just in case you have to
-        # interrupt in the middle, so you don't lose all the entries without
-        # writing any of them
-        if len(locations) == 10:
-            file = open('locations%d.json' % c, 'w')
-            file.write(json.dumps(locations))
-            file.close()
-            locations = []
-            c += 1
-
-        retry = False
-    except NoSuchElementException as e:
-        # If a location fails to load, it's probably because the server
-        # has started rejecting our requests. Note this in a log file, reset
-        # the web driver, and try to continue in 30 secs
-        log = open('scrape_locations_log.txt', 'a')
-        log.write('Failed at index %d: %s' % (i, str(e)))
-        log.close()
-
-        driver.quit()
-        sleep(30)
-        driver = webdriver.PhantomJS()
-        retry = True
-
-
-driver.quit()
-
-# Write any remaining locations to a file
-if len(locations) > 0:
-    file = open('locations%d.json' % c, 'w')
-    file.write(json.dumps(locations))
-    file.close()
-    c += 1
-
-# Combine intermediary files into locations.json
-all_locations = []
-for i in range(0, c):
-    file = open('locations%d.json' % i, 'r')
-    locations = json.loads(file.read())
-    for location in locations:
-        all_locations.append(location)
-    file.close()
-file = open('locations.json', 'w')
-file.write(json.dumps(all_locations))
-file.close()
-
-# Remove intermediary files
-for i in range(0, c):
-    os.remove('locations%d.json' % i)
-
-print 'Done!'
+        for i in range(0, count):
+            # Wait with a timeout, so the wait can be interrupted, and stop
+            # waiting once every worker has exited without a result
+            result = None
+            while result is None:
+                try:
+                    result = results.get(timeout=1)
+                except Empty:
+                    if not any(worker.is_alive() for worker in pool) and results.empty():
+                        break
+            if result is None:
+                out.write('Stopped: every worker exited with %d locations left.\n' % (count - i))
+                break
+            if 'error' in result:
+                errors[result['index']] = result['error']
+                out.write('Failed at index %d: %s\n' % (result['index'], result['error']))
+                if log is not None:
+                    log.write('Failed at index %d: %s\n' % (result['index'], result['error']))
+            else:
+                checkpoint.add(result)
+                locations[result['index']] = result
+                out.write('Entered: %s\n' % result['name'].encode('utf-8'))
+    finally:
+        stop.set()
+    for worker in pool:
+        worker.join()
+    return locations, errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Scrapes the coordinates of every location on campus.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+        help='Number of locations to scrape at once.')
+    parser.add_argument('--start', type=int, default=MIN_LOCATION_INDEX, help='First feature index to scrape.')
+    parser.add_argument('--end', type=int, default=MAX_LOCATION_INDEX, help='Last feature index to scrape.')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+        help='Number of times to retry a location before giving up on it.')
+    parser.add_argument('--backoff', type=float, default=DEFAULT_BACKOFF,
+        help='Seconds to wait after a first failure. Doubles with each failure in a row.')
+    parser.add_argument('--max-backoff', type=float, default=DEFAULT_MAX_BACKOFF,
+        help='Most seconds to wait between attempts.')
+    parser.add_argument('--backend', choices=['phantomjs', 'fixtures'], default='phantomjs',
+        help='Where to fetch pages from.')
+    parser.add_argument('--fixtures', help='Directory of recorded pages, for --backend fixtures.')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+        help='File that scraped locations are saved to as they come in.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='File to write the locations to.')
+    args = parser.parse_args(argv)
+
+    if args.backend == 'fixtures':
+        if args.fixtures is None:
+            parser.error('--backend fixtures needs --fixtures')
+        make_backend = lambda: FixtureBackend(args.fixtures)
+    else:
+        make_backend = PhantomJSBackend
+
+    print 'Getting locations...'
+    indexes = range(args.start, args.end + 1)
+    checkpoint = Checkpoint(args.checkpoint)
+    with open(LOG_FILE, 'a') as log:
+        try:
+            locations, errors = scrape(indexes, make_backend, checkpoint, args.workers, args.retries,
+                args.backoff, args.max_backoff, log=log)
+        except KeyboardInterrupt:
+            print 'Interrupted. Run again to resume.'
+            return 1
+
+    # Write locations in index order, as they appear on the map website
+    with open(args.output, 'w') as file:
+        file.write(json.dumps([dict([(key, locations[index][key]) for key in ['name', 'lat', 'lng']])
+            for index in indexes if index in locations]))
+
+    if len(errors) > 0:
+        print 'Done, but %d locations failed (see %s). Run again to retry them.' % (len(errors), LOG_FILE)
+        return 1
+    checkpoint.remove()
+    print 'Done!'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,13 +4,18 @@
 /*                                                                            */
 /* The main program that runs the scraper. It runs the email scraper, and if  */
 /* there are unread emails, processes them and alters the database.           */
+/*                                                                            */
+/* The emails of one sweep of the inbox are fetched a few at a time, only     */
+/* those added since the last sweep (see pipeline.js), and all written to the */
+/* database in one transaction, once every one of them has been parsed (see   */
+/* db.js).                                                                    */
 /******************************************************************************/
 
 var fs = require('fs');
 var google = require('googleapis');
 var db_module = require('./db');
 var oauth = require('./oauth');
-var scraper = require('./scraper');
+var pipeline = require('./pipeline');
 
 const PROJECT_MODE_ERROR = 'Error: PROJECT_MODE not set. Cannot set up \
 database. Did you activate the virtual environment in the Django project?';
@@ -48,7 +53,8 @@ else {
 }
 
 /**
- * Parses events from all unread emails and prints them stdout
+ * Parses events from the emails received since the last run and writes them
+ * to the database, in one transaction for the whole sweep of the inbox
  *
  * @param {Object} auth Authorization credentials for Google APIs.
  */
@@ -57,90 +63,29 @@ function main (auth) {
     // set auth as a global default
     google.options({auth: auth});
 
-    google.gmail('v1').users.messages.list({ // Get unread message list
-        userId: 'me',
-        q: 'is:unread',
-    }, function (err, res) {
-
-        // if unread message exists
-        if (!err && res && res.messages && res.messages.length) {
-            for(var i = 0; i < res.messages.length; i++) {
-                (function(index) {
-                    // Timeout to prevent making too many requests at once
-                    setTimeout(parseEmail, 1000+(1000*index)
-                        , res.messages[index].id, markAsRead);
-                })(i);
-            }
-        } else {
-            console.log('No unread message exists');
-        }
+    var sweeps = new pipeline.Pipeline(google.gmail('v1'), {
+        concurrency: parseInt(process.env.GMAIL_CONCURRENCY) || undefined,
+        unitsPerSecond: parseInt(process.env.GMAIL_UNITS_PER_SECOND) || undefined
     });
-};
-
-/**
- * Parses email and inserts or deletes an entry to/from the database
- *
- * @param {Object} messageId The id of a message to be parsed
- * @param {Function} callback The markAsRead function to be called after parsing
- *  completes
- */
-function parseEmail(messageId, callback) {
-    google.gmail('v1').users.messages.get({
-        userId: 'me',
-        id: messageId,
-    }, function(err, result) {
 
+    // One connection for the whole sweep, which reads the mailbox's cursor
+    // from the database and writes the emails read to it
+    db.connect({}, function(err) {
         if(err) {
             console.log(err);
             return;
         }
-
-        // Check if the sender is Free Food Listserv
-        sender = result.payload.headers.find(x => x.name === 'Sender');
-        if (typeof sender === 'undefined'
-        || sender.value !== 'Free Food <freefood@princeton.edu>') {
-            return;
-        }
-
-        entry = scraper.formatEmail(result, messageId);
-        // saveImage(entry.image, messageId);
-
-        // In case of failure to parse location, return without marking email
-        // as read
-        if(entry.location == '') {
-            console.log('Parsing failed - messageId: ' + messageId);
-            return;
-        }
-
-        // INSERT or DELETE entry
-        if(scraper.getRequestType(entry.title+entry.body) == scraper.INSERT) {
-            db.insert(entry);
-        }
-        else {
-            db.delete(entry);
-        }
-
-        callback(messageId);
-    });
-}
-
-/**
- * Marks a message with given id as read
- *
- * @param {Object} messageId The id of a message to be marked as read
- */
-function markAsRead(messageId) {
-    // Mark email as read by deleting UNREAD label
-    google.gmail('v1').users.messages.modify({
-        userId: 'me',
-        id: messageId,
-        resource: { removeLabelIds: ['UNREAD'] },
-    }, function(err, result) {
-        if(err) {
-            console.log(err);
-        }
+        sweeps.sweep(db, function(err, count) {
+            db.end();
+            if(err) {
+                console.log(err);
+                return;
+            }
+            console.log(count.written + ' of ' + count.listed + ' new emails written'
+                + (count.history ? ' (listed from the history).' : '.'));
+        });
     });
-}
+};
 
 /**
  * Save first attached image to filesystem / database
@@ -0,0 +1,344 @@
+/******************************************************************************/
+/* db.js                                                                      */
+/*                                                                            */
+/* Benchmarks writing a sweep of the inbox with db.js, in one transaction of  */
+/* multi-row statements, against the previous implementation, which looked    */
+/* up the location and inserted (or deleted) each entry on its own.           */
+/*                                                                            */
+/* Both are run against a new sqlite file in the temporary directory, and,    */
+/* if BENCH_DATABASE_URL is set, against the postgres-compatible database it  */
+/* names (e.g. a local postgres server). That database must be a scratch one: */
+/* its Offerings tables are created if missing, and emptied of the rows the   */
+/* benchmark writes. The tables written are checked to be identical between   */
+/* the two before timing them.                                                */
+/*                                                                            */
+/* Usage: node scraper/bench/db.js [entries per sweep] [sweeps]               */
+/******************************************************************************/
+
+var assert = require('assert');
+var fs = require('fs');
+var os = require('os');
+var path = require('path');
+var pg = require('pg');
+var sqlite3_lib = require('sqlite3');
+var db_module = require('../db.js');
+
+const NUM_ENTRIES = parseInt(process.argv[2]) || 200;
+const NUM_SWEEPS = parseInt(process.argv[3]) || 5;
+const NUM_LOCATIONS = 300;
+const DELETE_EVERY = 4; // one entry in this many deletes an earlier one
+
+// Only the columns the scraper writes, in the same tables as Django's
+const SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS foodmap_app_location (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL UNIQUE, '
+        + 'lat DECIMAL(15, 12) NOT NULL, lng DECIMAL(15, 12) NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS foodmap_app_offering (id %SERIAL% PRIMARY KEY, timestamp VARCHAR(32) NOT NULL, '
+        + 'location_id INTEGER NOT NULL, title VARCHAR(100) NOT NULL, description VARCHAR(10000) NOT NULL, '
+        + 'image VARCHAR(100) NULL, thread_id VARCHAR(16) NULL UNIQUE, tag_bits INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS foodmap_app_offeringchange (id %SERIAL% PRIMARY KEY, offering_id INTEGER NOT NULL, '
+        + 'timestamp VARCHAR(32) NOT NULL)'
+];
+
+
+/**
+ * Helper function: Build 'sweeps' sweeps of 'count' entries each, at
+ * locations 'Location 0' to 'Location <NUM_LOCATIONS - 1>', where every
+ * DELETE_EVERY-th entry deletes an offering inserted in an earlier sweep.
+ * Uses a fixed seed so runs are comparable.
+ */
+function makeSweeps(count, sweeps) {
+    var seed = 42;
+    function random() {
+        seed = (seed * 1103515245 + 12345) % 2147483648;
+        return seed / 2147483648;
+    }
+
+    var result = [];
+    var threadIds = [];
+    var next = 0;
+    for(var i = 0; i < sweeps; i++) {
+        var sweep = {inserts: [], deletes: []};
+        for(var j = 0; j < count; j++) {
+            if(j % DELETE_EVERY == DELETE_EVERY - 1 && threadIds.length > 0) {
+                sweep.deletes.push({threadId: threadIds.splice(Math.floor(random() * threadIds.length), 1)[0]});
+                continue;
+            }
+            var threadId = 'bench' + (next++).toString(16);
+            var entry = {timestamp: '2017-04-01 12:00:00', location: 'Location ' + Math.floor(random() * NUM_LOCATIONS),
+                food: 'Pizza, Cookies', body: 'Free pizza and cookies\nCome get some', threadId: threadId};
+            if(random() < 0.2) {
+                entry.image = {name: threadId + '.jpg', id: threadId};
+            }
+            sweep.inserts.push(entry);
+        }
+        result.push(sweep);
+        threadIds = threadIds.concat(sweep.inserts.map(entry => entry.threadId));
+    }
+    return result;
+}
+
+/**
+ * Helper function: Time 'run', which takes a callback, in milliseconds.
+ */
+function time(run, callback) {
+    var start = process.hrtime();
+    run(function(err) {
+        if(err) { throw err; }
+        var elapsed = process.hrtime(start);
+        callback(elapsed[0] * 1e3 + elapsed[1] / 1e6);
+    });
+}
+
+/**
+ * Helper function: Run 'f' on each item of 'items', one after the other.
+ */
+function forEachSeries(items, f, callback) {
+    var i = 0;
+    (function next(err) {
+        if(err || i == items.length) {
+            callback(err || null);
+            return;
+        }
+        f(items[i++], next);
+    })();
+}
+
+
+// Each database the benchmark runs against, with the previous implementation
+// for it
+var targets = {
+    sqlite: {
+        filename: path.join(os.tmpdir(), 'foodmap-bench-' + process.pid + '.sqlite3'),
+
+        open: function(callback) {
+            var self = this;
+            self.connection = new sqlite3_lib.Database(self.filename, function(err) {
+                if(err) { return callback(err); }
+                var steps = SCHEMA.map(sql => sql.replace(/%SERIAL%/g, 'INTEGER'));
+                self.connection.serialize(function() {
+                    steps.forEach(sql => self.connection.run(sql));
+                    self.connection.run('BEGIN');
+                    for(var i = 0; i < NUM_LOCATIONS; i++) {
+                        self.connection.run('INSERT INTO foodmap_app_location (name, lat, lng) VALUES (?, 40.3, -74.6)', ['Location ' + i]);
+                    }
+                    self.connection.run('COMMIT', callback);
+                });
+            });
+        },
+
+        query: function(sql, callback) {
+            this.connection.all(sql, callback);
+        },
+
+        reset: function(callback) {
+            var connection = this.connection;
+            connection.serialize(function() {
+                connection.run('DELETE FROM foodmap_app_offering');
+                connection.run('DELETE FROM foodmap_app_offeringchange', callback);
+            });
+        },
+
+        // Previous implementation: a lookup, then a statement prepared and
+        // finalized, for each entry
+        legacyWrite: function(sweep, callback) {
+            var connection = this.connection;
+            var now = '2017-04-01 12:00:00';
+            forEachSeries(sweep.inserts, function(entry, next) {
+                connection.get('SELECT id FROM foodmap_app_location WHERE name = ?', [entry.location], function(err, row) {
+                    if(err) { return next(err); }
+                    var image = (typeof entry.image === 'undefined') ? null : entry.image.name;
+                    var stmt = connection.prepare('INSERT INTO foodmap_app_offering (timestamp, location_id, title, '
+                        + 'description, thread_id, image, tag_bits) VALUES (?, ?, ?, ?, ?, ?, 0)');
+                    stmt.run(entry.timestamp, row.id, entry.food, entry.body, entry.threadId, image, function(err) {
+                        if(err) { return next(err); }
+                        var offeringId = this.lastID;
+                        stmt.finalize(function() {
+                            connection.run('INSERT INTO foodmap_app_offeringchange (offering_id, timestamp) VALUES (?, ?)',
+                                [offeringId, now], next);
+                        });
+                    });
+                });
+            }, function(err) {
+                if(err) { return callback(err); }
+                forEachSeries(sweep.deletes, function(entry, next) {
+                    connection.run('INSERT INTO foodmap_app_offeringchange (offering_id, timestamp) SELECT id, ? FROM '
+                        + 'foodmap_app_offering WHERE thread_id=(?)', [now, entry.threadId], function(err) {
+                        if(err) { return next(err); }
+                        connection.run('DELETE FROM foodmap_app_offering WHERE thread_id=(?)', entry.threadId, next);
+                    });
+                }, callback);
+            });
+        },
+
+        close: function(callback) {
+            var filename = this.filename;
+            this.connection.close(function() {
+                fs.unlink(filename, () => callback());
+            });
+        }
+    },
+
+    postgres: {
+        open: function(callback) {
+            var self = this;
+            self.connection = new pg.Client(process.env.BENCH_DATABASE_URL);
+            self.connection.connect(function(err) {
+                if(err) { return callback(err); }
+                var steps = SCHEMA.map(sql => (next => self.connection.query(sql.replace(/%SERIAL%/g, 'SERIAL'), next)));
+                for(var i = 0; i < NUM_LOCATIONS; i++) {
+                    (function(i) {
+                        steps.push(next => self.connection.query('INSERT INTO foodmap_app_location (id, name, lat, lng) '
+                            + 'VALUES ($1, $2, 40.3, -74.6) ON CONFLICT DO NOTHING', [1000000 + i, 'Location ' + i], next));
+                    })(i);
+                }
+                forEachSeries(steps, (step, next) => step(next), callback);
+            });
+        },
+
+        query: function(sql, callback) {
+            this.connection.query(sql, (err, result) => callback(err, result && result.rows));
+        },
+
+        reset: function(callback) {
+            var connection = this.connection;
+            connection.query("DELETE FROM foodmap_app_offeringchange WHERE offering_id IN "
+                + "(SELECT id FROM foodmap_app_offering WHERE thread_id LIKE 'bench%')", function(err) {
+                if(err) { return callback(err); }
+                connection.query("DELETE FROM foodmap_app_offering WHERE thread_id LIKE 'bench%'", callback);
+            });
+        },
+
+        // Previous implementation: a new connection, and a lookup, for each
+        // entry
+        legacyWrite: function(sweep, callback) {
+            forEachSeries(sweep.inserts.map(entry => ['insert', entry]).concat(sweep.deletes.map(entry => ['delete', entry])),
+                function(operation, next) {
+
+                var client = new pg.Client(process.env.BENCH_DATABASE_URL);
+                var entry = operation[1];
+                client.connect(function(err) {
+                    if(err) { return next(err); }
+                    function done(err) {
+                        client.end();
+                        next(err);
+                    }
+                    if(operation[0] == 'delete') {
+                        client.query('INSERT INTO foodmap_app_offeringchange (offering_id, timestamp) SELECT id, NOW() FROM '
+                            + 'foodmap_app_offering WHERE thread_id=($1)', [entry.threadId], function(err) {
+                            if(err) { return done(err); }
+                            client.query('DELETE FROM foodmap_app_offering WHERE thread_id=($1)', [entry.threadId], done);
+                        });
+                        return;
+                    }
+                    client.query('SELECT id FROM foodmap_app_location WHERE name = $1', [entry.location], function(err, result) {
+                        if(err) { return done(err); }
+                        var image = (typeof entry.image === 'undefined') ? null : entry.image.name;
+                        client.query('INSERT INTO foodmap_app_offering (timestamp, location_id, title, description, thread_id, '
+                            + 'image, tag_bits) VALUES ($1, $2, $3, $4, $5, $6, 0) RETURNING id',
+                            [entry.timestamp, result.rows[0].id, entry.food, entry.body, entry.threadId, image], function(err, result) {
+                            if(err) { return done(err); }
+                            client.query('INSERT INTO foodmap_app_offeringchange (offering_id, timestamp) VALUES ($1, NOW())',
+                                [result.rows[0].id], done);
+                        });
+                    });
+                });
+            }, callback);
+        },
+
+        close: function(callback) {
+            var connection = this.connection;
+            this.reset(function() {
+                connection.end();
+                callback();
+            });
+        }
+    }
+};
+
+
+/**
+ * Helper function: Count the rows of the Offering Changes table of 'target'.
+ */
+function countChanges(target, callback) {
+    target.query("SELECT COUNT(*) AS count FROM foodmap_app_offeringchange", function(err, rows) {
+        callback(err, err ? 0 : Number(rows[0].count));
+    });
+}
+
+/**
+ * Helper function: Get what the benchmark wrote to the Offerings tables of
+ * 'target', to compare the two implementations.
+ */
+function snapshot(target, callback) {
+    target.query("SELECT thread_id, location_id, title, image FROM foodmap_app_offering WHERE thread_id LIKE 'bench%' "
+        + "ORDER BY thread_id", function(err, offerings) {
+        if(err) { return callback(err); }
+        countChanges(target, function(err, changes) {
+            callback(err, {offerings: offerings, changes: changes - target.changes});
+        });
+    });
+}
+
+/**
+ * Run both implementations against 'target', whose implementation in db.js
+ * is 'impl', and print their times.
+ */
+function bench(name, target, impl, options, callback) {
+    var sweeps = makeSweeps(NUM_ENTRIES, NUM_SWEEPS);
+    var legacyWrite = target.legacyWrite.bind(target);
+    var batchedWrite = (sweep, next) => impl.write(sweep, next);
+    // The previous implementation has no connection of its own to open
+    var runs = [
+        ['legacy', next => forEachSeries(sweeps, legacyWrite, next)],
+        ['batched', next => impl.connect(options, err => err ? next(err) : forEachSeries(sweeps, batchedWrite, next))]
+    ];
+
+    // Silence the log of every write while timing
+    var log = console.log;
+    var results = [];
+    target.open(function(err) {
+        if(err) { throw err; }
+        forEachSeries(runs, function(run, next) {
+            target.reset(function(err) {
+                if(err) { return next(err); }
+                countChanges(target, function(err, changes) {
+                    if(err) { return next(err); }
+                    target.changes = changes; // rows already there, e.g. of offerings deleted since
+                    console.log = function() {};
+                    time(run[1], function(elapsed) {
+                        console.log = log;
+                        snapshot(target, function(err, written) {
+                            results.push({name: run[0], elapsed: elapsed, written: written});
+                            next(err);
+                        });
+                    });
+                });
+            });
+        }, function(err) {
+            if(err) { throw err; }
+            assert.deepEqual(results[0].written, results[1].written);
+            impl.end(function() {
+                target.close(function() {
+                    var legacyTime = results[0].elapsed;
+                    var batchedTime = results[1].elapsed;
+                    var entries = NUM_ENTRIES * NUM_SWEEPS;
+                    console.log(name + ': ' + NUM_SWEEPS + ' sweeps x ' + NUM_ENTRIES + ' entries');
+                    console.log('  legacy writes:  ' + legacyTime.toFixed(1) + ' ms (' + (legacyTime / entries).toFixed(3) + ' ms/entry)');
+                    console.log('  batched writes: ' + batchedTime.toFixed(1) + ' ms (' + (batchedTime / entries).toFixed(3) + ' ms/entry)');
+                    console.log('  speedup:        ' + (legacyTime / batchedTime).toFixed(1) + 'x');
+                    callback();
+                });
+            });
+        });
+    });
+}
+
+bench('sqlite', targets.sqlite, db_module.db.sqlite, {filename: targets.sqlite.filename}, function() {
+    if(!process.env.BENCH_DATABASE_URL) {
+        console.log('postgres: skipped, set BENCH_DATABASE_URL to a scratch database to run it');
+        return;
+    }
+    // A local stand-in does not take SSL, unlike Heroku's
+    pg.defaults.ssl = false;
+    bench('postgres', targets.postgres, db_module.db.postgres, {connectionString: process.env.BENCH_DATABASE_URL}, () => {});
+});
@@ -0,0 +1,116 @@
+/******************************************************************************/
+/* getFood.js                                                                 */
+/*                                                                            */
+/* Benchmarks getFood() in scraper.js against the previous implementation,    */
+/* which looped over every entry of foods.txt for every word of the text.     */
+/* Both are run on long, listserv-like email bodies, and their results are    */
+/* checked to be identical before timing them.                                */
+/*                                                                            */
+/* Usage: node scraper/bench/getFood.js [number of bodies] [words per body]   */
+/******************************************************************************/
+
+var assert = require('assert');
+var fs = require('fs');
+var scraper = require('../scraper.js');
+
+const NOT_FOUND = -1;
+const NUM_BODIES = parseInt(process.argv[2]) || 50;
+const WORDS_PER_BODY = parseInt(process.argv[3]) || 2000;
+
+var foods = fs.readFileSync(__dirname + '/../data/foods.txt').toString().split('\n');
+
+/**
+ * Previous implementation of getFood(), kept here as the baseline.
+ */
+function legacyGetFood(text) {
+    function isValidFood(text) {
+        if(foods.indexOf(text) != NOT_FOUND) { return true; }
+        if(text.slice(-1) == 's' && foods.indexOf(text.slice(0, -1)) != NOT_FOUND) { return true; }
+        if(text.slice(-2) == 'es' && foods.indexOf(text.slice(0, -2)) != NOT_FOUND) { return true; }
+        return false;
+    }
+
+    var words = text.toLowerCase().replace(/[.,\/#!$%\^&\*;:{}=\-_`~()']/g,"").split(/[\s,]+/g);
+    var matches = [];
+    for(var i = 0; i < words.length; i++) {
+        var phraseFound = false;
+        var word = words[i];
+        for(var food of foods) {
+            var splitFood = food.split(" ");
+            if(splitFood.length > 1 && splitFood.indexOf(word) != NOT_FOUND) {
+                if(i + splitFood.length > words.length) { continue; }
+                var phrase = [word];
+                for(var j = 1; j < splitFood.length; j++) {
+                    phrase.push(words[i+j]);
+                }
+                var phraseString = phrase.join(" ");
+                if(isValidFood(phraseString)) {
+                    matches.push(phraseString.charAt(0).toUpperCase() + phraseString.slice(1));
+                    i += splitFood.length - 1;
+                    phraseFound = true;
+                    break;
+                }
+            }
+        }
+        if(phraseFound) { continue; }
+        if(isValidFood(word)) {
+            matches.push(word.charAt(0).toUpperCase() + word.slice(1));
+        }
+    }
+    matches = matches.concat(scraper.listCheck(text));
+    return matches.filter(function(item, pos) { return matches.indexOf(item) == pos; });
+}
+
+/**
+ * Build 'count' email bodies of about 'length' words each, mixing foods,
+ * filler words and list separators. Uses a fixed seed so runs are comparable.
+ */
+function makeBodies(count, length) {
+    var seed = 42;
+    function random() {
+        seed = (seed * 1103515245 + 12345) % 2147483648;
+        return seed / 2147483648;
+    }
+    function pick(array) {
+        return array[Math.floor(random() * array.length)];
+    }
+
+    var filler = ['come', 'get', 'some', 'free', 'leftover', 'at', 'the', 'in',
+        'room', 'Frist', 'lobby', 'until', '5pm', 'from', 'our', 'event',
+        'please', 'bring', 'your', 'own', 'container', 'thanks', 'everyone'];
+    var separators = [' ', ' ', ' ', ', ', ' and ', ' or ', '! ', '.\r\n'];
+
+    var bodies = [];
+    for(var i = 0; i < count; i++) {
+        var body = '';
+        for(var j = 0; j < length; j++) {
+            body += (random() < 0.15 ? pick(foods) : pick(filler)) + pick(separators);
+        }
+        bodies.push(body);
+    }
+    return bodies;
+}
+
+/**
+ * Time how long 'f' takes to process every body, in milliseconds.
+ */
+function time(f, bodies) {
+    var start = process.hrtime();
+    for(var body of bodies) {
+        f(body);
+    }
+    var elapsed = process.hrtime(start);
+    return elapsed[0] * 1e3 + elapsed[1] / 1e6;
+}
+
+var bodies = makeBodies(NUM_BODIES, WORDS_PER_BODY);
+for(var body of bodies) {
+    assert.deepEqual(scraper.getFood(body), legacyGetFood(body));
+}
+
+var legacyTime = time(legacyGetFood, bodies);
+var trieTime = time(scraper.getFood, bodies);
+console.log(NUM_BODIES + ' bodies x ' + WORDS_PER_BODY + ' words');
+console.log('  legacy getFood: ' + legacyTime.toFixed(1) + ' ms (' + (legacyTime / NUM_BODIES).toFixed(2) + ' ms/body)');
+console.log('  trie getFood:   ' + trieTime.toFixed(1) + ' ms (' + (trieTime / NUM_BODIES).toFixed(2) + ' ms/body)');
+console.log('  speedup:        ' + (legacyTime / trieTime).toFixed(1) + 'x');
@@ -2,20 +2,41 @@
 /* db.js                                                                      */
 /* Author: Michael Friedman                                                   */
 /*                                                                            */
-/* Module for database operations required in app.js. Implements two          */
-/* operations, 'insert' and 'delete', for both the sqlite version of the      */
-/* database (for use during development) and the postgres version of the      */
-/* database (for use in the deployed production version).                     */
+/* Module for database operations required in app.js, for both the sqlite     */
+/* version of the database (for use during development) and the postgres      */
+/* version of the database (for use in the deployed production version).      */
+/*                                                                            */
+/* Each scraper run opens one connection with 'connect', which also loads     */
+/* the ids of every location once. The offerings to insert and delete in one  */
+/* sweep of the inbox are then written with 'write', in one transaction, with */
+/* a few statements of many rows each rather than a few per offering. 'end'   */
+/* closes the connection. Offerings of threads already in the database are    */
+/* left as they are, rather than failing the whole sweep.                     */
+/*                                                                            */
+/* A sweep can also move the cursor of the mailbox it read (see pipeline.js), */
+/* which is saved in the same transaction, so the emails since the cursor     */
+/* are only ever skipped once they are written. 'getCursor' reads it back.    */
+/*                                                                            */
+/* Offerings are inserted without tags, so their tag bits are 0 (see          */
+/* foodmap_app/offering_tags.py).                                             */
+/*                                                                            */
+/* Every offering written also gets a row in the Offering Changes table, so   */
+/* that the map picks up the change in its next refresh (see                  */
+/* foodmap_app/offerings_changes.py).                                         */
 /******************************************************************************/
 
 var sqlite3_lib = require('sqlite3').verbose();
 var pg = require('pg');
 
-var sqlite3 = new sqlite3_lib.Database(__dirname + '/../db.sqlite3');
-
 // https://devcenter.heroku.com/articles/heroku-postgresql#connecting-in-node-js
 pg.defaults.ssl = true;
 
+const SQLITE_FILENAME = __dirname + '/../db.sqlite3';
+
+// Number of offerings written per statement. Each takes at most 6
+// parameters, which keeps statements below the 999 sqlite allows.
+const ROWS_PER_STATEMENT = 150;
+
 
 // Constants specifying database schemas (table and column names)
 var OFFERINGS = {
@@ -27,7 +48,27 @@ var OFFERINGS = {
         TITLE: 'title',
         DESCRIPTION: 'description',
         IMAGE: 'image',
-        THREAD_ID: 'thread_id'
+        THREAD_ID: 'thread_id',
+        TAG_BITS: 'tag_bits'
+    }
+};
+
+var OFFERING_CHANGES = {
+    NAME: 'foodmap_app_offeringchange',
+    COLUMNS: {
+        ID: 'id',
+        OFFERING_ID: 'offering_id',
+        TIMESTAMP: 'timestamp'
+    }
+};
+
+var MAILBOX_CURSORS = {
+    NAME: 'foodmap_app_mailboxcursor',
+    COLUMNS: {
+        ID: 'id',
+        MAILBOX: 'mailbox',
+        HISTORY_ID: 'history_id',
+        TIMESTAMP: 'timestamp'
     }
 };
 
@@ -42,116 +83,399 @@ var LOCATIONS = {
 };
 
 
+/**
+ * Get the current time, formatted like the timestamps Django stores in sqlite
+ *
+ * @return {string} The current UTC time, as 'YYYY-MM-DD HH:MM:SS'
+ */
+function currentTimestamp() {
+    return new Date().toISOString().replace('T', ' ').split('.')[0];
+}
+
+// Columns written when logging a change to an offering
+var CHANGE_COLUMNS = "(" + OFFERING_CHANGES.COLUMNS.OFFERING_ID + ", " + OFFERING_CHANGES.COLUMNS.TIMESTAMP + ")";
+
+// Columns written when inserting an offering, in the order of getRow()
+var INSERT_COLUMNS = "(" + OFFERINGS.COLUMNS.TIMESTAMP + ", " + OFFERINGS.COLUMNS.LOCATION_ID + ", " + OFFERINGS.COLUMNS.TITLE + ", "
+    + OFFERINGS.COLUMNS.DESCRIPTION + ", " + OFFERINGS.COLUMNS.THREAD_ID + ", " + OFFERINGS.COLUMNS.IMAGE + ", " + OFFERINGS.COLUMNS.TAG_BITS + ")";
+
+// Columns written when saving the cursor of a mailbox
+var CURSOR_COLUMNS = "(" + MAILBOX_CURSORS.COLUMNS.MAILBOX + ", " + MAILBOX_CURSORS.COLUMNS.HISTORY_ID + ", " + MAILBOX_CURSORS.COLUMNS.TIMESTAMP + ")";
+
+
+/**
+ * Helper function: Run each of 'steps', functions that take a callback, one
+ * after the other, then call 'callback' with the first error, if any.
+ *
+ * @param {Array} steps The functions to run
+ * @param {Function} callback Called once all steps are done, or one fails
+ */
+function series(steps, callback) {
+    var i = 0;
+    (function next(err) {
+        if(err || i == steps.length) {
+            callback(err || null);
+            return;
+        }
+        steps[i++](next);
+    })();
+}
+
+/**
+ * Helper function: Split 'array' into arrays of at most ROWS_PER_STATEMENT
+ * items.
+ *
+ * @param {Array} array The array to split
+ * @return {Array} The arrays
+ */
+function chunk(array) {
+    var chunks = [];
+    for(var i = 0; i < array.length; i += ROWS_PER_STATEMENT) {
+        chunks.push(array.slice(i, i + ROWS_PER_STATEMENT));
+    }
+    return chunks;
+}
+
+/**
+ * Helper function: Get the entries of a sweep that can be written, each
+ * once. Inserts at unknown locations are left out, as are those of threads
+ * inserted earlier in the sweep (thread ids are unique) or deleted in it.
+ *
+ * @param {Object} sweep The sweep, as passed to write()
+ * @param {Object} locationIds Maps location names to their ids
+ * @return {Object} {inserts: [...], threadIds: [...]}, the entries to insert
+ *  and the thread ids to delete
+ */
+function prepareSweep(sweep, locationIds) {
+    var threadIds = [];
+    var deleted = new Set();
+    for(var entry of sweep.deletes || []) {
+        if(!deleted.has(entry.threadId)) {
+            deleted.add(entry.threadId);
+            threadIds.push(entry.threadId);
+        }
+    }
+
+    var inserts = [];
+    var inserted = new Set();
+    for(var entry of sweep.inserts || []) {
+        if(!locationIds.has(entry.location)) {
+            console.log('Unknown location \'' + entry.location + '\' - threadId: ' + entry.threadId);
+            continue;
+        }
+        if(deleted.has(entry.threadId) || inserted.has(entry.threadId)) {
+            continue;
+        }
+        inserted.add(entry.threadId);
+        inserts.push(entry);
+    }
+    return {inserts: inserts, threadIds: threadIds};
+}
+
+/**
+ * Helper function: Get the values inserted for 'entry', in the order of
+ * INSERT_COLUMNS (but for the tag bits, which are always 0).
+ *
+ * @param {Object} entry The entry to be inserted
+ * @param {Object} locationIds Maps location names to their ids
+ * @return {Array} The values
+ */
+function getRow(entry, locationIds) {
+    var image = (typeof entry.image === 'undefined') ? null : entry.image.name;
+    return [entry.timestamp, locationIds.get(entry.location), entry.food, entry.body, entry.threadId, image];
+}
+
+/**
+ * Helper function: Get the placeholders for 'count' rows of 'width'
+ * parameters each, followed by a tag bits of 0, e.g. "(?, ?, 0), (?, ?, 0)".
+ *
+ * @param {number} count The number of rows
+ * @param {number} width The number of parameters in each row
+ * @param {Function} placeholder Gets the placeholder of the parameter with
+ *  the given (0-based) index
+ * @return {string} The placeholders
+ */
+function getPlaceholders(count, width, placeholder) {
+    var rows = [];
+    for(var i = 0; i < count; i++) {
+        var row = [];
+        for(var j = 0; j < width; j++) {
+            row.push(placeholder(i * width + j));
+        }
+        rows.push("(" + row.join(", ") + ", 0)");
+    }
+    return rows.join(", ");
+}
+
+/**
+ * Helper function: Get the placeholders for 'count' parameters, e.g.
+ * "$1, $2, $3".
+ */
+function getList(count, placeholder) {
+    var list = [];
+    for(var i = 0; i < count; i++) {
+        list.push(placeholder(i));
+    }
+    return list.join(", ");
+}
+
+function sqlitePlaceholder(index) { return "?"; }
+function postgresPlaceholder(index) { return "$" + (index + 1); }
+
+
 // Database operations
 var db = {
 
     // Sqlite implementation
     sqlite: {
+        connection: null,
+        locationIds: null, // maps location names to their ids
+
         /**
-         * Insert given entry to the database
+         * Open the database and load the ids of every location
          *
-         * @param {Object} entry The entry to be inserted to the database
+         * @param {Object} options {filename: ...}, the database file, by
+         *  default the one of the Django project
+         * @param {Function} callback Called with an error, if any, once done
          */
-        insert: function(entry) {
-            sqlite3.serialize(function() {
-                sqlite3.each("SELECT " + LOCATIONS.COLUMNS.ID + " FROM " + LOCATIONS.NAME + " WHERE " + LOCATIONS.COLUMNS.NAME + " = ?",
-                    [entry.location], function(err, row) {
+        connect: function(options, callback) {
+            var self = this;
+            self.connection = new sqlite3_lib.Database(options.filename || SQLITE_FILENAME, function(err) {
+                if(err) {
+                    callback(err);
+                    return;
+                }
+                self.connection.all("SELECT " + LOCATIONS.COLUMNS.ID + ", " + LOCATIONS.COLUMNS.NAME + " FROM " + LOCATIONS.NAME,
+                    function(err, rows) {
 
                     if(err) {
-                        console.log(err);
+                        callback(err);
+                        return;
                     }
-                    var locationId = row.id;
-
-                    sqlite3.serialize(function() {
-                        if(typeof entry.image === 'undefined') {
-                            var columns = "(" + OFFERINGS.COLUMNS.TIMESTAMP + ", " + OFFERINGS.COLUMNS.LOCATION_ID + ", " + OFFERINGS.COLUMNS.TITLE + ", "
-                                + OFFERINGS.COLUMNS.DESCRIPTION + ", " + OFFERINGS.COLUMNS.THREAD_ID + ")";
-                            var stmt = sqlite3.prepare("INSERT INTO " + OFFERINGS.NAME + " " + columns + " VALUES (?, ?, ?, ?, ?)");
-                            stmt.run(entry.timestamp, locationId, entry.food, entry.body, entry.threadId);
-                            stmt.finalize();
-                        }
-                        else {
-                            var columns = "(" + OFFERINGS.COLUMNS.TIMESTAMP + ", " + OFFERINGS.COLUMNS.LOCATION_ID + ", " + OFFERINGS.COLUMNS.TITLE + ", "
-                                + OFFERINGS.COLUMNS.DESCRIPTION + ", " + OFFERINGS.COLUMNS.THREAD_ID + ", " + OFFERINGS.COLUMNS.IMAGE + ")";
-                            var stmt = sqlite3.prepare("INSERT INTO " + OFFERINGS.NAME + " " + columns + " VALUES (?, ?, ?, ?, ?, ?)");
-                            stmt.run(entry.timestamp, locationId, entry.food, entry.body, entry.threadId, entry.image.name);
-                            stmt.finalize();
-                        }
-                    });
-                    console.log("Entry inserted to database.");
+                    self.locationIds = new Map(rows.map(row => [row.name, row.id]));
+                    callback(null);
                 });
             });
         },
 
 
         /**
-         * Delete given entry from the database
+         * Get the history id that 'mailbox' was read up to
+         *
+         * @param {string} mailbox The email address of the mailbox
+         * @param {Function} callback Called with an error, if any, and the
+         *  history id, or null if the mailbox was never read
+         */
+        getCursor: function(mailbox, callback) {
+            this.connection.get("SELECT " + MAILBOX_CURSORS.COLUMNS.HISTORY_ID + " FROM " + MAILBOX_CURSORS.NAME + " WHERE "
+                + MAILBOX_CURSORS.COLUMNS.MAILBOX + " = ?", [mailbox], function(err, row) {
+                callback(err, row ? row.history_id : null);
+            });
+        },
+
+
+        /**
+         * Insert and delete the entries of one sweep of the inbox, and move
+         * the cursor of its mailbox, in one transaction. Deletes apply to
+         * offerings inserted in the same sweep too.
          *
-         * @param {Object} entry The entry to be deleted from the database
+         * @param {Object} sweep {inserts: [...], deletes: [...]}, the entries
+         *  to be inserted to and deleted from the database, and optionally
+         *  {mailbox: ..., historyId: ...}, the cursor to save
+         * @param {Function} callback Called with an error, if any, once the
+         *  transaction is committed or rolled back
          */
-        delete: function(entry) {
-            // If there is an entry with the given ThreadID, Delete
-            sqlite3.serialize(function() {
-                sqlite3.run("DELETE FROM " + OFFERINGS.NAME + " WHERE " + OFFERINGS.COLUMNS.THREAD_ID + "=(?)", entry.threadId);
+        write: function(sweep, callback) {
+            var connection = this.connection;
+            var prepared = prepareSweep(sweep, this.locationIds);
+            var rows = prepared.inserts.map(entry => getRow(entry, this.locationIds));
+            var now = currentTimestamp();
+            var maxId = 0; // largest offering id before the inserts
+
+            var steps = [
+                next => connection.run("BEGIN IMMEDIATE", next),
+                next => connection.get("SELECT COALESCE(MAX(" + OFFERINGS.COLUMNS.ID + "), 0) AS max_id FROM " + OFFERINGS.NAME,
+                    function(err, row) {
+                        if(!err) { maxId = row.max_id; }
+                        next(err);
+                    })
+            ];
+            for(var chunkRows of chunk(rows)) {
+                (function(chunkRows) {
+                    steps.push(next => connection.run("INSERT OR IGNORE INTO " + OFFERINGS.NAME + " " + INSERT_COLUMNS + " VALUES "
+                        + getPlaceholders(chunkRows.length, 6, sqlitePlaceholder), [].concat.apply([], chunkRows), next));
+                })(chunkRows);
+            }
+            // Ids only grow, and the transaction holds the write lock, so the
+            // offerings just inserted are those past the largest id before
+            steps.push(next => connection.run("INSERT INTO " + OFFERING_CHANGES.NAME + " " + CHANGE_COLUMNS + " SELECT "
+                + OFFERINGS.COLUMNS.ID + ", ? FROM " + OFFERINGS.NAME + " WHERE " + OFFERINGS.COLUMNS.ID + " > ?", [now, maxId], next));
+            for(var threadIds of chunk(prepared.threadIds)) {
+                (function(threadIds) {
+                    var list = getList(threadIds.length, sqlitePlaceholder);
+                    steps.push(next => connection.run("INSERT INTO " + OFFERING_CHANGES.NAME + " " + CHANGE_COLUMNS + " SELECT "
+                        + OFFERINGS.COLUMNS.ID + ", ? FROM " + OFFERINGS.NAME + " WHERE " + OFFERINGS.COLUMNS.THREAD_ID
+                        + " IN (" + list + ")", [now].concat(threadIds), next));
+                    steps.push(next => connection.run("DELETE FROM " + OFFERINGS.NAME + " WHERE " + OFFERINGS.COLUMNS.THREAD_ID
+                        + " IN (" + list + ")", threadIds, next));
+                })(threadIds);
+            }
+            if(sweep.historyId) {
+                // No upsert in the sqlite the scraper is built with
+                steps.push(next => connection.run("UPDATE " + MAILBOX_CURSORS.NAME + " SET " + MAILBOX_CURSORS.COLUMNS.HISTORY_ID
+                    + " = ?, " + MAILBOX_CURSORS.COLUMNS.TIMESTAMP + " = ? WHERE " + MAILBOX_CURSORS.COLUMNS.MAILBOX + " = ?",
+                    [sweep.historyId, now, sweep.mailbox], next));
+                steps.push(next => connection.run("INSERT INTO " + MAILBOX_CURSORS.NAME + " " + CURSOR_COLUMNS + " SELECT ?, ?, ? "
+                    + "WHERE NOT EXISTS (SELECT 1 FROM " + MAILBOX_CURSORS.NAME + " WHERE " + MAILBOX_CURSORS.COLUMNS.MAILBOX + " = ?)",
+                    [sweep.mailbox, sweep.historyId, now, sweep.mailbox], next));
+            }
+
+            series(steps, function(err) {
+                if(err) {
+                    console.log(err);
+                    connection.run("ROLLBACK", () => callback(err));
+                    return;
+                }
+                connection.run("COMMIT", function(err) {
+                    if(!err) {
+                        console.log(prepared.inserts.length + " entries inserted to and "
+                            + prepared.threadIds.length + " threads deleted from database.");
+                    }
+                    callback(err);
+                });
             });
-            console.log("Entry deleted from database.");
+        },
+
+
+        /**
+         * Close the database
+         *
+         * @param {Function} callback Called once it is closed
+         */
+        end: function(callback) {
+            this.connection.close(callback);
+            this.connection = null;
         }
     },
 
 
     // Postgres implementation
     postgres: {
+        connection: null,
+        locationIds: null, // maps location names to their ids
+
         /**
-         * Insert given entry to the database
+         * Connect to the database and load the ids of every location
          *
-         * @param {Object} entry The entry to be inserted to the database
+         * @param {Object} options {connectionString: ...}, the database to
+         *  connect to, by default DATABASE_URL
+         * @param {Function} callback Called with an error, if any, once done
          */
-        insert: function(entry) {
-            pg.connect(process.env.DATABASE_URL, function(err, client) {
-                if (err) throw err;
-                console.log('Connected to postgres! Getting schemas...');
+        connect: function(options, callback) {
+            var self = this;
+            self.connection = new pg.Client(options.connectionString || process.env.DATABASE_URL);
+            self.connection.connect(function(err) {
+                if(err) {
+                    callback(err);
+                    return;
+                }
+                self.connection.query('SELECT ' + LOCATIONS.COLUMNS.ID + ', ' + LOCATIONS.COLUMNS.NAME + ' FROM ' + LOCATIONS.NAME,
+                    function(err, result) {
 
-                client.query('SELECT ' + LOCATIONS.COLUMNS.ID + ' FROM ' + LOCATIONS.NAME + ' WHERE ' + LOCATIONS.COLUMNS.NAME + ' = $1',
-                    [entry.location], function(err, result) {
+                    if(err) {
+                        callback(err);
+                        return;
+                    }
+                    self.locationIds = new Map(result.rows.map(row => [row.name, row.id]));
+                    callback(null);
+                });
+            });
+        },
 
-                    if (err) throw err;
 
-                    if(!result || !result.rows || !result.rows[0]) { return; }
-                    var locationId = result.rows[0].id;
+        /**
+         * Get the history id that 'mailbox' was read up to
+         *
+         * @param {string} mailbox The email address of the mailbox
+         * @param {Function} callback Called with an error, if any, and the
+         *  history id, or null if the mailbox was never read
+         */
+        getCursor: function(mailbox, callback) {
+            this.connection.query('SELECT ' + MAILBOX_CURSORS.COLUMNS.HISTORY_ID + ' FROM ' + MAILBOX_CURSORS.NAME + ' WHERE '
+                + MAILBOX_CURSORS.COLUMNS.MAILBOX + ' = $1', [mailbox], function(err, result) {
+                callback(err, (!err && result.rows.length) ? result.rows[0].history_id : null);
+            });
+        },
 
-                    if(typeof entry.image === 'undefined') {
-                        var columns = "(" + OFFERINGS.COLUMNS.TIMESTAMP + ", " + OFFERINGS.COLUMNS.LOCATION_ID + ", " + OFFERINGS.COLUMNS.TITLE + ", "
-                                + OFFERINGS.COLUMNS.DESCRIPTION + ", " + OFFERINGS.COLUMNS.THREAD_ID + ")";
-                        client.query('INSERT INTO ' + OFFERINGS.NAME + ' ' + columns + ' VALUES ($1, $2, $3, $4, $5)',
-                            [entry.timestamp, locationId, entry.food, entry.body, entry.threadId], function(c,e){ client.end(); });
-                    }
-                    else {
-                        var columns = "(" + OFFERINGS.COLUMNS.TIMESTAMP + ", " + OFFERINGS.COLUMNS.LOCATION_ID + ", " + OFFERINGS.COLUMNS.TITLE + ", "
-                                + OFFERINGS.COLUMNS.DESCRIPTION + ", " + OFFERINGS.COLUMNS.THREAD_ID + ", " + OFFERINGS.COLUMNS.IMAGE + ")";
-                        client.query('INSERT INTO ' + OFFERINGS.NAME + ' ' + columns + ' VALUES ($1, $2, $3, $4, $5, $6)',
-                            [entry.timestamp, locationId, entry.food, entry.body, entry.threadId, entry.image.name], function(c,e){ client.end(); });
-                    }
 
-                    console.log("Entry inserted to database.");
+        /**
+         * Insert and delete the entries of one sweep of the inbox, and move
+         * the cursor of its mailbox, in one transaction. Deletes apply to
+         * offerings inserted in the same sweep too.
+         *
+         * @param {Object} sweep {inserts: [...], deletes: [...]}, the entries
+         *  to be inserted to and deleted from the database, and optionally
+         *  {mailbox: ..., historyId: ...}, the cursor to save
+         * @param {Function} callback Called with an error, if any, once the
+         *  transaction is committed or rolled back
+         */
+        write: function(sweep, callback) {
+            var connection = this.connection;
+            var prepared = prepareSweep(sweep, this.locationIds);
+            var rows = prepared.inserts.map(entry => getRow(entry, this.locationIds));
+
+            var steps = [next => connection.query('BEGIN', next)];
+            for(var chunkRows of chunk(rows)) {
+                (function(chunkRows) {
+                    // Log the new offerings in the same statement that
+                    // inserts them
+                    steps.push(next => connection.query('WITH inserted AS (INSERT INTO ' + OFFERINGS.NAME + ' ' + INSERT_COLUMNS + ' VALUES '
+                        + getPlaceholders(chunkRows.length, 6, postgresPlaceholder) + ' ON CONFLICT DO NOTHING RETURNING ' + OFFERINGS.COLUMNS.ID + ') '
+                        + 'INSERT INTO ' + OFFERING_CHANGES.NAME + ' ' + CHANGE_COLUMNS + ' SELECT ' + OFFERINGS.COLUMNS.ID
+                        + ', NOW() FROM inserted', [].concat.apply([], chunkRows), next));
+                })(chunkRows);
+            }
+            for(var threadIds of chunk(prepared.threadIds)) {
+                (function(threadIds) {
+                    steps.push(next => connection.query('WITH deleted AS (DELETE FROM ' + OFFERINGS.NAME + ' WHERE '
+                        + OFFERINGS.COLUMNS.THREAD_ID + ' IN (' + getList(threadIds.length, postgresPlaceholder) + ') RETURNING '
+                        + OFFERINGS.COLUMNS.ID + ') INSERT INTO ' + OFFERING_CHANGES.NAME + ' ' + CHANGE_COLUMNS + ' SELECT '
+                        + OFFERINGS.COLUMNS.ID + ', NOW() FROM deleted', threadIds, next));
+                })(threadIds);
+            }
+            if(sweep.historyId) {
+                steps.push(next => connection.query('INSERT INTO ' + MAILBOX_CURSORS.NAME + ' ' + CURSOR_COLUMNS + ' VALUES ($1, $2, NOW()) '
+                    + 'ON CONFLICT (' + MAILBOX_CURSORS.COLUMNS.MAILBOX + ') DO UPDATE SET ' + MAILBOX_CURSORS.COLUMNS.HISTORY_ID + ' = EXCLUDED.'
+                    + MAILBOX_CURSORS.COLUMNS.HISTORY_ID + ', ' + MAILBOX_CURSORS.COLUMNS.TIMESTAMP + ' = EXCLUDED.' + MAILBOX_CURSORS.COLUMNS.TIMESTAMP,
+                    [sweep.mailbox, sweep.historyId], next));
+            }
+
+            series(steps, function(err) {
+                if(err) {
+                    console.log(err);
+                    connection.query('ROLLBACK', () => callback(err));
+                    return;
+                }
+                connection.query('COMMIT', function(err) {
+                    if(!err) {
+                        console.log(prepared.inserts.length + " entries inserted to and "
+                            + prepared.threadIds.length + " threads deleted from database.");
+                    }
+                    callback(err);
                 });
             });
         },
 
 
         /**
-         * Delete given entry from the database
+         * Close the connection
          *
-         * @param {Object} entry The entry to be deleted from the database
+         * @param {Function} callback Called once it is closed
          */
-        delete: function(entry) {
-            // If there is an entry with the given ThreadID, Delete
-            pg.connect(process.env.DATABASE_URL, function(err, client) {
-                if (err) throw err;
-                console.log('Connected to postgres! Getting schemas...');
-
-                client.query('DELETE FROM ' + OFFERINGS.NAME + ' WHERE ' + OFFERINGS.COLUMNS.THREAD_ID + '=($1)', [entry.threadId], function(c,e){ client.end(); });
-                console.log("Entry deleted from database.");
-            });
+        end: function(callback) {
+            this.connection.end();
+            this.connection = null;
+            if(callback) { callback(); }
         }
     }
 };
@@ -0,0 +1,434 @@
+/******************************************************************************/
+/* pipeline.js                                                                */
+/*                                                                            */
+/* Runs one sweep of the inbox: lists the unread emails, fetches and parses   */
+/* them, has the entries written to the database, then marks the emails as    */
+/* read.                                                                      */
+/*                                                                            */
+/* Emails are fetched a few at a time (at most 'concurrency' requests to the  */
+/* Gmail API are in flight at once), and every request first takes its cost   */
+/* in quota units from a token bucket, which refills at 'unitsPerSecond', so  */
+/* the scraper stays within the per-user quota of the Gmail API. Requests     */
+/* that hit the quota anyway, or fail on the server, are retried after a      */
+/* growing delay. Every email of the sweep is marked as read with one         */
+/* batchModify request (or one per BATCH_MODIFY_MAX_IDS emails).              */
+/*                                                                            */
+/* After its first sweep, the pipeline only lists the emails added to the     */
+/* mailbox since the last sweep, from the mailbox's history, starting at the  */
+/* history id saved with the last sweep (see db.js). If that history id is    */
+/* too old for the Gmail API to still have the history since, it lists every  */
+/* unread email instead, as on the first sweep.                               */
+/*                                                                            */
+/* The Gmail client is passed in, so the pipeline can be run against a fake   */
+/* server (see test/fake/gmail.js).                                           */
+/******************************************************************************/
+
+var scraper = require('./scraper');
+
+const LISTSERV_SENDER = 'Free Food <freefood@princeton.edu>';
+
+// https://developers.google.com/gmail/api/v1/reference/quota
+const QUOTA_UNITS = {
+    'getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50
+};
+const DEFAULT_UNITS_PER_SECOND = 250; // per-user limit
+const DEFAULT_CONCURRENCY = 10;
+
+const LIST_PAGE_SIZE = 500; // the most messages.list and history.list return at once
+const BATCH_MODIFY_MAX_IDS = 1000; // the most batchModify takes at once
+
+const MAX_RETRIES = 3;
+const DEFAULT_RETRY_DELAY = 1000; // ms, doubled after each retry
+
+module.exports.Pipeline = Pipeline;
+module.exports.TokenBucket = TokenBucket;
+module.exports.mapLimit = mapLimit;
+module.exports.parseMessage = parseMessage;
+
+
+/**
+ * A token bucket holding up to 'capacity' tokens, which refills at 'rate'
+ * tokens per second. Starts full.
+ *
+ * @param {number} rate The number of tokens added per second
+ * @param {number} capacity The most tokens the bucket holds
+ */
+function TokenBucket(rate, capacity) {
+    this.rate = rate;
+    this.capacity = capacity;
+    this.tokens = capacity;
+    this.updated = Date.now();
+    this.waiting = []; // {cost, callback} waiting for tokens, in order
+}
+
+/**
+ * Take 'cost' tokens from the bucket, then call 'callback', as soon as there
+ * are enough. Callers are served in order. A cost above the capacity is
+ * taken once the bucket is full, leaving it in debt.
+ *
+ * @param {number} cost The number of tokens to take
+ * @param {Function} callback Called once they are taken
+ */
+TokenBucket.prototype.take = function(cost, callback) {
+    this.waiting.push({cost: cost, callback: callback});
+    if(this.waiting.length == 1) {
+        this.drain();
+    }
+};
+
+/**
+ * Helper function: Serve whoever is waiting, until the bucket runs out of
+ * tokens, then wait for it to refill.
+ */
+TokenBucket.prototype.drain = function() {
+    while(this.waiting.length) {
+        var now = Date.now();
+        this.tokens = Math.min(this.capacity, this.tokens + (now - this.updated) * this.rate / 1000);
+        this.updated = now;
+
+        var next = this.waiting[0];
+        var needed = Math.min(next.cost, this.capacity);
+        if(this.tokens < needed) {
+            setTimeout(this.drain.bind(this), Math.ceil((needed - this.tokens) * 1000 / this.rate));
+            return;
+        }
+        this.tokens -= next.cost;
+        this.waiting.shift();
+        setImmediate(next.callback);
+    }
+};
+
+
+/**
+ * Run 'worker' on every item of 'items', with at most 'limit' running at
+ * once, then call 'callback' with their results, in the order of 'items'.
+ *
+ * @param {Array} items The items
+ * @param {number} limit The most workers running at once
+ * @param {Function} worker Called with an item and a callback, to call with
+ *  its result
+ * @param {Function} callback Called with the results
+ */
+function mapLimit(items, limit, worker, callback) {
+    var results = new Array(items.length);
+    var started = 0;
+    var finished = 0;
+    if(items.length == 0) {
+        setImmediate(callback, results);
+        return;
+    }
+
+    function startNext() {
+        var index = started++;
+        worker(items[index], function(result) {
+            results[index] = result;
+            finished++;
+            if(finished == items.length) {
+                callback(results);
+            }
+            else if(started < items.length) {
+                startNext();
+            }
+        });
+    }
+    for(var i = 0; i < Math.min(limit, items.length); i++) {
+        startNext();
+    }
+}
+
+
+/**
+ * Parse a message into an entry to be inserted or deleted
+ *
+ * @param {Object} message The message, as users.messages.get returns it
+ * @return {Object} {type: scraper.INSERT or scraper.DELETE, entry: ...}, or
+ *  undefined if the message is not from the listserv or could not be parsed
+ */
+function parseMessage(message) {
+    // Check if the sender is Free Food Listserv
+    var sender = message.payload.headers.find(x => x.name === 'Sender');
+    if(typeof sender === 'undefined' || sender.value !== LISTSERV_SENDER) {
+        return undefined;
+    }
+
+    var entry = scraper.formatEmail(message, message.id);
+    if(entry.location == '') {
+        console.log('Parsing failed - messageId: ' + message.id);
+        return undefined;
+    }
+    return {type: scraper.getRequestType(entry.title+entry.body), entry: entry};
+}
+
+
+/**
+ * Get the larger of two history ids, which are unsigned 64-bit integers, as
+ * strings, so they are compared without rounding them to doubles
+ */
+function maxHistoryId(a, b) {
+    a = String(a);
+    b = String(b);
+    return (a.length > b.length || (a.length == b.length && a > b)) ? a : b;
+}
+
+
+/**
+ * Sweeps of the inbox through 'gmail', with the options (all optional):
+ *  - concurrency: the most requests in flight at once
+ *  - unitsPerSecond: the quota units that can be used per second
+ *  - burst: the most quota units that can be used at once, by default
+ *    unitsPerSecond
+ *  - retryDelay: the delay before retrying a failed request the first time,
+ *    in ms
+ *
+ * @param {Object} gmail A Gmail API client, e.g. google.gmail('v1')
+ * @param {Object} options The options
+ */
+function Pipeline(gmail, options) {
+    options = options || {};
+    var unitsPerSecond = options.unitsPerSecond || DEFAULT_UNITS_PER_SECOND;
+    this.gmail = gmail;
+    this.concurrency = options.concurrency || DEFAULT_CONCURRENCY;
+    this.bucket = new TokenBucket(unitsPerSecond, options.burst || unitsPerSecond);
+    this.retryDelay = options.retryDelay || DEFAULT_RETRY_DELAY;
+}
+
+/**
+ * Call users.'method' with 'params' once the quota allows, retrying if it
+ * fails because of the quota or the server
+ *
+ * @param {string} method The method, one of QUOTA_UNITS
+ * @param {Object} params Its parameters
+ * @param {Function} callback Called with an error, if any, and the result
+ */
+Pipeline.prototype.request = function(method, params, callback) {
+    var self = this;
+    var retries = 0;
+    var path = method.split('.');
+    var resource = path.slice(0, -1).reduce((resource, name) => resource[name], self.gmail.users);
+    (function attempt() {
+        self.bucket.take(QUOTA_UNITS[method], function() {
+            resource[path[path.length - 1]](params, function(err, result) {
+                if(err && (err.code == 429 || err.code >= 500) && retries < MAX_RETRIES) {
+                    setTimeout(attempt, self.retryDelay * Math.pow(2, retries++));
+                    return;
+                }
+                callback(err, result);
+            });
+        });
+    })();
+};
+
+/**
+ * List the ids of every unread message, one page after the other
+ *
+ * @param {Function} callback Called with an error, if any, and the ids
+ */
+Pipeline.prototype.listUnread = function(callback) {
+    var self = this;
+    var ids = [];
+    (function listPage(pageToken) {
+        var params = {userId: 'me', q: 'is:unread', maxResults: LIST_PAGE_SIZE};
+        if(pageToken) {
+            params.pageToken = pageToken;
+        }
+        self.request('messages.list', params, function(err, result) {
+            if(err) {
+                callback(err);
+                return;
+            }
+            for(var message of (result && result.messages) || []) {
+                ids.push(message.id);
+            }
+            if(result && result.nextPageToken) {
+                listPage(result.nextPageToken);
+            }
+            else {
+                callback(null, ids);
+            }
+        });
+    })();
+};
+
+/**
+ * List the ids of the unread messages added since history id 'start'
+ *
+ * @param {string} start The history id
+ * @param {Function} callback Called with an error, if any (with code 404 if
+ *  the history since 'start' is no longer kept), the ids, and the largest
+ *  history id listed
+ */
+Pipeline.prototype.listHistory = function(start, callback) {
+    var self = this;
+    var ids = [];
+    var seen = new Set();
+    var last = start;
+    (function listPage(pageToken) {
+        var params = {userId: 'me', startHistoryId: start, historyTypes: 'messageAdded', maxResults: LIST_PAGE_SIZE};
+        if(pageToken) {
+            params.pageToken = pageToken;
+        }
+        self.request('history.list', params, function(err, result) {
+            if(err) {
+                callback(err);
+                return;
+            }
+            for(var record of (result && result.history) || []) {
+                last = maxHistoryId(last, record.id);
+                for(var added of record.messagesAdded || []) {
+                    var message = added.message;
+                    if(!seen.has(message.id) && (message.labelIds || []).indexOf('UNREAD') != -1) {
+                        seen.add(message.id);
+                        ids.push(message.id);
+                    }
+                }
+            }
+            if(result && result.nextPageToken) {
+                listPage(result.nextPageToken);
+            }
+            else {
+                callback(null, ids, last);
+            }
+        });
+    })();
+};
+
+/**
+ * Fetch the messages with ids 'ids'
+ *
+ * @param {Array} ids The message ids
+ * @param {Function} callback Called with the messages, in the order of
+ *  'ids', with undefined for those that could not be fetched
+ */
+Pipeline.prototype.fetch = function(ids, callback) {
+    var self = this;
+    mapLimit(ids, self.concurrency, function(id, done) {
+        self.request('messages.get', {userId: 'me', id: id}, function(err, message) {
+            if(err) {
+                console.log(err);
+            }
+            done(err ? undefined : message);
+        });
+    }, callback);
+};
+
+/**
+ * Mark the messages with ids 'ids' as read, with as few requests as possible
+ *
+ * @param {Array} ids The message ids
+ * @param {Function} callback Called with an error, if any
+ */
+Pipeline.prototype.markAsRead = function(ids, callback) {
+    var batches = [];
+    for(var i = 0; i < ids.length; i += BATCH_MODIFY_MAX_IDS) {
+        batches.push(ids.slice(i, i + BATCH_MODIFY_MAX_IDS));
+    }
+    var self = this;
+    mapLimit(batches, self.concurrency, function(batch, done) {
+        self.request('messages.batchModify', {userId: 'me', resource: {ids: batch, removeLabelIds: ['UNREAD']}}, done);
+    }, function(errors) {
+        callback(errors.find(err => err) || null);
+    });
+};
+
+/**
+ * List the ids of the unread messages to read in this sweep: those added
+ * since 'start', if given and the history since is still kept, or else every
+ * unread message
+ *
+ * @param {string} start The history id the last sweep read up to, or null
+ * @param {Function} callback Called with an error, if any, the ids, whether
+ *  they are from the history, and the largest history id listed
+ */
+Pipeline.prototype.listNew = function(start, callback) {
+    var self = this;
+    if(!start) {
+        self.listUnread((err, ids) => callback(err, ids, false, null));
+        return;
+    }
+    self.listHistory(start, function(err, ids, last) {
+        if(err && err.code == 404) {
+            console.log('History since ' + start + ' is no longer kept, listing every unread email');
+            self.listUnread((err, ids) => callback(err, ids, false, null));
+            return;
+        }
+        callback(err, ids, true, last);
+    });
+};
+
+/**
+ * Run one sweep of the inbox. The emails that are not from the listserv, or
+ * could not be parsed, are left unread, as are all of them if writing them
+ * fails. The cursor of the mailbox only moves past the emails listed if
+ * every one of them could be fetched.
+ *
+ * @param {Object} store Where the sweep is read from and written to, with
+ *  the methods getCursor(mailbox, callback) and write(sweep, callback) of
+ *  db.js
+ * @param {Function} callback Called with an error, if any, and the number of
+ *  emails {listed: ..., written: ...}, and whether they were listed from the
+ *  history {history: ...}
+ */
+Pipeline.prototype.sweep = function(store, callback) {
+    var self = this;
+    // The history id before listing, so emails added while sweeping are
+    // listed again by the next sweep, rather than missed
+    self.request('getProfile', {userId: 'me'}, function(err, profile) {
+        if(err) {
+            callback(err);
+            return;
+        }
+        store.getCursor(profile.emailAddress, function(err, start) {
+            if(err) {
+                callback(err);
+                return;
+            }
+            self.listNew(start, function(err, ids, history, last) {
+                if(err) {
+                    callback(err);
+                    return;
+                }
+                var count = {listed: ids.length, written: 0, history: history};
+                if(ids.length == 0) {
+                    console.log('No unread message exists');
+                }
+
+                self.fetch(ids, function(messages) {
+                    var sweep = {inserts: [], deletes: [], mailbox: profile.emailAddress};
+                    var parsedIds = [];
+                    var fetchedAll = true;
+                    messages.forEach(function(message) {
+                        if(!message) {
+                            fetchedAll = false;
+                            return;
+                        }
+                        var parsed = parseMessage(message);
+                        if(parsed) {
+                            (parsed.type == scraper.INSERT ? sweep.inserts : sweep.deletes).push(parsed.entry);
+                            parsedIds.push(message.id);
+                        }
+                    });
+                    if(fetchedAll) {
+                        sweep.historyId = history ? maxHistoryId(profile.historyId, last) : profile.historyId;
+                    }
+                    if(parsedIds.length == 0 && (!sweep.historyId || sweep.historyId == start)) {
+                        callback(null, count);
+                        return;
+                    }
+
+                    store.write(sweep, function(err) {
+                        if(err) {
+                            callback(err);
+                            return;
+                        }
+                        count.written = parsedIds.length;
+                        self.markAsRead(parsedIds, err => callback(err, count));
+                    });
+                });
+            });
+        });
+    });
+};
@@ -40,19 +40,52 @@ var regexes = fs.readFileSync(__dirname + '/data/regexMap.txt').toString().split
 // Extract data from files
 var locationMap = {};
 var aliasList = [];
-for (location of locations) {
+for (var location of locations) {
     var tokens = location.split(',');
     locationMap[tokens[0]] = tokens[1];
     aliasList.push(tokens[0]);
 }
 var regexMap = {};
 var regexList = [];
-for (regex of regexes) {
+for (var regex of regexes) {
     var tokens = regex.split(',');
     regexMap[tokens[0]] = tokens[1];
     regexList.push(tokens[0]);
 }
 
+// Compile aliases into an automaton that finds the longest alias in a text
+// with one scan, and regexes into RegExp objects, once at load
+var aliasAutomaton = buildAliasAutomaton(aliasList.map(alias => alias.toLowerCase()));
+var compiledRegexList = regexList.map(regex => ({source: regex, regexp: new RegExp(regex, 'i')}));
+
+// Compile foods into a set for exact lookups, and a trie keyed by word for
+// finding every food that starts at a given word in a single walk
+var foodSet = new Set(foods);
+var foodTrie = newTrieNode();
+var phraseLengths = new Map(); // word -> lengths of multi-word foods containing it, in file order
+for (var food of foods) {
+    var splitFood = food.split(' ');
+    var node = foodTrie;
+    for (var word of splitFood) {
+        if (!node.children.has(word)) {
+            node.children.set(word, newTrieNode());
+        }
+        node = node.children.get(word);
+    }
+    node.isFood = true;
+
+    if (splitFood.length > 1) {
+        for (var word of splitFood) {
+            if (!phraseLengths.has(word)) {
+                phraseLengths.set(word, []);
+            }
+            if (phraseLengths.get(word).indexOf(splitFood.length) == NOT_FOUND) {
+                phraseLengths.get(word).push(splitFood.length);
+            }
+        }
+    }
+}
+
 /**
  * Formats a MIME message from the API to fit the database specification.
  *
@@ -208,15 +241,56 @@ function getBodyFromMime(mimeMessage) {
  */
 function isValidFood(text) {
     // Exact Match
-    if(foods.indexOf(text) != NOT_FOUND) { return true; }
+    if(foodSet.has(text)) { return true; }
 
     // Plural Form
-    if(text.slice(-1) == 's' && foods.indexOf(text.slice(0, -1)) != NOT_FOUND) { return true; }
-    if(text.slice(-2) == 'es' && foods.indexOf(text.slice(0, -2)) != NOT_FOUND) { return true; }
+    if(text.slice(-1) == 's' && foodSet.has(text.slice(0, -1))) { return true; }
+    if(text.slice(-2) == 'es' && foodSet.has(text.slice(0, -2))) { return true; }
 
     return false;
 }
 
+/**
+ * Create an empty node of the food trie
+ *
+ * @return {Object} node Node with a map of next words to child nodes.
+ */
+function newTrieNode() {
+    return {children: new Map(), isFood: false};
+}
+
+/**
+ * Find the lengths of all foods that start at a given word
+ *
+ * @param {Array} words The words of the text.
+ * @param {number} start The index of the word the foods should start at.
+ * @return {Set} lengths Set of n for which words[start..start+n-1] is a food
+ *  or the plural form of one.
+ */
+function matchLengths(words, start) {
+    var lengths = new Set();
+    var node = foodTrie;
+    for(var i = start; i < words.length; i++) {
+        var word = words[i];
+
+        // Plural Form: only the last word of a phrase can be plural
+        if(word.slice(-1) == 's') {
+            var child = node.children.get(word.slice(0, -1));
+            if(child && child.isFood) { lengths.add(i - start + 1); }
+        }
+        if(word.slice(-2) == 'es') {
+            var child = node.children.get(word.slice(0, -2));
+            if(child && child.isFood) { lengths.add(i - start + 1); }
+        }
+
+        // Exact Match
+        node = node.children.get(word);
+        if(!node) { break; }
+        if(node.isFood) { lengths.add(i - start + 1); }
+    }
+    return lengths;
+}
+
 /**
  * Capitalize the first letter of the text
  *
@@ -234,39 +308,28 @@ function capitalize(text) {
  */
 function getFood(text) {
     // Clean text and separate by whitespace
-    words = prepareText(text).split(/[\s,]+/g);
+    var words = prepareText(text).split(/[\s,]+/g);
 
     var matches = [];
 
     for(var i = 0; i < words.length; i++) {
         var phraseFound = false;
-        word = words[i];
-
-        // Check if the word is part of a phrase
-        for(food of foods) {
-            splitFood = food.split(" ");
-            if(splitFood.length > 1 && splitFood.indexOf(word) != NOT_FOUND) {
-                // Check boundary
-                if(i + splitFood.length > words.length) { continue; }
-
-                // Create phrase
-                phrase = [word];
-                for(var j = 1; j < splitFood.length; j++) {
-                    phrase.push(words[i+j]);
-                }
-                phraseString = phrase.join(" ");
-
-                if(isValidFood(phraseString)) {
-                    matches.push(capitalize(phraseString));
-                    i += splitFood.length - 1; // Increment index to skip over the phrase
-                    phraseFound = true;
-                    break;
-                }
+        var word = words[i];
+        var lengths = matchLengths(words, i);
+
+        // Check if the word is part of a phrase. Try phrase lengths in the
+        // order the phrases are listed in foods.txt.
+        for(var length of (phraseLengths.get(word) || [])) {
+            if(lengths.has(length)) {
+                matches.push(capitalize(words.slice(i, i + length).join(" ")));
+                i += length - 1; // Increment index to skip over the phrase
+                phraseFound = true;
+                break;
             }
         }
         if(phraseFound) { continue; }
 
-        if(isValidFood(word)) {
+        if(lengths.has(1)) {
             matches.push(capitalize(word));
         }
     }
@@ -278,6 +341,92 @@ function getFood(text) {
 
 }
 
+/**
+ * Build an Aho-Corasick automaton that finds the longest of the given
+ * patterns occurring in a text (the first one listed, on ties)
+ *
+ * @param {Array} patterns The strings to search for.
+ * @return {Object} automaton The goto, failure and best-match tables.
+ */
+function buildAliasAutomaton(patterns) {
+    var automaton = {patterns: patterns, goto: [new Map()], fail: [0], best: [NOT_FOUND]};
+
+    // Build the trie of patterns
+    for(var index = 0; index < patterns.length; index++) {
+        if(patterns[index] === '') { continue; }
+        var state = 0;
+        for(var char of patterns[index]) {
+            if(!automaton.goto[state].has(char)) {
+                automaton.goto[state].set(char, automaton.goto.length);
+                automaton.goto.push(new Map());
+                automaton.fail.push(0);
+                automaton.best.push(NOT_FOUND);
+            }
+            state = automaton.goto[state].get(char);
+        }
+        automaton.best[state] = betterAlias(automaton, automaton.best[state], index);
+    }
+
+    // Add failure links breadth-first, carrying the best pattern of each
+    // state's suffixes along with it
+    var queue = Array.from(automaton.goto[0].values());
+    while(queue.length > 0) {
+        var state = queue.shift();
+        for(var [char, nextState] of automaton.goto[state]) {
+            queue.push(nextState);
+            var failState = automaton.fail[state];
+            while(failState && !automaton.goto[failState].has(char)) {
+                failState = automaton.fail[failState];
+            }
+            automaton.fail[nextState] = automaton.goto[failState].get(char) || 0;
+            automaton.best[nextState] = betterAlias(automaton, automaton.best[nextState],
+                automaton.best[automaton.fail[nextState]]);
+        }
+    }
+
+    return automaton;
+}
+
+/**
+ * Pick the better of two pattern indices: the longer pattern, or the one
+ * listed first
+ *
+ * @param {Object} automaton The automaton the patterns belong to.
+ * @param {number} index1 Index of a pattern, or NOT_FOUND.
+ * @param {number} index2 Index of a pattern, or NOT_FOUND.
+ * @return {number} index The index of the better pattern.
+ */
+function betterAlias(automaton, index1, index2) {
+    if(index1 == NOT_FOUND) { return index2; }
+    if(index2 == NOT_FOUND) { return index1; }
+    var length1 = automaton.patterns[index1].length;
+    var length2 = automaton.patterns[index2].length;
+    if(length1 != length2) {
+        return length1 > length2 ? index1 : index2;
+    }
+    return Math.min(index1, index2);
+}
+
+/**
+ * Find the longest pattern that is a substring of the text
+ *
+ * @param {Object} automaton The automaton built by buildAliasAutomaton.
+ * @param {string} text The text to search.
+ * @return {number} index Index of the longest pattern found, or NOT_FOUND.
+ */
+function longestAlias(automaton, text) {
+    var best = NOT_FOUND;
+    var state = 0;
+    for(var char of text) {
+        while(state && !automaton.goto[state].has(char)) {
+            state = automaton.fail[state];
+        }
+        state = automaton.goto[state].get(char) || 0;
+        best = betterAlias(automaton, best, automaton.best[state]);
+    }
+    return best;
+}
+
 /**
  * Parse location from text and return official location name
  *
@@ -289,22 +438,18 @@ function getLocation(text) {
     var aliasLength = 0;
 
     text = prepareText(text);
-    for(loc of aliasList) {
-        if(text.indexOf(loc.toLowerCase()) > - 1) { // Substring search
-            if(aliasLength < loc.length) { // For longest match
-                location = locationMap[loc];
-                aliasLength = loc.length;
-            }
-        }
+
+    // Longest alias that is a substring of the text
+    var index = longestAlias(aliasAutomaton, text);
+    if(index != NOT_FOUND) {
+        location = locationMap[aliasList[index]];
+        aliasLength = aliasList[index].length;
     }
-    for(regex of regexList) {
-        var regexp = new RegExp(regex, 'i');
-        var result = text.match(regexp);
-        if(result) {
-            if(aliasLength < regex.length) { // For longest match
-                location = regexMap[regex];
-                aliasLength = loc.length;
-            }
+
+    for(var regex of compiledRegexList) {
+        if(aliasLength < regex.source.length && regex.regexp.test(text)) { // For longest match
+            location = regexMap[regex.source];
+            aliasLength = regex.source.length;
         }
     }
 
@@ -320,7 +465,7 @@ function getLocation(text) {
 function getRequestType(text) {
     text = prepareText(text);
     var deleteRequests = ["all gone"];
-    for(req of deleteRequests) {
+    for(var req of deleteRequests) {
         if(text.indexOf(req) != NOT_FOUND) {
             return DELETE;
         }
@@ -345,7 +490,7 @@ function listCheck(text) {
         chunks[i] = chunks[i].trim();
 
         // if it has punctuation, ignore
-        for(punctuation of PUNCTUATIONS) {
+        for(var punctuation of PUNCTUATIONS) {
             if(chunks[i].indexOf(punctuation) != NOT_FOUND) {
                 canBeFood[i] = false;
                 break;
@@ -362,12 +507,7 @@ function listCheck(text) {
 
 
         // find list with food
-        for (food of foods) {
-            if(isValidFood(chunks[i])) {
-                isFood[i] = true;
-                break;
-            }
-        }    
+        isFood[i] = isValidFood(chunks[i]);
     }
     
     var matches = [];
@@ -0,0 +1,304 @@
+/******************************************************************************/
+/* gmail.js                                                                   */
+/*                                                                            */
+/* A fake Gmail API server, for testing the scraper without a Google account. */
+/* It serves the messages recorded in test/fixtures/messages, as the real API */
+/* would for users.getProfile, history.list and messages.list, get and        */
+/* batchModify, over HTTP on a local port, and keeps track of the requests it */
+/* gets. The mailbox's history starts with a record adding each message, at   */
+/* the message's historyId.                                                   */
+/*                                                                            */
+/* client() returns a client for it with the same methods and callbacks as    */
+/* google.gmail('v1'), to pass to the scraper in place of the real one.       */
+/******************************************************************************/
+
+var fs = require('fs');
+var http = require('http');
+var path = require('path');
+var url = require('url');
+
+const FIXTURES_DIR = path.join(__dirname, '..', 'fixtures', 'messages');
+
+module.exports.FakeGmail = FakeGmail;
+module.exports.loadFixtures = loadFixtures;
+
+
+/**
+ * Load the recorded messages
+ *
+ * @return {Array} The messages, as users.messages.get returns them, oldest
+ *  first
+ */
+function loadFixtures() {
+    return fs.readdirSync(FIXTURES_DIR).filter(name => name.endsWith('.json')).sort()
+        .map(name => JSON.parse(fs.readFileSync(path.join(FIXTURES_DIR, name))))
+        .sort((a, b) => parseInt(a.internalDate) - parseInt(b.internalDate));
+}
+
+
+/**
+ * A fake server, with the options (all optional):
+ *  - messages: the messages in the mailbox, by default the recorded ones
+ *  - latency: how long it takes to answer each request, in ms
+ *  - pageSize: the most messages users.messages.list returns at once
+ *  - failures: maps message ids to the number of times getting them fails
+ *    with 429 (rate limit exceeded) before it succeeds
+ *  - oldestHistoryId: the oldest history id the history is kept since; a
+ *    history.list starting before it fails with 404
+ *  - emailAddress: the email address of the mailbox
+ *
+ * @param {Object} options The options
+ */
+function FakeGmail(options) {
+    options = options || {};
+    this.messages = new Map();
+    this.history = []; // {id, messagesAdded or labelsRemoved/labelsAdded: [...]}, oldest first
+    this.historyId = 1; // the mailbox's current history id
+    for(var message of (options.messages || loadFixtures()).slice().sort((a, b) => parseInt(a.historyId) - parseInt(b.historyId))) {
+        message = JSON.parse(JSON.stringify(message));
+        this.messages.set(message.id, message);
+        this.historyId = Math.max(this.historyId, parseInt(message.historyId));
+        this.record(parseInt(message.historyId), 'messagesAdded', message, message.labelIds);
+    }
+    this.oldestHistoryId = options.oldestHistoryId || 0;
+    this.emailAddress = options.emailAddress || 'freefood.scraper@gmail.com';
+    this.latency = options.latency || 0;
+    this.pageSize = options.pageSize || 100;
+    this.failures = Object.assign({}, options.failures);
+
+    this.requests = []; // {method, path, start} of every request
+    this.inFlight = 0;
+    this.maxInFlight = 0; // the most requests answered at once
+    this.server = http.createServer(this.handle.bind(this));
+}
+
+/**
+ * Start listening on a free local port
+ *
+ * @param {Function} callback Called once listening
+ */
+FakeGmail.prototype.listen = function(callback) {
+    this.server.listen(0, '127.0.0.1', callback);
+};
+
+/**
+ * Stop listening
+ *
+ * @param {Function} callback Called once stopped
+ */
+FakeGmail.prototype.close = function(callback) {
+    this.server.close(callback);
+};
+
+/**
+ * Add 'message' to the mailbox, as if it was just received
+ *
+ * @param {Object} message The message, as users.messages.get returns it
+ */
+FakeGmail.prototype.add = function(message) {
+    message = JSON.parse(JSON.stringify(message));
+    message.historyId = String(++this.historyId);
+    this.messages.set(message.id, message);
+    this.record(this.historyId, 'messagesAdded', message, message.labelIds);
+};
+
+/**
+ * Helper function: Add a record of type 'type' (messagesAdded, labelsAdded
+ * or labelsRemoved) for 'message' to the history.
+ */
+FakeGmail.prototype.record = function(id, type, message, labelIds) {
+    var change = {message: {id: message.id, threadId: message.threadId, labelIds: message.labelIds.slice()}};
+    if(type != 'messagesAdded') {
+        change.labelIds = labelIds;
+    }
+    var record = {id: String(id), messages: [{id: message.id, threadId: message.threadId}]};
+    record[type] = [change];
+    this.history.push(record);
+};
+
+/**
+ * Count the requests made so far with 'method', one of 'getProfile',
+ * 'history.list', 'messages.list', 'messages.get' and 'messages.batchModify'
+ */
+FakeGmail.prototype.count = function(method) {
+    return this.requests.filter(request => request.method == method).length;
+};
+
+/**
+ * Get the ids of the messages still unread
+ */
+FakeGmail.prototype.unread = function() {
+    return Array.from(this.messages.values()).filter(message => message.labelIds.indexOf('UNREAD') != -1)
+        .map(message => message.id).sort();
+};
+
+/**
+ * Helper function: Answer a request to the server.
+ */
+FakeGmail.prototype.handle = function(req, res) {
+    var self = this;
+    var parsed = url.parse(req.url, true);
+    var match = parsed.pathname.match(/^\/gmail\/v1\/users\/me\/(profile|history|messages)(?:\/([^\/]+))?$/) || [];
+    var method = (req.method == 'GET' && match[1] == 'profile') ? 'getProfile'
+        : (req.method == 'GET' && match[1] == 'history') ? 'history.list'
+        : (req.method == 'GET' && match[1] == 'messages' && !match[2]) ? 'messages.list'
+        : (req.method == 'GET' && match[1] == 'messages') ? 'messages.get'
+        : (req.method == 'POST' && match[1] == 'messages' && match[2] == 'batchModify') ? 'messages.batchModify'
+        : null;
+
+    self.requests.push({method: method, path: req.url, start: Date.now()});
+    self.inFlight++;
+    self.maxInFlight = Math.max(self.maxInFlight, self.inFlight);
+
+    var body = '';
+    req.on('data', chunk => { body += chunk; });
+    req.on('end', function() {
+        setTimeout(function() {
+            var answer = self.answer(method, match[2], parsed.query, body);
+            self.inFlight--;
+            res.writeHead(answer.status, {'Content-Type': 'application/json'});
+            res.end(answer.body === undefined ? '' : JSON.stringify(answer.body));
+        }, self.latency);
+    });
+};
+
+/**
+ * Helper function: Get the status and body of the answer to a request.
+ */
+FakeGmail.prototype.answer = function(method, id, query, body) {
+    function error(status, reason, message) {
+        return {status: status, body: {error: {errors: [{domain: 'global', reason: reason, message: message}],
+            code: status, message: message}}};
+    }
+
+    if(method == 'getProfile') {
+        return {status: 200, body: {emailAddress: this.emailAddress, messagesTotal: this.messages.size,
+            threadsTotal: new Set(Array.from(this.messages.values()).map(message => message.threadId)).size,
+            historyId: String(this.historyId)}};
+    }
+
+    if(method == 'history.list') {
+        var start = parseInt(query.startHistoryId);
+        if(!(start >= this.oldestHistoryId)) {
+            return error(404, 'notFound', 'Requested entity was not found.');
+        }
+        var types = [].concat(query.historyTypes || ['messageAdded', 'labelAdded', 'labelRemoved']).map(type => type.replace(/^(message|label)/, '$1s')); // e.g. messagesAdded
+        var records = this.history.filter(record => parseInt(record.id) > start && types.some(type => record[type]));
+        var offset = parseInt(query.pageToken) || 0;
+        var size = Math.min(parseInt(query.maxResults) || this.pageSize, this.pageSize);
+        var result = {historyId: String(this.historyId)};
+        if(records.length > offset) {
+            result.history = records.slice(offset, offset + size);
+        }
+        if(offset + size < records.length) {
+            result.nextPageToken = String(offset + size);
+        }
+        return {status: 200, body: result};
+    }
+
+    if(method == 'messages.list') {
+        var messages = Array.from(this.messages.values());
+        if(query.q == 'is:unread') {
+            messages = messages.filter(message => message.labelIds.indexOf('UNREAD') != -1);
+        }
+        else if(query.q) {
+            return error(400, 'invalidArgument', 'Only "is:unread" is supported');
+        }
+        // Newest first, like the real API
+        messages.sort((a, b) => parseInt(b.internalDate) - parseInt(a.internalDate));
+        var start = parseInt(query.pageToken) || 0;
+        var size = Math.min(parseInt(query.maxResults) || this.pageSize, this.pageSize);
+        var page = messages.slice(start, start + size).map(message => ({id: message.id, threadId: message.threadId}));
+        var result = {resultSizeEstimate: messages.length};
+        if(page.length) {
+            result.messages = page;
+        }
+        if(start + size < messages.length) {
+            result.nextPageToken = String(start + size);
+        }
+        return {status: 200, body: result};
+    }
+
+    if(method == 'messages.get') {
+        if(this.failures[id] > 0) {
+            this.failures[id]--;
+            return error(429, 'rateLimitExceeded', 'User-rate limit exceeded.');
+        }
+        if(!this.messages.has(id)) {
+            return error(404, 'notFound', 'Not Found');
+        }
+        return {status: 200, body: this.messages.get(id)};
+    }
+
+    if(method == 'messages.batchModify') {
+        var resource = JSON.parse(body || '{}');
+        for(var messageId of resource.ids || []) {
+            var message = this.messages.get(messageId);
+            if(!message) {
+                continue;
+            }
+            var removed = (resource.removeLabelIds || []).filter(label => message.labelIds.indexOf(label) != -1);
+            var added = (resource.addLabelIds || []).filter(label => message.labelIds.indexOf(label) == -1);
+            message.labelIds = message.labelIds.filter(label => removed.indexOf(label) == -1).concat(added);
+            if(removed.length) {
+                this.record(++this.historyId, 'labelsRemoved', message, removed);
+            }
+            if(added.length) {
+                this.record(++this.historyId, 'labelsAdded', message, added);
+            }
+            message.historyId = String(this.historyId);
+        }
+        return {status: 204};
+    }
+
+    return error(404, 'notFound', 'Not Found');
+};
+
+/**
+ * Get a client for the server, with the methods of google.gmail('v1') the
+ * scraper uses. Errors have the HTTP status as 'code', like those of the
+ * real client.
+ */
+FakeGmail.prototype.client = function() {
+    var port = this.server.address().port;
+
+    function request(method, path, params, resource, callback) {
+        var query = Object.assign({}, params);
+        delete query.userId;
+        delete query.id;
+        delete query.resource;
+        var req = http.request({host: '127.0.0.1', port: port, method: method,
+            path: '/gmail/v1/users/' + params.userId + path + url.format({query: query})}, function(res) {
+
+            var body = '';
+            res.on('data', chunk => { body += chunk; });
+            res.on('end', function() {
+                var result = body ? JSON.parse(body) : '';
+                if(res.statusCode >= 400) {
+                    var err = new Error(result.error.message);
+                    err.code = res.statusCode;
+                    err.errors = result.error.errors;
+                    callback(err);
+                    return;
+                }
+                callback(null, result);
+            });
+        });
+        req.on('error', callback);
+        req.end(resource === undefined ? undefined : JSON.stringify(resource));
+    }
+
+    return {
+        users: {
+            getProfile: (params, callback) => request('GET', '/profile', params, undefined, callback),
+            history: {
+                list: (params, callback) => request('GET', '/history', params, undefined, callback)
+            },
+            messages: {
+                list: (params, callback) => request('GET', '/messages', params, undefined, callback),
+                get: (params, callback) => request('GET', '/messages/' + params.id, params, undefined, callback),
+                batchModify: (params, callback) => request('POST', '/messages/batchModify', params, params.resource, callback)
+            }
+        }
+    };
+};
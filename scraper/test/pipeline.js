@@ -0,0 +1,297 @@
+/******************************************************************************/
+/* pipeline.js                                                                */
+/*                                                                            */
+/* This is a mocha test file that tests the Pipeline in pipeline.js, against  */
+/* a fake Gmail API server serving recorded messages (see fake/gmail.js).     */
+/******************************************************************************/
+
+var assert = require("assert");
+var pipeline = require('../pipeline.js');
+var scraper = require('../scraper.js');
+var FakeGmail = require('./fake/gmail.js').FakeGmail;
+var loadFixtures = require('./fake/gmail.js').loadFixtures;
+
+/**
+ * Helper function: A store keeping the cursors of mailboxes, and the sweeps
+ * written, in memory, in place of db.js. Writing fails with 'error', if
+ * given.
+ */
+function MemoryStore(error) {
+    this.cursors = {};
+    this.sweeps = [];
+    this.error = error;
+}
+
+MemoryStore.prototype.getCursor = function(mailbox, callback) {
+    setImmediate(callback, null, this.cursors[mailbox] || null);
+};
+
+MemoryStore.prototype.write = function(sweep, callback) {
+    if(!this.error) {
+        this.sweeps.push(sweep);
+        if(sweep.historyId) {
+            this.cursors[sweep.mailbox] = sweep.historyId;
+        }
+    }
+    setImmediate(callback, this.error || null);
+};
+
+/**
+ * Helper function: Run a sweep into 'store' against a new fake server with
+ * 'serverOptions', with a pipeline with 'options', then call 'callback' with
+ * the error, if any, the count of emails and the server.
+ */
+function sweep(serverOptions, options, store, callback) {
+    var server = new FakeGmail(serverOptions);
+    server.listen(function() {
+        new pipeline.Pipeline(server.client(), options).sweep(store, function(err, count) {
+            server.close(() => callback(err, count, server));
+        });
+    });
+}
+
+describe('TokenBucket', function() {
+    it('take() should serve callers up to the capacity at once, then at the rate', function(done) {
+        var bucket = new pipeline.TokenBucket(100, 3);
+        var start = Date.now();
+        var times = [];
+        for(var i = 0; i < 5; i++) {
+            bucket.take(1, function() {
+                times.push(Date.now() - start);
+                if(times.length == 5) {
+                    assert(times[2] < 10);
+                    assert(times[3] >= 9);
+                    assert(times[4] >= 19);
+                    done();
+                }
+            });
+        }
+    });
+
+    it('take() should serve a cost above the capacity once the bucket is full', function(done) {
+        var bucket = new pipeline.TokenBucket(1000, 5);
+        bucket.take(50, function() {
+            bucket.take(5, function() {
+                done();
+            });
+        });
+    });
+});
+
+describe('mapLimit()', function() {
+    it('mapLimit() should return results in order, with at most limit running at once', function(done) {
+        var running = 0;
+        var maxRunning = 0;
+        pipeline.mapLimit([30, 10, 20, 0, 5], 2, function(delay, callback) {
+            running++;
+            maxRunning = Math.max(maxRunning, running);
+            setTimeout(function() {
+                running--;
+                callback(delay * 2);
+            }, delay);
+        }, function(results) {
+            assert.deepEqual(results, [60, 20, 40, 0, 10]);
+            assert.equal(maxRunning, 2);
+            done();
+        });
+    });
+
+    it('mapLimit() should return no results for no items', function(done) {
+        pipeline.mapLimit([], 2, null, function(results) {
+            assert.deepEqual(results, []);
+            done();
+        });
+    });
+});
+
+describe('parseMessage()', function() {
+    var messages = new Map(loadFixtures().map(message => [message.id, message]));
+
+    it('parseMessage() should return an insert for a listserv email', function() {
+        var parsed = pipeline.parseMessage(messages.get('15b1a0c2d3e4f501'));
+        assert.equal(parsed.type, scraper.INSERT);
+        assert.equal(parsed.entry.location, 'Frist Campus Center');
+        assert.equal(parsed.entry.threadId, '15b1a0c2d3e4f501');
+    });
+
+    it('parseMessage() should return a delete for an "all gone" reply', function() {
+        var parsed = pipeline.parseMessage(messages.get('15b1a0c2d3e4f503'));
+        assert.equal(parsed.type, scraper.DELETE);
+        assert.equal(parsed.entry.threadId, '15b1a0c2d3e4f501');
+    });
+
+    it('parseMessage() should return undefined for an email not from the listserv', function() {
+        assert.equal(pipeline.parseMessage(messages.get('15b1a0c2d3e4f504')), undefined);
+    });
+
+    it('parseMessage() should return undefined for an email without a location', function() {
+        assert.equal(pipeline.parseMessage(messages.get('15b1a0c2d3e4f505')), undefined);
+    });
+});
+
+describe('Pipeline', function() {
+    it('sweep() should write the listserv emails, then mark them read with one request', function(done) {
+        var store = new MemoryStore();
+        sweep({}, {}, store, function(err, count, server) {
+            assert.equal(err, null);
+            assert.deepEqual(count, {listed: 5, written: 3, history: false});
+            assert.equal(store.sweeps.length, 1);
+            assert.deepEqual(store.sweeps[0].inserts.map(entry => entry.threadId).sort(), ['15b1a0c2d3e4f501', '15b1a0c2d3e4f502']);
+            assert.deepEqual(store.sweeps[0].deletes.map(entry => entry.threadId), ['15b1a0c2d3e4f501']);
+            assert.equal(server.count('messages.get'), 5);
+            assert.equal(server.count('messages.batchModify'), 1);
+            assert.deepEqual(server.unread(), ['15b1a0c2d3e4f504', '15b1a0c2d3e4f505']);
+            done();
+        });
+    });
+
+    it('sweep() should have at most concurrency requests in flight', function(done) {
+        sweep({latency: 20}, {concurrency: 2}, new MemoryStore(), function(err, count, server) {
+            assert.equal(err, null);
+            assert.equal(server.maxInFlight, 2);
+            done();
+        });
+    });
+
+    it('sweep() should list every page of unread emails', function(done) {
+        sweep({pageSize: 2}, {}, new MemoryStore(), function(err, count, server) {
+            assert.equal(err, null);
+            assert.equal(server.count('messages.list'), 3);
+            assert.equal(count.listed, 5);
+            done();
+        });
+    });
+
+    it('sweep() should wait for the quota to allow each request', function(done) {
+        var start = Date.now();
+        // 5 units per request, so 20 requests per second after the first
+        sweep({}, {unitsPerSecond: 100, burst: 5}, new MemoryStore(), function(err, count, server) {
+            assert.equal(err, null);
+            // 1 getProfile, 1 list, 5 gets and 1 batchModify
+            assert(Date.now() - start >= 6 * 50 - 10);
+            done();
+        });
+    });
+
+    it('sweep() should retry requests that exceed the rate limit', function(done) {
+        sweep({failures: {'15b1a0c2d3e4f502': 2}}, {retryDelay: 5}, new MemoryStore(), function(err, count, server) {
+            assert.equal(err, null);
+            assert.equal(server.count('messages.get'), 7);
+            assert.equal(count.written, 3);
+            done();
+        });
+    });
+
+    it('sweep() should leave every email unread if writing them fails', function(done) {
+        var store = new MemoryStore(new Error('database is locked'));
+        sweep({}, {}, store, function(err, count, server) {
+            assert.equal(err.message, 'database is locked');
+            assert.equal(server.count('messages.batchModify'), 0);
+            assert.equal(server.unread().length, 5);
+            assert.deepEqual(store.cursors, {});
+            done();
+        });
+    });
+
+    it('sweep() should only save the cursor if there are no unread emails', function(done) {
+        var messages = loadFixtures().filter(message => message.labelIds.indexOf('UNREAD') == -1);
+        var store = new MemoryStore();
+        sweep({messages: messages}, {}, store, function(err, count, server) {
+            assert.equal(err, null);
+            assert.deepEqual(count, {listed: 0, written: 0, history: false});
+            assert.deepEqual(store.sweeps, [{inserts: [], deletes: [], mailbox: 'freefood.scraper@gmail.com', historyId: '4100'}]);
+            done();
+        });
+    });
+});
+
+describe('Pipeline history', function() {
+    var fixtures = loadFixtures();
+    var pizza = fixtures.find(message => message.id == '15b1a0c2d3e4f501');
+
+    /**
+     * Helper function: Run sweeps into 'store' against 'server', one after
+     * the other, calling 'check' after each with the error, if any, and the
+     * count of emails, then 'done' once they are all run.
+     */
+    function sweeps(server, store, checks, done) {
+        server.listen(function() {
+            var sweeper = new pipeline.Pipeline(server.client());
+            (function next(i) {
+                if(i == checks.length) {
+                    server.close(() => done());
+                    return;
+                }
+                sweeper.sweep(store, function(err, count) {
+                    checks[i](err, count);
+                    next(i + 1);
+                });
+            })(0);
+        });
+    }
+
+    it('sweep() should save the history id from before listing, on the first sweep', function(done) {
+        var server = new FakeGmail();
+        var store = new MemoryStore();
+        sweeps(server, store, [function(err, count) {
+            assert.equal(err, null);
+            assert.equal(count.history, false);
+            assert.equal(store.cursors['freefood.scraper@gmail.com'], '4152');
+        }], done);
+    });
+
+    it('sweep() should only fetch the emails added since the last sweep', function(done) {
+        var server = new FakeGmail();
+        var store = new MemoryStore();
+        var listed;
+        sweeps(server, store, [
+            function(err, count) {
+                assert.equal(err, null);
+                listed = server.count('messages.list');
+                server.add(Object.assign({}, pizza, {id: '15b1a0c2d3e4f506', threadId: '15b1a0c2d3e4f506'}));
+            },
+            function(err, count) {
+                assert.equal(err, null);
+                assert.deepEqual(count, {listed: 1, written: 1, history: true});
+                assert.equal(server.count('messages.list'), listed);
+                assert.equal(server.count('history.list'), 1);
+                assert.equal(server.count('messages.get'), 6);
+                assert.deepEqual(store.sweeps[1].inserts.map(entry => entry.threadId), ['15b1a0c2d3e4f506']);
+                assert.equal(store.cursors['freefood.scraper@gmail.com'], String(server.historyId - 1));
+            },
+            function(err, count) {
+                // Marking the email read is in the history, but adds no email
+                assert.equal(err, null);
+                assert.deepEqual(count, {listed: 0, written: 0, history: true});
+                assert.equal(server.count('messages.get'), 6);
+            }
+        ], done);
+    });
+
+    it('sweep() should list every unread email if the history since the cursor is no longer kept', function(done) {
+        var server = new FakeGmail({oldestHistoryId: 5000});
+        var store = new MemoryStore();
+        store.cursors['freefood.scraper@gmail.com'] = '4000';
+        sweeps(server, store, [function(err, count) {
+            assert.equal(err, null);
+            assert.deepEqual(count, {listed: 5, written: 3, history: false});
+            assert.equal(server.count('history.list'), 1);
+            assert.equal(server.count('messages.list'), 1);
+            assert.equal(store.cursors['freefood.scraper@gmail.com'], '4152');
+        }], done);
+    });
+
+    it('sweep() should not move the cursor past emails it could not fetch', function(done) {
+        var server = new FakeGmail({failures: {'15b1a0c2d3e4f502': 10}});
+        var store = new MemoryStore();
+        store.cursors['freefood.scraper@gmail.com'] = '4110';
+        server.listen(function() {
+            new pipeline.Pipeline(server.client(), {retryDelay: 1}).sweep(store, function(err, count) {
+                assert.equal(err, null);
+                assert.deepEqual(count, {listed: 5, written: 2, history: true});
+                assert.equal(store.cursors['freefood.scraper@gmail.com'], '4110');
+                server.close(() => done());
+            });
+        });
+    });
+});